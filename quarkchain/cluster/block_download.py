@@ -0,0 +1,126 @@
+""" Download of the blocks of a chain of headers from several peers.
+
+The headers are split in chunks that the peers take from a queue, each peer with a
+few requests in flight.  The downloaded chunks are handed out in height order, so
+the caller adds the blocks of one chunk while the next ones download.  A peer that
+times out or lacks blocks is not asked again during the download, one sending
+blocks other than those asked for is closed.
+"""
+import asyncio
+import heapq
+from typing import Callable, List, Optional
+
+from quarkchain.utils import Logger
+
+CHUNK_SIZE = 100
+# requests kept in flight by each peer
+MAX_IN_FLIGHT_PER_PEER = 2
+# chunks downloaded ahead of the next one to hand out, to bound the memory used
+MAX_CHUNKS_AHEAD = 16
+
+
+class BlockDownloader:
+    def __init__(self, header_list, peer_list, download_blocks: Callable, timeout):
+        """ download_blocks(peer, header_list) is a coroutine returning the blocks of
+        header_list sent by peer
+        """
+        self.chunk_list = [
+            header_list[i : i + CHUNK_SIZE]
+            for i in range(0, len(header_list), CHUNK_SIZE)
+        ]
+        # indices of the chunks to download
+        self.pending = list(range(len(self.chunk_list)))
+        # index -> blocks of the chunks downloaded
+        self.downloaded = dict()
+        self.next_index = 0
+        self.peer_list = list(peer_list)
+        self.download_blocks = download_blocks
+        self.timeout = timeout
+        self.error = None
+        self.condition = asyncio.Condition()
+        self.task_list = []
+
+    def start(self):
+        for peer in self.peer_list:
+            for _ in range(MAX_IN_FLIGHT_PER_PEER):
+                self.task_list.append(asyncio.ensure_future(self.__run(peer)))
+
+    def close(self):
+        for task in self.task_list:
+            task.cancel()
+
+    async def get_next(self) -> Optional[List]:
+        """ The blocks of the next chunk, None once all of them were returned.
+        Raises if no peer could send the chunk.
+        """
+        if self.next_index == len(self.chunk_list):
+            return None
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.next_index in self.downloaded or self.error is not None
+            )
+            if self.next_index not in self.downloaded:
+                raise self.error
+            block_list = self.downloaded.pop(self.next_index)
+            self.next_index += 1
+            self.condition.notify_all()
+        return block_list
+
+    def __can_take_chunk(self, peer):
+        return (
+            peer not in self.peer_list
+            or not self.pending
+            or self.pending[0] < self.next_index + MAX_CHUNKS_AHEAD
+        )
+
+    async def __run(self, peer):
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.__can_take_chunk(peer))
+                if peer not in self.peer_list or not self.pending:
+                    return
+                index = heapq.heappop(self.pending)
+
+            header_list = self.chunk_list[index]
+            block_list, error = None, None
+            try:
+                block_list = await asyncio.wait_for(
+                    self.download_blocks(peer, header_list), self.timeout
+                )
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e)
+            else:
+                if len(block_list) != len(header_list):
+                    error = "missing blocks"
+                elif any(
+                    block.header.get_hash() != header.get_hash()
+                    for block, header in zip(block_list, header_list)
+                ):
+                    peer.close_with_error("Bad peer sending blocks not requested")
+                    error = "blocks not requested"
+
+            async with self.condition:
+                if error is None:
+                    self.downloaded[index] = block_list
+                else:
+                    heapq.heappush(self.pending, index)
+                    self.__drop_peer(peer, error)
+                self.condition.notify_all()
+
+    def __drop_peer(self, peer, error):
+        if peer not in self.peer_list:
+            return
+        self.peer_list.remove(peer)
+        Logger.info(
+            "Stop downloading blocks from peer {} ({}), {} peers remaining".format(
+                peer, error, len(self.peer_list)
+            )
+        )
+        if not self.peer_list:
+            self.error = RuntimeError(
+                "No peer to download blocks from ({})".format(error)
+            )
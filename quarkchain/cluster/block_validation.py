@@ -0,0 +1,61 @@
+""" Checks of minor blocks that don't depend on the chain.
+
+The PoW seal, the merkle root of the txs and the tx signatures only depend on the
+block itself.  When a list of blocks is added for sync these checks run for all
+of them on a process pool, so they are done for the next blocks while the current
+one executes.  ShardState.add_block then skips them.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from quarkchain.cluster.miner import validate_seal
+from quarkchain.core import MinorBlock, calculate_merkle_root
+from quarkchain.evm.transactions import recover_sender, sender_cache
+from quarkchain.utils import sha3_256
+
+
+def validate_block_stateless(block: MinorBlock, consensus_type) -> None:
+    """ Raises if the seal or the merkle root of the block is invalid"""
+    merkle_hash = calculate_merkle_root(block.tx_list)
+    if merkle_hash != block.meta.hash_merkle_root:
+        raise ValueError("incorrect merkle root")
+    validate_seal(block.header, consensus_type)
+
+
+def _validate_block(block_data: bytes, consensus_type) -> List[Optional[bytes]]:
+    """ Validates the serialized block and returns the senders of its evm txs"""
+    block = MinorBlock.deserialize(block_data)
+    validate_block_stateless(block, consensus_type)
+    return [
+        recover_sender(tx.code.code[1:]) if tx.code.is_evm() else None
+        for tx in block.tx_list
+    ]
+
+
+class BlockValidator:
+    def __init__(self, num_workers: int):
+        self.executor = (
+            ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        )
+
+    async def validate(self, block: MinorBlock, consensus_type):
+        """ Runs validate_block_stateless() on the block.  With workers, the senders
+        of its evm txs are recovered too and cached on tx.code.
+        """
+        if self.executor is None:
+            validate_block_stateless(block, consensus_type)
+            return
+        loop = asyncio.get_event_loop()
+        senders = await loop.run_in_executor(
+            self.executor, _validate_block, block.serialize(), consensus_type
+        )
+        for tx, sender in zip(block.tx_list, senders):
+            if sender is not None and tx.code.evm_sender is None:
+                tx.code.evm_sender = sender
+                # the workers' caches are not shared with this process
+                sender_cache.put(sha3_256(tx.code.code[1:]), sender)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -130,6 +130,29 @@ class ClusterConfig(BaseConfig):
     JSON_RPC_PORT = 38391
     PRIVATE_JSON_RPC_PORT = 38491
     ENABLE_TRANSACTION_HISTORY = False
+    # serve state reads from flat account/storage tables instead of the trie
+    ENABLE_FLAT_STATE = False
+    # import the minor blocks far behind the tip without running them and download
+    # the state of a recent one instead, see cluster.state_sync.  The slaves must be
+    # upgraded first, the older ones run the blocks the master asks to import.
+    ENABLE_STATE_SYNC = False
+    # keep the state of the last minor blocks only (at least those of the forks still
+    # accepted), 0 to keep every state, see cluster.state_pruning
+    STATE_PRUNING_BLOCKS = 0
+    # move the blocks of the best chains older than this (at least the blocks kept in
+    # memory) out of the db into flat files, 0 to keep every block in the db, see
+    # cluster.freezer
+    FREEZER_BLOCKS = 0
+    # processes recovering the senders of incoming tx lists, 0 to recover in-process
+    TX_SENDER_RECOVERY_WORKERS = 0
+    # processes running the txs of a minor block speculatively, 0 to run them
+    # in order, see cluster.parallel_execution
+    PARALLEL_TX_EXECUTION_WORKERS = 0
+    # processes checking the seal, merkle root and signatures of blocks added for
+    # sync ahead of their execution, 0 to check them in-process
+    BLOCK_VALIDATION_WORKERS = 0
+    # processes checking the seals of the headers synced, 0 to check them in-process
+    HEADER_VALIDATION_WORKERS = 0
 
     DB_PATH_ROOT = "./db"
     LOG_LEVEL = "info"
@@ -193,6 +216,12 @@ class ClusterConfig(BaseConfig):
     def use_mem_db(self):
         return not self.DB_PATH_ROOT
 
+    def get_freezer_path(self, name):
+        """ The directory of the blocks frozen of the db name, None if disabled"""
+        if self.use_mem_db() or self.FREEZER_BLOCKS <= 0:
+            return None
+        return "{path}/{name}.ancient".format(path=self.DB_PATH_ROOT, name=name)
+
     @classmethod
     def attach_arguments(cls, parser):
         parser.add_argument("--cluster_config", default="", type=str)
@@ -242,6 +271,46 @@ class ClusterConfig(BaseConfig):
             default=False,
             dest="enable_transaction_history",
         )
+        parser.add_argument(
+            "--enable_flat_state",
+            action="store_true",
+            default=False,
+            dest="enable_flat_state",
+        )
+        parser.add_argument(
+            "--enable_state_sync",
+            action="store_true",
+            default=False,
+            dest="enable_state_sync",
+        )
+        parser.add_argument(
+            "--state_pruning_blocks",
+            default=ClusterConfig.STATE_PRUNING_BLOCKS,
+            type=int,
+        )
+        parser.add_argument(
+            "--freezer_blocks", default=ClusterConfig.FREEZER_BLOCKS, type=int
+        )
+        parser.add_argument(
+            "--tx_sender_recovery_workers",
+            default=ClusterConfig.TX_SENDER_RECOVERY_WORKERS,
+            type=int,
+        )
+        parser.add_argument(
+            "--parallel_tx_execution_workers",
+            default=ClusterConfig.PARALLEL_TX_EXECUTION_WORKERS,
+            type=int,
+        )
+        parser.add_argument(
+            "--block_validation_workers",
+            default=ClusterConfig.BLOCK_VALIDATION_WORKERS,
+            type=int,
+        )
+        parser.add_argument(
+            "--header_validation_workers",
+            default=ClusterConfig.HEADER_VALIDATION_WORKERS,
+            type=int,
+        )
 
         parser.add_argument(
             "--simple_network_bootstrap_host",
@@ -310,6 +379,14 @@ class ClusterConfig(BaseConfig):
             config.CLEAN = args.clean
             config.START_SIMULATED_MINING = args.start_simulated_mining
             config.ENABLE_TRANSACTION_HISTORY = args.enable_transaction_history
+            config.ENABLE_FLAT_STATE = args.enable_flat_state
+            config.ENABLE_STATE_SYNC = args.enable_state_sync
+            config.STATE_PRUNING_BLOCKS = args.state_pruning_blocks
+            config.FREEZER_BLOCKS = args.freezer_blocks
+            config.TX_SENDER_RECOVERY_WORKERS = args.tx_sender_recovery_workers
+            config.PARALLEL_TX_EXECUTION_WORKERS = args.parallel_tx_execution_workers
+            config.BLOCK_VALIDATION_WORKERS = args.block_validation_workers
+            config.HEADER_VALIDATION_WORKERS = args.header_validation_workers
 
             config.QUARKCHAIN.update(
                 args.num_chains,
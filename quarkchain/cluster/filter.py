@@ -87,8 +87,12 @@ class Filter:
         """Given potential blocks, re-run tx to find exact matches."""
         ret = []
         for b_i, block in enumerate(blocks):
+            receipts = self.db.get_receipts(block)
+            if receipts is None:
+                # imported without running it
+                continue
             for i in range(len(block.tx_list or [])):
-                r = block.get_receipt(self.db.db, i)
+                r = block.get_receipt(receipts, i)
                 for log in r.logs:
                     # empty recipient means no filtering
                     if self.recipients and log.recipient not in self.recipients:
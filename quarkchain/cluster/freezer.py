@@ -0,0 +1,204 @@
+""" Append-only storage of the blocks deep enough to be final.
+
+With the freezer enabled, the blocks of the best chains older than a finality depth
+are moved out of the db into flat files indexed by height, so that the db (and its
+compactions and caches) no longer grows with the length of the chain.  A freezer
+is a directory of tables sharing the heights of their items, one table per kind of
+entry of the blocks.  A table is a data file of its items appended back to back and
+an index file of the 8-byte end offset of each item, both memory-mapped for
+reading.  Nothing is rewritten once appended.
+
+The blocks are appended to the tables before their entries are deleted from the db.
+A freezer whose tables have different lengths after a crash is truncated to the
+shortest one when opened, the entries of the blocks truncated being still in the
+db.  The items of a table whose index is ahead of the data are dropped.
+
+The blocks are looked up by height.  The "hashes" table of the 32-byte hashes of
+the blocks, which every freezer has, checks the hash of a block whose height is
+known.  The heights of the other blocks are read from an index by hash kept in the
+db, written by the batches deleting the entries frozen, so that no table is ever
+searched.
+"""
+import mmap
+import os
+import shutil
+from typing import Optional
+
+from quarkchain.utils import check
+
+# blocks added to the best chain between two passes moving the final blocks
+FREEZE_INTERVAL = 16
+
+OFFSET_SIZE = 8
+HASHES = "hashes"
+
+
+class FreezerTable:
+    """ Items indexed from 0, appended one at a time"""
+
+    def __init__(self, path, name):
+        self.data_path = os.path.join(path, name + ".dat")
+        self.index_path = os.path.join(path, name + ".idx")
+        for file_path in (self.data_path, self.index_path):
+            open(file_path, "ab").close()
+        self.data_file = open(self.data_path, "r+b")
+        self.index_file = open(self.index_path, "r+b")
+        self.data_map = None
+        self.index_map = None
+
+        # drop the end of an append interrupted.  After a power loss the index may
+        # be ahead of the data, or end with zeros.
+        self.count = os.path.getsize(self.index_path) // OFFSET_SIZE
+        data_size = os.path.getsize(self.data_path)
+        while self.count:
+            end = self.__read_end(self.count - 1)
+            prev_end = self.__read_end(self.count - 2) if self.count > 1 else 0
+            if prev_end <= end <= data_size:
+                break
+            self.count -= 1
+        self.index_file.truncate(self.count * OFFSET_SIZE)
+        self.size = self.__read_end(self.count - 1) if self.count else 0
+        self.data_file.truncate(self.size)
+
+    def __len__(self):
+        return self.count
+
+    def __read_end(self, i):
+        self.index_file.seek(i * OFFSET_SIZE)
+        return int.from_bytes(self.index_file.read(OFFSET_SIZE), "big")
+
+    def __get_end(self, i):
+        if i < 0:
+            return 0
+        end = (i + 1) * OFFSET_SIZE
+        if self.index_map is None or len(self.index_map) < end:
+            self.index_map = self.__map(self.index_file, self.index_map)
+        return int.from_bytes(self.index_map[end - OFFSET_SIZE : end], "big")
+
+    def __get_data_map(self, size):
+        if self.data_map is None or len(self.data_map) < size:
+            self.data_map = self.__map(self.data_file, self.data_map)
+        return self.data_map
+
+    @staticmethod
+    def __map(f, old_map):
+        """ Maps the whole file again as it grew"""
+        if old_map is not None:
+            old_map.close()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def append(self, data):
+        self.data_file.seek(self.size)
+        self.data_file.write(data)
+        self.data_file.flush()
+        self.size += len(data)
+        self.index_file.seek(self.count * OFFSET_SIZE)
+        self.index_file.write(self.size.to_bytes(OFFSET_SIZE, "big"))
+        self.index_file.flush()
+        self.count += 1
+
+    def get(self, i) -> bytes:
+        check(0 <= i < self.count)
+        start, end = self.__get_end(i - 1), self.__get_end(i)
+        if start == end:
+            return b""
+        return self.__get_data_map(end)[start:end]
+
+    def truncate(self, count):
+        check(count <= self.count)
+        self.close_maps()
+        self.count = count
+        self.size = self.__read_end(count - 1) if count else 0
+        self.index_file.truncate(count * OFFSET_SIZE)
+        self.data_file.truncate(self.size)
+
+    def sync(self):
+        for f in (self.data_file, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close_maps(self):
+        for m in (self.data_map, self.index_map):
+            if m is not None:
+                m.close()
+        self.data_map = None
+        self.index_map = None
+
+    def close(self):
+        self.close_maps()
+        self.data_file.close()
+        self.index_file.close()
+
+
+class Freezer:
+    """ Tables of the entries of the blocks from height start, the "hashes" table
+    being added to name_list.  The heights by hash are kept in db, under
+    height_prefix.
+    """
+
+    def __init__(
+        self, path, name_list, start=0, clean=False, db=None, height_prefix=b""
+    ):
+        if clean:
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.start = start
+        self.db = db
+        self.height_prefix = height_prefix
+        self.table_map = {
+            name: FreezerTable(path, name) for name in [HASHES] + list(name_list)
+        }
+        count = min(len(table) for table in self.table_map.values())
+        for table in self.table_map.values():
+            if len(table) > count:
+                table.truncate(count)
+
+    @property
+    def frozen(self):
+        """ The height of the next block to freeze"""
+        return self.start + len(self.table_map[HASHES])
+
+    def has(self, height):
+        return self.start <= height < self.frozen
+
+    def append(self, height, block_hash, entry_map):
+        """ Appends the block at height, entry_map having an item for each table"""
+        check(height == self.frozen)
+        self.table_map[HASHES].append(block_hash)
+        for name, table in self.table_map.items():
+            if name != HASHES:
+                table.append(entry_map[name])
+
+    def get(self, name, height) -> Optional[bytes]:
+        if not self.has(height):
+            return None
+        return self.table_map[name].get(height - self.start)
+
+    def put_height(self, batch, block_hash, height):
+        """ Indexes the height of a block frozen, or of another item looked up by
+        hash, in the batch deleting the entries frozen from db
+        """
+        batch.put(self.height_prefix + block_hash, height.to_bytes(8, "big"))
+
+    def get_height(self, block_hash) -> Optional[int]:
+        if self.db is None:
+            return None
+        data = self.db.get(self.height_prefix + block_hash)
+        return None if data is None else int.from_bytes(data, "big")
+
+    def get_by_hash(self, name, block_hash, height=None) -> Optional[bytes]:
+        """ The entry of the block frozen, whose height is read from db if not given"""
+        if height is None:
+            height = self.get_height(block_hash)
+        if height is None or self.get(HASHES, height) != block_hash:
+            return None
+        return self.get(name, height)
+
+    def sync(self):
+        for table in self.table_map.values():
+            table.sync()
+
+    def close(self):
+        for table in self.table_map.values():
+            table.close()
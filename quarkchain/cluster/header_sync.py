@@ -0,0 +1,272 @@
+""" Skeleton sync of the headers of a chain.
+
+Instead of walking back from the tip of a peer one header list after the other, the
+headers every SKELETON_INTERVAL heights (the skeleton) are downloaded from the peer
+first, then the gaps between them are filled from several peers at once.  Every
+header of a gap has to link to the skeleton, so the peers filling them cannot
+change the chain synced.  The seals of the headers are then checked in batches on
+a process pool, so that the event loop keeps serving the other requests.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+from quarkchain.cluster.guardian import Guardian
+from quarkchain.cluster.miner import validate_seal
+from quarkchain.utils import Logger
+
+# heights between two headers of the skeleton, each gap is filled with one request
+SKELETON_INTERVAL = 128
+# headers of the skeleton downloaded with one request
+SKELETON_SIZE = 64
+# headers whose seals are checked at once by a worker
+SEAL_BATCH_SIZE = 64
+
+
+def validate_seals(header_list, consensus_type, guardian_public_key=None) -> None:
+    """ Raises if the seal of a header is invalid.  With guardian_public_key, the
+    difficulty of the root block headers signed by the guardian is lowered.
+    """
+    for header in header_list:
+        adjusted_diff = None
+        if guardian_public_key is not None and header.verify_signature(
+            guardian_public_key
+        ):
+            adjusted_diff = Guardian.adjust_difficulty(header.difficulty, header.height)
+        validate_seal(header, consensus_type, adjusted_diff=adjusted_diff)
+
+
+def _validate_seals(
+    header_class, header_data_list, consensus_type, guardian_public_key
+):
+    header_list = [header_class.deserialize(data) for data in header_data_list]
+    validate_seals(header_list, consensus_type, guardian_public_key)
+
+
+class HeaderValidator:
+    def __init__(self, num_workers: int):
+        self.executor = (
+            ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        )
+
+    async def validate(self, header_list, consensus_type, guardian_public_key=None):
+        """ Runs validate_seals() on batches of SEAL_BATCH_SIZE headers"""
+        batch_list = [
+            header_list[i : i + SEAL_BATCH_SIZE]
+            for i in range(0, len(header_list), SEAL_BATCH_SIZE)
+        ]
+        if self.executor is None:
+            for batch in batch_list:
+                validate_seals(batch, consensus_type, guardian_public_key)
+                # serve the other coroutines between the batches
+                await asyncio.sleep(0)
+            return
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor,
+                    _validate_seals,
+                    type(batch[0]),
+                    [header.serialize() for header in batch],
+                    consensus_type,
+                    guardian_public_key,
+                )
+                for batch in batch_list
+            ]
+        )
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class HeaderSyncStats:
+    """ Headers synced and the time spent syncing them, for getSyncStats"""
+
+    def __init__(self):
+        self.header_count = 0
+        self.duration = 0.0
+
+    def add(self, header_count, duration):
+        self.header_count += header_count
+        self.duration += duration
+
+    def to_dict(self):
+        return {
+            "headersSynced": self.header_count,
+            "headerSyncRate": self.header_count / self.duration
+            if self.duration > 0
+            else 0,
+        }
+
+
+class HeaderSync:
+    def __init__(
+        self,
+        peer,
+        peer_list,
+        download_skeleton: Callable,
+        download_headers: Callable,
+        has_block_hash: Callable,
+        get_prev_hash: Callable,
+        validate_headers: Callable,
+        timeout,
+        stats: Optional[HeaderSyncStats] = None,
+    ):
+        """ download_skeleton(peer, block_hash, limit, skip) and
+        download_headers(peer, block_hash, limit) are coroutines returning the
+        headers sent by peer from the block toward genesis, every skip + 1 heights
+        for the skeleton.  validate_headers(header_list) is a coroutine raising if
+        the seal of a header is invalid.  The skeleton is downloaded from peer, the
+        gaps from peer_list.
+        """
+        self.peer = peer
+        self.peer_list = list(peer_list)
+        self.download_skeleton = download_skeleton
+        self.download_headers = download_headers
+        self.has_block_hash = has_block_hash
+        self.get_prev_hash = get_prev_hash
+        self.validate_headers = validate_headers
+        self.timeout = timeout
+        self.stats = stats
+
+    async def sync(self, header, min_height) -> Optional[List]:
+        """ The headers from the one after the last known block up to header, in
+        ascending height.  None if the chain forks below min_height.  Raises if the
+        headers sent are invalid.
+        """
+        start = time.time()
+        skeleton = await self.__download_skeleton(header, min_height)
+        if skeleton is None:
+            return None
+        # the gaps below the headers of the skeleton, the last one is only filled if
+        # it is unknown, which happens near genesis
+        gap_list = []
+        for i, upper in enumerate(skeleton):
+            lower = skeleton[i + 1] if i + 1 < len(skeleton) else None
+            if lower is None and self.has_block_hash(upper.get_hash()):
+                continue
+            if self.__gap_size(upper, lower) > 0:
+                gap_list.append((upper, lower))
+        gap_map = dict(
+            zip(
+                [upper.get_hash() for upper, _ in gap_list],
+                await self.__download_gaps(gap_list),
+            )
+        )
+
+        # descending height, down to the first known block
+        header_chain = []
+        for upper in skeleton:
+            header_chain.append(upper)
+            header_chain.extend(gap_map.get(upper.get_hash(), []))
+        for i, h in enumerate(header_chain):
+            if self.has_block_hash(h.get_hash()):
+                del header_chain[i:]
+                break
+        else:
+            raise RuntimeError("Bad peer sending headers from another genesis")
+        for h, prev in zip(header_chain, header_chain[1:]):
+            if h.height != prev.height + 1 or self.get_prev_hash(h) != prev.get_hash():
+                raise RuntimeError("Bad peer sending a discontinuous skeleton")
+        if header_chain and header_chain[-1].height < min_height:
+            return None
+        header_chain.reverse()
+
+        await self.validate_headers(header_chain)
+        duration = time.time() - start
+        if self.stats is not None:
+            self.stats.add(len(header_chain), duration)
+        Logger.info(
+            "Synced {} headers from {} peers in {:.2f} seconds".format(
+                len(header_chain), len(self.peer_list), duration
+            )
+        )
+        return header_chain
+
+    async def __download_skeleton(self, header, min_height):
+        """ The headers every SKELETON_INTERVAL heights from header down to the first
+        known one, in descending height
+        """
+        skeleton = [header]
+        while not self.has_block_hash(skeleton[-1].get_hash()):
+            last = skeleton[-1]
+            if last.height < min_height:
+                return None
+            if last.height < SKELETON_INTERVAL:
+                break
+            header_list = await asyncio.wait_for(
+                self.download_skeleton(
+                    self.peer, last.get_hash(), SKELETON_SIZE + 1, SKELETON_INTERVAL - 1
+                ),
+                self.timeout,
+            )
+            if len(header_list) < 2 or header_list[0].get_hash() != last.get_hash():
+                raise RuntimeError("Bad peer sending a skeleton not requested")
+            for h, prev in zip(header_list, header_list[1:]):
+                if h.height - prev.height != SKELETON_INTERVAL:
+                    raise RuntimeError("Bad peer sending a skeleton with wrong heights")
+            skeleton.extend(header_list[1:])
+        return skeleton
+
+    @staticmethod
+    def __gap_size(upper, lower):
+        """ Heights between the headers, down to genesis without lower"""
+        return upper.height - (lower.height if lower else -1) - 1
+
+    def __check_gap(self, upper, lower, header_list):
+        """ The error of the headers downloaded for the gap, None if they fill it"""
+        if len(header_list) != self.__gap_size(upper, lower):
+            return "missing headers"
+        for h, prev in zip([upper] + header_list, header_list + [lower]):
+            if prev is None:
+                break
+            if h.height != prev.height + 1 or self.get_prev_hash(h) != prev.get_hash():
+                return "discontinuous headers"
+        return None
+
+    async def __download_gaps(self, gap_list):
+        """ The headers of the gaps, downloaded from all the peers"""
+        result_list = [None] * len(gap_list)
+
+        async def run(peer, pending):
+            while pending:
+                i = pending.pop()
+                upper, lower = gap_list[i]
+                try:
+                    header_list = await asyncio.wait_for(
+                        self.download_headers(
+                            peer,
+                            self.get_prev_hash(upper),
+                            self.__gap_size(upper, lower),
+                        ),
+                        self.timeout,
+                    )
+                    error = self.__check_gap(upper, lower, header_list)
+                except asyncio.TimeoutError:
+                    error = "timeout"
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    error = str(e)
+                if error is not None:
+                    if error == "discontinuous headers":
+                        peer.close_with_error("Bad peer sending discontinuous headers")
+                    Logger.info(
+                        "Stop downloading headers from peer {} ({})".format(peer, error)
+                    )
+                    self.peer_list.remove(peer)
+                    pending.append(i)
+                    return
+                result_list[i] = header_list
+
+        # the gaps left by the peers failing are retried by the others
+        while True:
+            pending = [i for i, r in enumerate(result_list) if r is None][::-1]
+            if not pending:
+                return result_list
+            if not self.peer_list:
+                raise RuntimeError("No peer to download headers from")
+            await asyncio.gather(*[run(peer, pending) for peer in self.peer_list])
@@ -8,12 +8,14 @@ import time
 from collections import deque
 from typing import Optional, List, Union, Dict, Tuple
 
-from quarkchain.cluster.guardian import Guardian
-from quarkchain.cluster.miner import Miner, MiningWork, validate_seal
+from quarkchain.cluster.block_download import BlockDownloader
+from quarkchain.cluster.header_sync import HeaderSync, HeaderSyncStats, HeaderValidator
+from quarkchain.cluster.miner import Miner, MiningWork
 from quarkchain.cluster.p2p_commands import (
     CommandOp,
     Direction,
     GetRootBlockHeaderListRequest,
+    GetRootBlockHeaderListWithSkipRequest,
     GetRootBlockListRequest,
 )
 from quarkchain.cluster.protocol import (
@@ -36,6 +38,7 @@ from quarkchain.cluster.rpc import (
     CreateClusterPeerConnectionRequest,
     DestroyClusterPeerConnectionCommand,
     SyncMinorBlockListRequest,
+    SyncMinorBlockStateRequest,
     GetMinorBlockRequest,
     GetTransactionRequest,
     ArtificialTxConfig,
@@ -82,6 +85,12 @@ from quarkchain.cluster.cluster_config import ClusterConfig
 
 
 TIMEOUT = 10
+# with ClusterConfig.ENABLE_STATE_SYNC, the number of root blocks to sync above which
+# the minor blocks are imported without running them up to a pivot root block, and
+# the state of the shards at the pivot is downloaded (see state_sync.py)
+STATE_SYNC_MIN_ROOT_BLOCKS = 256
+# root blocks synced as usual after the pivot
+STATE_SYNC_PIVOT_DEPTH = 64
 
 
 class SyncTask:
@@ -110,37 +119,34 @@ class SyncTask:
         if self.__has_block_hash(self.header.get_hash()):
             return
 
-        # descending height
-        block_header_chain = [self.header]
-
-        while not self.__has_block_hash(block_header_chain[-1].hash_prev_block):
-            block_hash = block_header_chain[-1].hash_prev_block
-            height = block_header_chain[-1].height - 1
-
+        enable_state_sync = self.root_state.env.cluster_config.ENABLE_STATE_SYNC
+        if enable_state_sync:
+            # resume the download of the state interrupted by a restart
+            await self.__sync_state()
+
+        header_sync = HeaderSync(
+            self.peer,
+            self.__get_peers(),
+            self.__download_skeleton,
+            self.__download_block_headers,
+            self.__has_block_hash,
+            lambda header: header.hash_prev_block,
+            self.__validate_block_headers,
+            TIMEOUT,
+            stats=self.master_server.synchronizer.header_sync_stats,
+        )
+        # ascending height
+        block_header_chain = await header_sync.sync(
+            self.header, self.root_state.tip.height - self.max_staleness + 1
+        )
+        if block_header_chain is None:
             # abort if we have to download super old blocks
-            if self.root_state.tip.height - height > self.max_staleness:
-                Logger.warning(
-                    "[R] abort syncing due to forking at super old block {} << {}".format(
-                        height, self.root_state.tip.height
-                    )
+            Logger.warning(
+                "[R] abort syncing due to forking at super old block << {}".format(
+                    self.root_state.tip.height
                 )
-                return
-
-            Logger.info(
-                "[R] downloading block header list from {} {}".format(
-                    height, block_hash.hex()
-                )
-            )
-            block_header_list = await asyncio.wait_for(
-                self.__download_block_headers(block_hash), TIMEOUT
             )
-            self.__validate_block_headers(block_header_list)
-            for header in block_header_list:
-                if self.__has_block_hash(header.get_hash()):
-                    break
-                block_header_chain.append(header)
-
-        block_header_chain.reverse()
+            return
 
         Logger.info(
             "[R] going to download {} blocks ({} - {})".format(
@@ -150,81 +156,102 @@ class SyncTask:
             )
         )
 
-        while len(block_header_chain) > 0:
-            block_chain = await asyncio.wait_for(
-                self.__download_blocks(block_header_chain[:100]), TIMEOUT
-            )
+        pivot = None
+        if enable_state_sync and len(block_header_chain) > STATE_SYNC_MIN_ROOT_BLOCKS:
+            pivot = block_header_chain[-STATE_SYNC_PIVOT_DEPTH]
             Logger.info(
-                "[R] downloaded {} blocks ({} - {}) from peer".format(
-                    len(block_chain),
-                    block_chain[0].header.height,
-                    block_chain[-1].header.height,
+                "[R] going to sync the state of the shards at root block {}".format(
+                    pivot.height
                 )
             )
-            if len(block_chain) != len(block_header_chain[:100]):
-                # TODO: tag bad peer
-                raise RuntimeError("Bad peer missing blocks for headers they have")
 
-            for block in block_chain:
-                await self.__add_block(block)
-                block_header_chain.pop(0)
+        downloader = BlockDownloader(
+            block_header_chain, self.__get_peers(), self.__download_blocks, TIMEOUT
+        )
+        downloader.start()
+        try:
+            while True:
+                block_chain = await downloader.get_next()
+                if block_chain is None:
+                    break
+                Logger.info(
+                    "[R] downloaded {} blocks ({} - {}) from {} peers".format(
+                        len(block_chain),
+                        block_chain[0].header.height,
+                        block_chain[-1].header.height,
+                        len(downloader.peer_list),
+                    )
+                )
+                for block in block_chain:
+                    without_state = (
+                        pivot is not None and block.header.height <= pivot.height
+                    )
+                    await self.__add_block(block, without_state)
+                    if without_state and block.header == pivot:
+                        await self.__sync_state()
+        finally:
+            downloader.close()
 
     def __has_block_hash(self, block_hash):
         return self.root_state.contain_root_block_by_hash(block_hash)
 
-    def __validate_block_headers(self, block_header_list):
+    def __get_peers(self):
+        """ The peer of the task and the other peers advertising the header's height"""
+        peer_list = [self.peer]
+        network = self.master_server.network
+        for peer in network.iterate_peers() if network else []:
+            tip = peer.best_root_block_header_observed
+            if peer is not self.peer and tip and tip.height >= self.header.height:
+                peer_list.append(peer)
+        return peer_list
+
+    async def __validate_block_headers(self, block_header_list):
         """Raise on validation failure"""
-        # TODO: tag bad peer
-        consensus_type = self.root_state.env.quark_chain_config.ROOT.CONSENSUS_TYPE
-        for i in range(len(block_header_list) - 1):
-            header, prev = block_header_list[i : i + 2]
-            if header.height != prev.height + 1:
-                raise RuntimeError(
-                    "Bad peer sending root block headers with discontinuous height"
-                )
-            if header.hash_prev_block != prev.get_hash():
-                raise RuntimeError(
-                    "Bad peer sending root block headers with discontinuous hash_prev_block"
-                )
+        config = self.root_state.env.quark_chain_config
+        # check difficulty, potentially lowered for the root blocks signed by the
+        # guardian, and PoW if applicable
+        await self.master_server.header_validator.validate(
+            block_header_list,
+            config.ROOT.CONSENSUS_TYPE,
+            None if config.SKIP_ROOT_DIFFICULTY_CHECK else config.guardian_public_key,
+        )
 
-            # check difficulty, potentially adjusted by guardian mechanism
-            adjusted_diff = None  # type: Optional[int]
-            if not self.root_state.env.quark_chain_config.SKIP_ROOT_DIFFICULTY_CHECK:
-                # lower the difficulty for root block signed by guardian
-                if header.verify_signature(
-                    self.root_state.env.quark_chain_config.guardian_public_key
-                ):
-                    adjusted_diff = Guardian.adjust_difficulty(
-                        header.difficulty, header.height
-                    )
-            # check PoW if applicable
-            validate_seal(header, consensus_type, adjusted_diff=adjusted_diff)
+    async def __download_skeleton(self, peer, block_hash, limit, skip):
+        request = GetRootBlockHeaderListWithSkipRequest(
+            block_hash=block_hash, limit=limit, skip=skip, direction=Direction.GENESIS
+        )
+        op, resp, rpc_id = await peer.write_rpc_request(
+            CommandOp.GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST, request
+        )
+        return resp.block_header_list
 
-    async def __download_block_headers(self, block_hash):
+    async def __download_block_headers(self, peer, block_hash, limit):
         request = GetRootBlockHeaderListRequest(
-            block_hash=block_hash, limit=500, direction=Direction.GENESIS
+            block_hash=block_hash, limit=limit, direction=Direction.GENESIS
         )
-        op, resp, rpc_id = await self.peer.write_rpc_request(
+        op, resp, rpc_id = await peer.write_rpc_request(
             CommandOp.GET_ROOT_BLOCK_HEADER_LIST_REQUEST, request
         )
         return resp.block_header_list
 
-    async def __download_blocks(self, block_header_list):
+    async def __download_blocks(self, peer, block_header_list):
         block_hash_list = [b.get_hash() for b in block_header_list]
-        op, resp, rpc_id = await self.peer.write_rpc_request(
+        op, resp, rpc_id = await peer.write_rpc_request(
             CommandOp.GET_ROOT_BLOCK_LIST_REQUEST,
             GetRootBlockListRequest(block_hash_list),
         )
         return resp.root_block_list
 
-    async def __add_block(self, root_block):
+    async def __add_block(self, root_block, without_state=False):
         Logger.info(
             "[R] syncing root block {} {}".format(
                 root_block.header.height, root_block.header.get_hash().hex()
             )
         )
         start = time.time()
-        await self.__sync_minor_blocks(root_block.minor_block_header_list)
+        await self.__sync_minor_blocks(
+            root_block.minor_block_header_list, without_state
+        )
         await self.master_server.add_root_block(root_block)
         elapse = time.time() - start
         Logger.info(
@@ -233,7 +260,7 @@ class SyncTask:
             )
         )
 
-    async def __sync_minor_blocks(self, minor_block_header_list):
+    async def __sync_minor_blocks(self, minor_block_header_list, without_state):
         minor_block_download_map = dict()
         for m_block_header in minor_block_header_list:
             m_block_hash = m_block_header.get_hash()
@@ -248,7 +275,10 @@ class SyncTask:
             future = slave_conn.write_rpc_request(
                 op=ClusterOp.SYNC_MINOR_BLOCK_LIST_REQUEST,
                 cmd=SyncMinorBlockListRequest(
-                    m_block_hash_list, branch, self.peer.get_cluster_peer_id()
+                    m_block_hash_list,
+                    branch,
+                    self.peer.get_cluster_peer_id(),
+                    without_state,
                 ),
             )
             future_list.append(future)
@@ -270,6 +300,21 @@ class SyncTask:
         for m_header in minor_block_header_list:
             self.root_state.add_validated_minor_block_hash(m_header.get_hash())
 
+    async def __sync_state(self):
+        """ Download the state of the shards whose blocks were imported without
+        running them
+        """
+        future_list = [
+            slave.write_rpc_request(
+                ClusterOp.SYNC_MINOR_BLOCK_STATE_REQUEST,
+                SyncMinorBlockStateRequest(self.peer.get_cluster_peer_id()),
+            )
+            for slave in self.master_server.slave_pool
+        ]
+        for _, resp, _ in await asyncio.gather(*future_list):
+            if resp.error_code != 0:
+                raise RuntimeError("Unable to download the state of the shards")
+
 
 class Synchronizer:
     """ Buffer the headers received from peer and sync one by one """
@@ -278,6 +323,7 @@ class Synchronizer:
         self.tasks = dict()
         self.running = False
         self.running_task = None
+        self.header_sync_stats = HeaderSyncStats()
 
     def add_task(self, header, peer):
         self.tasks[peer] = header
@@ -307,6 +353,7 @@ class Synchronizer:
             "queuedTasks": [
                 _task_to_dict(peer, header) for peer, header in self.tasks.items()
             ],
+            "headerSync": self.header_sync_stats.to_dict(),
         }
 
     def _pop_best_task(self):
@@ -612,6 +659,9 @@ class MasterServer:
         )
 
         self.synchronizer = Synchronizer()
+        self.header_validator = HeaderValidator(
+            self.cluster_config.HEADER_VALIDATION_WORKERS
+        )
 
         self.branch_to_shard_stats = dict()  # type: Dict[int, ShardStats]
         # (epoch in minute, tx_count in the minute)
@@ -1217,6 +1267,12 @@ class MasterServer:
             shard["blockCount60s"] = shard_stats.block_count60s
             shard["staleBlockCount60s"] = shard_stats.stale_block_count60s
             shard["lastBlockTime"] = shard_stats.last_block_time
+            shard["blockCacheHits"] = shard_stats.block_cache_hits
+            shard["blockCacheMisses"] = shard_stats.block_cache_misses
+            shard["senderCacheHits"] = shard_stats.sender_cache_hits
+            shard["senderCacheMisses"] = shard_stats.sender_cache_misses
+            shard["codeCacheHits"] = shard_stats.code_cache_hits
+            shard["codeCacheMisses"] = shard_stats.code_cache_misses
             shards.append(shard)
 
         tx_count60s = sum(
@@ -1273,6 +1329,8 @@ class MasterServer:
             "rootCoinbaseAddress": "0x" + self.root_state.tip.coinbase_address.to_hex(),
             "rootTimestamp": self.root_state.tip.create_time,
             "rootLastBlockTime": root_last_block_time,
+            "rootBlockCacheHits": self.root_state.db.r_block_cache.hits,
+            "rootBlockCacheMisses": self.root_state.db.r_block_cache.misses,
             "txCount60s": tx_count60s,
             "blockCount60s": block_count60s,
             "staleBlockCount60s": stale_block_count60s,
@@ -1448,7 +1506,9 @@ def main():
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
     env = parse_args()
-    root_state = RootState(env)
+    root_state = RootState(
+        env, freezer_path=env.cluster_config.get_freezer_path("master")
+    )
 
     master = MasterServer(env, root_state)
     master.start()
@@ -1471,6 +1531,7 @@ def main():
 
     master.do_loop()
 
+    master.header_validator.shutdown()
     public_json_rpc_server.shutdown()
     private_json_rpc_server.shutdown()
 
@@ -3,6 +3,7 @@ from enum import IntEnum
 from quarkchain.core import Branch, uint8, uint16, uint32, uint128, hash256, Transaction
 from quarkchain.core import RootBlockHeader, MinorBlockHeader, RootBlock, MinorBlock
 from quarkchain.core import Serializable, PrependedSizeListSerializer
+from quarkchain.core import PrependedSizeBytesSerializer, CrossShardTransactionList
 
 
 class HelloCommand(Serializable):
@@ -112,6 +113,25 @@ class GetRootBlockHeaderListResponse(Serializable):
         self.block_header_list = block_header_list
 
 
+class GetRootBlockHeaderListWithSkipRequest(Serializable):
+    """ Obtain the headers every skip + 1 heights from the block, the skeleton of
+    a chain synced.
+    """
+
+    FIELDS = [
+        ("block_hash", hash256),
+        ("limit", uint32),
+        ("skip", uint32),
+        ("direction", uint8),  # 0 to genesis, 1 to tip
+    ]
+
+    def __init__(self, block_hash, limit, skip, direction):
+        self.block_hash = block_hash
+        self.limit = limit
+        self.skip = skip
+        self.direction = direction
+
+
 class GetRootBlockListRequest(Serializable):
     """ RPC to get a root block list.  The RPC should be only fired by root chain
     """
@@ -182,6 +202,82 @@ class GetMinorBlockHeaderListResponse(Serializable):
         self.block_header_list = block_header_list
 
 
+class GetMinorBlockHeaderListWithSkipRequest(Serializable):
+    """ Obtain the headers every skip + 1 heights from the block, the skeleton of
+    a chain synced.
+    """
+
+    FIELDS = [
+        ("block_hash", hash256),
+        ("branch", Branch),
+        ("limit", uint32),
+        ("skip", uint32),
+        ("direction", uint8),  # 0 to genesis, 1 to tip
+    ]
+
+    def __init__(self, block_hash, branch, limit, skip, direction):
+        self.block_hash = block_hash
+        self.branch = branch
+        self.limit = limit
+        self.skip = skip
+        self.direction = direction
+
+
+class GetMinorBlockStateNodeListRequest(Serializable):
+    """ Obtain the trie nodes, code and key preimages of the state by their hashes,
+    see state_sync.py
+    """
+
+    FIELDS = [
+        ("branch", Branch),
+        ("node_hash_list", PrependedSizeListSerializer(4, hash256)),
+    ]
+
+    def __init__(self, branch, node_hash_list):
+        self.branch = branch
+        self.node_hash_list = node_hash_list
+
+
+class GetMinorBlockStateNodeListResponse(Serializable):
+    """ The data of the hashes found, in any order"""
+
+    FIELDS = [
+        ("node_list", PrependedSizeListSerializer(4, PrependedSizeBytesSerializer(4)))
+    ]
+
+    def __init__(self, node_list):
+        self.node_list = node_list
+
+
+class GetMinorBlockXshardTxListRequest(Serializable):
+    """ Obtain the cross-shard tx lists received from the minor blocks of the
+    neighbor shards, for the blocks imported without running them
+    """
+
+    FIELDS = [
+        ("branch", Branch),
+        ("minor_block_hash_list", PrependedSizeListSerializer(4, hash256)),
+    ]
+
+    def __init__(self, branch, minor_block_hash_list):
+        self.branch = branch
+        self.minor_block_hash_list = minor_block_hash_list
+
+
+class GetMinorBlockXshardTxListResponse(Serializable):
+    FIELDS = [
+        ("minor_block_hash_list", PrependedSizeListSerializer(4, hash256)),
+        (
+            "xshard_tx_list_list",
+            PrependedSizeListSerializer(4, CrossShardTransactionList),
+        ),
+    ]
+
+    def __init__(self, minor_block_hash_list, xshard_tx_list_list):
+        self.minor_block_hash_list = minor_block_hash_list
+        self.xshard_tx_list_list = xshard_tx_list_list
+
+
 class NewBlockMinorCommand(Serializable):
     FIELDS = [("block", MinorBlock)]
 
@@ -204,6 +300,14 @@ class CommandOp:
     GET_MINOR_BLOCK_HEADER_LIST_REQUEST = 11
     GET_MINOR_BLOCK_HEADER_LIST_RESPONSE = 12
     NEW_BLOCK_MINOR = 13
+    GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST = 14
+    GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE = 15
+    GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST = 16
+    GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE = 17
+    GET_MINOR_BLOCK_STATE_NODE_LIST_REQUEST = 18
+    GET_MINOR_BLOCK_STATE_NODE_LIST_RESPONSE = 19
+    GET_MINOR_BLOCK_XSHARD_TX_LIST_REQUEST = 20
+    GET_MINOR_BLOCK_XSHARD_TX_LIST_RESPONSE = 21
 
 
 OP_SERIALIZER_MAP = {
@@ -221,4 +325,12 @@ OP_SERIALIZER_MAP = {
     CommandOp.GET_MINOR_BLOCK_HEADER_LIST_REQUEST: GetMinorBlockHeaderListRequest,
     CommandOp.GET_MINOR_BLOCK_HEADER_LIST_RESPONSE: GetMinorBlockHeaderListResponse,
     CommandOp.NEW_BLOCK_MINOR: NewBlockMinorCommand,
+    CommandOp.GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST: GetRootBlockHeaderListWithSkipRequest,
+    CommandOp.GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE: GetRootBlockHeaderListResponse,
+    CommandOp.GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST: GetMinorBlockHeaderListWithSkipRequest,
+    CommandOp.GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE: GetMinorBlockHeaderListResponse,
+    CommandOp.GET_MINOR_BLOCK_STATE_NODE_LIST_REQUEST: GetMinorBlockStateNodeListRequest,
+    CommandOp.GET_MINOR_BLOCK_STATE_NODE_LIST_RESPONSE: GetMinorBlockStateNodeListResponse,
+    CommandOp.GET_MINOR_BLOCK_XSHARD_TX_LIST_REQUEST: GetMinorBlockXshardTxListRequest,
+    CommandOp.GET_MINOR_BLOCK_XSHARD_TX_LIST_RESPONSE: GetMinorBlockXshardTxListResponse,
 }
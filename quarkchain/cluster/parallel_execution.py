@@ -0,0 +1,457 @@
+""" Optimistic parallel execution of the txs of a minor block.
+
+The txs are first run speculatively by worker processes, each tx on its own fork
+of the block's state after the cross-shard deposits.  The workers are spawned once
+and kept: every block sends them an explicit snapshot of the state (its committed
+root, the block parameters and the accounts modified by the deposits), and they
+read the trie nodes and the code they miss from this process, which only serves
+content-addressed data.  Every run records the accounts and storage slots it read
+and what it wrote.  The runs are then committed in block order: a run that read
+nothing written by the txs committed before it is applied as is, otherwise the tx
+is executed again on the block's state.  The state and receipts are the same as
+those of sequential execution.
+
+Balance credits made without reading the balance (the fee paid to the coinbase,
+the value sent to a recipient) are kept as deltas, so txs paying the same coinbase
+or sending to the same account don't conflict.
+"""
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from quarkchain.db import Db, OverlayDb
+from quarkchain.evm import utils
+from quarkchain.evm.config import Env
+from quarkchain.evm.messages import apply_transaction, mk_receipt
+from quarkchain.evm.state import STATE_DEFAULTS, Account, State
+from quarkchain.evm.trie import BLANK_ROOT
+from quarkchain.utils import Logger
+
+# smaller blocks are executed sequentially as sending them to the workers costs more
+# than it saves
+MIN_BLOCK_SIZE = 64
+
+SpeculativeResult = NamedTuple(
+    "SpeculativeResult",
+    [
+        # addresses and (address, storage key) read by the tx
+        ("reads", Set),
+        # address -> (nonce, balance, code or None if unchanged) of the accounts
+        # read and written
+        ("accounts", Dict[bytes, Tuple[int, int, Optional[bytes]]]),
+        # address -> balance added to an account not read
+        ("deltas", Dict[bytes, int]),
+        # (address, storage key) -> value written
+        ("storage", Dict[Tuple[bytes, int], int]),
+        # (address, full_shard_key) of the blank accounts cached by the tx
+        ("created", List[Tuple[bytes, int]]),
+        ("gas_used", int),
+        ("block_fee", int),
+        ("xshard_list", List),
+        # success, logs, contract_address and contract_full_shard_key of the receipt
+        ("receipt", Tuple),
+    ],
+)
+
+
+class AccessRecordingState(State):
+    """ Proxy of a State that records the accounts and storage slots read and
+    written through it.  The attributes are read from and set on the state, while
+    the methods of State run on the proxy so that the reads they make are recorded.
+    """
+
+    def __init__(self, state):
+        # not calling State.__init__: the proxy has no state of its own
+        object.__setattr__(self, "_state", state)
+        object.__setattr__(self, "reads", set())
+        # accounts written by value, and (address, None) for reset storage
+        object.__setattr__(self, "writes", set())
+        object.__setattr__(self, "deltas", dict())
+        object.__setattr__(self, "storage_writes", set())
+        object.__setattr__(self, "codes", dict())
+
+    def __getattr__(self, name):
+        # only called for the attributes not found on the proxy or its class
+        return getattr(self._state, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._state, name, value)
+
+    @property
+    def db(self):
+        return self._state.db
+
+    def get_balance(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().get_balance(address)
+
+    def get_code(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().get_code(address)
+
+    def get_code_hash(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().get_code_hash(address)
+
+    def get_nonce(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().get_nonce(address)
+
+    def get_full_shard_key(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().get_full_shard_key(address)
+
+    def account_exists(self, address):
+        self.reads.add(utils.normalize_address(address))
+        return super().account_exists(address)
+
+    def get_storage_data(self, address, key):
+        self.reads.add((utils.normalize_address(address), key))
+        return super().get_storage_data(address, key)
+
+    def set_balance(self, address, value):
+        self.writes.add(utils.normalize_address(address))
+        super().set_balance(address, value)
+
+    def set_code(self, address, value):
+        address = utils.normalize_address(address)
+        self.writes.add(address)
+        self.codes[address] = value
+        super().set_code(address, value)
+
+    def set_nonce(self, address, value):
+        self.writes.add(utils.normalize_address(address))
+        super().set_nonce(address, value)
+
+    def increment_nonce(self, address):
+        address = utils.normalize_address(address)
+        self.reads.add(address)
+        self.writes.add(address)
+        super().increment_nonce(address)
+
+    def delta_balance(self, address, value):
+        address = utils.normalize_address(address)
+        self.deltas[address] = self.deltas.get(address, 0) + value
+        super().delta_balance(address, value)
+
+    def set_storage_data(self, address, key, value):
+        self.storage_writes.add((utils.normalize_address(address), key))
+        super().set_storage_data(address, key, value)
+
+    def reset_storage(self, address):
+        address = utils.normalize_address(address)
+        self.writes.add(address)
+        self.writes.add((address, None))
+        super().reset_storage(address)
+
+    def written(self) -> Set:
+        """ Addresses and (address, storage key) written through the view"""
+        return self.writes | set(self.deltas) | self.storage_writes
+
+    def result(self, cached, pre) -> Optional[SpeculativeResult]:
+        """ The effects of the tx just applied on the view, None if they can't be
+        replayed from values and deltas (deleted accounts, reset storage, or
+        accounts written without being read).
+        cached are the addresses cached and pre the STATE_DEFAULTS values before it.
+        """
+        if any(isinstance(key, tuple) for key in self.writes):
+            return None
+        accounts = dict()
+        for address in self.writes | set(self.deltas):
+            if address not in self.reads:
+                if address in self.writes:
+                    return None
+                continue
+            acct = self.cache[address]
+            accounts[address] = (acct.nonce, acct.balance, self.codes.get(address))
+        created = [
+            (address, acct.full_shard_key)
+            for address, acct in self.cache.items()
+            if address not in cached and not acct.existent_at_start
+        ]
+        receipt = self.receipts[-1]
+        return SpeculativeResult(
+            reads=self.reads,
+            accounts=accounts,
+            deltas={
+                address: delta
+                for address, delta in self.deltas.items()
+                if address not in self.reads
+            },
+            storage={
+                (address, key): self.cache[address].get_storage_data(key)
+                for address, key in self.storage_writes
+            },
+            created=created,
+            gas_used=self.gas_used - pre["gas_used"],
+            block_fee=self.block_fee - pre["block_fee"],
+            xshard_list=self.xshard_list[len(pre["xshard_list"]) :],
+            receipt=(
+                1 if receipt.state_root else 0,
+                list(receipt.logs),
+                receipt.contract_address,
+                receipt.contract_full_shard_key,
+            ),
+        )
+
+
+class StateSnapshot(NamedTuple):
+    """ What the workers need to open the block's state after the cross-shard
+    deposits, besides the trie nodes and the code they read from this process
+    """
+
+    root: bytes
+    # STATE_DEFAULTS values but the lists of the block's receipts and xshard
+    # deposits, of which the speculative runs only record the ones they add
+    params: Dict
+    # address -> (nonce, balance, storage root, code hash, full_shard_key, storage
+    # cache, existent_at_start, touched, deleted, storage_reset) of the accounts
+    # modified since the root
+    accounts: Dict
+
+    @classmethod
+    def create(cls, state):
+        params = {k: getattr(state, k) for k in STATE_DEFAULTS}
+        params["receipts"] = []
+        params["xshard_list"] = []
+        accounts = {
+            address: (
+                acct.nonce,
+                acct.balance,
+                acct.storage,
+                acct.code_hash,
+                acct.full_shard_key,
+                acct.storage_cache,
+                acct.existent_at_start,
+                acct.touched,
+                acct.deleted,
+                acct.storage_reset,
+            )
+            for address, acct in state.cache.items()
+            if not acct.is_clean()
+        }
+        return cls(state.trie.root_hash, params, accounts)
+
+    def open(self, db, env_config, qkc_config):
+        """ The state on a temporary overlay of db"""
+        db = OverlayDb(db, temporary=True)
+        env = Env(db, env_config)
+        state = State(self.root, env, qkc_config=qkc_config)
+        for k, v in self.params.items():
+            setattr(state, k, v)
+        for address, fields in self.accounts.items():
+            acct = Account(*fields[:5], env, address, db=db)
+            (
+                acct.storage_cache,
+                acct.existent_at_start,
+                acct.touched,
+                acct.deleted,
+                acct.storage_reset,
+            ) = fields[5:]
+            if acct.storage_reset:
+                acct.storage_trie.root_hash = BLANK_ROOT
+            acct._cached_rlp = None
+            state.cache[address] = acct
+        return state
+
+
+class _ParentDb(Db):
+    """ The db of the state being speculated, read from the parent process"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def get(self, key, default=None):
+        self.conn.send(("get", key))
+        value = self.conn.recv()
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+def _speculate(state, evm_tx, tx_hash, full_shard_key):
+    snapshot = state.snapshot()
+    cached = set(state.cache)
+    view = AccessRecordingState(state)
+    # the key blank accounts get until apply_transaction() sets the tx's
+    state.full_shard_key = full_shard_key
+    try:
+        apply_transaction(view, evm_tx, tx_hash)
+        return view.result(cached, snapshot[2])
+    except Exception:
+        return None
+    finally:
+        state.revert(snapshot)
+        for address in set(state.cache) - cached:
+            # blank accounts keep the full_shard_key of the tx that cached them
+            if not state.cache[address].existent_at_start:
+                del state.cache[address]
+
+
+def _worker_loop(conn):
+    """ Runs the txs sent by the parent process on the snapshots it sends"""
+    db = _ParentDb(conn)
+    env_config, qkc_config = None, None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == "config":
+            _, env_config, qkc_config = message
+            continue
+        _, snapshot, evm_tx_list, tx_hash_list, full_shard_key_list = message
+        try:
+            state = snapshot.open(db, env_config, qkc_config)
+            results = [
+                _speculate(state, *args)
+                for args in zip(evm_tx_list, tx_hash_list, full_shard_key_list)
+            ]
+        except Exception:
+            results = [None] * len(evm_tx_list)
+        conn.send(("done", results))
+
+
+def _conflicts(result: SpeculativeResult, written: Set) -> bool:
+    for key in result.reads:
+        if key in written:
+            return True
+        if isinstance(key, tuple) and (key[0], None) in written:
+            return True
+    return False
+
+
+def _commit(state, evm_tx, result: SpeculativeResult):
+    """ Applies the effects of a speculative run to state as apply_transaction()
+    would have.
+    """
+    for address, full_shard_key in result.created:
+        if address not in state.cache:
+            state.full_shard_key = full_shard_key
+            state.get_and_cache_account(address)
+    state.full_shard_key = evm_tx.to_full_shard_key
+    for address, (nonce, balance, code) in result.accounts.items():
+        state.set_nonce(address, nonce)
+        state.set_balance(address, balance)
+        if code is not None:
+            state.set_code(address, code)
+    for address, delta in result.deltas.items():
+        state.delta_balance(address, delta)
+    for (address, key), value in result.storage.items():
+        state.set_storage_data(address, key, value)
+    state.gas_used += result.gas_used
+    state.block_fee += result.block_fee
+    state.xshard_list.extend(result.xshard_list)
+    state.logs = []
+    state.suicides = []
+    state.refunds = 0
+
+    r = mk_receipt(state, *result.receipt)
+    state.add_receipt(r)
+    state.set_param("bloom", state.bloom | r.bloom)
+    state.set_param("txindex", state.txindex + 1)
+
+
+class ParallelTxExecutor:
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        # (process, connection) of the workers, spawned on first use
+        self.worker_list = []
+        # (env config, qkc config) sent to the workers
+        self.config = None
+
+    def start(self):
+        """ Spawns the workers if not running, done by the first speculate()"""
+        if self.worker_list:
+            return
+        # spawned as this process runs threads and holds an open db
+        ctx = multiprocessing.get_context("spawn")
+        for _ in range(self.num_workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker_loop, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            self.worker_list.append((process, conn))
+        self.config = None
+
+    def speculate(self, state, evm_tx_list, tx_hash_list):
+        """ The result of running each tx on the state, None if it failed or can't
+        be replayed
+        """
+        n = len(evm_tx_list)
+        results = [None] * n
+        self.start()
+        config = (state.env.config, state.qkc_config)
+        snapshot = StateSnapshot.create(state)
+        full_shard_key_list = [state.full_shard_key] + [
+            evm_tx.to_full_shard_key for evm_tx in evm_tx_list[:-1]
+        ]
+        size = -(-n // self.num_workers)
+        # connection -> index of the first tx sent to the worker
+        pending = dict()
+        try:
+            if self.config is None or any(
+                a is not b for a, b in zip(config, self.config)
+            ):
+                for _, conn in self.worker_list:
+                    conn.send(("config",) + config)
+                self.config = config
+            for (_, conn), start in zip(self.worker_list, range(0, n, size)):
+                end = min(start + size, n)
+                conn.send(
+                    (
+                        "run",
+                        snapshot,
+                        evm_tx_list[start:end],
+                        tx_hash_list[start:end],
+                        full_shard_key_list[start:end],
+                    )
+                )
+                pending[conn] = start
+            while pending:
+                for conn in wait(list(pending)):
+                    kind, value = conn.recv()
+                    if kind == "get":
+                        conn.send(state.db.get(value))
+                        continue
+                    start = pending.pop(conn)
+                    results[start : start + len(value)] = value
+        except (EOFError, OSError) as e:
+            Logger.error("Parallel tx execution workers failed: {}".format(e))
+            # spawned again for the next block
+            self.shutdown()
+        return results
+
+    def shutdown(self):
+        for process, conn in self.worker_list:
+            conn.close()
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.worker_list = []
+
+    def run(self, state, evm_tx_list, tx_hash_list, apply_tx):
+        """ Applies the txs to state as applying them in order would.
+        apply_tx(state, i) applies the i-th tx without speculation and raises if it
+        is invalid.
+        """
+        if not state.is_METROPOLIS():
+            # the state is committed after every tx
+            results = [None] * len(evm_tx_list)
+        else:
+            results = self.speculate(state, evm_tx_list, tx_hash_list)
+
+        written = set()
+        for i, (evm_tx, result) in enumerate(zip(evm_tx_list, results)):
+            if (
+                result is None
+                or state.gas_used + evm_tx.startgas > state.gas_limit
+                or _conflicts(result, written)
+            ):
+                view = AccessRecordingState(state)
+                apply_tx(view, i)
+                written |= view.written()
+                continue
+            _commit(state, evm_tx, result)
+            written |= set(result.accounts) | set(result.deltas) | set(result.storage)
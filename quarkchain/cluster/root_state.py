@@ -4,6 +4,7 @@ import asyncio
 from fractions import Fraction
 from typing import Optional
 
+from quarkchain.cluster.freezer import HASHES, Freezer
 from quarkchain.cluster.miner import validate_seal
 from quarkchain.cluster.guardian import Guardian
 from quarkchain.core import RootBlock, MinorBlockHeader, RootBlockHeader
@@ -12,9 +13,13 @@ from quarkchain.core import (
     Serializable,
     PrependedSizeListSerializer,
 )
+from quarkchain.db import WriteBatch
 from quarkchain.diff import EthDifficultyCalculator
 from quarkchain.genesis import GenesisManager
-from quarkchain.utils import Logger, check, time_ms
+from quarkchain.utils import Logger, LRUCache, check, time_ms
+
+# Max total serialized size of the decoded root blocks kept in memory by the master
+MASTER_ROOT_BLOCK_CACHE_SIZE = 32 * 1024 * 1024
 
 
 class LastMinorBlockHeaderList(Serializable):
@@ -35,9 +40,12 @@ class RootDb:
     Forks can always be downloaded again from peers if they ever became the best chain.
     """
 
-    def __init__(self, db, quark_chain_config, count_minor_blocks=False):
+    def __init__(self, db, quark_chain_config, count_minor_blocks=False, freezer=None):
         # TODO: evict old blocks from memory
         self.db = db
+        # the final blocks of the best chain moved out of db, see freezer.py.  Its
+        # "blocks" table has the serialized blocks.
+        self.freezer = freezer
         self.quark_chain_config = quark_chain_config
         self.max_num_blocks_to_recover = (
             quark_chain_config.ROOT.max_root_blocks_in_memory
@@ -46,6 +54,8 @@ class RootDb:
         # TODO: May store locally to save memory space (e.g., with LRU cache)
         self.m_hash_set = set()
         self.r_header_pool = dict()
+        # hash -> decoded root block.  Callers must not modify the returned blocks.
+        self.r_block_cache = LRUCache(MASTER_ROOT_BLOCK_CACHE_SIZE)
         self.tip_header = None
 
         self.__recover_from_db()
@@ -59,14 +69,14 @@ class RootDb:
             return None
 
         r_hash = self.db.get(b"tipHash")
-        r_block = RootBlock.deserialize(self.db.get(b"rblock_" + r_hash))
+        r_block = self.__get_root_block(r_hash)
         if r_block.header.height <= 0:
             return None
         # use the parent of the tipHash block as the new tip
         # since it's guaranteed to have been accepted by all the shards
         # while shards might not have seen the block of tipHash
         r_hash = r_block.header.hash_prev_block
-        r_block = RootBlock.deserialize(self.db.get(b"rblock_" + r_hash))
+        r_block = self.__get_root_block(r_hash, r_block.header.height - 1)
         self.tip_header = r_block.header  # type: RootBlockHeader
 
         while len(self.r_header_pool) < self.max_num_blocks_to_recover:
@@ -78,7 +88,7 @@ class RootDb:
                 break
 
             r_hash = r_block.header.hash_prev_block
-            r_block = RootBlock.deserialize(self.db.get(b"rblock_" + r_hash))
+            r_block = self.__get_root_block(r_hash, r_block.header.height - 1)
 
     def get_tip_header(self):
         return self.tip_header
@@ -91,7 +101,9 @@ class RootDb:
             root_block_hash = root_block.header.get_hash()
 
         last_list = LastMinorBlockHeaderList(header_list=last_minor_block_header_list)
-        self.db.put(b"rblock_" + root_block_hash, root_block.serialize())
+        data = root_block.serialize()
+        self.db.put(b"rblock_" + root_block_hash, data)
+        self.r_block_cache.put(root_block_hash, root_block, len(data))
         self.db.put(b"lastlist_" + root_block_hash, last_list.serialize())
         self.r_header_pool[root_block_hash] = root_block.header
 
@@ -102,10 +114,23 @@ class RootDb:
         if consistency_check and h not in self.r_header_pool:
             return None
 
-        raw_block = self.db.get(b"rblock_" + h, None)
-        if not raw_block:
-            return None
-        return RootBlock.deserialize(raw_block)
+        header = self.r_header_pool.get(h)
+        return self.__get_root_block(h, header.height if header else None)
+
+    def __get_root_block(self, h, height=None):
+        """ From the cache, the db or the freezer, the height of h being read from
+        db if not given
+        """
+        block = self.r_block_cache.get(h)
+        if block is None:
+            raw_block = self.db.get(b"rblock_" + h, None)
+            if raw_block is None and self.freezer is not None:
+                raw_block = self.freezer.get_by_hash("blocks", h, height)
+            if not raw_block:
+                return None
+            block = RootBlock.deserialize(raw_block)
+            self.r_block_cache.put(h, block, len(raw_block))
+        return block
 
     def get_root_block_header_by_hash(self, h, consistency_check=True):
         header = self.r_header_pool.get(h, None)
@@ -173,12 +198,34 @@ class RootDb:
         return shard_recipient_cnt
 
     def get_root_block_by_height(self, height):
+        if self.freezer is not None and self.freezer.has(height):
+            return self.__get_root_block(self.freezer.get(HASHES, height), height)
         key = b"ri_%d" % height
         if key not in self.db:
             return None
         block_hash = self.db.get(key)
         return self.get_root_block_by_hash(block_hash, False)
 
+    def freeze_blocks(self, height) -> int:
+        """ Moves the root blocks of the best chain below height to the freezer.
+        Returns the number of blocks frozen.
+        """
+        if self.freezer is None:
+            return 0
+        batch = WriteBatch()
+        start = self.freezer.frozen
+        for h in range(start, height):
+            block_hash = self.db.get(b"ri_%d" % h)
+            data = self.db.get(b"rblock_" + block_hash)
+            self.freezer.append(h, block_hash, {"blocks": data})
+            batch.delete(b"ri_%d" % h)
+            batch.delete(b"rblock_" + block_hash)
+            self.freezer.put_height(batch, block_hash, h)
+        # the entries are only deleted once in the freezer
+        self.freezer.sync()
+        self.db.write(batch)
+        return max(height - start, 0)
+
     # ------------------------- Minor block db operations --------------------------------
     def contain_minor_block_by_hash(self, h):
         return h in self.m_hash_set
@@ -202,7 +249,7 @@ class RootState:
     """ State of root
     """
 
-    def __init__(self, env, diff_calc=None):
+    def __init__(self, env, diff_calc=None, freezer_path=None):
         self.env = env
         if not diff_calc:
             cutoff = env.quark_chain_config.ROOT.DIFFICULTY_ADJUSTMENT_CUTOFF_TIME
@@ -218,6 +265,15 @@ class RootState:
             self.raw_db,
             env.quark_chain_config,
             count_minor_blocks=env.cluster_config.ENABLE_TRANSACTION_HISTORY,
+            freezer=Freezer(
+                freezer_path,
+                ["blocks"],
+                clean=env.cluster_config.CLEAN,
+                db=self.raw_db,
+                height_prefix=b"frozen_rblock_",
+            )
+            if freezer_path is not None
+            else None,
         )
 
         persisted_tip = self.db.get_tip_header()
@@ -491,9 +547,17 @@ class RootState:
             self.tip = block.header
             self.db.update_tip_hash(block_hash)
             self.__rewrite_block_index_to(block)
+            self.db.freeze_blocks(self.tip.height - self.__get_num_unfrozen_blocks())
             return True
         return False
 
+    def __get_num_unfrozen_blocks(self):
+        """ The blocks below the tip kept in db, the older ones being final"""
+        return max(
+            self.env.cluster_config.FREEZER_BLOCKS,
+            self.env.quark_chain_config.ROOT.max_root_blocks_in_memory,
+        )
+
     # -------------------------------- Root block db related operations ------------------------------
     def get_root_block_by_hash(self, h):
         return self.db.get_root_block_by_hash(h)
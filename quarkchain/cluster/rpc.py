@@ -14,6 +14,7 @@ from quarkchain.core import (
 )
 from quarkchain.core import (
     Transaction,
+    Appended,
     Optional,
     PrependedSizeBytesSerializer,
     PrependedSizeListSerializer,
@@ -506,6 +507,14 @@ class ShardStats(Serializable):
         ("block_count60s", uint32),
         ("stale_block_count60s", uint32),
         ("last_block_time", uint32),
+        # absent from the stats of the older slaves, always the last field of the
+        # messages carrying the stats
+        ("block_cache_hits", Appended(uint64, 0)),
+        ("block_cache_misses", Appended(uint64, 0)),
+        ("sender_cache_hits", Appended(uint64, 0)),
+        ("sender_cache_misses", Appended(uint64, 0)),
+        ("code_cache_hits", Appended(uint64, 0)),
+        ("code_cache_misses", Appended(uint64, 0)),
     ]
 
     def __init__(
@@ -521,6 +530,12 @@ class ShardStats(Serializable):
         block_count60s: int,
         stale_block_count60s: int,
         last_block_time: int,
+        block_cache_hits: int = 0,
+        block_cache_misses: int = 0,
+        sender_cache_hits: int = 0,
+        sender_cache_misses: int = 0,
+        code_cache_hits: int = 0,
+        code_cache_misses: int = 0,
     ):
         self.branch = branch
         self.height = height
@@ -533,6 +548,12 @@ class ShardStats(Serializable):
         self.block_count60s = block_count60s
         self.stale_block_count60s = stale_block_count60s
         self.last_block_time = last_block_time
+        self.block_cache_hits = block_cache_hits
+        self.block_cache_misses = block_cache_misses
+        self.sender_cache_hits = sender_cache_hits
+        self.sender_cache_misses = sender_cache_misses
+        self.code_cache_hits = code_cache_hits
+        self.code_cache_misses = code_cache_misses
 
 
 class SyncMinorBlockListRequest(Serializable):
@@ -540,12 +561,18 @@ class SyncMinorBlockListRequest(Serializable):
         ("minor_block_hash_list", PrependedSizeListSerializer(4, hash256)),
         ("branch", Branch),
         ("cluster_peer_id", uint64),
+        # import the blocks without running them, their state is synced later.  The
+        # older slaves ignore it, ENABLE_STATE_SYNC needs all the slaves upgraded.
+        ("without_state", Appended(boolean, False)),
     ]
 
-    def __init__(self, minor_block_hash_list, branch, cluster_peer_id):
+    def __init__(
+        self, minor_block_hash_list, branch, cluster_peer_id, without_state=False
+    ):
         self.minor_block_hash_list = minor_block_hash_list
         self.branch = branch
         self.cluster_peer_id = cluster_peer_id
+        self.without_state = without_state
 
 
 class SyncMinorBlockListResponse(Serializable):
@@ -556,6 +583,24 @@ class SyncMinorBlockListResponse(Serializable):
         self.shard_stats = shard_stats
 
 
+class SyncMinorBlockStateRequest(Serializable):
+    """ Download the state of the tips of the shards whose blocks were imported
+    without running them
+    """
+
+    FIELDS = [("cluster_peer_id", uint64)]
+
+    def __init__(self, cluster_peer_id):
+        self.cluster_peer_id = cluster_peer_id
+
+
+class SyncMinorBlockStateResponse(Serializable):
+    FIELDS = [("error_code", uint32)]
+
+    def __init__(self, error_code):
+        self.error_code = error_code
+
+
 # slave -> master
 
 
@@ -849,6 +894,8 @@ class ClusterOp:
     GET_WORK_RESPONSE = 56 + CLUSTER_OP_BASE
     SUBMIT_WORK_REQUEST = 57 + CLUSTER_OP_BASE
     SUBMIT_WORK_RESPONSE = 58 + CLUSTER_OP_BASE
+    SYNC_MINOR_BLOCK_STATE_REQUEST = 59 + CLUSTER_OP_BASE
+    SYNC_MINOR_BLOCK_STATE_RESPONSE = 60 + CLUSTER_OP_BASE
 
 
 CLUSTER_OP_SERIALIZER_MAP = {
@@ -909,4 +956,6 @@ CLUSTER_OP_SERIALIZER_MAP = {
     ClusterOp.GET_WORK_RESPONSE: GetWorkResponse,
     ClusterOp.SUBMIT_WORK_REQUEST: SubmitWorkRequest,
     ClusterOp.SUBMIT_WORK_RESPONSE: SubmitWorkResponse,
+    ClusterOp.SYNC_MINOR_BLOCK_STATE_REQUEST: SyncMinorBlockStateRequest,
+    ClusterOp.SYNC_MINOR_BLOCK_STATE_RESPONSE: SyncMinorBlockStateResponse,
 }
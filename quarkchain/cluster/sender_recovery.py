@@ -0,0 +1,61 @@
+""" Batched sender recovery for incoming transactions.
+
+ecrecover dominates tx admission (see experimental/tx_perf.py).  Tx lists from
+peers and the tx generator have their senders recovered on a process pool before
+they enter ShardState.add_tx.  The results are cached on the tx's Code, so
+validation then reuses them.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from quarkchain.core import Transaction
+from quarkchain.evm.transactions import recover_sender, sender_cache
+from quarkchain.utils import sha3_256
+
+# smaller batches are recovered in-process as shipping them costs more than it saves
+MIN_BATCH_SIZE = 64
+
+
+def _recover_senders(rlp_tx_list):
+    return [recover_sender(rlp_tx) for rlp_tx in rlp_tx_list]
+
+
+class SenderRecoverer:
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        self.executor = (
+            ProcessPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        )
+
+    async def recover(self, tx_list: List[Transaction]):
+        """ Recover the senders of the evm txs in tx_list and cache them on tx.code.
+        Txs with invalid signatures are left alone and fail validation as usual.
+        """
+        pending = [
+            tx for tx in tx_list if tx.code.is_evm() and tx.code.evm_sender is None
+        ]
+        rlp_tx_list = [tx.code.code[1:] for tx in pending]
+        if self.executor is None or len(pending) < MIN_BATCH_SIZE:
+            senders = _recover_senders(rlp_tx_list)
+        else:
+            loop = asyncio.get_event_loop()
+            size = -(-len(rlp_tx_list) // self.num_workers)
+            results = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.executor, _recover_senders, rlp_tx_list[i : i + size]
+                    )
+                    for i in range(0, len(rlp_tx_list), size)
+                ]
+            )
+            senders = [sender for result in results for sender in result]
+        for tx, rlp_tx, sender in zip(pending, rlp_tx_list, senders):
+            if sender is not None:
+                tx.code.evm_sender = sender
+                # the workers' caches are not shared with this process
+                sender_cache.put(sha3_256(rlp_tx), sender)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
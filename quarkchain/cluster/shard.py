@@ -1,5 +1,5 @@
 import asyncio
-from collections import deque
+from collections import Counter, deque
 
 from quarkchain.cluster.p2p_commands import (
     CommandOp,
@@ -8,17 +8,26 @@ from quarkchain.cluster.p2p_commands import (
     GetMinorBlockListRequest,
     GetMinorBlockListResponse,
     GetMinorBlockHeaderListRequest,
+    GetMinorBlockHeaderListWithSkipRequest,
     Direction,
     GetMinorBlockHeaderListResponse,
     NewTransactionListCommand,
     NewBlockMinorCommand,
+    GetMinorBlockStateNodeListRequest,
+    GetMinorBlockStateNodeListResponse,
+    GetMinorBlockXshardTxListRequest,
+    GetMinorBlockXshardTxListResponse,
 )
+from quarkchain.cluster.block_download import BlockDownloader
+from quarkchain.cluster.header_sync import SKELETON_INTERVAL, SKELETON_SIZE, HeaderSync
 from quarkchain.cluster.miner import Miner, validate_seal
 from quarkchain.cluster.tx_generator import TransactionGenerator
 from quarkchain.cluster.protocol import VirtualConnection, ClusterMetadata
 from quarkchain.cluster.shard_state import ShardState
+from quarkchain.cluster.state_sync import StateSync
 from quarkchain.config import ConsensusType
 from quarkchain.core import (
+    CrossShardTransactionList,
     RootBlock,
     MinorBlock,
     MinorBlockHeader,
@@ -106,6 +115,8 @@ class PeerShardConnection(VirtualConnection):
             header = self.shard_state.db.get_minor_block_header_by_hash(
                 block_hash, consistency_check=False
             )
+            if header is None:
+                break
             header_list.append(header)
             if header.height == 0:
                 break
@@ -115,6 +126,38 @@ class PeerShardConnection(VirtualConnection):
             self.shard_state.root_tip, self.shard_state.header_tip, header_list
         )
 
+    async def handle_get_minor_block_header_list_with_skip_request(self, request):
+        if request.branch != self.shard_state.branch:
+            return self.close_with_error("Wrong branch from peer")
+        # no more than a skeleton
+        if request.limit <= 0 or request.limit > SKELETON_SIZE + 1:
+            return self.close_with_error("Bad limit")
+        if request.skip >= SKELETON_INTERVAL:
+            return self.close_with_error("Bad skip")
+        # TODO: support tip direction
+        if request.direction != Direction.GENESIS:
+            return self.close_with_error("Bad direction")
+
+        header = self.shard_state.db.get_minor_block_header_by_hash(
+            request.block_hash, consistency_check=False
+        )
+        header_list = []
+        while header is not None and len(header_list) < request.limit:
+            header_list.append(header)
+            if header.height <= request.skip:
+                break
+            for i in range(request.skip + 1):
+                header = self.shard_state.db.get_minor_block_header_by_hash(
+                    header.hash_prev_minor_block, consistency_check=False
+                )
+                # e.g. a fork deleted below the blocks frozen
+                if header is None:
+                    break
+
+        return GetMinorBlockHeaderListResponse(
+            self.shard_state.root_tip, self.shard_state.header_tip, header_list
+        )
+
     async def handle_get_minor_block_list_request(self, request):
         m_block_list = []
         for m_block_hash in request.minor_block_hash_list:
@@ -128,6 +171,34 @@ class PeerShardConnection(VirtualConnection):
 
         return GetMinorBlockListResponse(m_block_list)
 
+    async def handle_get_minor_block_state_node_list_request(self, request):
+        if request.branch != self.shard_state.branch:
+            return self.close_with_error("Wrong branch from peer")
+
+        node_list = []
+        for node_hash in request.node_hash_list:
+            data = self.shard_state.raw_db.get(node_hash)
+            if data is not None:
+                node_list.append(data)
+        return GetMinorBlockStateNodeListResponse(node_list)
+
+    async def handle_get_minor_block_xshard_tx_list_request(self, request):
+        if request.branch != self.shard_state.branch:
+            return self.close_with_error("Wrong branch from peer")
+
+        m_block_hash_list = []
+        xshard_tx_list_list = []
+        for m_block_hash in request.minor_block_hash_list:
+            # also the lists frozen
+            xshard_tx_list = self.shard_state.db.get_minor_block_xshard_tx_list(
+                m_block_hash
+            )
+            if xshard_tx_list is None:
+                continue
+            m_block_hash_list.append(m_block_hash)
+            xshard_tx_list_list.append(xshard_tx_list)
+        return GetMinorBlockXshardTxListResponse(m_block_hash_list, xshard_tx_list_list)
+
     async def handle_new_block_minor_command(self, _op, cmd, _rpc_id):
         self.best_minor_block_header_observed = cmd.block.header
         await self.shard.handle_new_block(cmd.block)
@@ -189,7 +260,7 @@ class PeerShardConnection(VirtualConnection):
         self.shard.synchronizer.add_task(m_header, self)
 
     async def handle_new_transaction_list_command(self, op_code, cmd, rpc_id):
-        self.shard.add_tx_list(cmd.transaction_list, self)
+        await self.shard.add_tx_list(cmd.transaction_list, self)
 
 
 # P2P command definitions
@@ -205,13 +276,27 @@ OP_RPC_MAP = {
         CommandOp.GET_MINOR_BLOCK_HEADER_LIST_RESPONSE,
         PeerShardConnection.handle_get_minor_block_header_list_request,
     ),
+    CommandOp.GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST: (
+        CommandOp.GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE,
+        PeerShardConnection.handle_get_minor_block_header_list_with_skip_request,
+    ),
     CommandOp.GET_MINOR_BLOCK_LIST_REQUEST: (
         CommandOp.GET_MINOR_BLOCK_LIST_RESPONSE,
         PeerShardConnection.handle_get_minor_block_list_request,
     ),
+    CommandOp.GET_MINOR_BLOCK_STATE_NODE_LIST_REQUEST: (
+        CommandOp.GET_MINOR_BLOCK_STATE_NODE_LIST_RESPONSE,
+        PeerShardConnection.handle_get_minor_block_state_node_list_request,
+    ),
+    CommandOp.GET_MINOR_BLOCK_XSHARD_TX_LIST_REQUEST: (
+        CommandOp.GET_MINOR_BLOCK_XSHARD_TX_LIST_RESPONSE,
+        PeerShardConnection.handle_get_minor_block_xshard_tx_list_request,
+    ),
 }
 
 TIMEOUT = 10
+# the peers that must send the same cross-shard tx list for it to be downloaded
+XSHARD_TX_LIST_PEER_COUNT = 3
 
 
 class SyncTask:
@@ -240,108 +325,121 @@ class SyncTask:
         if self.__has_block_hash(self.header.get_hash()):
             return
 
-        # descending height
-        block_header_chain = [self.header]
-
-        # TODO: Stop if too many headers to revert
-        while not self.__has_block_hash(block_header_chain[-1].hash_prev_minor_block):
-            block_hash = block_header_chain[-1].hash_prev_minor_block
-            height = block_header_chain[-1].height - 1
+        # the blocks can't run before the state of the tip is downloaded
+        if self.shard_state.state_sync_tracker is not None:
+            return
 
-            if self.shard_state.header_tip.height - height > self.max_staleness:
-                Logger.warning(
-                    "[{}] abort syncing due to forking at very old block {} << {}".format(
-                        self.header.branch.get_full_shard_id(),
-                        height,
-                        self.shard_state.header_tip.height,
-                    )
-                )
-                return
+        # the root blocks of the lower headers are known too
+        if not self.shard_state.db.contain_root_block_by_hash(
+            self.header.hash_prev_root_block
+        ):
+            return
 
-            if not self.shard_state.db.contain_root_block_by_hash(
-                block_header_chain[-1].hash_prev_root_block
-            ):
-                return
-            Logger.info(
-                "[{}] downloading headers from {} {}".format(
-                    self.shard_state.branch.get_full_shard_id(),
-                    height,
-                    block_hash.hex(),
+        header_sync = HeaderSync(
+            self.shard_conn,
+            self.__get_peers(),
+            self.__download_skeleton,
+            self.__download_block_headers,
+            self.__has_block_hash,
+            lambda header: header.hash_prev_minor_block,
+            self.__validate_block_headers,
+            TIMEOUT,
+        )
+        # ascending height
+        block_header_chain = await header_sync.sync(
+            self.header, self.shard_state.header_tip.height - self.max_staleness + 1
+        )
+        if block_header_chain is None:
+            Logger.warning(
+                "[{}] abort syncing due to forking at very old block << {}".format(
+                    self.header.branch.get_full_shard_id(),
+                    self.shard_state.header_tip.height,
                 )
             )
-            block_header_list = await asyncio.wait_for(
-                self.__download_block_headers(block_hash), TIMEOUT
-            )
-            Logger.info(
-                "[{}] downloaded {} headers from peer".format(
-                    self.shard_state.branch.get_full_shard_id(), len(block_header_list)
-                )
+            return
+        Logger.info(
+            "[{}] downloaded {} headers from peers".format(
+                self.shard_state.branch.get_full_shard_id(), len(block_header_chain)
             )
-            if not self.__validate_block_headers(block_header_list):
-                # TODO: tag bad peer
-                return self.shard_conn.close_with_error(
-                    "Bad peer sending discontinuing block headers"
-                )
-            for header in block_header_list:
-                if self.__has_block_hash(header.get_hash()):
-                    break
-                block_header_chain.append(header)
+        )
 
-        # ascending height
-        block_header_chain.reverse()
-        while len(block_header_chain) > 0:
-            block_chain = await asyncio.wait_for(
-                self.__download_blocks(block_header_chain[:100]), TIMEOUT
-            )
-            Logger.info(
-                "[{}] downloaded {} blocks from peer".format(
-                    self.shard_state.branch.get_full_shard_id(), len(block_chain)
+        downloader = BlockDownloader(
+            block_header_chain, self.__get_peers(), self.__download_blocks, TIMEOUT
+        )
+        downloader.start()
+        try:
+            while True:
+                block_chain = await downloader.get_next()
+                if block_chain is None:
+                    break
+                Logger.info(
+                    "[{}] downloaded {} blocks from {} peers".format(
+                        self.shard_state.branch.get_full_shard_id(),
+                        len(block_chain),
+                        len(downloader.peer_list),
+                    )
                 )
-            )
-            check(len(block_chain) == len(block_header_chain[:100]))
 
-            for block in block_chain:
-                # Stop if the block depends on an unknown root block
-                # TODO: move this check to early stage to avoid downloading unnecessary headers
-                if not self.shard_state.db.contain_root_block_by_hash(
-                    block.header.hash_prev_root_block
-                ):
-                    return
-                await self.shard.add_block(block)
-                block_header_chain.pop(0)
+                for block in block_chain:
+                    # Stop if the block depends on an unknown root block
+                    # TODO: move this check to early stage to avoid downloading unnecessary headers
+                    if not self.shard_state.db.contain_root_block_by_hash(
+                        block.header.hash_prev_root_block
+                    ):
+                        return
+                    await self.shard.add_block(block)
+        finally:
+            downloader.close()
 
     def __has_block_hash(self, block_hash):
         return self.shard_state.db.contain_minor_block_by_hash(block_hash)
 
-    def __validate_block_headers(self, block_header_list):
-        for i in range(len(block_header_list) - 1):
-            header, prev = block_header_list[i : i + 2]
-            if header.height != prev.height + 1:
-                return False
-            if header.hash_prev_minor_block != prev.get_hash():
-                return False
-            full_shard_id = header.branch.get_full_shard_id()
-            consensus_type = self.shard.env.quark_chain_config.shards[
-                full_shard_id
-            ].CONSENSUS_TYPE
-            validate_seal(header, consensus_type)
-        return True
+    def __get_peers(self):
+        """ The peer of the task and the other peers advertising the header's height"""
+        peer_list = [self.shard_conn]
+        for peer in self.shard.peers.values():
+            tip = peer.best_minor_block_header_observed
+            if peer is not self.shard_conn and tip and tip.height >= self.header.height:
+                peer_list.append(peer)
+        return peer_list
+
+    async def __validate_block_headers(self, block_header_list):
+        full_shard_id = self.shard_state.branch.get_full_shard_id()
+        consensus_type = self.shard.env.quark_chain_config.shards[
+            full_shard_id
+        ].CONSENSUS_TYPE
+        await self.shard.slave.header_validator.validate(
+            block_header_list, consensus_type
+        )
 
-    async def __download_block_headers(self, block_hash):
+    async def __download_skeleton(self, peer, block_hash, limit, skip):
+        request = GetMinorBlockHeaderListWithSkipRequest(
+            block_hash=block_hash,
+            branch=self.shard_state.branch,
+            limit=limit,
+            skip=skip,
+            direction=Direction.GENESIS,
+        )
+        op, resp, rpc_id = await peer.write_rpc_request(
+            CommandOp.GET_MINOR_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST, request
+        )
+        return resp.block_header_list
+
+    async def __download_block_headers(self, peer, block_hash, limit):
         request = GetMinorBlockHeaderListRequest(
             block_hash=block_hash,
             branch=self.shard_state.branch,
-            limit=100,
+            limit=limit,
             direction=Direction.GENESIS,
         )
-        op, resp, rpc_id = await self.shard_conn.write_rpc_request(
+        op, resp, rpc_id = await peer.write_rpc_request(
             CommandOp.GET_MINOR_BLOCK_HEADER_LIST_REQUEST, request
         )
         return resp.block_header_list
 
-    async def __download_blocks(self, block_header_list):
+    async def __download_blocks(self, peer, block_header_list):
         block_hash_list = [b.get_hash() for b in block_header_list]
-        op, resp, rpc_id = await self.shard_conn.write_rpc_request(
+        op, resp, rpc_id = await peer.write_rpc_request(
             CommandOp.GET_MINOR_BLOCK_LIST_REQUEST,
             GetMinorBlockListRequest(block_hash_list),
         )
@@ -375,7 +473,14 @@ class Shard:
         self.full_shard_id = full_shard_id
         self.slave = slave
 
-        self.state = ShardState(env, full_shard_id, self.__init_shard_db())
+        self.state = ShardState(
+            env,
+            full_shard_id,
+            self.__init_shard_db(),
+            freezer_path=env.cluster_config.get_freezer_path(
+                "shard-{}".format(full_shard_id)
+            ),
+        )
 
         self.loop = asyncio.get_event_loop()
         self.synchronizer = Synchronizer()
@@ -409,7 +514,11 @@ class Shard:
 
         async def __create_block(retry=True):
             # hold off mining if the shard is syncing
-            while self.synchronizer.running or not self.state.initialized:
+            while (
+                self.synchronizer.running
+                or not self.state.initialized
+                or self.state.state_sync_tracker is not None
+            ):
                 if not retry:
                     break
                 await asyncio.sleep(0.1)
@@ -473,12 +582,96 @@ class Shard:
         check(root_block.header.height >= self.genesis_root_height)
 
         if root_block.header.height > self.genesis_root_height:
+            await self.__download_xshard_tx_lists(
+                self.state.get_missing_cross_shard_tx_list_hashes(root_block)
+            )
             return self.state.add_root_block(root_block)
 
         # this happens when there is a root chain fork
         if root_block.header.height == self.genesis_root_height:
             await self.__init_genesis_state(root_block)
 
+    async def __download_xshard_tx_lists(self, hash_list):
+        """ The neighbor shards don't broadcast the cross-shard tx lists of the blocks
+        they import without running them, these lists are downloaded from the peers.
+        They can't be checked, so a list is only stored once XSHARD_TX_LIST_PEER_COUNT
+        peers (all of them if fewer are connected) and most of the peers answering
+        sent it.  A block failing to run discards the downloaded lists it received,
+        and they are downloaded again.
+        """
+        if not hash_list:
+            return
+
+        async def __download(peer):
+            try:
+                op, resp, rpc_id = await asyncio.wait_for(
+                    peer.write_rpc_request(
+                        CommandOp.GET_MINOR_BLOCK_XSHARD_TX_LIST_REQUEST,
+                        GetMinorBlockXshardTxListRequest(self.state.branch, hash_list),
+                    ),
+                    TIMEOUT,
+                )
+            except Exception:
+                Logger.error_exception()
+                return dict()
+            return {
+                m_block_hash: bytes(tx_list.serialize())
+                for m_block_hash, tx_list in zip(
+                    resp.minor_block_hash_list, resp.xshard_tx_list_list
+                )
+            }
+
+        peer_list = list(self.peers.values())
+        min_count = min(XSHARD_TX_LIST_PEER_COUNT, len(peer_list))
+        answer_list = await asyncio.gather(*[__download(peer) for peer in peer_list])
+        for m_block_hash in hash_list:
+            counter = Counter(
+                answers[m_block_hash]
+                for answers in answer_list
+                if m_block_hash in answers
+            )
+            if not counter:
+                continue
+            data, count = counter.most_common(1)[0]
+            if count < min_count or count * 2 <= sum(counter.values()):
+                Logger.error(
+                    "[{}] Peers disagree on the cross-shard tx list of {}".format(
+                        self.full_shard_id, m_block_hash.hex()
+                    )
+                )
+                continue
+            self.state.add_cross_shard_tx_list_by_minor_block_hash(
+                m_block_hash,
+                CrossShardTransactionList.deserialize(data),
+                downloaded=True,
+            )
+
+    async def sync_state(self, cluster_peer_id):
+        """ Download the state of the tip once the blocks confirmed by the root
+        chain are imported without running them, see state_sync.py.
+        The peer of cluster_peer_id is asked first.
+        Raises if no peer could send the state.
+        """
+        tracker = self.state.state_sync_tracker
+        if tracker is None:
+            return
+        block_hash = self.state.header_tip.get_hash()
+        if tracker.block_hash != block_hash:
+            tracker.start(block_hash, self.state.meta_tip.hash_evm_state_root)
+
+        async def __download_nodes(peer, node_hash_list):
+            op, resp, rpc_id = await peer.write_rpc_request(
+                CommandOp.GET_MINOR_BLOCK_STATE_NODE_LIST_REQUEST,
+                GetMinorBlockStateNodeListRequest(self.state.branch, node_hash_list),
+            )
+            return resp.node_list
+
+        first_peer = self.peers.get(cluster_peer_id, None)
+        peer_list = [first_peer] if first_peer else []
+        peer_list.extend(p for p in self.peers.values() if p is not first_peer)
+        await StateSync(tracker, peer_list, __download_nodes, TIMEOUT).run()
+        self.state.finish_state_sync()
+
     def broadcast_new_block(self, block):
         for cluster_peer_id, peer in self.peers.items():
             peer.send_new_block(block)
@@ -504,7 +697,7 @@ class Shard:
         6. add_block() to local state (then remove from cache)
              also, broadcast tip if tip is updated (so that peers can sync if they missed blocks, or are new)
         """
-        if self.synchronizer.running:
+        if self.synchronizer.running or self.state.state_sync_tracker is not None:
             # TODO optinal: queue the block if it came from broadcast to so that once sync is over, catch up immediately
             return
 
@@ -555,6 +748,9 @@ class Shard:
             xshard_list = self.state.add_block(block)
         except Exception as e:
             Logger.error_exception()
+            await self.__download_xshard_tx_lists(
+                self.state.get_missing_cross_shard_tx_list_hashes_by_block(block)
+            )
             return False
 
         # only remove from pool if the block successfully added to state,
@@ -610,16 +806,35 @@ class Shard:
         if not block_list:
             return True
 
+        # the stateless checks of the next blocks run while the current one executes
+        consensus_type = self.env.quark_chain_config.shards[
+            self.full_shard_id
+        ].CONSENSUS_TYPE
+        validations = [
+            asyncio.ensure_future(
+                self.slave.block_validator.validate(block, consensus_type)
+            )
+            for block in block_list
+        ]
+
         existing_add_block_futures = []
         block_hash_to_x_shard_list = dict()
-        for block in block_list:
+        for block, validation in zip(block_list, validations):
             check(block.header.branch.get_full_shard_id() == self.full_shard_id)
 
             block_hash = block.header.get_hash()
             try:
-                xshard_list = self.state.add_block(block, skip_if_too_old=False)
+                await validation
+                xshard_list = self.state.add_block(
+                    block, skip_if_too_old=False, stateless_validated=True
+                )
             except Exception as e:
                 Logger.error_exception()
+                for v in validations:
+                    v.cancel()
+                await self.__download_xshard_tx_lists(
+                    self.state.get_missing_cross_shard_tx_list_hashes_by_block(block)
+                )
                 return False
 
             # block already existed in local shard state
@@ -648,9 +863,38 @@ class Shard:
 
         return True
 
-    def add_tx_list(self, tx_list, source_peer=None):
-        if not tx_list:
+    async def import_block_list_for_sync(self, block_list):
+        """ Like add_block_list_for_sync() but without running the blocks, the state
+        is downloaded afterward by sync_state().
+
+        Returns true if blocks are successfully imported. False on any error.
+        """
+        consensus_type = self.env.quark_chain_config.shards[
+            self.full_shard_id
+        ].CONSENSUS_TYPE
+        validations = [
+            asyncio.ensure_future(
+                self.slave.block_validator.validate(block, consensus_type)
+            )
+            for block in block_list
+        ]
+        for block, validation in zip(block_list, validations):
+            check(block.header.branch.get_full_shard_id() == self.full_shard_id)
+            try:
+                await validation
+                self.state.import_block(block, stateless_validated=True)
+            except Exception:
+                Logger.error_exception()
+                for v in validations:
+                    v.cancel()
+                return False
+        return True
+
+    async def add_tx_list(self, tx_list, source_peer=None):
+        # the txs can't be validated before the state of the tip is downloaded
+        if not tx_list or self.state.state_sync_tracker is not None:
             return
+        await self.slave.sender_recoverer.recover(tx_list)
         valid_tx_list = []
         for tx in tx_list:
             if self.add_tx(tx):
@@ -1,5 +1,11 @@
+import os
+from collections.abc import Sequence
+from contextlib import contextmanager
 from typing import Tuple, Optional
 
+import rlp
+
+from quarkchain.cluster.freezer import HASHES, Freezer
 from quarkchain.cluster.rpc import TransactionDetail
 from quarkchain.core import (
     RootBlock,
@@ -9,7 +15,50 @@ from quarkchain.core import (
     Branch,
     Address,
 )
-from quarkchain.utils import check, Logger
+from quarkchain.db import OverlayDb, WriteBatch
+from quarkchain.evm import trie
+from quarkchain.evm.messages import Receipt
+from quarkchain.utils import check, Logger, LRUCache
+
+# Max total serialized size of the decoded blocks kept in memory by a shard, the
+# root blocks being those cached by the shard (see root_state.py for the master)
+SHARD_MINOR_BLOCK_CACHE_SIZE = 64 * 1024 * 1024
+SHARD_ROOT_BLOCK_CACHE_SIZE = 16 * 1024 * 1024
+
+# table of the freezer -> db prefix of the entries of the minor blocks frozen
+MINOR_BLOCK_TABLES = {"blocks": b"mblock_", "tx_counts": b"tx_count_", "xr": b"xr_"}
+
+
+class ReceiptList(Sequence):
+    """ The receipts of a block stored as a flat list, decoded on access"""
+
+    def __init__(self, data: bytes):
+        self.items = rlp.decode_lazy(data)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        # raises IndexError past the end, which LazyList doesn't
+        i = range(len(self))[i]
+        return rlp.decode(self.items[i], Receipt)
+
+
+class ReceiptTrie(Sequence):
+    """ The receipts of a block stored before the receipt list, read from the
+    receipt trie
+    """
+
+    def __init__(self, db, m_block):
+        self.trie = trie.Trie(db, m_block.meta.hash_evm_receipt_root)
+        self.size = len(m_block.tx_list)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        return rlp.decode(self.trie.get(rlp.encode(i)), Receipt)
 
 
 class TransactionHistoryMixin:
@@ -33,8 +82,12 @@ class TransactionHistoryMixin:
         l = CrossShardTransactionList(cross_shard_transaction_deposit_list)
         self.db.put(b"xr_" + minor_block_hash, l.serialize())
 
-    def __get_confirmed_cross_shard_transaction_deposit_list(self, minor_block_hash):
+    def __get_confirmed_cross_shard_transaction_deposit_list(
+        self, minor_block_hash, height
+    ):
         data = self.db.get(b"xr_" + minor_block_hash, None)
+        if data is None and self.minor_freezer is not None:
+            data = self.minor_freezer.get_by_hash("xr", minor_block_hash, height)
         if not data:
             return []
         return CrossShardTransactionList.deserialize(data).tx_list
@@ -68,7 +121,7 @@ class TransactionHistoryMixin:
 
     def __update_transaction_history_index_from_block(self, minor_block, func):
         x_shard_receive_tx_list = self.__get_confirmed_cross_shard_transaction_deposit_list(
-            minor_block.header.get_hash()
+            minor_block.header.get_hash(), minor_block.header.height
         )
         for i, tx in enumerate(x_shard_receive_tx_list):
             if tx.tx_hash == bytes(32):  # coinbase reward for root block miner
@@ -117,7 +170,7 @@ class TransactionHistoryMixin:
             if cross_shard:  # cross shard receive
                 m_block = self.get_minor_block_by_height(height)
                 x_shard_receive_tx_list = self.__get_confirmed_cross_shard_transaction_deposit_list(
-                    m_block.header.get_hash()
+                    m_block.header.get_hash(), height
                 )
                 tx = x_shard_receive_tx_list[
                     index
@@ -135,7 +188,11 @@ class TransactionHistoryMixin:
                 )
             else:
                 m_block = self.get_minor_block_by_height(height)
-                receipt = m_block.get_receipt(self.db, index)
+                receipts = self.get_receipts(m_block)
+                if receipts is None:
+                    # imported without running it, the result of the tx is unknown
+                    continue
+                receipt = m_block.get_receipt(receipts, index)
                 tx = m_block.tx_list[index]  # tx is Transaction
                 evm_tx = tx.code.get_evm_transaction()
                 tx_list.append(
@@ -159,9 +216,11 @@ class TransactionHistoryMixin:
 
 
 class ShardDbOperator(TransactionHistoryMixin):
-    def __init__(self, db, env, branch: Branch):
+    def __init__(self, db, env, branch: Branch, freezer_path=None):
         self.env = env
         self.db = db
+        # self.db is an overlay of it in write_batch()
+        self.raw_db = db
         self.branch = branch
         # TODO:  iterate db to recover pools and set
         self.m_header_pool = dict()
@@ -173,6 +232,40 @@ class ShardDbOperator(TransactionHistoryMixin):
         # height -> set(minor block hash) for counting wasted blocks
         self.height_to_minor_block_hashes = dict()
 
+        # hash -> decoded block.  Blocks are immutable once stored so entries never go stale
+        # (reorgs only rewrite the height index, which is always read from db).
+        # Callers must not modify the returned blocks.
+        self.m_block_cache = LRUCache(SHARD_MINOR_BLOCK_CACHE_SIZE)
+        self.r_block_cache = LRUCache(SHARD_ROOT_BLOCK_CACHE_SIZE)
+        # the minor blocks put in the pools by the pending write batch, if any
+        self.batch_block_list = None
+
+        # the final blocks of the best chains moved out of db, see freezer.py.  The
+        # root blocks are frozen with the cross-shard tx lists of the minor blocks
+        # they confirm.
+        self.minor_freezer = None
+        self.root_freezer = None
+        if freezer_path is not None:
+            clean = env.cluster_config.CLEAN
+            self.minor_freezer = Freezer(
+                os.path.join(freezer_path, "minor"),
+                MINOR_BLOCK_TABLES,
+                clean=clean,
+                db=db,
+                height_prefix=b"frozen_mblock_",
+            )
+            # with the heights of the cross-shard tx lists by minor block hash
+            self.root_freezer = Freezer(
+                os.path.join(freezer_path, "root"),
+                ["blocks", "xshard_hashes", "xshard_lists"],
+                start=env.quark_chain_config.get_genesis_root_height(
+                    branch.get_full_shard_id()
+                ),
+                clean=clean,
+                db=db,
+                height_prefix=b"frozen_rblock_",
+            )
+
     def __get_last_minor_block_in_root_block(self, root_block):
         # genesis root block contains no minor block header
         if (
@@ -199,12 +292,12 @@ class ShardDbOperator(TransactionHistoryMixin):
         Forking blocks can be in inconsistent state and thus should be pruned from the database
         so that they can be retried in the future.
         """
-        r_hash = r_header.get_hash()
+        r_hash, height = r_header.get_hash(), r_header.height
         while (
             len(self.r_header_pool)
             < self.env.quark_chain_config.ROOT.max_root_blocks_in_memory
         ):
-            block = RootBlock.deserialize(self.db.get(b"rblock_" + r_hash))
+            block = self.__get_root_block(r_hash, height)
             self.r_minor_header_pool[
                 r_hash
             ] = self.__get_last_minor_block_in_root_block(block)
@@ -216,19 +309,19 @@ class ShardDbOperator(TransactionHistoryMixin):
                 )
             ):
                 break
-            r_hash = block.header.hash_prev_block
+            r_hash, height = block.header.hash_prev_block, block.header.height - 1
 
-        m_hash = m_header.get_hash()
+        m_hash, height = m_header.get_hash(), m_header.height
         shard_config = self.env.quark_chain_config.shards[
             self.branch.get_full_shard_id()
         ]
         while len(self.m_header_pool) < shard_config.max_minor_blocks_in_memory:
-            block = MinorBlock.deserialize(self.db.get(b"mblock_" + m_hash))
+            block = self.__get_minor_block(m_hash, height)
             self.m_header_pool[m_hash] = block.header
             self.m_meta_pool[m_hash] = block.meta
             if block.header.height <= 0:
                 break
-            m_hash = block.header.hash_prev_minor_block
+            m_hash, height = block.header.hash_prev_minor_block, block.header.height - 1
 
         Logger.info(
             "[{}] recovered {} minor blocks and {} root blocks".format(
@@ -245,14 +338,31 @@ class ShardDbOperator(TransactionHistoryMixin):
         if root_block_hash is None:
             root_block_hash = root_block.header.get_hash()
 
-        self.db.put(b"rblock_" + root_block_hash, root_block.serialize())
+        data = root_block.serialize()
+        self.db.put(b"rblock_" + root_block_hash, data)
+        self.r_block_cache.put(root_block_hash, root_block, len(data))
         self.r_header_pool[root_block_hash] = root_block.header
         self.r_minor_header_pool[root_block_hash] = r_minor_header
 
     def get_root_block_by_hash(self, h):
         if h not in self.r_header_pool:
             return None
-        return RootBlock.deserialize(self.db.get(b"rblock_" + h))
+        return self.__get_root_block(h, self.r_header_pool[h].height)
+
+    def __get_root_block(self, h, height=None) -> Optional[RootBlock]:
+        """ From the cache, the db or the freezer, the height of h being read from
+        db if not given
+        """
+        block = self.r_block_cache.get(h)
+        if block is None:
+            data = self.db.get(b"rblock_" + h, None)
+            if data is None and self.root_freezer is not None:
+                data = self.root_freezer.get_by_hash("blocks", h, height)
+            if not data:
+                return None
+            block = RootBlock.deserialize(data)
+            self.r_block_cache.put(h, block, len(data))
+        return block
 
     def get_root_block_header_by_hash(self, h):
         return self.r_header_pool.get(h, None)
@@ -270,7 +380,9 @@ class ShardDbOperator(TransactionHistoryMixin):
     def put_minor_block(self, m_block, x_shard_receive_tx_list):
         m_block_hash = m_block.header.get_hash()
 
-        self.db.put(b"mblock_" + m_block_hash, m_block.serialize())
+        data = m_block.serialize()
+        self.db.put(b"mblock_" + m_block_hash, data)
+        self.m_block_cache.put(m_block_hash, m_block, len(data))
         self.put_total_tx_count(m_block)
 
         self.m_header_pool[m_block_hash] = m_block.header
@@ -279,11 +391,35 @@ class ShardDbOperator(TransactionHistoryMixin):
         self.height_to_minor_block_hashes.setdefault(m_block.header.height, set()).add(
             m_block.header.get_hash()
         )
+        if self.batch_block_list is not None:
+            self.batch_block_list.append(m_block.header)
 
         self.put_confirmed_cross_shard_transaction_deposit_list(
             m_block_hash, x_shard_receive_tx_list
         )
 
+    def put_receipts(self, m_block_hash, receipts):
+        """ Stores the evm receipts of a block as a list, in place of the nodes of
+        its receipt trie
+        """
+        self.db.put(
+            b"receipts_" + m_block_hash, rlp.encode([rlp.encode(r) for r in receipts])
+        )
+
+    def put_no_receipts(self, m_block_hash):
+        """ Marks a block imported without running it, see ShardState.import_block()"""
+        self.db.put(b"no_receipts_" + m_block_hash, b"\x01")
+
+    def get_receipts(self, m_block) -> Optional[Sequence]:
+        """ None for the blocks imported without running them"""
+        m_block_hash = m_block.header.get_hash()
+        data = self.db.get(b"receipts_" + m_block_hash, None)
+        if data is not None:
+            return ReceiptList(data)
+        if (b"no_receipts_" + m_block_hash) in self.db:
+            return None
+        return ReceiptTrie(self.db, m_block)
+
     def put_total_tx_count(self, m_block):
         prev_count = 0
         if m_block.header.height > 2:
@@ -293,6 +429,11 @@ class ShardDbOperator(TransactionHistoryMixin):
 
     def get_total_tx_count(self, m_block_hash):
         count_bytes = self.db.get(b"tx_count_" + m_block_hash, None)
+        if count_bytes is None and self.minor_freezer is not None:
+            header = self.m_header_pool.get(m_block_hash)
+            count_bytes = self.minor_freezer.get_by_hash(
+                "tx_counts", m_block_hash, header.height if header else None
+            )
         if not count_bytes:
             return 0
         return int.from_bytes(count_bytes, "big")
@@ -321,8 +462,23 @@ class ShardDbOperator(TransactionHistoryMixin):
     ) -> Optional[MinorBlock]:
         if consistency_check and h not in self.m_header_pool:
             return None
-        data = self.db.get(b"mblock_" + h, None)
-        return MinorBlock.deserialize(data) if data else None
+        header = self.m_header_pool.get(h)
+        return self.__get_minor_block(h, header.height if header else None)
+
+    def __get_minor_block(self, h, height=None) -> Optional[MinorBlock]:
+        """ From the cache, the db or the freezer, the height of h being read from
+        db if not given
+        """
+        block = self.m_block_cache.get(h)
+        if block is None:
+            data = self.db.get(b"mblock_" + h, None)
+            if data is None and self.minor_freezer is not None:
+                data = self.minor_freezer.get_by_hash("blocks", h, height)
+            if not data:
+                return None
+            block = MinorBlock.deserialize(data)
+            self.m_block_cache.put(h, block, len(data))
+        return block
 
     def contain_minor_block_by_hash(self, h):
         return h in self.m_header_pool
@@ -334,6 +490,10 @@ class ShardDbOperator(TransactionHistoryMixin):
         self.db.remove(b"mi_%d" % block.header.height)
 
     def get_minor_block_by_height(self, height) -> Optional[MinorBlock]:
+        if self.minor_freezer is not None and self.minor_freezer.has(height):
+            return self.__get_minor_block(
+                self.minor_freezer.get(HASHES, height), height
+            )
         key = b"mi_%d" % height
         if key not in self.db:
             return None
@@ -342,7 +502,7 @@ class ShardDbOperator(TransactionHistoryMixin):
 
     def get_block_count_by_height(self, height):
         """ Return the total number of blocks with the given height"""
-        return len(self.height_to_minor_block_hashes.setdefault(height, set()))
+        return len(self.height_to_minor_block_hashes.get(height, ()))
 
     # ------------------------- Transaction db operations --------------------------------
     def put_transaction_index(self, tx, block_height, index):
@@ -388,21 +548,166 @@ class ShardDbOperator(TransactionHistoryMixin):
         self.remove_transaction_history_index_from_block(minor_block)
 
     # -------------------------- Cross-shard tx operations ----------------------------
-    def put_minor_block_xshard_tx_list(self, h, tx_list: CrossShardTransactionList):
+    def put_minor_block_xshard_tx_list(
+        self, h, tx_list: CrossShardTransactionList, downloaded=False
+    ):
+        """ downloaded is set for the lists downloaded from the peers instead of
+        received from the neighbor shards, see discard_downloaded_xshard_tx_lists()
+        """
         # self.x_shard_set.add(h)
         self.db.put(b"xShard_" + h, tx_list.serialize())
+        if downloaded:
+            self.db.put(b"xShardDownloaded_" + h, b"\x01")
+
+    def discard_downloaded_xshard_tx_lists(self, hash_list):
+        """ Deletes the lists of hash_list that were downloaded from the peers.
+        The deletes go to the underlying db at once, also in a write batch.
+        Returns the hashes of the lists deleted.
+        """
+        discarded_list = []
+        for h in hash_list:
+            if (b"xShardDownloaded_" + h) in self.raw_db:
+                self.raw_db.remove(b"xShard_" + h)
+                self.raw_db.remove(b"xShardDownloaded_" + h)
+                discarded_list.append(h)
+        return discarded_list
 
     def get_minor_block_xshard_tx_list(self, h) -> CrossShardTransactionList:
-        key = b"xShard_" + h
-        if key not in self.db:
+        data = self.db.get(b"xShard_" + h, None)
+        if data is None and self.root_freezer is not None:
+            data = self.__get_frozen_xshard_tx_list(h)
+        if data is None:
             return None
-        return CrossShardTransactionList.deserialize(self.db.get(key))
+        return CrossShardTransactionList.deserialize(data)
+
+    def __get_frozen_xshard_tx_list(self, h):
+        height = self.root_freezer.get_height(h)
+        if height is None:
+            return None
+        data = self.root_freezer.get("xshard_hashes", height)
+        hash_list = [data[i : i + 32] for i in range(0, len(data), 32)]
+        data_list = rlp.decode(self.root_freezer.get("xshard_lists", height))
+        return data_list[hash_list.index(h)]
 
     def contain_remote_minor_block_hash(self, h):
+        """ The lists frozen are not searched for, they are final and only served
+        to the peers through get_minor_block_xshard_tx_list()
+        """
         key = b"xShard_" + h
         return key in self.db
 
+    # ------------------------------- Freezer operations --------------------------------
+    def freeze_blocks(self, minor_height, root_header) -> int:
+        """ Moves the minor blocks of the best chain below minor_height to the
+        freezer, deleting the forks at their heights, and the root blocks of the best
+        chain up to root_header with the cross-shard tx lists they confirm.
+        Returns the number of blocks frozen.
+        """
+        if self.minor_freezer is None:
+            return 0
+        batch = WriteBatch()
+        count = 0
+        for height in range(self.minor_freezer.frozen, minor_height):
+            block_hash = self.db.get(b"mi_%d" % height)
+            if block_hash is None:
+                break
+            self.minor_freezer.append(
+                height,
+                block_hash,
+                {
+                    name: self.db.get(prefix + block_hash, b"")
+                    for name, prefix in MINOR_BLOCK_TABLES.items()
+                },
+            )
+            batch.delete(b"mi_%d" % height)
+            self.minor_freezer.put_height(batch, block_hash, height)
+            # with the forks, no block is left at the height
+            hash_set = self.height_to_minor_block_hashes.pop(height, set())
+            for h in hash_set | {block_hash}:
+                for prefix in MINOR_BLOCK_TABLES.values():
+                    batch.delete(prefix + h)
+                if h != block_hash:
+                    self.m_header_pool.pop(h, None)
+                    self.m_meta_pool.pop(h, None)
+            count += 1
+
+        root_list = []
+        if root_header is not None:
+            r_hash, height = root_header.get_hash(), root_header.height
+            while height >= self.root_freezer.frozen:
+                data = self.db.get(b"rblock_" + r_hash)
+                block = RootBlock.deserialize(data)
+                root_list.append((r_hash, data, block))
+                r_hash, height = block.header.hash_prev_block, height - 1
+        for r_hash, data, block in reversed(root_list):
+            hash_list, xshard_list = [], []
+            for m_header in block.minor_block_header_list:
+                h = m_header.get_hash()
+                # only the lists of the neighbors are stored
+                xshard_data = self.db.get(b"xShard_" + h, None)
+                if xshard_data is not None:
+                    hash_list.append(h)
+                    xshard_list.append(xshard_data)
+                    self.root_freezer.put_height(batch, h, block.header.height)
+                    batch.delete(b"xShard_" + h)
+                    batch.delete(b"xShardDownloaded_" + h)
+            self.root_freezer.append(
+                block.header.height,
+                r_hash,
+                {
+                    "blocks": data,
+                    "xshard_hashes": b"".join(hash_list),
+                    "xshard_lists": rlp.encode(xshard_list),
+                },
+            )
+            batch.delete(b"rblock_" + r_hash)
+            self.root_freezer.put_height(batch, r_hash, block.header.height)
+            count += 1
+
+        # the entries are only deleted once in the freezer
+        self.minor_freezer.sync()
+        self.root_freezer.sync()
+        self.db.write(batch)
+        return count
+
     # ------------------------- Common operations -----------------------------------------
+    @contextmanager
+    def write_batch(self):
+        """ Buffer all the writes made through the operator (and through the yielded db) and apply
+        them to the underlying db in one atomic batch when the context exits without error.
+        Writes are discarded if an exception is raised.
+        Note that the in-memory pools are updated immediately, and the minor blocks put
+        are removed from them if the batch is discarded, as are the trie nodes from the
+        node cache.
+        """
+        self.db = OverlayDb(self.raw_db)
+        self.batch_block_list = []
+        try:
+            yield self.db
+            self.db.commit()
+        except Exception:
+            # blocks put in the discarded batch must not be served from cache
+            self.m_block_cache.clear()
+            self.r_block_cache.clear()
+            # neither the trie nodes, which are cached once written to the batch
+            for key in self.db.overlay:
+                trie.node_cache.pop(key, None)
+            for header in self.batch_block_list:
+                self.__remove_minor_block_from_pools(header)
+            raise
+        finally:
+            self.db = self.raw_db
+            self.batch_block_list = None
+
+    def __remove_minor_block_from_pools(self, header):
+        h = header.get_hash()
+        self.m_header_pool.pop(h, None)
+        self.m_meta_pool.pop(h, None)
+        hash_set = self.height_to_minor_block_hashes.get(header.height, set())
+        hash_set.discard(h)
+        if not hash_set:
+            self.height_to_minor_block_hashes.pop(header.height, None)
+
     def put(self, key, value):
         self.db.put(key, value)
 
@@ -5,13 +5,17 @@ from collections import defaultdict
 from fractions import Fraction
 from typing import Optional, Tuple, List, Union, Dict
 
+from quarkchain.cluster.block_validation import validate_block_stateless
 from quarkchain.cluster.filter import Filter
-from quarkchain.cluster.miner import validate_seal
+from quarkchain.cluster.freezer import FREEZE_INTERVAL
 from quarkchain.cluster.neighbor import is_neighbor
+from quarkchain.cluster import parallel_execution
+from quarkchain.cluster.parallel_execution import ParallelTxExecutor
 from quarkchain.cluster.rpc import ShardStats, TransactionDetail
 from quarkchain.cluster.shard_db_operator import ShardDbOperator
+from quarkchain.cluster.state_pruning import PRUNE_BLOCKS_PER_PASS, StatePruner
+from quarkchain.cluster.state_sync import StateSyncTracker
 from quarkchain.core import (
-    calculate_merkle_root,
     Address,
     Branch,
     Code,
@@ -29,11 +33,14 @@ from quarkchain.core import (
     TransactionReceipt,
 )
 from quarkchain.diff import EthDifficultyCalculator
-from quarkchain.evm import opcodes
+from quarkchain.evm import opcodes, trie
+from quarkchain.evm.exceptions import InvalidTransaction
+from quarkchain.evm.flat_state import FlatState
 from quarkchain.evm.messages import apply_transaction, validate_transaction
 from quarkchain.evm.state import State as EvmState
 from quarkchain.evm.transaction_queue import TransactionQueue
-from quarkchain.evm.transactions import Transaction as EvmTransaction
+from quarkchain.evm.transactions import Transaction as EvmTransaction, sender_cache
+from quarkchain.evm.vm import code_cache
 from quarkchain.genesis import GenesisManager
 from quarkchain.reward import ConstMinorBlockRewardCalcultor
 from quarkchain.utils import Logger, check, time_ms
@@ -58,7 +65,9 @@ class ShardState:
     - reshard by split
     """
 
-    def __init__(self, env, full_shard_id: int, db=None, diff_calc=None):
+    def __init__(
+        self, env, full_shard_id: int, db=None, diff_calc=None, freezer_path=None
+    ):
         self.env = env
         self.full_shard_id = full_shard_id
         if not diff_calc:
@@ -74,9 +83,32 @@ class ShardState:
         self.reward_calc = ConstMinorBlockRewardCalcultor(env)
         self.raw_db = db if db is not None else env.db
         self.branch = Branch(full_shard_id)
-        self.db = ShardDbOperator(self.raw_db, self.env, self.branch)
-        self.tx_queue = TransactionQueue()  # queue of EvmTransaction
+        # the final blocks are moved to the files of freezer_path, see freezer.py
+        self.db = ShardDbOperator(self.raw_db, self.env, self.branch, freezer_path)
+        self.flat_state = (
+            FlatState(self.raw_db) if env.cluster_config.ENABLE_FLAT_STATE else None
+        )
+        # set while blocks are imported without running them and the state of the
+        # tip is downloaded, see state_sync.py
+        self.state_sync_tracker = StateSyncTracker.load(self.raw_db)
+        # deletes the states of all but the recent blocks, see state_pruning.py.  The
+        # states kept cover the forks accepted by add_block().
+        num_blocks = env.cluster_config.STATE_PRUNING_BLOCKS
+        shard_config = env.quark_chain_config.shards[full_shard_id]
+        self.state_pruner = (
+            StatePruner(
+                self.raw_db,
+                max(num_blocks, shard_config.max_stale_minor_block_height_diff),
+            )
+            if num_blocks > 0
+            else None
+        )
+        self.tx_queue = TransactionQueue(
+            limit=env.quark_chain_config.TRANSACTION_QUEUE_SIZE_LIMIT_PER_SHARD
+        )  # queue of EvmTransaction
         self.tx_dict = dict()  # hash -> Transaction for explorer
+        num_workers = env.cluster_config.PARALLEL_TX_EXECUTION_WORKERS
+        self.tx_executor = ParallelTxExecutor(num_workers) if num_workers > 0 else None
         self.initialized = False
         # TODO: make the oracle configurable
         self.gas_price_suggestion_oracle = GasPriceSuggestionOracle(
@@ -134,7 +166,10 @@ class ShardState:
         self.meta_tip = self.db.get_minor_block_meta_by_hash(self.header_tip.get_hash())
         self.confirmed_header_tip = self.header_tip
         self.evm_state = self.__create_evm_state()
-        self.evm_state.trie.root_hash = self.meta_tip.hash_evm_state_root
+        # the state of the tip is still being downloaded, it is set once complete
+        if self.state_sync_tracker is None:
+            self.evm_state.trie.root_hash = self.meta_tip.hash_evm_state_root
+            self.__init_flat_state()
         check(
             self.db.get_minor_block_evm_root_hash_by_hash(self.header_tip.get_hash())
             == self.meta_tip.hash_evm_state_root
@@ -145,10 +180,26 @@ class ShardState:
             add_tx_back_to_queue=False,
         )
 
-    def __create_evm_state(self):
-        return EvmState(
-            env=self.env.evm_env, db=self.raw_db, qkc_config=self.env.quark_chain_config
+    def __create_evm_state(self, db=None):
+        state = EvmState(
+            env=self.env.evm_env,
+            db=self.raw_db if db is None else db,
+            qkc_config=self.env.quark_chain_config,
+        )
+        state.flat_state = self.flat_state
+        return state
+
+    def __init_flat_state(self):
+        """ The in-memory diff layers are lost on restart so the flat state on disk
+        usually lags behind the tip and has to be regenerated.
+        """
+        root = self.evm_state.trie.root_hash
+        if self.flat_state is None or self.flat_state.has_root(root):
+            return
+        Logger.info(
+            "[{}] Rebuilding flat state at {}".format(self.full_shard_id, root.hex())
         )
+        self.flat_state.rebuild(root)
 
     def init_genesis_state(self, root_block):
         """ root_block should have the same height as configured in shard GENESIS.
@@ -177,6 +228,7 @@ class ShardState:
 
         self.evm_state = self.__create_evm_state()
         self.evm_state.trie.root_hash = genesis_block.meta.hash_evm_state_root
+        self.__init_flat_state()
         self.root_tip = root_block.header
         # Tips that are confirmed by root
         self.confirmed_header_tip = None
@@ -196,9 +248,12 @@ class ShardState:
         return genesis_block
 
     def __validate_tx(
-        self, tx: Transaction, evm_state, from_address=None, gas=None
+        self, tx: Transaction, evm_state, from_address=None, gas=None, check_state=True
     ) -> EvmTransaction:
-        """from_address will be set for execute_tx"""
+        """from_address will be set for execute_tx
+        check_state=False leaves the checks against evm_state, i.e.
+        validate_transaction(), to the caller
+        """
         # UTXOs are not supported now
         if len(tx.in_list) != 0:
             raise RuntimeError("input list must be empty")
@@ -269,19 +324,13 @@ class ShardState:
             )
 
         # This will check signature, nonce, balance, gas limit
-        validate_transaction(evm_state, evm_tx)
+        if check_state:
+            validate_transaction(evm_state, evm_tx)
 
         # TODO: xshard gas limit check
         return evm_tx
 
     def add_tx(self, tx: Transaction):
-        if (
-            len(self.tx_queue)
-            > self.env.quark_chain_config.TRANSACTION_QUEUE_SIZE_LIMIT_PER_SHARD
-        ):
-            # exceeding tx queue size limit
-            return False
-
         tx_hash = tx.get_hash()
 
         if self.db.contain_transaction_hash(tx_hash):
@@ -294,15 +343,17 @@ class ShardState:
         evm_state.gas_used = 0
         try:
             evm_tx = self.__validate_tx(tx, evm_state)
-            self.tx_queue.add_transaction(evm_tx)
+            # may replace a tx of the same nonce or evict the cheapest ones
+            dropped = self.tx_queue.add_transaction(evm_tx)
             self.tx_dict[tx_hash] = tx
+            self.__remove_from_tx_dict(dropped)
             return True
         except Exception as e:
             Logger.warning_every_sec("Failed to add transaction: {}".format(e), 1)
             return False
 
-    def _get_evm_state_for_new_block(self, block, ephemeral=True):
-        state = self.__create_evm_state()
+    def _get_evm_state_for_new_block(self, block, ephemeral=True, db=None):
+        state = self.__create_evm_state(db)
         if ephemeral:
             state = state.ephemeral_clone()
         state.trie.root_hash = self.db.get_minor_block_evm_root_hash_by_hash(
@@ -426,8 +477,9 @@ class ShardState:
         else:
             return gas_limit
 
-    def __validate_block(self, block: MinorBlock):
+    def __validate_block(self, block: MinorBlock, stateless_validated=False):
         """ Validate a block before running evm transactions
+        stateless_validated skips the checks of validate_block_stateless()
         """
         height = block.header.height
         if height < 1:
@@ -476,11 +528,6 @@ class ShardState:
 
         self.__validate_gas_limit(block.header.evm_gas_limit, prev_header.evm_gas_limit)
 
-        # Make sure merkle tree is valid
-        merkle_hash = calculate_merkle_root(block.tx_list)
-        if merkle_hash != block.meta.hash_merkle_root:
-            raise ValueError("incorrect merkle root")
-
         # Check the first transaction of the block
         if not self.branch.is_in_branch(block.header.coinbase_address.full_shard_key):
             raise ValueError("coinbase output address must be in the shard")
@@ -527,11 +574,12 @@ class ShardState:
         ):
             raise ValueError("prev root blocks are not on the same chain")
 
-        # Check PoW if applicable
-        consensus_type = self.env.quark_chain_config.shards[
-            self.full_shard_id
-        ].CONSENSUS_TYPE
-        validate_seal(block.header, consensus_type)
+        # Check merkle root and PoW if applicable
+        if not stateless_validated:
+            consensus_type = self.env.quark_chain_config.shards[
+                self.full_shard_id
+            ].CONSENSUS_TYPE
+            validate_block_stateless(block, consensus_type)
 
     def run_block(
         self, block, evm_state=None, evm_tx_included=None, x_shard_receive_tx_list=None
@@ -560,12 +608,13 @@ class ShardState:
         )
 
         # TODO: check xshard tx limit is not exceeded (CRITICAL)
-        for idx, tx in enumerate(block.tx_list):
+        def run_tx(evm_state, idx):
+            tx = block.tx_list[idx]
             try:
-                evm_tx = self.__validate_tx(tx, evm_state)
-                evm_tx.set_quark_chain_config(self.env.quark_chain_config)
-                apply_transaction(evm_state, evm_tx, tx.get_hash())
-                evm_tx_included.append(evm_tx)
+                evm_tx = self.__validate_tx(tx, evm_state, check_state=False)
+                validated = validate_transaction(evm_state, evm_tx)
+                apply_transaction(evm_state, evm_tx, tx.get_hash(), validated)
+                return evm_tx
             except Exception as e:
                 Logger.debug_exception()
                 Logger.debug(
@@ -575,6 +624,31 @@ class ShardState:
                 )
                 raise e
 
+        evm_tx_list = None
+        if (
+            self.tx_executor is not None
+            and len(block.tx_list) >= parallel_execution.MIN_BLOCK_SIZE
+        ):
+            try:
+                evm_tx_list = [
+                    self.__validate_tx(tx, evm_state, check_state=False)
+                    for tx in block.tx_list
+                ]
+            except Exception:
+                # run in order to fail at the same tx
+                evm_tx_list = None
+        if evm_tx_list is None:
+            for idx in range(len(block.tx_list)):
+                evm_tx_included.append(run_tx(evm_state, idx))
+        else:
+            self.tx_executor.run(
+                evm_state,
+                evm_tx_list,
+                [tx.get_hash() for tx in block.tx_list],
+                run_tx,
+            )
+            evm_tx_included.extend(evm_tx_list)
+
         # Pay miner
         pure_coinbase_amount = self.get_coinbase_amount()
         evm_state.delta_balance(evm_state.block_coinbase, pure_coinbase_amount)
@@ -639,22 +713,35 @@ class ShardState:
             self.db.put_minor_block_index(block)
             self.__remove_transactions_from_block(block)
 
+    def __remove_from_tx_dict(self, evm_tx_list):
+        for evm_tx in evm_tx_list:
+            tx = Transaction(code=Code.create_evm_code(evm_tx))
+            self.tx_dict.pop(tx.get_hash(), None)
+
     def __add_transactions_from_block(self, block):
         for tx in block.tx_list:
+            try:
+                dropped = self.tx_queue.add_transaction(tx.code.get_evm_transaction())
+            except InvalidTransaction:
+                # a pending tx with the same nonce pays more
+                continue
             self.tx_dict[tx.get_hash()] = tx
-            self.tx_queue.add_transaction(tx.code.get_evm_transaction())
+            self.__remove_from_tx_dict(dropped)
 
     def __remove_transactions_from_block(self, block):
         evm_tx_list = []
         for tx in block.tx_list:
             self.tx_dict.pop(tx.get_hash(), None)
             evm_tx_list.append(tx.code.get_evm_transaction())
-        self.tx_queue = self.tx_queue.diff(evm_tx_list)
+        # pending txs with lower nonces than the included ones can't be included anymore
+        stale = self.tx_queue.remove_transactions(evm_tx_list)
+        self.__remove_from_tx_dict(stale)
 
-    def add_block(self, block, skip_if_too_old=True):
+    def add_block(self, block, skip_if_too_old=True, stateless_validated=False):
         """  Add a block to local db.  Perform validate and update tip accordingly
         Returns None if block is already added.
         Returns a list of CrossShardTransactionDeposit from block.
+        stateless_validated is set if validate_block_stateless() already passed.
         Raises on any error.
         """
         start_time = time.time()
@@ -684,87 +771,142 @@ class ShardState:
         if self.db.contain_minor_block_by_hash(block.header.get_hash()):
             return None
 
-        evm_tx_included = []
-        x_shard_receive_tx_list = []
-        # Throw exception if fail to run
-        self.__validate_block(block)
-        evm_state = self.run_block(
-            block,
-            evm_tx_included=evm_tx_included,
-            x_shard_receive_tx_list=x_shard_receive_tx_list,
-        )
-
-        # ------------------------ Validate ending result of the block --------------------
-        if block.meta.hash_evm_state_root != evm_state.trie.root_hash:
-            raise ValueError(
-                "State root mismatch: header %s computed %s"
-                % (block.meta.hash_evm_state_root.hex(), evm_state.trie.root_hash.hex())
+        # Block body, indexes and state trie nodes are committed in one atomic batch
+        with self.db.write_batch() as batch_db:
+            evm_tx_included = []
+            x_shard_receive_tx_list = []
+            # Throw exception if fail to run
+            self.__validate_block(block, stateless_validated)
+            evm_state = self._get_evm_state_for_new_block(
+                block, ephemeral=False, db=batch_db
             )
-
-        receipt_root = mk_receipt_sha(evm_state.receipts, evm_state.db)
-        if block.meta.hash_evm_receipt_root != receipt_root:
-            raise ValueError(
-                "Receipt root mismatch: header {} computed {}".format(
-                    block.meta.hash_evm_receipt_root.hex(), receipt_root.hex()
-                )
+            if self.state_pruner is not None:
+                evm_state.new_trie_nodes = []
+            evm_state = self.run_block(
+                block,
+                evm_state=evm_state,
+                evm_tx_included=evm_tx_included,
+                x_shard_receive_tx_list=x_shard_receive_tx_list,
             )
 
-        if evm_state.gas_used != block.meta.evm_gas_used:
-            raise ValueError(
-                "Gas used mismatch: header %d computed %d"
-                % (block.meta.evm_gas_used, evm_state.gas_used)
-            )
+            # ------------------------ Validate ending result of the block --------------------
+            if block.meta.hash_evm_state_root != evm_state.trie.root_hash:
+                # a cross-shard tx list downloaded from a peer may be wrong, the
+                # lists are downloaded again (see Shard.add_block())
+                self.db.discard_downloaded_xshard_tx_lists(
+                    [
+                        m_header.get_hash()
+                        for r_block in self.__get_root_blocks_since_prev_block(block)
+                        for m_header in r_block.minor_block_header_list
+                    ]
+                )
+                raise ValueError(
+                    "State root mismatch: header %s computed %s"
+                    % (
+                        block.meta.hash_evm_state_root.hex(),
+                        evm_state.trie.root_hash.hex(),
+                    )
+                )
 
-        if (
-            evm_state.xshard_receive_gas_used
-            != block.meta.evm_cross_shard_receive_gas_used
-        ):
-            raise ValueError(
-                "X-shard gas used mismatch: header %d computed %d"
-                % (
-                    block.meta.evm_cross_shard_receive_gas_used,
-                    evm_state.xshard_receive_gas_used,
+            receipt_root = mk_receipt_sha(evm_state.receipts)
+            if block.meta.hash_evm_receipt_root != receipt_root:
+                raise ValueError(
+                    "Receipt root mismatch: header {} computed {}".format(
+                        block.meta.hash_evm_receipt_root.hex(), receipt_root.hex()
+                    )
                 )
-            )
-        coinbase_amount = self.get_coinbase_amount() + evm_state.block_fee
-        if coinbase_amount != block.header.coinbase_amount:
-            raise ValueError("Coinbase reward incorrect")
 
-        if evm_state.bloom != block.header.bloom:
-            raise ValueError("Bloom mismatch")
+            if evm_state.gas_used != block.meta.evm_gas_used:
+                raise ValueError(
+                    "Gas used mismatch: header %d computed %d"
+                    % (block.meta.evm_gas_used, evm_state.gas_used)
+                )
 
-        self.db.put_minor_block(block, x_shard_receive_tx_list)
+            if (
+                evm_state.xshard_receive_gas_used
+                != block.meta.evm_cross_shard_receive_gas_used
+            ):
+                raise ValueError(
+                    "X-shard gas used mismatch: header %d computed %d"
+                    % (
+                        block.meta.evm_cross_shard_receive_gas_used,
+                        evm_state.xshard_receive_gas_used,
+                    )
+                )
+            coinbase_amount = self.get_coinbase_amount() + evm_state.block_fee
+            if coinbase_amount != block.header.coinbase_amount:
+                raise ValueError("Coinbase reward incorrect")
+
+            if evm_state.bloom != block.header.bloom:
+                raise ValueError("Bloom mismatch")
+
+            self.db.put_minor_block(block, x_shard_receive_tx_list)
+            self.db.put_receipts(block.header.get_hash(), evm_state.receipts)
+            if self.state_pruner is not None:
+                self.state_pruner.add_block(
+                    batch_db,
+                    block.header,
+                    evm_state.trie.root_hash,
+                    evm_state.new_trie_nodes,
+                )
 
-        # Update tip if a block is appended or a fork is longer (with the same ancestor confirmed by root block tip)
-        # or they are equal length but the root height confirmed by the block is longer
-        update_tip = False
-        if not self.__is_same_root_chain(
-            self.root_tip,
-            self.db.get_root_block_header_by_hash(block.header.hash_prev_root_block),
-        ):
-            # Don't update tip if the block depends on a root block that is not root_tip or root_tip's ancestor
+            # Update tip if a block is appended or a fork is longer (with the same ancestor confirmed by root block tip)
+            # or they are equal length but the root height confirmed by the block is longer
             update_tip = False
-        elif block.header.hash_prev_minor_block == self.header_tip.get_hash():
-            update_tip = True
-        elif self.__is_minor_block_linked_to_root_tip(block):
-            if block.header.height > self.header_tip.height:
+            if not self.__is_same_root_chain(
+                self.root_tip,
+                self.db.get_root_block_header_by_hash(
+                    block.header.hash_prev_root_block
+                ),
+            ):
+                # Don't update tip if the block depends on a root block that is not root_tip or root_tip's ancestor
+                update_tip = False
+            elif block.header.hash_prev_minor_block == self.header_tip.get_hash():
                 update_tip = True
-            elif block.header.height == self.header_tip.height:
-                update_tip = (
-                    self.db.get_root_block_header_by_hash(
-                        block.header.hash_prev_root_block
-                    ).height
-                    > self.db.get_root_block_header_by_hash(
-                        self.header_tip.hash_prev_root_block
-                    ).height
-                )
+            elif self.__is_minor_block_linked_to_root_tip(block):
+                if block.header.height > self.header_tip.height:
+                    update_tip = True
+                elif block.header.height == self.header_tip.height:
+                    update_tip = (
+                        self.db.get_root_block_header_by_hash(
+                            block.header.hash_prev_root_block
+                        ).height
+                        > self.db.get_root_block_header_by_hash(
+                            self.header_tip.hash_prev_root_block
+                        ).height
+                    )
+
+            if update_tip:
+                self.__rewrite_block_index_to(block)
 
+        # only once the batch is committed
         if update_tip:
-            self.__rewrite_block_index_to(block)
+            # out of the batch, which is no longer written to
+            evm_state.set_db(self.raw_db)
             self.evm_state = evm_state
             self.header_tip = block.header
             self.meta_tip = block.meta
 
+        if self.flat_state is not None:
+            self.flat_state.add_layer(evm_state.get_flat_diff())
+            # the layer is shared now, later commits start a new diff
+            evm_state.flat_diff = None
+            if update_tip:
+                self.flat_state.cap(evm_state.trie.root_hash)
+        if (
+            self.state_pruner is not None
+            and self.state_pruner.due
+            and not self.state_pruner.pending
+        ):
+            # in the background of the block import
+            asyncio.get_event_loop().call_soon(self.prune_state)
+        if (
+            self.db.minor_freezer is not None
+            and update_tip
+            and self.header_tip.height % FREEZE_INTERVAL == 0
+        ):
+            asyncio.get_event_loop().call_soon(self.freeze_blocks)
+
         check(
             self.__is_same_root_chain(
                 self.root_tip,
@@ -774,8 +916,13 @@ class ShardState:
             )
         )
         Logger.debug(
-            "Add block took {} seconds for {} tx".format(
-                time.time() - start_time, len(block.tx_list)
+            "Add block took {} seconds for {} tx, wrote {} trie nodes ({} bytes), trie node cache hits {} misses {}".format(
+                time.time() - start_time,
+                len(block.tx_list),
+                evm_state.trie_nodes_written,
+                evm_state.trie_bytes_written,
+                trie.node_cache.hits,
+                trie.node_cache.misses,
             )
         )
         tracking_data_str = block.tracking_data.decode("utf-8")
@@ -803,6 +950,102 @@ class ShardState:
             )
         return evm_state.xshard_list
 
+    def import_block(self, block, stateless_validated=False):
+        """ Add a block to local db without running it, for a sync downloading the
+        state of a later block (see state_sync.py).  The tip is not updated, and
+        the receipts and the cross-shard deposits received by the block are not
+        stored: get_transaction_receipt() returns None for its txs.
+        Returns False if block is already added.
+        Raises on any error.
+        """
+        if self.db.contain_minor_block_by_hash(block.header.get_hash()):
+            return False
+        self.__validate_block(block, stateless_validated)
+        if self.state_sync_tracker is None:
+            if self.state_pruner is not None:
+                # the nodes downloaded are not tracked and may reference the
+                # tracked ones
+                self.state_pruner.reset()
+            self.state_sync_tracker = StateSyncTracker(self.raw_db)
+            self.state_sync_tracker.save()
+        with self.db.write_batch():
+            self.db.put_minor_block(block, [])
+            self.db.put_no_receipts(block.header.get_hash())
+        return True
+
+    def finish_state_sync(self):
+        """ Called once the state of the tip is downloaded"""
+        check(self.state_sync_tracker is not None and self.state_sync_tracker.done)
+        self.evm_state = self.__create_evm_state()
+        self.evm_state.trie.root_hash = self.meta_tip.hash_evm_state_root
+        self.__init_flat_state()
+        self.state_sync_tracker.remove()
+        self.state_sync_tracker = None
+        Logger.info(
+            "[{}] Synced state of block {} {}".format(
+                self.full_shard_id,
+                self.header_tip.height,
+                self.header_tip.get_hash().hex(),
+            )
+        )
+
+    def prune_state(self):
+        """ Deletes the trie nodes of the states no longer kept, see state_pruning.py"""
+        if self.state_pruner is None or self.state_sync_tracker is not None:
+            return
+        # a root chain reorg may reset the tip to the last minor block confirmed by
+        # one of the recent root blocks
+        root_list = [self.meta_tip.hash_evm_state_root]
+        r_header = self.root_tip
+        root_config = self.env.quark_chain_config.ROOT
+        for _ in range(root_config.MAX_STALE_ROOT_BLOCK_HEIGHT_DIFF):
+            if r_header is None:
+                break
+            m_header = self.db.get_last_minor_block_in_root_block(r_header.get_hash())
+            if m_header is not None:
+                root_list.append(
+                    self.db.get_minor_block_evm_root_hash_by_hash(m_header.get_hash())
+                )
+            r_header = self.db.get_root_block_header_by_hash(r_header.hash_prev_block)
+        self.state_pruner.prune(
+            self.header_tip.height, root_list, PRUNE_BLOCKS_PER_PASS
+        )
+        if self.state_pruner.pending:
+            # the event loop runs between the passes
+            asyncio.get_event_loop().call_soon(self.prune_state)
+
+    def freeze_blocks(self):
+        """ Moves the blocks deep enough to be final out of the db, see freezer.py.
+        A minor block is final once confirmed by a root block that a root chain reorg
+        can't reset the tip past, and kept in db FREEZER_BLOCKS below the tip.
+        """
+        num_blocks = self.env.cluster_config.FREEZER_BLOCKS
+        shard_config = self.env.quark_chain_config.shards[self.full_shard_id]
+        r_header = self.root_tip
+        for _ in range(self.env.quark_chain_config.ROOT.max_root_blocks_in_memory):
+            r_header = self.db.get_root_block_header_by_hash(r_header.hash_prev_block)
+            if r_header is None:
+                return
+        m_header = self.db.get_last_minor_block_in_root_block(r_header.get_hash())
+        if m_header is None:
+            return
+        minor_height = min(
+            m_header.height + 1,
+            self.header_tip.height
+            - max(num_blocks, shard_config.max_minor_blocks_in_memory),
+        )
+        start_time = time.time()
+        # with the root blocks whose cross-shard txs are run by the final blocks
+        count = self.db.freeze_blocks(
+            minor_height,
+            self.db.get_root_block_header_by_hash(m_header.hash_prev_root_block),
+        )
+        Logger.debug(
+            "[{}] Froze {} blocks in {} seconds".format(
+                self.full_shard_id, count, time.time() - start_time
+            )
+        )
+
     def get_coinbase_amount(self) -> int:
         local_fee_rate = (
             1 - self.env.quark_chain_config.reward_tax_rate
@@ -818,7 +1061,10 @@ class ShardState:
         return self.db.get_minor_block_by_hash(self.header_tip.get_hash())
 
     def finalize_and_add_block(self, block):
-        evm_state = self.run_block(block)
+        # the trie nodes are written by add_block()
+        evm_state = self.run_block(
+            block, evm_state=self._get_evm_state_for_new_block(block)
+        )
         coinbase_amount = self.get_coinbase_amount() + evm_state.block_fee
         block.finalize(evm_state=evm_state, coinbase_amount=coinbase_amount)
         self.add_block(block)
@@ -869,9 +1115,12 @@ class ShardState:
         gas = evm_tx.startgas if evm_tx.startgas else state.gas_limit
 
         try:
-            evm_tx = self.__validate_tx(tx, state, from_address, gas)
+            evm_tx = self.__validate_tx(
+                tx, state, from_address, gas, check_state=False
+            )
+            validated = validate_transaction(state, evm_tx)
             success, output = apply_transaction(
-                state, evm_tx, tx_wrapper_hash=bytes(32)
+                state, evm_tx, tx_wrapper_hash=bytes(32), validated=validated
             )
             return output if success else None
         except Exception as e:
@@ -959,7 +1208,8 @@ class ShardState:
 
         while evm_state.gas_used < evm_state.gas_limit:
             evm_tx = self.tx_queue.pop_transaction(
-                max_gas=evm_state.gas_limit - evm_state.gas_used
+                max_gas=evm_state.gas_limit - evm_state.gas_used,
+                get_nonce=evm_state.get_nonce,
             )
             if evm_tx is None:  # tx_queue is exhausted
                 break
@@ -985,10 +1235,15 @@ class ShardState:
                 Logger.warning_every_sec(
                     "Failed to include transaction: {}".format(e), 1
                 )
-                tx = Transaction(code=Code.create_evm_code(evm_tx))
-                self.tx_dict.pop(tx.get_hash(), None)
+                self.__remove_from_tx_dict([evm_tx])
+                if evm_tx.nonce == evm_state.get_nonce(evm_tx.sender):
+                    # the sender's later txs would stay gapped, drop them too
+                    self.__remove_from_tx_dict(
+                        self.tx_queue.remove_later_transactions(evm_tx)
+                    )
 
         # We don't want to drop the transactions if the mined block failed to be appended
+        self.tx_queue.requeue_gapped()
         for evm_tx in poped_txs:
             self.tx_queue.add_transaction(evm_tx)
 
@@ -1074,15 +1329,70 @@ class ShardState:
     # ============================ Cross-shard transaction handling =============================
     #
     def add_cross_shard_tx_list_by_minor_block_hash(
-        self, h, tx_list: CrossShardTransactionList
+        self, h, tx_list: CrossShardTransactionList, downloaded=False
     ):
         """ Add a cross shard tx list from remote shard
         The list should be validated by remote shard, however,
         it is better to diagnose some bugs in peer shard if we could check
         - x-shard gas limit exceeded
         - it is a neighor of current shard following our routing rule
+        downloaded is set for the lists downloaded from the peers, they are discarded
+        if a block fails to run with them.
         """
-        self.db.put_minor_block_xshard_tx_list(h, tx_list)
+        self.db.put_minor_block_xshard_tx_list(h, tx_list, downloaded)
+
+    def get_missing_cross_shard_tx_list_hashes(self, root_block: RootBlock):
+        """ The hashes of the neighbor minor blocks confirmed by the root block whose
+        cross-shard tx lists are not in local db
+        """
+        hash_list = []
+        for m_header in root_block.minor_block_header_list:
+            if m_header.branch == self.branch:
+                continue
+            prev_root_header = self.db.get_root_block_header_by_hash(
+                m_header.hash_prev_root_block
+            )
+            if prev_root_header is None or (
+                prev_root_header.height
+                <= self.env.quark_chain_config.get_genesis_root_height(
+                    self.full_shard_id
+                )
+            ):
+                continue
+            if not self.__is_neighbor(m_header.branch, prev_root_header.height):
+                continue
+            if not self.db.contain_remote_minor_block_hash(m_header.get_hash()):
+                hash_list.append(m_header.get_hash())
+        return hash_list
+
+    def get_missing_cross_shard_tx_list_hashes_by_block(self, block: MinorBlock):
+        """ get_missing_cross_shard_tx_list_hashes() of the root blocks confirmed by
+        the block since its previous block
+        """
+        hash_list = []
+        for r_block in self.__get_root_blocks_since_prev_block(block):
+            hash_list.extend(self.get_missing_cross_shard_tx_list_hashes(r_block))
+        return hash_list
+
+    def __get_root_blocks_since_prev_block(self, block: MinorBlock):
+        prev_header = self.db.get_minor_block_header_by_hash(
+            block.header.hash_prev_minor_block
+        )
+        if prev_header is None:
+            return []
+        ancestor = self.db.get_root_block_header_by_hash(
+            prev_header.hash_prev_root_block
+        )
+        r_block = self.db.get_root_block_by_hash(block.header.hash_prev_root_block)
+        r_block_list = []
+        while (
+            ancestor is not None
+            and r_block is not None
+            and r_block.header.height > ancestor.height
+        ):
+            r_block_list.append(r_block)
+            r_block = self.db.get_root_block_by_hash(r_block.header.hash_prev_block)
+        return r_block_list
 
     def add_root_block(self, root_block: RootBlock):
         """ Add a root block.
@@ -1357,7 +1667,10 @@ class ShardState:
         block, index = self.db.get_transaction_by_hash(h)
         if not block:
             return None
-        receipt = block.get_receipt(self.evm_state.db, index)
+        receipts = self.db.get_receipts(block)
+        if receipts is None:
+            return None
+        receipt = block.get_receipt(receipts, index)
         if receipt.contract_address != Address.create_empty_account(0):
             address = receipt.contract_address
             check(
@@ -1372,7 +1685,7 @@ class ShardState:
 
         if start == bytes(1):  # get pending tx
             tx_list = []
-            for orderable_tx in self.tx_queue.txs + self.tx_queue.aside:
+            for orderable_tx in self.tx_queue:
                 tx = orderable_tx.tx
                 if Address(tx.sender, tx.from_full_shard_key) == address:
                     tx_list.append(
@@ -1420,6 +1733,13 @@ class ShardState:
             block_count60s=block_count,
             stale_block_count60s=stale_block_count,
             last_block_time=last_block_time,
+            block_cache_hits=self.db.m_block_cache.hits,
+            block_cache_misses=self.db.m_block_cache.misses,
+            # shared by the shards of the slave
+            sender_cache_hits=sender_cache.hits,
+            sender_cache_misses=sender_cache.misses,
+            code_cache_hits=code_cache.hits,
+            code_cache_misses=code_cache.misses,
         )
 
     def get_logs(
@@ -1460,9 +1780,12 @@ class ShardState:
             try:
                 evm_state = self.evm_state.ephemeral_clone()  # type: EvmState
                 evm_state.gas_used = 0
-                evm_tx = self.__validate_tx(tx, evm_state, from_address, gas=gas)
+                evm_tx = self.__validate_tx(
+                    tx, evm_state, from_address, gas=gas, check_state=False
+                )
+                validated = validate_transaction(evm_state, evm_tx)
                 success, _ = apply_transaction(
-                    evm_state, evm_tx, tx_wrapper_hash=bytes(32)
+                    evm_state, evm_tx, tx_wrapper_hash=bytes(32), validated=validated
                 )
                 return success
             except Exception:
@@ -1514,4 +1837,10 @@ class ShardState:
         if not block:
             Logger.error("Failed to get block at height {}".format(height))
             return None
+        state_root = self.db.get_minor_block_evm_root_hash_by_hash(
+            block.header.hash_prev_minor_block
+        )
+        if state_root != trie.BLANK_ROOT and state_root not in self.raw_db:
+            Logger.error("State at height {} is pruned".format(height))
+            return None
         return self._get_evm_state_for_new_block(block)
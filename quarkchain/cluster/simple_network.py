@@ -3,6 +3,7 @@ import asyncio
 import ipaddress
 import socket
 
+from quarkchain.cluster.header_sync import SKELETON_INTERVAL, SKELETON_SIZE
 from quarkchain.cluster.p2p_commands import CommandOp, OP_SERIALIZER_MAP
 from quarkchain.cluster.p2p_commands import (
     HelloCommand,
@@ -234,12 +235,40 @@ class Peer(P2PConnection):
             header = self.root_state.db.get_root_block_header_by_hash(
                 block_hash, consistency_check=False
             )
+            if header is None:
+                break
             header_list.append(header)
             if header.height == 0:
                 break
             block_hash = header.hash_prev_block
         return GetRootBlockHeaderListResponse(self.root_state.tip, header_list)
 
+    async def handle_get_root_block_header_list_with_skip_request(self, request):
+        # no more than a skeleton
+        if request.limit <= 0 or request.limit > SKELETON_SIZE + 1:
+            return self.close_with_error("Bad limit")
+        if request.skip >= SKELETON_INTERVAL:
+            return self.close_with_error("Bad skip")
+        # TODO: support tip direction
+        if request.direction != Direction.GENESIS:
+            return self.close_with_error("Bad direction")
+
+        header = self.root_state.db.get_root_block_header_by_hash(
+            request.block_hash, consistency_check=False
+        )
+        header_list = []
+        while header is not None and len(header_list) < request.limit:
+            header_list.append(header)
+            if header.height <= request.skip:
+                break
+            for i in range(request.skip + 1):
+                header = self.root_state.db.get_root_block_header_by_hash(
+                    header.hash_prev_block, consistency_check=False
+                )
+                if header is None:
+                    break
+        return GetRootBlockHeaderListResponse(self.root_state.tip, header_list)
+
     async def handle_get_root_block_list_request(self, request):
         r_block_list = []
         for h in request.root_block_hash_list:
@@ -283,6 +312,10 @@ OP_RPC_MAP = {
         CommandOp.GET_ROOT_BLOCK_HEADER_LIST_RESPONSE,
         Peer.handle_get_root_block_header_list_request,
     ),
+    CommandOp.GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_REQUEST: (
+        CommandOp.GET_ROOT_BLOCK_HEADER_LIST_WITH_SKIP_RESPONSE,
+        Peer.handle_get_root_block_header_list_with_skip_request,
+    ),
     CommandOp.GET_ROOT_BLOCK_LIST_REQUEST: (
         CommandOp.GET_ROOT_BLOCK_LIST_RESPONSE,
         Peer.handle_get_root_block_list_request,
@@ -44,6 +44,7 @@ from quarkchain.cluster.rpc import (
     AddTransactionResponse,
     CreateClusterPeerConnectionResponse,
     SyncMinorBlockListResponse,
+    SyncMinorBlockStateResponse,
     GetMinorBlockResponse,
     GetTransactionResponse,
     AccountBranchData,
@@ -64,6 +65,9 @@ from quarkchain.cluster.rpc import (
     GetTransactionReceiptResponse,
     SlaveInfo,
 )
+from quarkchain.cluster.sender_recovery import SenderRecoverer
+from quarkchain.cluster.block_validation import BlockValidator
+from quarkchain.cluster.header_sync import HeaderValidator
 from quarkchain.cluster.shard import Shard, PeerShardConnection
 from quarkchain.core import Branch, Transaction, Address, Log
 from quarkchain.core import (
@@ -424,9 +428,14 @@ class MasterConnection(ClusterConnection):
                 )
                 check(len(block_chain) == len(blocks_to_download))
 
-                add_block_success = await self.slave_server.add_block_list_for_sync(
-                    block_chain
-                )
+                if req.without_state:
+                    add_block_success = await shard.import_block_list_for_sync(
+                        block_chain
+                    )
+                else:
+                    add_block_success = await self.slave_server.add_block_list_for_sync(
+                        block_chain
+                    )
                 if not add_block_success:
                     raise RuntimeError(
                         "Failed to add minor blocks for syncing root block"
@@ -443,6 +452,19 @@ class MasterConnection(ClusterConnection):
             Logger.error_exception()
             return SyncMinorBlockListResponse(error_code=1)
 
+    async def handle_sync_minor_block_state_request(self, req):
+        try:
+            await asyncio.gather(
+                *[
+                    shard.sync_state(req.cluster_peer_id)
+                    for shard in self.shards.values()
+                ]
+            )
+        except Exception:
+            Logger.error_exception()
+            return SyncMinorBlockStateResponse(error_code=1)
+        return SyncMinorBlockStateResponse(error_code=0)
+
     async def handle_get_logs(self, req: GetLogRequest) -> GetLogResponse:
         res = self.slave_server.get_logs(
             req.addresses, req.topics, req.start_block, req.end_block, req.branch
@@ -599,6 +621,10 @@ MASTER_OP_RPC_MAP = {
         ClusterOp.SUBMIT_WORK_RESPONSE,
         MasterConnection.handle_submit_work,
     ),
+    ClusterOp.SYNC_MINOR_BLOCK_STATE_REQUEST: (
+        ClusterOp.SYNC_MINOR_BLOCK_STATE_RESPONSE,
+        MasterConnection.handle_sync_minor_block_state_request,
+    ),
 }
 
 
@@ -811,6 +837,16 @@ class SlaveServer:
         # the block that has been added locally but not have been fully propagated will have an entry here
         self.add_block_futures = dict()
 
+        self.sender_recoverer = SenderRecoverer(
+            env.cluster_config.TX_SENDER_RECOVERY_WORKERS
+        )
+        self.block_validator = BlockValidator(
+            env.cluster_config.BLOCK_VALIDATION_WORKERS
+        )
+        self.header_validator = HeaderValidator(
+            env.cluster_config.HEADER_VALIDATION_WORKERS
+        )
+
     def __cover_shard_id(self, full_shard_id):
         """ Does the shard belong to this slave? """
         for chain_mask in self.chain_mask_list:
@@ -897,6 +933,12 @@ class SlaveServer:
 
         self.slave_connection_manager.close_all()
         self.server.close()
+        self.sender_recoverer.shutdown()
+        self.block_validator.shutdown()
+        self.header_validator.shutdown()
+        for shard in self.shards.values():
+            if shard.state.tx_executor is not None:
+                shard.state.tx_executor.shutdown()
 
     def get_shutdown_future(self):
         return self.shutdown_future
@@ -0,0 +1,214 @@
+""" Pruning of the trie nodes of the states no longer needed.
+
+With pruning enabled, a shard only keeps the states of its last blocks and of the
+minor blocks confirmed by the recent root blocks, which a root chain reorg may
+reset the tip to.  The trie nodes first written to the db while pruning is enabled
+are tracked by reference counting: the count of a node is the number of
+references to it from the other tracked nodes, the storage root of an account
+being referenced by the leaf of the account.  The counts of the children of the
+nodes written by a block are incremented in the batch of the block, so identical
+subtrees shared by several tries are counted once per reference.
+
+Each block also records its state root and the nodes it wrote first.  Once the
+block leaves the window of states kept, the nodes of the record that nothing
+references are deleted along with the children left unreferenced, which frees the
+nodes replaced by the block and the later blocks.  The nodes written before
+pruning was enabled (or downloaded by a state sync) are never deleted, neither
+are the code and the preimages of the keys.  A shard releases a few blocks per
+pass so that the event loop runs between the passes, the refcounts being updated
+by the block imports on the same loop.
+"""
+import time
+
+import rlp
+
+from quarkchain.db import OverlayDb, WriteBatch
+from quarkchain.evm import trie
+from quarkchain.evm.trie import BLANK_NODE, BLANK_ROOT, NIBBLE_TERMINATOR
+from quarkchain.evm.trie import unpack_to_nibbles
+from quarkchain.utils import Logger
+
+# blocks added between two pruning passes
+PRUNE_INTERVAL = 16
+# blocks whose nodes are released by a pass run on the event loop
+PRUNE_BLOCKS_PER_PASS = 4
+
+REFCOUNT_PREFIX = b"trie_rc_"
+# height + block hash + state root -> the hashes of the nodes first written
+JOURNAL_PREFIX = b"trie_journal_"
+
+
+def iter_node_refs(node):
+    """ The hashes of the nodes referenced by a decoded trie node, including the
+    storage roots of the accounts in its leaves
+    """
+    if node == BLANK_NODE:
+        return
+    if len(node) == 17:
+        # the keys of the secure tries have the same length, the value of a branch
+        # node is always blank
+        for item in node[:16]:
+            yield from _iter_refs(item)
+        return
+    nibbles = unpack_to_nibbles(node[0])
+    if not nibbles or nibbles[-1] != NIBBLE_TERMINATOR:
+        yield from _iter_refs(node[1])
+        return
+    # the values of the storage tries are integers, the accounts are lists
+    value = rlp.decode(node[1])
+    if isinstance(value, list) and value[2] != BLANK_ROOT:
+        yield value[2]
+
+
+def _iter_refs(ref):
+    if isinstance(ref, list):
+        # embedded in the parent node
+        yield from iter_node_refs(ref)
+    elif ref != BLANK_NODE:
+        yield ref
+
+
+def _get_count(db, node_hash):
+    """ None if the node is not tracked"""
+    data = db.get(REFCOUNT_PREFIX + node_hash)
+    return None if data is None else int.from_bytes(data, "big")
+
+
+class StatePruner:
+    def __init__(self, db, num_blocks):
+        """ Keeps the states of the last num_blocks blocks"""
+        self.db = db
+        self.num_blocks = num_blocks
+        self.block_count = 0
+        # nodes deleted
+        self.node_count = 0
+        # set if the last pass stopped before the end of the blocks to release
+        self.pending = False
+
+    def add_block(self, db, header, state_root, node_list):
+        """ Tracks the trie nodes first written by the block, (hash, rlp) pairs.
+        db is the batch of the block.
+        """
+        count_map = dict()
+
+        def get_count(node_hash):
+            if node_hash not in count_map:
+                count_map[node_hash] = _get_count(db, node_hash)
+            return count_map[node_hash]
+
+        for node_hash, _ in node_list:
+            if get_count(node_hash) is None:
+                count_map[node_hash] = 0
+        for _, rlpnode in node_list:
+            for ref in iter_node_refs(rlp.decode(rlpnode)):
+                count = get_count(ref)
+                # the nodes written before pruning was enabled are not tracked
+                if count is not None:
+                    count_map[ref] = count + 1
+        for node_hash, count in count_map.items():
+            if count is not None:
+                db.put(REFCOUNT_PREFIX + node_hash, count.to_bytes(4, "big"))
+        db.put(
+            JOURNAL_PREFIX
+            + header.height.to_bytes(8, "big")
+            + header.get_hash()
+            + state_root,
+            b"".join(node_hash for node_hash, _ in node_list),
+        )
+        self.block_count += 1
+
+    @property
+    def due(self):
+        """ Set once every PRUNE_INTERVAL blocks added"""
+        return self.block_count % PRUNE_INTERVAL == 0
+
+    def prune(self, tip_height, retained_root_list, max_block_count=None) -> int:
+        """ Deletes the nodes of the states of the blocks below the window of
+        num_blocks blocks up to tip_height, but the states of retained_root_list.
+        At most max_block_count blocks are released, pending is set if some are left.
+        Returns the number of nodes deleted.
+        """
+        start_time = time.time()
+        self.pending = False
+        min_height = tip_height - self.num_blocks + 1
+        if min_height <= 0:
+            return 0
+        journal_list = list(
+            self.db.range_iter(
+                JOURNAL_PREFIX, JOURNAL_PREFIX + min_height.to_bytes(8, "big")
+            )
+        )
+        # the states of the blocks in the window, on any fork
+        retained = set(retained_root_list)
+        for key, _ in self.db.range_iter(
+            JOURNAL_PREFIX + min_height.to_bytes(8, "big"),
+            JOURNAL_PREFIX + b"\xff" * 72,
+        ):
+            retained.add(key[-32:])
+
+        db = OverlayDb(self.db)
+        count_map = dict()
+        deleted = 0
+        block_count = 0
+        for key, data in journal_list:
+            state_root = key[-32:]
+            if state_root in retained:
+                # the state is kept, its nodes are released with the block it
+                # is retained for
+                continue
+            if block_count == max_block_count:
+                self.pending = True
+                break
+            block_count += 1
+            db.remove(key)
+            candidate_list = [state_root] + [
+                data[i : i + 32] for i in range(0, len(data), 32)
+            ]
+            for node_hash in candidate_list:
+                deleted += self.__delete(db, count_map, retained, node_hash)
+        for node_hash, count in count_map.items():
+            if count is not None:
+                db.put(REFCOUNT_PREFIX + node_hash, count.to_bytes(4, "big"))
+        db.commit()
+        self.node_count += deleted
+        Logger.debug(
+            "Pruned {} trie nodes below height {} in {} seconds".format(
+                deleted, min_height, time.time() - start_time
+            )
+        )
+        return deleted
+
+    def __delete(self, db, count_map, retained, node_hash) -> int:
+        """ Deletes the node if unreferenced, and its children left unreferenced"""
+        deleted = 0
+        stack = [node_hash]
+        while stack:
+            node_hash = stack.pop()
+            if node_hash not in count_map:
+                count_map[node_hash] = _get_count(db, node_hash)
+            if count_map[node_hash] != 0 or node_hash in retained:
+                continue
+            rlpnode = db.get(node_hash)
+            db.remove(node_hash)
+            db.remove(REFCOUNT_PREFIX + node_hash)
+            # the cache is shared by the tries of all the dbs
+            trie.node_cache.pop(node_hash, None)
+            count_map[node_hash] = None
+            deleted += 1
+            if rlpnode is None:
+                continue
+            for ref in iter_node_refs(rlp.decode(rlpnode)):
+                if ref not in count_map:
+                    count_map[ref] = _get_count(db, ref)
+                if count_map[ref]:
+                    count_map[ref] -= 1
+                    stack.append(ref)
+        return deleted
+
+    def reset(self):
+        """ Stops tracking the nodes in the db, which are then never deleted"""
+        batch = WriteBatch()
+        for prefix in (REFCOUNT_PREFIX, JOURNAL_PREFIX):
+            for key, _ in self.db.range_iter(prefix, prefix + b"\xff" * 72):
+                batch.delete(key)
+        self.db.write(batch)
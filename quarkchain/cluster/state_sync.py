@@ -0,0 +1,290 @@
+""" Download of the state of a minor block from peers.
+
+A shard far behind the tip imports the blocks confirmed by the root chain without
+running them, then downloads the state of the last one (the pivot) instead of
+replaying every block.  The state is walked down from meta.hash_evm_state_root: the
+trie nodes are requested by hash in batches from all the peers, and the data
+received is only stored if its hash is one requested, so a peer can't send
+anything that is not part of the state.  The children of the nodes stored, the
+storage tries and the code of the accounts, and the preimages of the keys (used by
+the flat state) are requested next.
+
+The hashes still to download are persisted with every batch stored, so a sync
+interrupted resumes where it stopped.  Nodes already in the db are not requested
+again, the subtree below them being in the db or pending too.
+"""
+import asyncio
+import time
+from typing import Callable, Optional
+
+import rlp
+
+from quarkchain.db import WriteBatch
+from quarkchain.evm.state import BLANK_HASH
+from quarkchain.evm.trie import (
+    BLANK_NODE,
+    BLANK_ROOT,
+    NIBBLE_TERMINATOR,
+    nibbles_to_bin,
+    unpack_to_nibbles,
+)
+from quarkchain.utils import Logger, sha3_256
+
+# hashes requested at once from a peer
+NODE_BATCH_SIZE = 384
+# requests kept in flight by each peer
+MAX_IN_FLIGHT_PER_PEER = 2
+
+# kinds of the data downloaded
+ACCOUNT_NODE = 0
+STORAGE_NODE = 1
+CODE = 2
+PREIMAGE = 3
+
+TRACKER_KEY = b"state_sync"
+
+
+class StateSyncTracker:
+    """ The hashes of the state still to download, persisted in the shard db.
+    Its presence in the db means the state of the shard tip is incomplete.
+    """
+
+    def __init__(self, db, block_hash=b"", pending=None):
+        self.db = db
+        # the block whose state is synced
+        self.block_hash = block_hash
+        # (hash, kind, path) to download, path being the nibbles of the node in its
+        # trie.  Taken from the end, so that the tries are walked depth first and
+        # the list stays short.
+        self.pending = pending if pending is not None else []
+        # hash -> entry of the hashes requested from the peers
+        self.requested = dict()
+        self.queued = {entry[0] for entry in self.pending}
+
+    @classmethod
+    def load(cls, db) -> Optional["StateSyncTracker"]:
+        data = db.get(TRACKER_KEY)
+        if data is None:
+            return None
+        block_hash, entry_list = rlp.decode(data)
+        return cls(
+            db,
+            block_hash,
+            [(node_hash, kind[0], path) for node_hash, kind, path in entry_list],
+        )
+
+    @property
+    def done(self):
+        return not self.pending and not self.requested
+
+    def start(self, block_hash, state_root):
+        """ Syncs the state of the block.  The hashes pending for another block are
+        kept, nodes already stored might lead to them.
+        """
+        self.block_hash = block_hash
+        if state_root != BLANK_ROOT:
+            self.__add(state_root, ACCOUNT_NODE, b"")
+        batch = WriteBatch()
+        batch.put(BLANK_HASH, b"")
+        self.__save(batch)
+
+    def save(self):
+        batch = WriteBatch()
+        self.__save(batch)
+
+    def remove(self):
+        self.db.remove(TRACKER_KEY)
+
+    def take(self, n):
+        """ Entries to request from a peer"""
+        entry_list = self.pending[-n:]
+        del self.pending[-n:]
+        for entry in entry_list:
+            self.queued.discard(entry[0])
+            self.requested[entry[0]] = entry
+        return entry_list
+
+    def put_nodes(self, entry_list, data_map) -> int:
+        """ Stores the data received for the entries taken, hash -> data, and queues
+        the children of the nodes.  The entries without data are queued again.
+        Returns the number of entries stored.
+        """
+        batch = WriteBatch()
+        stored = []
+        for entry in entry_list:
+            data = data_map.get(entry[0])
+            if data is None:
+                continue
+            batch.put(entry[0], data)
+            stored.append(entry)
+            self.__expand(entry, data)
+        for entry in entry_list:
+            del self.requested[entry[0]]
+        self.__requeue([entry for entry in entry_list if entry[0] not in data_map])
+        self.__save(batch)
+        return len(stored)
+
+    def release(self, entry_list):
+        """ Queues the entries taken again"""
+        for entry in entry_list:
+            del self.requested[entry[0]]
+        self.__requeue(entry_list)
+
+    def __requeue(self, entry_list):
+        for entry in entry_list:
+            if entry[0] not in self.queued:
+                self.pending.append(entry)
+                self.queued.add(entry[0])
+
+    def __save(self, batch):
+        entry_list = [
+            [node_hash, bytes([kind]), path]
+            for node_hash, kind, path in self.pending + list(self.requested.values())
+        ]
+        batch.put(TRACKER_KEY, rlp.encode([self.block_hash, entry_list]))
+        self.db.write(batch)
+
+    def __add(self, node_hash, kind, path):
+        if node_hash in self.queued or node_hash in self.requested:
+            return
+        if self.db.get(node_hash) is not None:
+            return
+        self.pending.append((node_hash, kind, path))
+        self.queued.add(node_hash)
+
+    def __expand(self, entry, data):
+        _, kind, path = entry
+        if kind in (ACCOUNT_NODE, STORAGE_NODE):
+            self.__expand_node(rlp.decode(data), kind, list(path))
+
+    def __expand_node(self, node, kind, path):
+        if node == BLANK_NODE:
+            return
+        if len(node) == 17:
+            # the keys of the secure tries have the same length, the value of a
+            # branch node is always blank
+            for i in range(16):
+                self.__add_ref(node[i], kind, path + [i])
+            return
+        nibbles = unpack_to_nibbles(node[0])
+        if nibbles and nibbles[-1] == NIBBLE_TERMINATOR:
+            self.__add_leaf(kind, path + nibbles[:-1], node[1])
+        else:
+            self.__add_ref(node[1], kind, path + nibbles)
+
+    def __add_ref(self, ref, kind, path):
+        if isinstance(ref, list):
+            # embedded in the parent node
+            self.__expand_node(ref, kind, path)
+        elif ref != BLANK_NODE:
+            self.__add(ref, kind, bytes(path))
+
+    def __add_leaf(self, kind, path, value):
+        self.__add(nibbles_to_bin(path), PREIMAGE, b"")
+        if kind != ACCOUNT_NODE:
+            return
+        account = rlp.decode(value)
+        storage_root, code_hash = account[2], account[3]
+        if storage_root != BLANK_ROOT:
+            self.__add(storage_root, STORAGE_NODE, b"")
+        if code_hash != BLANK_HASH:
+            self.__add(code_hash, CODE, b"")
+
+
+class StateSync:
+    def __init__(self, tracker, peer_list, download_nodes: Callable, timeout):
+        """ download_nodes(peer, hash_list) is a coroutine returning the data of
+        the hashes sent by peer, those it does not have being left out
+        """
+        self.tracker = tracker
+        self.peer_list = list(peer_list)
+        self.download_nodes = download_nodes
+        self.timeout = timeout
+        self.error = None
+        self.node_count = 0
+        self.condition = asyncio.Condition()
+
+    async def run(self):
+        """ Raises if no peer could send the state"""
+        start = time.time()
+        if not self.peer_list and not self.tracker.done:
+            raise RuntimeError("No peer to download the state from")
+        task_list = [
+            asyncio.ensure_future(self.__run(peer))
+            for peer in self.peer_list
+            for _ in range(MAX_IN_FLIGHT_PER_PEER)
+        ]
+        try:
+            async with self.condition:
+                await self.condition.wait_for(
+                    lambda: self.tracker.done or self.error is not None
+                )
+        finally:
+            for task in task_list:
+                task.cancel()
+            # the hashes in flight are requested again by the next sync
+            self.tracker.release(list(self.tracker.requested.values()))
+        if not self.tracker.done:
+            raise self.error
+        Logger.info(
+            "Synced {} state entries from {} peers in {:.2f} seconds".format(
+                self.node_count, len(self.peer_list), time.time() - start
+            )
+        )
+
+    async def __run(self, peer):
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(
+                    lambda: peer not in self.peer_list
+                    or self.tracker.pending
+                    or self.tracker.done
+                )
+                if peer not in self.peer_list or self.tracker.done:
+                    return
+                entry_list = self.tracker.take(NODE_BATCH_SIZE)
+
+            data_map, error = None, None
+            try:
+                data_list = await asyncio.wait_for(
+                    self.download_nodes(peer, [entry[0] for entry in entry_list]),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e)
+            else:
+                data_map = {sha3_256(data): data for data in data_list}
+                hash_set = {entry[0] for entry in entry_list}
+                if any(h not in hash_set for h in data_map):
+                    peer.close_with_error("Bad peer sending state not requested")
+                    error = "state not requested"
+
+            async with self.condition:
+                if error is None:
+                    stored = self.tracker.put_nodes(entry_list, data_map)
+                    self.node_count += stored
+                    if stored == 0:
+                        error = "missing state"
+                else:
+                    self.tracker.release(entry_list)
+                if error is not None:
+                    self.__drop_peer(peer, error)
+                self.condition.notify_all()
+
+    def __drop_peer(self, peer, error):
+        if peer not in self.peer_list:
+            return
+        self.peer_list.remove(peer)
+        Logger.info(
+            "Stop downloading the state from peer {} ({}), {} peers remaining".format(
+                peer, error, len(self.peer_list)
+            )
+        )
+        if not self.peer_list:
+            self.error = RuntimeError(
+                "No peer to download the state from ({})".format(error)
+            )
@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from quarkchain.cluster import block_download
+from quarkchain.cluster.block_download import BlockDownloader
+from quarkchain.core import MinorBlock, MinorBlockHeader, MinorBlockMeta
+
+
+class Peer:
+    def __init__(self, block_map):
+        self.block_map = block_map
+        self.requests = 0
+        self.error = None
+
+    def close_with_error(self, error):
+        self.error = error
+
+
+async def download_blocks(peer, header_list):
+    peer.requests += 1
+    await asyncio.sleep(0)
+    block_list = []
+    for header in header_list:
+        block = peer.block_map.get(header.get_hash())
+        if block is not None:
+            block_list.append(block)
+    return block_list
+
+
+def create_chain(n):
+    block_list = [
+        MinorBlock(MinorBlockHeader(height=i), MinorBlockMeta()) for i in range(n)
+    ]
+    return [b.header for b in block_list], {b.header.get_hash(): b for b in block_list}
+
+
+class TestBlockDownloader(unittest.TestCase):
+    def download(self, header_list, peer_list):
+        async def run():
+            downloader = BlockDownloader(header_list, peer_list, download_blocks, 1)
+            downloader.start()
+            try:
+                block_list = []
+                while True:
+                    chunk = await downloader.get_next()
+                    if chunk is None:
+                        return block_list
+                    block_list.extend(chunk)
+            finally:
+                downloader.close()
+
+        with mock.patch.object(block_download, "CHUNK_SIZE", 3):
+            return asyncio.get_event_loop().run_until_complete(run())
+
+    def test_download(self):
+        header_list, block_map = create_chain(20)
+        peer_list = [Peer(block_map) for _ in range(3)]
+        block_list = self.download(header_list, peer_list)
+        self.assertEqual([b.header for b in block_list], header_list)
+        for peer in peer_list:
+            self.assertGreater(peer.requests, 0)
+
+    def test_peer_missing_blocks(self):
+        header_list, block_map = create_chain(20)
+        lacking = Peer(dict(list(block_map.items())[:10]))
+        block_list = self.download(header_list, [lacking, Peer(block_map)])
+        self.assertEqual([b.header for b in block_list], header_list)
+        self.assertIsNone(lacking.error)
+
+    def test_bad_peer(self):
+        header_list, block_map = create_chain(20)
+        other_blocks = list(block_map.values())[::-1]
+        bad = Peer(dict(zip(block_map, other_blocks)))
+        block_list = self.download(header_list, [bad, Peer(block_map)])
+        self.assertEqual([b.header for b in block_list], header_list)
+        self.assertIsNotNone(bad.error)
+
+    def test_no_peer_with_blocks(self):
+        header_list, block_map = create_chain(20)
+        with self.assertRaises(RuntimeError):
+            self.download(header_list, [Peer(dict()), Peer(dict())])
@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+from quarkchain.cluster.block_validation import BlockValidator
+from quarkchain.cluster.tests.test_shard_state import create_default_shard_state
+from quarkchain.cluster.tests.test_utils import (
+    get_test_env,
+    create_transfer_transaction,
+)
+from quarkchain.config import ConsensusType
+from quarkchain.core import Address, Identity, MinorBlock
+
+
+def create_block():
+    identity = Identity.create_random_identity()
+    acc = Address.create_from_identity(identity, full_shard_key=0)
+    env = get_test_env(genesis_account=acc, genesis_minor_quarkash=10 ** 18)
+    state = create_default_shard_state(env=env)
+    tx = create_transfer_transaction(
+        shard_state=state,
+        key=identity.get_key(),
+        from_address=acc,
+        to_address=Address.create_random_account(full_shard_key=0),
+        value=1,
+    )
+    state.add_tx(tx)
+    block = state.create_block_to_mine()
+    # a fresh copy without the sender recovered at admission
+    return MinorBlock.deserialize(block.serialize()), acc
+
+
+class TestBlockValidator(unittest.TestCase):
+    def run_validate(self, num_workers, block):
+        validator = BlockValidator(num_workers)
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                validator.validate(block, ConsensusType.POW_SIMULATE)
+            )
+        finally:
+            validator.shutdown()
+
+    def test_validate(self):
+        for num_workers in [0, 2]:
+            block, acc = create_block()
+            self.run_validate(num_workers, block)
+            if num_workers:
+                self.assertEqual(block.tx_list[0].code.evm_sender, acc.recipient)
+
+    def test_incorrect_merkle_root(self):
+        for num_workers in [0, 2]:
+            block, _ = create_block()
+            block.meta.hash_merkle_root = bytes(32)
+            with self.assertRaisesRegex(ValueError, "incorrect merkle root"):
+                self.run_validate(num_workers, block)
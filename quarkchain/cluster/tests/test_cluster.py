@@ -1,4 +1,7 @@
 import unittest
+from unittest import mock
+
+from quarkchain.cluster import header_sync, master, state_sync
 from quarkchain.genesis import GenesisManager
 from quarkchain.cluster.tests.test_utils import (
     create_transfer_transaction,
@@ -485,6 +488,155 @@ class TestCluster(unittest.TestCase):
                 clusters[0].get_shard_state(0b10).header_tip,
             )
 
+    def test_shard_synchronizer_with_skeleton(self):
+        id1 = Identity.create_random_identity()
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+
+        with ClusterContext(2, acc1) as clusters, mock.patch.object(
+            header_sync, "SKELETON_INTERVAL", 4
+        ), mock.patch.object(header_sync, "SKELETON_SIZE", 2):
+            # shutdown cluster connection
+            clusters[1].peer.close()
+
+            block_list = []
+            shard_state0 = clusters[0].get_shard_state(0b10)
+            coinbase_amount = (
+                shard_state0.env.quark_chain_config.shards[
+                    shard_state0.full_shard_id
+                ].COINBASE_AMOUNT
+                // 2
+            )
+            for i in range(14):
+                if i == 13:
+                    # reestablish cluster connection, the new block will trigger
+                    # sync in cluster 1
+                    call_async(
+                        clusters[1].network.connect(
+                            "127.0.0.1",
+                            clusters[
+                                0
+                            ].master.env.cluster_config.SIMPLE_NETWORK.BOOTSTRAP_PORT,
+                        )
+                    )
+                block = shard_state0.get_tip().create_block_to_append()
+                evm_state = shard_state0.run_block(block)
+                block.finalize(
+                    evm_state=evm_state,
+                    coinbase_amount=evm_state.block_fee + coinbase_amount,
+                )
+                add_result = call_async(
+                    clusters[0].master.add_raw_minor_block(
+                        block.header.branch, block.serialize()
+                    )
+                )
+                self.assertTrue(add_result)
+                block_list.append(block)
+
+            for block in block_list:
+                assert_true_with_timeout(
+                    lambda: clusters[1]
+                    .get_shard_state(0b10)
+                    .contain_block_by_hash(block.header.get_hash())
+                )
+            self.assertEqual(
+                clusters[1].get_shard_state(0b10).header_tip,
+                clusters[0].get_shard_state(0b10).header_tip,
+            )
+
+    def test_root_chain_sync_with_state_sync(self):
+        id1 = Identity.create_random_identity()
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+        acc3 = Address.create_random_account(full_shard_key=1)
+
+        with ClusterContext(2, acc1) as clusters, mock.patch.object(
+            master, "STATE_SYNC_MIN_ROOT_BLOCKS", 3
+        ), mock.patch.object(master, "STATE_SYNC_PIVOT_DEPTH", 2), mock.patch.object(
+            state_sync, "NODE_BATCH_SIZE", 4
+        ):
+            # shutdown cluster connection
+            clusters[1].peer.close()
+            clusters[1].master.env.cluster_config.ENABLE_STATE_SYNC = True
+
+            master0 = clusters[0].master
+            is_root, root_block = call_async(
+                master0.get_next_block_to_mine(
+                    Address.create_empty_account(), prefer_root=True
+                )
+            )
+            call_async(master0.add_root_block(root_block))
+
+            block_list = []
+            for i in range(5):
+                if i == 3:
+                    # sent before the pivot root block, received after it
+                    tx = create_transfer_transaction(
+                        shard_state=clusters[0].get_shard_state(2 | 0),
+                        key=id1.get_key(),
+                        from_address=acc1,
+                        to_address=acc3,
+                        value=54321,
+                        gas=opcodes.GTXXSHARDCOST + opcodes.GTXCOST,
+                    )
+                    self.assertTrue(clusters[0].slave_list[0].add_tx(tx))
+                for full_shard_id in [2 | 0, 2 | 1]:
+                    block = (
+                        clusters[0]
+                        .get_shard_state(full_shard_id)
+                        .create_block_to_mine(
+                            address=acc1.address_in_shard(full_shard_id)
+                        )
+                    )
+                    self.assertTrue(
+                        call_async(
+                            master0.add_raw_minor_block(
+                                block.header.branch, block.serialize()
+                            )
+                        )
+                    )
+                    block_list.append(block)
+                is_root, root_block = call_async(
+                    master0.get_next_block_to_mine(acc1, prefer_root=True)
+                )
+                self.assertTrue(is_root)
+                call_async(master0.add_root_block(root_block))
+
+            # reestablish cluster connection to sync the root chain
+            call_async(
+                clusters[1].network.connect(
+                    "127.0.0.1",
+                    clusters[0].master.env.cluster_config.SIMPLE_NETWORK.BOOTSTRAP_PORT,
+                )
+            )
+            assert_true_with_timeout(
+                lambda: clusters[1].master.root_state.tip
+                == clusters[0].master.root_state.tip,
+                duration=10,
+            )
+
+            for full_shard_id in [2 | 0, 2 | 1]:
+                shard_state = clusters[1].get_shard_state(full_shard_id)
+                self.assertIsNone(shard_state.state_sync_tracker)
+                self.assertEqual(
+                    shard_state.header_tip,
+                    clusters[0].get_shard_state(full_shard_id).header_tip,
+                )
+            # the blocks up to the pivot were imported without running them
+            block_hash = block_list[0].header.get_hash()
+            shard_state = clusters[1].get_shard_state(2 | 0)
+            self.assertIsNone(shard_state.db.get(b"receipts_" + block_hash))
+            self.assertIsNone(shard_state.db.get_receipts(block_list[0]))
+            self.assertIsNotNone(shard_state.get_transaction_by_hash(tx.get_hash())[0])
+            self.assertIsNone(shard_state.get_transaction_receipt(tx.get_hash()))
+            for acc in [acc1, acc3]:
+                self.assertEqual(
+                    call_async(clusters[1].master.get_primary_account_data(acc)),
+                    call_async(master0.get_primary_account_data(acc)),
+                )
+            self.assertEqual(
+                call_async(clusters[1].master.get_primary_account_data(acc3)).balance,
+                54321,
+            )
+
     def test_shard_genesis_fork_fork(self):
         """ Test shard forks at genesis blocks due to root chain fork at GENESIS.ROOT_HEIGHT"""
         acc1 = Address.create_random_account(0)
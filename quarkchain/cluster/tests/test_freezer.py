@@ -0,0 +1,293 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from quarkchain.cluster.freezer import Freezer
+from quarkchain.cluster.root_state import RootState
+from quarkchain.cluster.shard_state import ShardState
+from quarkchain.cluster.tests.test_utils import get_test_env
+from quarkchain.core import CrossShardTransactionList
+from quarkchain.db import InMemoryDb, WriteBatch
+
+
+class TestFreezer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "freezer")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_freezer(self, start=0, db=None):
+        return Freezer(self.path, ["blocks"], start=start, db=db)
+
+    def test_append(self):
+        db = InMemoryDb()
+        freezer = self.create_freezer(start=3, db=db)
+        self.assertEqual(freezer.frozen, 3)
+        batch = WriteBatch()
+        for i in range(100):
+            block = b"" if i % 10 == 0 else bytes([i]) * i
+            freezer.append(i + 3, i.to_bytes(32, "big"), {"blocks": block})
+            freezer.put_height(batch, i.to_bytes(32, "big"), i + 3)
+            # readable at once
+            self.assertEqual(freezer.get("blocks", i + 3), block)
+        db.write(batch)
+        self.assertEqual(freezer.frozen, 103)
+        self.assertIsNone(freezer.get("blocks", 2))
+        self.assertIsNone(freezer.get("blocks", 103))
+        with self.assertRaises(AssertionError):
+            freezer.append(104, bytes(32), {"blocks": b""})
+
+        self.assertEqual(freezer.get_by_hash("blocks", (10).to_bytes(32, "big")), b"")
+        self.assertEqual(
+            freezer.get_by_hash("blocks", (7).to_bytes(32, "big")), bytes([7]) * 7
+        )
+        self.assertEqual(
+            freezer.get_by_hash("blocks", (7).to_bytes(32, "big"), 10), bytes([7]) * 7
+        )
+        # the height given doesn't match
+        self.assertIsNone(freezer.get_by_hash("blocks", (7).to_bytes(32, "big"), 11))
+        self.assertIsNone(freezer.get_by_hash("blocks", b"\xff" * 32))
+        freezer.close()
+
+        freezer = self.create_freezer(start=3)
+        self.assertEqual(freezer.frozen, 103)
+        # without the index
+        self.assertIsNone(freezer.get_by_hash("blocks", (7).to_bytes(32, "big")))
+        for i in range(100):
+            self.assertEqual(freezer.get("hashes", i + 3), i.to_bytes(32, "big"))
+        freezer.close()
+
+    def test_interrupted_append(self):
+        freezer = self.create_freezer()
+        for i in range(10):
+            freezer.append(i, bytes([i]) * 32, {"blocks": bytes([i]) * 100})
+        freezer.sync()
+        # the block is only in some of the tables
+        freezer.table_map["hashes"].append(bytes([10]) * 32)
+        freezer.close()
+        with open(os.path.join(self.path, "blocks.dat"), "ab") as f:
+            f.write(b"\x01" * 50)
+        with open(os.path.join(self.path, "blocks.idx"), "ab") as f:
+            f.write(b"\x01" * 3)
+
+        freezer = self.create_freezer()
+        self.assertEqual(freezer.frozen, 10)
+        freezer.append(10, bytes([10]) * 32, {"blocks": b"\x02"})
+        self.assertEqual(freezer.get("blocks", 9), bytes([9]) * 100)
+        self.assertEqual(freezer.get("blocks", 10), b"\x02")
+        freezer.close()
+
+    def test_index_ahead_of_data(self):
+        freezer = self.create_freezer()
+        for i in range(10):
+            freezer.append(i, bytes([i]) * 32, {"blocks": bytes([i]) * 100})
+        freezer.close()
+        # the last items and a zeroed index entry were written to the index only
+        data_path = os.path.join(self.path, "blocks.dat")
+        with open(data_path, "r+b") as f:
+            f.truncate(850)
+        with open(os.path.join(self.path, "blocks.idx"), "ab") as f:
+            f.write(bytes(8))
+
+        freezer = self.create_freezer()
+        self.assertEqual(freezer.frozen, 8)
+        # not extended
+        self.assertEqual(os.path.getsize(data_path), 800)
+        self.assertEqual(freezer.get("blocks", 7), bytes([7]) * 100)
+        freezer.append(8, bytes([8]) * 32, {"blocks": b"\x02"})
+        self.assertEqual(freezer.get("blocks", 8), b"\x02")
+        freezer.close()
+
+
+class TestFreezeBlocks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.env = get_test_env(chain_size=1, shard_size=2)
+        self.env.cluster_config.FREEZER_BLOCKS = 1
+        # 4 root blocks and 40 minor blocks kept in memory
+        self.env.quark_chain_config.ROOT.MAX_STALE_ROOT_BLOCK_HEIGHT_DIFF = 2
+        self.r_state = RootState(self.env, freezer_path=self.get_path("master"))
+        self.s_states = dict()
+        for full_shard_id in self.env.quark_chain_config.get_full_shard_ids():
+            self.s_states[full_shard_id] = ShardState(
+                self.env,
+                full_shard_id,
+                InMemoryDb(),
+                freezer_path=self.get_path("shard-{}".format(full_shard_id)),
+            )
+        self.block_list_map = {full_shard_id: [] for full_shard_id in self.s_states}
+        # the headers to confirm by the next root block
+        self.header_list = []
+        self.root_block_list = [self.r_state.get_tip_block()]
+        for full_shard_id, state in self.s_states.items():
+            state.init_genesis_state(self.root_block_list[0])
+            self.add_cross_shard_tx_list(full_shard_id, state.get_tip())
+
+    def tearDown(self):
+        for state in self.s_states.values():
+            state.tx_executor and state.tx_executor.shutdown()
+        self.tmp_dir.cleanup()
+
+    def get_path(self, name):
+        return os.path.join(self.tmp_dir.name, name + ".ancient")
+
+    def add_cross_shard_tx_list(self, full_shard_id, block):
+        self.block_list_map[full_shard_id].append(block)
+        self.header_list.append(block.header)
+        self.r_state.add_validated_minor_block_hash(block.header.get_hash())
+        if (
+            block.header.hash_prev_root_block
+            == self.root_block_list[0].header.get_hash()
+        ):
+            # no cross-shard tx before the first root block
+            return
+        for other_id, state in self.s_states.items():
+            if other_id != full_shard_id:
+                state.add_cross_shard_tx_list_by_minor_block_hash(
+                    block.header.get_hash(), CrossShardTransactionList(tx_list=[])
+                )
+
+    def add_blocks(self, num_root_blocks, blocks_per_root_block=5):
+        """ Minor blocks in every shard then a root block confirming them"""
+        for _ in range(num_root_blocks):
+            for full_shard_id, state in self.s_states.items():
+                for _ in range(blocks_per_root_block):
+                    block = state.create_block_to_mine(
+                        create_time=state.header_tip.create_time + 1
+                    )
+                    state.finalize_and_add_block(block)
+                    self.add_cross_shard_tx_list(full_shard_id, block)
+            root_block = self.r_state.tip.create_block_to_append(
+                create_time=max(h.create_time for h in self.header_list) + 1
+            )
+            root_block.minor_block_header_list = sorted(
+                self.header_list, key=lambda h: h.branch.get_full_shard_id()
+            )
+            self.header_list = []
+            root_block.finalize()
+            self.assertTrue(self.r_state.add_block(root_block))
+            self.root_block_list.append(root_block)
+            for state in self.s_states.values():
+                self.assertTrue(state.add_root_block(root_block))
+            # frozen in the background
+            asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+
+    def count_block_entries(self, db):
+        return sum(
+            1
+            for k in db.kv
+            if k.startswith((b"mblock_", b"rblock_", b"xShard_", b"tx_count_"))
+        )
+
+    def test_freeze_blocks(self):
+        self.add_blocks(12)
+        state = self.s_states[2 | 1]
+        block_list = self.block_list_map[2 | 1]
+        self.assertEqual(len(block_list), 61)
+        # a fork of the block 11
+        fork = block_list[10].create_block_to_append(
+            create_time=block_list[11].header.create_time + 1
+        )
+        evm_state = state.run_block(
+            fork, evm_state=state._get_evm_state_for_new_block(fork)
+        )
+        fork.finalize(
+            evm_state=evm_state,
+            coinbase_amount=state.get_coinbase_amount() + evm_state.block_fee,
+        )
+        state.add_block(fork, skip_if_too_old=False)
+        fork_hash = fork.header.get_hash()
+        self.assertEqual(state.db.get_block_count_by_height(11), 2)
+        # the root block 4 below the tip confirms the minor block 40, 40 minor
+        # blocks are kept below the tip
+        state.freeze_blocks()
+        self.assertEqual(state.db.minor_freezer.frozen, 20)
+        # up to the root block that the minor block 40 runs the cross-shard txs of
+        self.assertEqual(state.db.root_freezer.frozen, 8)
+        self.assertEqual(self.r_state.db.freezer.frozen, 8)
+        # the fork is deleted and the frozen heights are no longer indexed
+        self.assertFalse(state.db.contain_minor_block_by_hash(fork_hash))
+        self.assertNotIn(b"mblock_" + fork_hash, state.raw_db)
+        self.assertEqual(min(state.db.height_to_minor_block_hashes), 20)
+
+        entry_count = self.count_block_entries(state.raw_db)
+        root_entry_count = self.count_block_entries(self.env.db)
+        self.add_blocks(8)
+        state.freeze_blocks()
+        self.assertEqual(state.db.minor_freezer.frozen, 60)
+        # the db no longer grows with the chain
+        self.assertEqual(self.count_block_entries(state.raw_db), entry_count)
+        self.assertEqual(self.count_block_entries(self.env.db), root_entry_count)
+
+        block_list = self.block_list_map[2 | 1]
+        for block in block_list:
+            block_hash, height = block.header.get_hash(), block.header.height
+            state.db.m_block_cache.clear()
+            self.assertEqual((b"mblock_" + block_hash) in state.raw_db, height >= 60)
+            self.assertEqual((b"tx_count_" + block_hash) in state.raw_db, height >= 60)
+            self.assertEqual(state.db.get_minor_block_by_height(height), block)
+            self.assertEqual(state.db.get_minor_block_by_hash(block_hash), block)
+        # the blocks confirmed by the frozen root blocks, the ones of the first root
+        # block having no cross-shard tx list
+        for block in self.block_list_map[2 | 0][6:40]:
+            block_hash = block.header.get_hash()
+            self.assertNotIn(b"xShard_" + block_hash, state.raw_db)
+            self.assertFalse(state.contain_remote_minor_block_hash(block_hash))
+            self.assertEqual(
+                state.db.get_minor_block_xshard_tx_list(block_hash).tx_list, []
+            )
+        self.assertIsNone(state.db.get_minor_block_xshard_tx_list(bytes(32)))
+        for root_block in self.root_block_list:
+            block_hash = root_block.header.get_hash()
+            self.assertEqual(state.db.get_root_block_by_hash(block_hash), root_block)
+            self.assertEqual(
+                self.r_state.get_root_block_by_height(root_block.header.height),
+                root_block,
+            )
+            self.assertEqual(
+                self.r_state.db.get_root_block_by_hash(block_hash, False), root_block
+            )
+
+        # the chains still grow from the blocks kept
+        self.add_blocks(2)
+        self.assertEqual(state.header_tip, self.block_list_map[2 | 1][-1].header)
+
+    def test_recover(self):
+        self.add_blocks(12)
+        for state in self.s_states.values():
+            state.freeze_blocks()
+        state = self.s_states[2 | 1]
+        block_list = self.block_list_map[2 | 1]
+
+        r_state = RootState(self.env, freezer_path=self.get_path("master"))
+        self.assertEqual(r_state.tip, self.root_block_list[-2].header)
+        for root_block in self.root_block_list:
+            self.assertEqual(
+                r_state.get_root_block_by_height(root_block.header.height), root_block
+            )
+            self.assertEqual(
+                r_state.db.get_root_block_by_hash(root_block.header.get_hash(), False),
+                root_block,
+            )
+
+        recovered = ShardState(
+            self.env, 2 | 1, state.raw_db, freezer_path=self.get_path("shard-3")
+        )
+        recovered.init_from_root_block(self.root_block_list[-1])
+        self.assertEqual(recovered.header_tip, block_list[-1].header)
+        for block in block_list:
+            self.assertEqual(
+                recovered.db.get_minor_block_by_height(block.header.height), block
+            )
+            # searched for by hash
+            self.assertEqual(
+                recovered.db.get_minor_block_by_hash(block.header.get_hash(), False),
+                block,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
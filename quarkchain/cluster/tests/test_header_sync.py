@@ -0,0 +1,167 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from quarkchain.cluster import header_sync
+from quarkchain.cluster.header_sync import HeaderSync, HeaderSyncStats, HeaderValidator
+from quarkchain.config import ConsensusType
+from quarkchain.core import MinorBlockHeader
+
+
+class Peer:
+    def __init__(self, header_list):
+        self.header_map = {h.get_hash(): h for h in header_list}
+        self.skeleton_requests = 0
+        self.requests = 0
+        self.serve_headers = True
+        self.error = None
+
+    def close_with_error(self, error):
+        self.error = error
+
+
+async def download_skeleton(peer, block_hash, limit, skip):
+    peer.skeleton_requests += 1
+    header = peer.header_map.get(block_hash)
+    header_list = []
+    while header is not None and len(header_list) < limit:
+        header_list.append(header)
+        if header.height <= skip:
+            break
+        for _ in range(skip + 1):
+            header = peer.header_map[header.hash_prev_minor_block]
+    return header_list
+
+
+async def download_headers(peer, block_hash, limit):
+    peer.requests += 1
+    await asyncio.sleep(0)
+    header_list = []
+    header = peer.header_map.get(block_hash) if peer.serve_headers else None
+    while header is not None and len(header_list) < limit:
+        header_list.append(header)
+        header = peer.header_map.get(header.hash_prev_minor_block)
+    return header_list
+
+
+def create_chain(n, prev=None, nonce=0):
+    header_list = [prev] if prev else []
+    for i in range(n):
+        header_list.append(
+            MinorBlockHeader(
+                height=header_list[-1].height + 1 if header_list else 0,
+                hash_prev_minor_block=header_list[-1].get_hash()
+                if header_list
+                else bytes(32),
+                difficulty=1,
+                nonce=nonce,
+            )
+        )
+    return header_list[1:] if prev else header_list
+
+
+class TestHeaderSync(unittest.TestCase):
+    def sync(self, header_list, known_list, peer_list, min_height=0):
+        known = {h.get_hash() for h in known_list}
+        validated = []
+
+        async def validate_headers(header_list):
+            validated.extend(header_list)
+
+        stats = HeaderSyncStats()
+        sync = HeaderSync(
+            peer_list[0],
+            peer_list,
+            download_skeleton,
+            download_headers,
+            lambda h: h in known,
+            lambda header: header.hash_prev_minor_block,
+            validate_headers,
+            1,
+            stats=stats,
+        )
+        with mock.patch.object(header_sync, "SKELETON_INTERVAL", 8), mock.patch.object(
+            header_sync, "SKELETON_SIZE", 4
+        ):
+            result = asyncio.get_event_loop().run_until_complete(
+                sync.sync(header_list[-1], min_height)
+            )
+        if result is not None:
+            self.assertEqual(validated, result)
+            self.assertEqual(stats.header_count, len(result))
+        return result
+
+    def test_sync(self):
+        header_list = create_chain(100)
+        peer_list = [Peer(header_list) for _ in range(3)]
+        result = self.sync(header_list, header_list[:10], peer_list)
+        self.assertEqual(result, header_list[10:])
+        # the skeleton only comes from the first peer
+        self.assertGreater(peer_list[0].skeleton_requests, 1)
+        for peer in peer_list[1:]:
+            self.assertEqual(peer.skeleton_requests, 0)
+            self.assertGreater(peer.requests, 0)
+
+    def test_sync_from_genesis(self):
+        header_list = create_chain(30)
+        result = self.sync(header_list, header_list[:1], [Peer(header_list)])
+        self.assertEqual(result, header_list[1:])
+
+    def test_sync_fork(self):
+        header_list = create_chain(50)
+        fork_list = header_list[:21] + create_chain(40, prev=header_list[20], nonce=1)
+        result = self.sync(fork_list, header_list, [Peer(fork_list)])
+        self.assertEqual(result, fork_list[21:])
+        # forking below min_height
+        self.assertIsNone(self.sync(fork_list, header_list, [Peer(fork_list)], 30))
+
+    def test_peer_on_other_chain(self):
+        header_list = create_chain(100)
+        other = Peer(create_chain(100, nonce=1))
+        result = self.sync(header_list, header_list[:10], [Peer(header_list), other])
+        self.assertEqual(result, header_list[10:])
+        self.assertIsNone(other.error)
+
+    def test_bad_peer(self):
+        header_list = create_chain(100)
+        bad = Peer(header_list)
+        # headers other than the ones asked for
+        for block_hash, header in bad.header_map.items():
+            bad.header_map[block_hash] = MinorBlockHeader(
+                height=header.height,
+                hash_prev_minor_block=header.hash_prev_minor_block,
+                nonce=1,
+            )
+        peer_list = [Peer(header_list), bad]
+        result = self.sync(header_list, header_list[:10], peer_list)
+        self.assertEqual(result, header_list[10:])
+        self.assertIsNotNone(bad.error)
+
+    def test_no_peer_with_headers(self):
+        header_list = create_chain(100)
+        skeleton_only = Peer(header_list)
+        skeleton_only.serve_headers = False
+        with self.assertRaisesRegex(RuntimeError, "No peer"):
+            self.sync(header_list, header_list[:10], [skeleton_only, Peer([])])
+
+
+class TestHeaderValidator(unittest.TestCase):
+    def run_validate(self, num_workers, header_list):
+        validator = HeaderValidator(num_workers)
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                validator.validate(header_list, ConsensusType.POW_DOUBLESHA256)
+            )
+        finally:
+            validator.shutdown()
+
+    def test_validate(self):
+        for num_workers in [0, 2]:
+            self.run_validate(num_workers, create_chain(100))
+
+    def test_invalid_seal(self):
+        for num_workers in [0, 2]:
+            header_list = create_chain(100)
+            header_list[70].difficulty = 2 ** 255
+            with self.assertRaisesRegex(ValueError, "invalid pow proof"):
+                self.run_validate(num_workers, header_list)
@@ -36,13 +36,18 @@ class TestMiner(unittest.TestCase):
         async def create(retry=True):
             if len(self.added_blocks) >= 5:
                 return None  # stop the game
-            return RootBlock(
+            block = RootBlock(
                 RootBlockHeader(create_time=int(time.time())),
                 tracking_data="{}".encode("utf-8"),
             )
+            # memoized before the miner sets nonce and mixhash
+            block.header.get_hash()
+            return block
 
         async def add(block):
             nonlocal miner
+            header = RootBlockHeader.deserialize(block.header.serialize())
+            self.assertEqual(block.header.get_hash(), header.get_hash())
             self.added_blocks.append(block)
 
         for consensus in (
@@ -186,6 +191,7 @@ class TestMiner(unittest.TestCase):
         miner = self.miner_gen(ConsensusType.POW_DOUBLESHA256, create, add, remote=True)
 
         async def go():
+            unmined_hash = block.header.get_hash()
             work = await miner.get_work(now=now)
             self.assertEqual(work.height, 0)
             self.assertEqual(work.difficulty, 5)
@@ -206,6 +212,15 @@ class TestMiner(unittest.TestCase):
             self.assertEqual(miner.work_map, {})
             self.assertEqual(len(self.added_blocks), 1)
             self.assertIsNone(miner.current_work)
+            # the copy submitted has the hash of its nonce
+            header = self.added_blocks[0].header
+            self.assertEqual(header.nonce, sol)
+            self.assertNotEqual(header.get_hash(), unmined_hash)
+            self.assertEqual(
+                header.get_hash(),
+                RootBlockHeader.deserialize(header.serialize()).get_hash(),
+            )
+            self.assertEqual(block.header.get_hash(), unmined_hash)
 
         loop = asyncio.get_event_loop()
         loop.run_until_complete(go())
@@ -0,0 +1,120 @@
+import unittest
+from unittest import mock
+
+from quarkchain.cluster import parallel_execution
+from quarkchain.cluster.tests.test_shard_state import create_default_shard_state
+from quarkchain.cluster.tests.test_utils import (
+    get_test_env,
+    create_transfer_transaction,
+    create_contract_creation_with_event_transaction,
+    create_contract_with_storage_transaction,
+)
+from quarkchain.core import Identity, Address
+from quarkchain.evm.state import State
+
+
+def create_shard_state(id_list, num_workers):
+    acc_list = [Address.create_from_identity(i, full_shard_key=0) for i in id_list]
+    env = get_test_env(genesis_account=acc_list[0], genesis_minor_quarkash=10 ** 24)
+    for full_shard_id, shard in env.quark_chain_config.shards.items():
+        for acc in acc_list[1:]:
+            addr = acc.address_in_shard(full_shard_id).serialize().hex()
+            shard.GENESIS.ALLOC[addr] = 10 ** 24
+    env.cluster_config.PARALLEL_TX_EXECUTION_WORKERS = num_workers
+    return create_default_shard_state(env=env), acc_list
+
+
+class TestParallelExecution(unittest.TestCase):
+    def test_same_result_as_sequential(self):
+        id_list = [
+            Identity.create_random_identity()
+            for _ in range(parallel_execution.MIN_BLOCK_SIZE + 2)
+        ]
+        state, acc_list = create_shard_state(id_list, num_workers=0)
+        to = Address.create_random_account(full_shard_key=0)
+        tx_list = [
+            create_transfer_transaction(
+                shard_state=state,
+                key=identity.get_key(),
+                from_address=acc,
+                to_address=to,
+                value=1,
+            )
+            for identity, acc in zip(id_list[:-2], acc_list[:-2])
+        ]
+        # the second txs of senders conflict with their first ones
+        tx_list.append(
+            create_transfer_transaction(
+                shard_state=state,
+                key=id_list[0].get_key(),
+                from_address=acc_list[0],
+                to_address=acc_list[1],
+                value=10 ** 20,
+                nonce=1,
+            )
+        )
+        tx_list.append(
+            create_transfer_transaction(
+                shard_state=state,
+                key=id_list[1].get_key(),
+                from_address=acc_list[1],
+                to_address=to,
+                value=10 ** 18,
+                nonce=1,
+            )
+        )
+        for create_tx, i in [
+            (create_contract_creation_with_event_transaction, -2),
+            (create_contract_with_storage_transaction, -1),
+        ]:
+            tx_list.append(
+                create_tx(
+                    shard_state=state,
+                    key=id_list[i].get_key(),
+                    from_address=acc_list[i],
+                    to_full_shard_key=0,
+                )
+            )
+        # the tx queue doesn't take the txs with nonce 1
+        block = state.create_block_to_mine()
+        for tx in tx_list:
+            block.add_tx(tx)
+        state.finalize_and_add_block(block)
+        self.assertEqual(state.header_tip, block.header)
+
+        parallel_state, _ = create_shard_state(id_list, num_workers=2)
+        self.addCleanup(parallel_state.tx_executor.shutdown)
+        with mock.patch.object(
+            parallel_execution, "_commit", wraps=parallel_execution._commit
+        ) as commit:
+            parallel_state.add_block(block)
+        self.assertGreater(commit.call_count, 0)
+        self.assertLess(commit.call_count, len(tx_list))
+        # kept for the next blocks
+        for process, _ in parallel_state.tx_executor.worker_list:
+            self.assertTrue(process.is_alive())
+
+        self.assertEqual(parallel_state.header_tip, state.header_tip)
+        self.assertEqual(
+            parallel_state.evm_state.trie.root_hash, state.evm_state.trie.root_hash
+        )
+        for tx in block.tx_list:
+            self.assertEqual(
+                parallel_state.get_transaction_receipt(tx.get_hash()),
+                state.get_transaction_receipt(tx.get_hash()),
+            )
+
+    def test_access_recording_state(self):
+        state = State()
+        address = b"\x01" * 20
+        state.set_balance(address, 10)
+        view = parallel_execution.AccessRecordingState(state)
+        # read by State.transfer_value() running on the view
+        self.assertTrue(view.transfer_value(address, b"\x02" * 20, 3))
+        self.assertIn(address, view.reads)
+        self.assertEqual(view.written(), {address, b"\x02" * 20})
+        # the attributes are the state's
+        view.gas_used += 5
+        self.assertEqual(state.gas_used, 5)
+        self.assertIs(view.cache, state.cache)
+        self.assertFalse(hasattr(state, "reads"))
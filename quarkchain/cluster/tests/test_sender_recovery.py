@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+from quarkchain.cluster import sender_recovery
+from quarkchain.cluster.sender_recovery import SenderRecoverer
+from quarkchain.core import Code, Identity, Transaction
+from quarkchain.evm.transactions import Transaction as EvmTransaction, sender_cache
+
+
+def create_tx(identity, nonce):
+    evm_tx = EvmTransaction(
+        nonce=nonce,
+        gasprice=1,
+        startgas=21000,
+        to=bytes(20),
+        value=1,
+        data=b"",
+        from_full_shard_key=0,
+        to_full_shard_key=0,
+        network_id=1,
+    )
+    evm_tx.sign(key=identity.get_key())
+    return Transaction(code=Code.create_evm_code(evm_tx))
+
+
+class TestSenderRecoverer(unittest.TestCase):
+    def run_recover(self, num_workers, tx_list):
+        recoverer = SenderRecoverer(num_workers)
+        try:
+            asyncio.get_event_loop().run_until_complete(recoverer.recover(tx_list))
+        finally:
+            recoverer.shutdown()
+
+    def test_recover(self):
+        identity = Identity.create_random_identity()
+        tx_list = [create_tx(identity, i) for i in range(10)]
+        self.run_recover(0, tx_list)
+        for tx in tx_list:
+            self.assertEqual(tx.code.evm_sender, identity.get_recipient())
+            self.assertEqual(
+                tx.code.get_evm_transaction().sender, identity.get_recipient()
+            )
+
+    def test_recover_with_workers(self):
+        id1 = Identity.create_random_identity()
+        id2 = Identity.create_random_identity()
+        tx_list = [
+            create_tx(id1 if i % 2 else id2, i)
+            for i in range(sender_recovery.MIN_BATCH_SIZE)
+        ]
+        bad_tx = Transaction(code=Code(Code.OP_EVM + b"not rlp"))
+        tx_list.append(bad_tx)
+        self.run_recover(2, tx_list)
+        for i, tx in enumerate(tx_list[:-1]):
+            expected = id1 if i % 2 else id2
+            self.assertEqual(tx.code.evm_sender, expected.get_recipient())
+        self.assertIsNone(bad_tx.code.evm_sender)
+
+    def test_sender_cache(self):
+        identity = Identity.create_random_identity()
+        tx = create_tx(identity, 0)
+        sender_cache.clear()
+        misses = sender_cache.misses
+        self.assertEqual(tx.code.get_evm_transaction().sender, identity.get_recipient())
+        self.assertEqual(sender_cache.misses, misses + 1)
+        hits = sender_cache.hits
+        # a re-decoded tx finds its sender in the cache
+        self.assertEqual(tx.code.get_evm_transaction().sender, identity.get_recipient())
+        self.assertEqual(sender_cache.hits, hits + 1)
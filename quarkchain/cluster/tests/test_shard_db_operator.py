@@ -1,9 +1,19 @@
 import unittest
 
+import rlp
+
 from quarkchain.cluster.shard_db_operator import ShardDbOperator
-from quarkchain.core import Branch, MinorBlockHeader, MinorBlock, MinorBlockMeta
+from quarkchain.core import (
+    Branch,
+    MinorBlockHeader,
+    MinorBlock,
+    MinorBlockMeta,
+    mk_receipt_sha,
+)
 from quarkchain.db import InMemoryDb
 from quarkchain.env import DEFAULT_ENV
+from quarkchain.evm import trie
+from quarkchain.evm.messages import Receipt
 
 
 class TestShardDbOperator(unittest.TestCase):
@@ -17,3 +27,79 @@ class TestShardDbOperator(unittest.TestCase):
 
         self.assertEqual(db.get_minor_block_header_by_hash(block_hash), block.header)
         self.assertIsNone(db.get_minor_block_header_by_hash(b""))
+
+    def test_write_batch(self):
+        raw_db = InMemoryDb()
+        db = ShardDbOperator(raw_db, DEFAULT_ENV, Branch(2))
+        block = MinorBlock(MinorBlockHeader(), MinorBlockMeta())
+        block_hash = block.header.get_hash()
+        with db.write_batch() as batch_db:
+            db.put_minor_block(block, [])
+            db.put_minor_block_index(block)
+            batch_db.put(b"trie_node", b"value")
+            # reads inside the batch see the pending writes
+            self.assertEqual(db.get_minor_block_by_height(0), block)
+            self.assertNotIn(b"mblock_" + block_hash, raw_db)
+        self.assertEqual(raw_db.get(b"trie_node"), b"value")
+        self.assertEqual(db.get_minor_block_by_hash(block_hash), block)
+
+        # writes are dropped if the batch fails, with the blocks put in the pools
+        block1 = MinorBlock(MinorBlockHeader(height=1), MinorBlockMeta())
+        with self.assertRaises(ValueError):
+            with db.write_batch():
+                db.put(b"dropped", b"value")
+                db.put_minor_block(block1, [])
+                t = trie.Trie(db.db, write_back=True)
+                t.update(b"key", b"value" * 10)
+                t.flush()
+                root_hash = t.root_hash
+                # the nodes written are cached, they are read by the next blocks
+                self.assertIsNotNone(trie.node_cache.get(root_hash))
+                raise ValueError()
+        self.assertNotIn(root_hash, raw_db)
+        self.assertIsNone(trie.node_cache.get(root_hash))
+        self.assertNotIn(b"dropped", raw_db)
+        self.assertFalse(db.contain_minor_block_by_hash(block1.header.get_hash()))
+        self.assertIsNone(db.get_minor_block_by_hash(block1.header.get_hash()))
+        self.assertEqual(db.get_block_count_by_height(1), 0)
+        self.assertTrue(db.contain_minor_block_by_hash(block_hash))
+
+    def test_minor_block_cache(self):
+        db = ShardDbOperator(InMemoryDb(), DEFAULT_ENV, Branch(2))
+        block = MinorBlock(MinorBlockHeader(), MinorBlockMeta())
+        block_hash = block.header.get_hash()
+        db.put_minor_block(block, [])
+        db.m_block_cache.clear()
+
+        block1 = db.get_minor_block_by_hash(block_hash)
+        self.assertEqual(block1, block)
+        self.assertIs(db.get_minor_block_by_hash(block_hash), block1)
+        self.assertEqual(db.m_block_cache.misses, 1)
+        self.assertEqual(db.m_block_cache.hits, 1)
+
+    def test_receipts(self):
+        raw_db = InMemoryDb()
+        db = ShardDbOperator(raw_db, DEFAULT_ENV, Branch(2))
+        receipts = [Receipt(b"\x01", 21000 * (i + 1), 0, [], b"", 0) for i in range(3)]
+        block = MinorBlock(MinorBlockHeader(), MinorBlockMeta())
+        block.meta.hash_evm_receipt_root = mk_receipt_sha(receipts)
+        # the root is computed without writing the trie
+        self.assertEqual(len(raw_db.kv), 0)
+
+        db.put_receipts(block.header.get_hash(), receipts)
+        self.assertEqual(list(db.get_receipts(block)), receipts)
+
+        # blocks stored before the receipt list are read from the receipt trie
+        t = trie.Trie(raw_db)
+        for i, receipt in enumerate(receipts):
+            t.update(rlp.encode(i), rlp.encode(receipt))
+        self.assertEqual(t.root_hash, block.meta.hash_evm_receipt_root)
+        raw_db.remove(b"receipts_" + block.header.get_hash())
+        block.tx_list = [None] * len(receipts)
+        self.assertEqual(list(db.get_receipts(block)), receipts)
+
+        # blocks imported without running them have no receipts
+        other_block = MinorBlock(MinorBlockHeader(height=1), MinorBlockMeta())
+        db.put_no_receipts(other_block.header.get_hash())
+        self.assertIsNone(db.get_receipts(other_block))
+        self.assertEqual(list(db.get_receipts(block)), receipts)
@@ -5,6 +5,7 @@ from quarkchain.cluster.shard_state import ShardState
 from quarkchain.cluster.tests.test_utils import (
     get_test_env,
     create_transfer_transaction,
+    create_contract_with_storage_transaction,
 )
 from quarkchain.core import CrossShardTransactionDeposit, CrossShardTransactionList
 from quarkchain.core import Identity, Address
@@ -180,6 +181,9 @@ class TestShardState(unittest.TestCase):
         # Should succeed
         state.finalize_and_add_block(b1)
         self.assertEqual(state.header_tip, b1.header)
+        # the tip state no longer reads and writes the batch of the block
+        self.assertIs(state.evm_state.db, state.raw_db)
+        self.assertIs(state.evm_state.trie.trie.db, state.raw_db)
         self.assertEqual(
             state.get_balance(id1.recipient), 10000000 - opcodes.GTXCOST - 12345
         )
@@ -295,6 +299,36 @@ class TestShardState(unittest.TestCase):
         self.assertFalse(state.add_tx(tx))
         self.assertEqual(len(state.tx_queue), 0)
 
+    def test_failed_tx_drops_later_nonces(self):
+        id1 = Identity.create_random_identity()
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+        acc2 = Address.create_random_account(full_shard_key=0)
+
+        env = get_test_env(genesis_account=acc1, genesis_minor_quarkash=10000000)
+        state = create_default_shard_state(env=env)
+
+        # queued as if put back from a reverted block, the first can't pay its value
+        tx_list = [
+            create_transfer_transaction(
+                shard_state=state,
+                key=id1.get_key(),
+                from_address=acc1,
+                to_address=acc2,
+                value=value,
+                nonce=nonce,
+            )
+            for nonce, value in [(0, 999999999999999999999), (1, 12345)]
+        ]
+        for tx in tx_list:
+            state.tx_queue.add_transaction(tx.code.get_evm_transaction())
+            state.tx_dict[tx.get_hash()] = tx
+
+        # the later tx would otherwise be skipped for the nonce gap by every block
+        b1 = state.create_block_to_mine()
+        self.assertEqual(len(b1.tx_list), 0)
+        self.assertEqual(len(state.tx_queue), 0)
+        self.assertEqual(len(state.tx_dict), 0)
+
     def test_add_non_neighbor_tx_fail(self):
         id1 = Identity.create_random_identity()
         acc1 = Address.create_from_identity(id1, full_shard_key=0)
@@ -362,7 +396,7 @@ class TestShardState(unittest.TestCase):
         b1 = state.create_block_to_mine(address=acc3)
         self.assertEqual(len(b1.tx_list), 0)
 
-        # inshard tx
+        # inshard tx, which has the same nonce and replaces the xshard tx
         tx = create_transfer_transaction(
             shard_state=state,
             key=id1.get_key(),
@@ -370,6 +404,7 @@ class TestShardState(unittest.TestCase):
             to_address=acc3,
             value=12345,
             gas=50000,
+            gas_price=2,
         )
         self.assertTrue(state.add_tx(tx))
 
@@ -761,6 +796,100 @@ class TestShardState(unittest.TestCase):
         evmState0 = state0.evm_state
         self.assertEqual(evmState0.xshard_receive_gas_used, opcodes.GTXXSHARDCOST)
 
+    def test_xshard_tx_list_downloaded_discarded(self):
+        id1 = Identity.create_random_identity()
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+        acc2 = Address.create_from_identity(id1, full_shard_key=16)
+
+        env0 = get_test_env(
+            genesis_account=acc1, genesis_minor_quarkash=10000000, shard_size=64
+        )
+        env1 = get_test_env(
+            genesis_account=acc1, genesis_minor_quarkash=10000000, shard_size=64
+        )
+        env2 = get_test_env(
+            genesis_account=acc1, genesis_minor_quarkash=10000000, shard_size=64
+        )
+        state0 = create_default_shard_state(env=env0, shard_id=0)
+        state1 = create_default_shard_state(env=env1, shard_id=16)
+        # runs the blocks with the right list
+        state2 = create_default_shard_state(env=env2, shard_id=0)
+
+        root_block = (
+            state0.root_tip.create_block_to_append()
+            .add_minor_block_header(state0.header_tip)
+            .add_minor_block_header(state1.header_tip)
+            .finalize()
+        )
+        for state in [state0, state1, state2]:
+            state.add_root_block(root_block)
+
+        b0 = state0.create_block_to_mine()
+        state0.finalize_and_add_block(b0)
+        state2.add_block(b0)
+
+        b1 = state1.get_tip().create_block_to_append()
+        b1.header.hash_prev_root_block = root_block.header.get_hash()
+        tx = create_transfer_transaction(
+            shard_state=state1,
+            key=id1.get_key(),
+            from_address=acc2,
+            to_address=acc1,
+            value=888888,
+            gas=opcodes.GTXXSHARDCOST + opcodes.GTXCOST,
+            gas_price=2,
+        )
+        b1.add_tx(tx)
+
+        def create_tx_list(value):
+            return CrossShardTransactionList(
+                tx_list=[
+                    CrossShardTransactionDeposit(
+                        tx_hash=tx.get_hash(),
+                        from_address=acc2,
+                        to_address=acc1,
+                        value=value,
+                        gas_price=2,
+                    )
+                ]
+            )
+
+        b1_hash = b1.header.get_hash()
+        state0.add_cross_shard_tx_list_by_minor_block_hash(
+            b1_hash, create_tx_list(1), downloaded=True
+        )
+        state2.add_cross_shard_tx_list_by_minor_block_hash(
+            b1_hash, create_tx_list(888888)
+        )
+
+        root_block = (
+            state0.root_tip.create_block_to_append()
+            .add_minor_block_header(b0.header)
+            .add_minor_block_header(b1.header)
+            .finalize()
+        )
+        state0.add_root_block(root_block)
+        state2.add_root_block(root_block)
+
+        b2 = state2.create_block_to_mine()
+        state2.finalize_and_add_block(b2)
+        self.assertEqual(state2.db.discard_downloaded_xshard_tx_lists([b1_hash]), [])
+
+        # the wrong list is discarded to be downloaded again
+        with self.assertRaisesRegex(ValueError, "State root mismatch"):
+            state0.add_block(b2)
+        self.assertIsNone(state0.db.get_minor_block_xshard_tx_list(b1_hash))
+        self.assertEqual(
+            state0.get_missing_cross_shard_tx_list_hashes_by_block(b2), [b1_hash]
+        )
+
+        state0.add_cross_shard_tx_list_by_minor_block_hash(
+            b1_hash, create_tx_list(888888), downloaded=True
+        )
+        state0.add_block(b2)
+        self.assertEqual(state0.header_tip, b2.header)
+        self.assertEqual(state0.get_balance(acc1.recipient), 10000000 + 888888)
+
     def test_xshard_tx_received_exclude_non_neighbor(self):
         id1 = Identity.create_random_identity()
         acc1 = Address.create_from_identity(id1, full_shard_key=0)
@@ -1371,3 +1500,71 @@ class TestShardState(unittest.TestCase):
         state.add_root_block(r3)
         self.assertEqual(state.root_tip, r3.header)
         self.assertEqual(state.header_tip, m2.header)
+
+    def test_flat_state(self):
+        id1 = Identity.create_from_key(
+            bytes.fromhex(
+                "c987d4506fb6824639f9a9e3b8834584f5165e94680501d1b0044071cd36c3b3"
+            )
+        )
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+        acc2 = Address.create_random_account(full_shard_key=0)
+        acc3 = Address.create_random_account(full_shard_key=0)
+        contract = bytes.fromhex("8531eb33bba796115f56ffa1b7df1ea3acdd8cdd")
+        env = get_test_env(genesis_account=acc1, genesis_minor_quarkash=10000000)
+        env.cluster_config.ENABLE_FLAT_STATE = True
+        state = create_default_shard_state(env=env)
+        state.flat_state.max_layers = 2
+        self.assertEqual(state.flat_state.disk_root, state.evm_state.trie.root_hash)
+
+        root_block = state.root_tip.create_block_to_append().finalize()
+        state.add_root_block(root_block)
+
+        state.add_tx(
+            create_contract_with_storage_transaction(
+                shard_state=state,
+                key=id1.get_key(),
+                from_address=acc1,
+                to_full_shard_key=acc1.full_shard_key,
+            )
+        )
+        b1 = state.create_block_to_mine(address=acc3)
+        state.finalize_and_add_block(b1)
+        self.assertIn(state.evm_state.trie.root_hash, state.flat_state.layers)
+
+        for _ in range(3):
+            state.add_tx(
+                create_transfer_transaction(
+                    shard_state=state,
+                    key=id1.get_key(),
+                    from_address=acc1,
+                    to_address=acc2,
+                    value=12345,
+                )
+            )
+            b = state.create_block_to_mine(address=acc3)
+            state.finalize_and_add_block(b)
+
+        # b1 and the next block have been flattened to disk
+        self.assertEqual(len(state.flat_state.layers), 2)
+        self.assertEqual(
+            state.flat_state.disk_root,
+            state.db.get_minor_block_by_height(2).meta.hash_evm_state_root,
+        )
+        self.assertEqual(state.flat_state.verify(), [])
+
+        self.assertEqual(state.get_storage_at(contract, 0), (1234).to_bytes(32, "big"))
+        self.assertEqual(state.get_balance(acc2.recipient), 12345 * 3)
+        self.assertEqual(state.get_transaction_count(acc1.recipient), 4)
+        self.assertEqual(state.get_balance(acc2.recipient, height=2), 12345)
+        # reads at a root unknown to the flat state fall back to the trie
+        self.assertIsNone(
+            state.flat_state.get_account(
+                state.header_tip.hash_prev_minor_block, acc1.recipient
+            )
+        )
+        self.assertEqual(state.get_balance(acc2.recipient, height=0), 0)
+
+        state.flat_state.rebuild(state.evm_state.trie.root_hash)
+        self.assertEqual(state.flat_state.verify(), [])
+        self.assertEqual(state.get_storage_at(contract, 0), (1234).to_bytes(32, "big"))
@@ -0,0 +1,253 @@
+import asyncio
+import unittest
+from collections import Counter
+from unittest import mock
+
+import rlp
+
+from quarkchain.cluster.state_pruning import (
+    JOURNAL_PREFIX,
+    REFCOUNT_PREFIX,
+    StatePruner,
+    iter_node_refs,
+)
+from quarkchain.cluster.tests.test_shard_state import create_default_shard_state
+from quarkchain.cluster.tests.test_utils import (
+    create_transfer_transaction,
+    get_test_env,
+)
+from quarkchain.core import Address, Identity, MinorBlockHeader
+from quarkchain.db import InMemoryDb, OverlayDb
+from quarkchain.evm import trie
+from quarkchain.evm.config import Env
+from quarkchain.evm.securetrie import SecureTrie
+from quarkchain.evm.state import State
+from quarkchain.evm.trie import Trie
+from quarkchain.utils import LRUCache
+
+
+def dump_state(db, root):
+    """ Accounts with their storage, read from db only"""
+    result = dict()
+    with mock.patch.object(trie, "node_cache", LRUCache(trie.NODE_CACHE_SIZE)):
+        for address, rlpdata in SecureTrie(Trie(db, root)).iter_branch():
+            account = rlp.decode(rlpdata)
+            result[address] = (rlpdata, SecureTrie(Trie(db, account[2])).to_dict())
+    return result
+
+
+class TestStatePruner(unittest.TestCase):
+    def setUp(self):
+        self.db = InMemoryDb()
+        self.pruner = StatePruner(self.db, 3)
+        # the state written before pruning is not tracked
+        state = State(env=Env(self.db), db=self.db)
+        for i in range(20):
+            state.set_balance(i.to_bytes(20, "big"), 10 ** 18)
+        state.commit()
+        self.genesis_root = state.trie.root_hash
+        self.header_list = []
+        self.root_list = []
+        self.dump_list = []
+
+    def add_block(self, update, prev_root=None, nonce=0):
+        """ Runs update(state) on top of the state of prev_root, the last block by
+        default
+        """
+        if prev_root is None:
+            prev_root = self.root_list[-1] if self.root_list else self.genesis_root
+        batch = OverlayDb(self.db)
+        state = State(env=Env(batch), db=batch)
+        state.trie.root_hash = prev_root
+        state.new_trie_nodes = []
+        # committed after every tx as blocks are run
+        for tx in update:
+            tx(state)
+            state.commit()
+        header = MinorBlockHeader(height=len(self.header_list) + 1, nonce=nonce)
+        self.pruner.add_block(batch, header, state.trie.root_hash, state.new_trie_nodes)
+        batch.commit()
+        self.header_list.append(header)
+        self.root_list.append(state.trie.root_hash)
+        self.dump_list.append(dump_state(self.db, state.trie.root_hash))
+
+    def add_blocks(self, n):
+        for i in range(n):
+            height = len(self.header_list)
+            self.add_block(
+                [
+                    lambda s: s.delta_balance((height % 20).to_bytes(20, "big"), 1),
+                    lambda s: s.set_storage_data(b"\x01" * 20, height % 4, height),
+                    lambda s: s.set_balance((100 + height).to_bytes(20, "big"), 1),
+                ]
+            )
+
+    def assert_tracked_nodes(self, retained_root_list):
+        """ The tracked nodes are the ones of the states kept and the ones written
+        by the blocks kept, with the number of references to them as count
+        """
+        node_map = {
+            k[len(REFCOUNT_PREFIX) :]: int.from_bytes(v, "big")
+            for k, v in self.db.range_iter(
+                REFCOUNT_PREFIX, REFCOUNT_PREFIX + b"\xff" * 32
+            )
+        }
+        stack = list(retained_root_list)
+        for _, data in self.db.range_iter(
+            JOURNAL_PREFIX, JOURNAL_PREFIX + b"\xff" * 72
+        ):
+            stack.extend(data[i : i + 32] for i in range(0, len(data), 32))
+        reachable = set()
+        while stack:
+            node_hash = stack.pop()
+            if node_hash in reachable or node_hash not in node_map:
+                continue
+            reachable.add(node_hash)
+            stack.extend(iter_node_refs(rlp.decode(self.db.get(node_hash))))
+        self.assertEqual(set(node_map), reachable)
+
+        ref_counter = Counter()
+        for node_hash in node_map:
+            for ref in iter_node_refs(rlp.decode(self.db.get(node_hash))):
+                ref_counter[ref] += 1
+        self.assertEqual(node_map, {h: ref_counter[h] for h in node_map})
+
+    def assert_states(self, kept):
+        for i, root in enumerate(self.root_list):
+            if i in kept:
+                self.assertEqual(dump_state(self.db, root), self.dump_list[i])
+            else:
+                self.assertNotIn(root, self.db)
+        self.assertEqual(len(dump_state(self.db, self.genesis_root)), 20)
+
+    def test_prune(self):
+        self.add_blocks(20)
+        size = len(self.db.kv)
+        self.assertGreater(self.pruner.prune(20, []), 0)
+        self.assertLess(len(self.db.kv), size)
+        self.assert_states(range(17, 20))
+        self.assert_tracked_nodes(self.root_list[17:])
+
+        # the db stops growing
+        self.add_blocks(20)
+        self.pruner.prune(40, [])
+        self.assert_states(range(37, 40))
+        self.assert_tracked_nodes(self.root_list[37:])
+        self.assertLess(len(self.db.kv), size)
+
+    def test_bounded_passes(self):
+        self.add_blocks(20)
+        root = self.root_list[0]
+        trie.cache_node(root, rlp.decode(self.db.get(root)))
+        pass_count = 0
+        while pass_count == 0 or self.pruner.pending:
+            self.pruner.prune(20, [], max_block_count=5)
+            pass_count += 1
+        self.assertEqual(pass_count, 4)
+        self.assert_states(range(17, 20))
+        self.assert_tracked_nodes(self.root_list[17:])
+        # not served from the cache once deleted
+        self.assertNotIn(root, trie.node_cache)
+
+    def test_retained_root(self):
+        self.add_blocks(20)
+        self.pruner.prune(20, [self.root_list[5]])
+        self.assert_states([5, 17, 18, 19])
+        self.assert_tracked_nodes([self.root_list[5]] + self.root_list[17:])
+
+        self.add_blocks(5)
+        self.pruner.prune(25, [])
+        self.assert_states(range(22, 25))
+        self.assert_tracked_nodes(self.root_list[22:])
+
+    def test_shared_subtrees(self):
+        contract_list = [b"\x02" * 20, b"\x03" * 20]
+
+        def set_storage(contract, value):
+            def update(state):
+                for key in range(50):
+                    state.set_storage_data(contract, key, value)
+
+            return update
+
+        # identical storage tries, then one of them emptied
+        self.add_block([set_storage(contract, 1) for contract in contract_list])
+        self.add_block([lambda s: s.del_account(contract_list[0])])
+        self.add_blocks(10)
+        self.pruner.prune(12, [])
+        self.assert_states(range(9, 12))
+        self.assert_tracked_nodes(self.root_list[9:])
+        self.assertEqual(
+            len(dump_state(self.db, self.root_list[-1])[contract_list[1]][1]), 50
+        )
+
+    def test_fork(self):
+        self.add_blocks(10)
+        # forking from an old block
+        fork_root = self.root_list[3]
+        self.add_block(
+            [lambda s: s.set_balance(b"\x04" * 20, 4)], prev_root=fork_root, nonce=1
+        )
+        self.add_blocks(2)
+        self.pruner.prune(13, [])
+        self.assert_states(range(10, 13))
+        self.assert_tracked_nodes(self.root_list[10:])
+
+    def test_empty_blocks(self):
+        # blocks sharing the state of their parent
+        self.add_blocks(5)
+        for _ in range(3):
+            self.add_block([])
+        self.add_blocks(3)
+        self.pruner.prune(9, [])
+        self.assert_states(range(4, 11))
+        self.pruner.prune(11, [])
+        self.assert_states(range(8, 11))
+        self.assert_tracked_nodes(self.root_list[8:])
+
+
+class TestShardStatePruning(unittest.TestCase):
+    def test_add_block(self):
+        id1 = Identity.create_random_identity()
+        acc1 = Address.create_from_identity(id1, full_shard_key=0)
+        acc2 = Address.create_random_account(full_shard_key=0)
+        env = get_test_env(genesis_account=acc1, genesis_minor_quarkash=10 ** 18)
+        env.cluster_config.STATE_PRUNING_BLOCKS = 4
+        # so that the states of the forks accepted fit in the window
+        env.quark_chain_config.ROOT.MAX_STALE_ROOT_BLOCK_HEIGHT_DIFF = 1
+        state = create_default_shard_state(env=env)
+        self.assertEqual(state.state_pruner.num_blocks, 10)
+
+        # keys of the trie nodes, the preimages and the code
+        node_count_list = []
+        for i in range(64):
+            block = state.create_block_to_mine()
+            block.add_tx(
+                create_transfer_transaction(
+                    shard_state=state,
+                    key=id1.get_key(),
+                    from_address=acc1,
+                    to_address=acc2,
+                    value=1,
+                )
+            )
+            state.finalize_and_add_block(block)
+            if state.state_pruner.due:
+                # pruned in the background, in several passes
+                asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+                while state.state_pruner.pending:
+                    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+                node_count_list.append(sum(1 for k in state.raw_db.kv if len(k) == 32))
+        self.assertGreater(state.state_pruner.node_count, 0)
+        # the trie nodes no longer grow with the chain
+        self.assertEqual(len(node_count_list), 4)
+        self.assertLessEqual(node_count_list[-1], node_count_list[0])
+
+        self.assertEqual(state.get_balance(acc2.recipient), 64)
+        self.assertEqual(state.get_balance(acc2.recipient, 55), 55)
+        # pruned
+        self.assertEqual(state.get_balance(acc2.recipient, 30), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
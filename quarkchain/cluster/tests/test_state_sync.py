@@ -0,0 +1,139 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import rlp
+
+from quarkchain.cluster import state_sync
+from quarkchain.cluster.state_sync import StateSync, StateSyncTracker
+from quarkchain.db import InMemoryDb
+from quarkchain.evm import trie
+from quarkchain.evm.config import Env
+from quarkchain.evm.securetrie import SecureTrie
+from quarkchain.evm.state import State
+from quarkchain.evm.trie import Trie
+from quarkchain.utils import LRUCache
+
+
+class Peer:
+    def __init__(self, db, fail_after=None):
+        self.db = db
+        self.fail_after = fail_after
+        self.requests = 0
+        self.error = None
+
+    def close_with_error(self, error):
+        self.error = error
+
+
+async def download_nodes(peer, hash_list):
+    peer.requests += 1
+    await asyncio.sleep(0)
+    if peer.fail_after is not None and peer.requests > peer.fail_after:
+        raise RuntimeError("connection lost")
+    return [peer.db.get(h) for h in hash_list if peer.db.get(h) is not None]
+
+
+def create_state(db, num_accounts=100, root=None):
+    state = State(env=Env(db), db=db)
+    if root is not None:
+        state.trie.root_hash = root
+    for i in range(num_accounts):
+        address = i.to_bytes(20, "big")
+        state.set_balance(address, 10 ** 18 + i)
+        if i % 10 == 0:
+            for key in range(i // 10 + 1):
+                state.set_storage_data(address, key, key + 1)
+            state.set_code(address, b"\x60\x00" * (i + 1))
+    state.commit()
+    return state.trie.root_hash
+
+
+class TestStateSync(unittest.TestCase):
+    def sync(self, db, root, peer_list, download=download_nodes):
+        tracker = StateSyncTracker.load(db) or StateSyncTracker(db)
+        tracker.start(b"\x01" * 32, root)
+        sync = StateSync(tracker, peer_list, download, 1)
+        with mock.patch.object(state_sync, "NODE_BATCH_SIZE", 8):
+            asyncio.get_event_loop().run_until_complete(sync.run())
+        self.assertTrue(tracker.done)
+        return sync
+
+    def dump_state(self, db, root):
+        """ Accounts with their storage and code, read through the preimages of the
+        keys like the flat state
+        """
+        result = dict()
+        # without the nodes cached from the other db
+        with mock.patch.object(trie, "node_cache", LRUCache(trie.NODE_CACHE_SIZE)):
+            for address, rlpdata in SecureTrie(Trie(db, root)).iter_branch():
+                account = rlp.decode(rlpdata)
+                storage = SecureTrie(Trie(db, account[2])).to_dict()
+                result[address] = (rlpdata, storage, db.get(account[3]))
+        return result
+
+    def assert_synced(self, source_db, db, root):
+        self.assertEqual(self.dump_state(db, root), self.dump_state(source_db, root))
+
+    def test_sync(self):
+        source_db = InMemoryDb()
+        root = create_state(source_db)
+        peer_list = [Peer(source_db) for _ in range(3)]
+        db = InMemoryDb()
+        self.sync(db, root, peer_list)
+        self.assert_synced(source_db, db, root)
+        for peer in peer_list:
+            self.assertGreater(peer.requests, 0)
+        tracker = StateSyncTracker.load(db)
+        self.assertEqual(tracker.pending, [])
+
+    def test_sync_new_state(self):
+        source_db = InMemoryDb()
+        root = create_state(source_db)
+        db = InMemoryDb()
+        sync = self.sync(db, root, [Peer(source_db)])
+        total = sync.node_count
+
+        # only the nodes changed are downloaded
+        root = create_state(source_db, num_accounts=3, root=root)
+        sync = self.sync(db, root, [Peer(source_db)])
+        self.assert_synced(source_db, db, root)
+        self.assertLess(sync.node_count, total // 4)
+
+    def test_resume(self):
+        source_db = InMemoryDb()
+        root = create_state(source_db)
+        total = self.sync(InMemoryDb(), root, [Peer(source_db)]).node_count
+
+        db = InMemoryDb()
+        with self.assertRaisesRegex(RuntimeError, "No peer"):
+            self.sync(db, root, [Peer(source_db, fail_after=5)])
+        tracker = StateSyncTracker.load(db)
+        self.assertGreater(len(tracker.pending), 0)
+
+        sync = self.sync(db, root, [Peer(source_db)])
+        self.assert_synced(source_db, db, root)
+        # the entries stored before are not requested again
+        self.assertLess(sync.node_count, total)
+
+    def test_bad_peer(self):
+        source_db = InMemoryDb()
+        root = create_state(source_db)
+        bad = Peer(source_db)
+        good = Peer(source_db)
+
+        async def download(peer, hash_list):
+            if peer is bad:
+                return [b"\x01" * 40]
+            return await download_nodes(peer, hash_list)
+
+        db = InMemoryDb()
+        self.sync(db, root, [bad, good], download)
+        self.assert_synced(source_db, db, root)
+        self.assertIsNotNone(bad.error)
+
+    def test_no_peer_with_state(self):
+        source_db = InMemoryDb()
+        root = create_state(source_db)
+        with self.assertRaisesRegex(RuntimeError, "No peer"):
+            self.sync(InMemoryDb(), root, [Peer(InMemoryDb()), Peer(InMemoryDb())])
@@ -22,6 +22,7 @@ from quarkchain.utils import (
     int_left_most_bit,
     is_p2,
     sha3_256,
+    sha3_256_batch,
     check,
     masks_have_overlap,
 )
@@ -232,6 +233,40 @@ class Serializable:
         return hash(tuple(h_list))
 
 
+class MemoizedSerializable(Serializable):
+    """ Serializable keeping its serialized bytes and hash once computed, for objects
+    hashed over and over such as block headers and txs.  Assigning an attribute
+    drops them, so fields must be replaced instead of mutated in place.
+    """
+
+    _memo = None
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if self._memo is not None:
+            self.__dict__["_memo"] = None
+
+    def memoize(self, key, func):
+        """ func() computed once until the object changes"""
+        memo = self._memo
+        if memo is None:
+            memo = self.__dict__["_memo"] = dict()
+        if key not in memo:
+            memo[key] = func()
+        return memo[key]
+
+    def memoized(self, key):
+        """ The value memoized under key, None if not computed yet"""
+        return None if self._memo is None else self._memo.get(key)
+
+    def serialize(self, barray: bytearray = None):
+        data = self.memoize("serialized", lambda: bytes(Serializable.serialize(self)))
+        if barray is None:
+            return bytearray(data)
+        barray.extend(data)
+        return barray
+
+
 class Optional:
     def __init__(self, serializer):
         self.serializer = serializer
@@ -250,6 +285,26 @@ class Optional:
         return self.serializer.deserialize(bb)
 
 
+class Appended:
+    """ A field appended to a message after the message was released.  The messages
+    of the older versions end before it and read it as default, and the older
+    versions ignore the bytes left after their last field.  Only the last fields of
+    a message can be appended, the message being the last field of its parents.
+    """
+
+    def __init__(self, serializer, default):
+        self.serializer = serializer
+        self.default = default
+
+    def serialize(self, obj, barray):
+        self.serializer.serialize(obj, barray)
+
+    def deserialize(self, bb):
+        if bb.remaining() == 0:
+            return self.default
+        return self.serializer.deserialize(bb)
+
+
 class EnumSerializer:
     """ EnumSerializer.
     The enum field must be the first field to be serialized/deserialized.
@@ -509,6 +564,8 @@ class Code(Serializable):
     OP_ROOT_COINBASE = b"r"
     # TODO: Replace it with vary-size bytes serializer
     FIELDS = [("code", PrependedSizeBytesSerializer(4))]
+    # sender of the evm tx once recovered, see cluster.sender_recovery
+    evm_sender = None
 
     def __init__(self, code=OP_TRANSFER):
         fields = {k: v for k, v in locals().items() if k != "self"}
@@ -561,10 +618,17 @@ class Code(Serializable):
 
     def get_evm_transaction(self) -> EvmTransaction:
         assert self.is_evm()
-        return rlp.decode(self.code[1:], EvmTransaction)
+        evm_tx = rlp.decode(self.code[1:], EvmTransaction)
+        if self.evm_sender is not None:
+            evm_tx.sender = self.evm_sender
+        return evm_tx
+
 
+class Transaction(MemoizedSerializable):
+    """ The hash is memoized, so in_list, code, out_list and sign_list must be
+    replaced instead of changed in place, e.g. sign() assigns a new sign_list.
+    """
 
-class Transaction(Serializable):
     FIELDS = [
         ("in_list", PrependedSizeListSerializer(1, TransactionInput)),
         ("code", Code),
@@ -583,7 +647,7 @@ class Transaction(Serializable):
         return self.serialize_without(["sign_list"], barray)
 
     def get_hash(self):
-        return sha3_256(self.serialize())
+        return self.memoize("hash", lambda: sha3_256(self.serialize()))
 
     def get_hash_hex(self):
         return self.get_hash().hex()
@@ -622,25 +686,33 @@ class Transaction(Serializable):
 
 
 def calculate_merkle_root(item_list):
+    """ item_list holds txs or minor block headers, whose hash is the sha3_256 of their
+    serialization
+    """
     if len(item_list) == 0:
         return bytes(32)
 
-    sha_tree = []
-    for item in item_list:
-        sha_tree.append(sha3_256(item.serialize()))
+    # hash in one batch the items whose hash isn't known
+    unhashed = [item for item in item_list if item.memoized("hash") is None]
+    hash_list = sha3_256_batch([item.serialize() for item in unhashed])
+    for item, h in zip(unhashed, hash_list):
+        item.memoize("hash", lambda: h)
+    sha_tree = [item.get_hash() for item in item_list]
 
     while len(sha_tree) != 1:
-        next_sha_tree = []
-        for i in range(0, len(sha_tree) - 1, 2):
-            next_sha_tree.append(sha3_256(sha_tree[i] + sha_tree[i + 1]))
         if len(sha_tree) % 2 != 0:
-            next_sha_tree.append(sha3_256(sha_tree[-1] + sha_tree[-1]))
-        sha_tree = next_sha_tree
+            sha_tree.append(sha_tree[-1])
+        # hash the pairs of the level out of one buffer
+        level = b"".join(sha_tree)
+        sha_tree = sha3_256_batch([level[i : i + 64] for i in range(0, len(level), 64)])
     return sha_tree[0]
 
 
-def mk_receipt_sha(receipts, db):
-    t = trie.Trie(db)
+def mk_receipt_sha(receipts):
+    """ Root of the receipt trie, built in memory.  The receipts themselves are
+    stored as a list, see ShardDbOperator.put_receipts()
+    """
+    t = trie.MemoryTrie()
     for i, receipt in enumerate(receipts):
         t.update(rlp.encode(i), rlp.encode(receipt))
     return t.root_hash
@@ -676,12 +748,15 @@ class MinorBlockMeta(Serializable):
         return sha3_256(self.serialize())
 
 
-class MinorBlockHeader(Serializable):
+class MinorBlockHeader(MemoizedSerializable):
     """ Header fields that are included in root block so that the root chain could quickly verify
     - Verify minor block headers included are valid appends on existing shards
     - Verify minor block headers reach sufficient difficulty
     - Verify minor block headers have correct timestamp
     Once the root block contains these correct information, then it is highly likely that the root block is valid.
+
+    The hash is memoized, so branch and coinbase_address must be replaced instead of
+    changed in place.  The miners assign nonce and mixhash, which is fine.
     """
 
     FIELDS = [
@@ -737,7 +812,7 @@ class MinorBlockHeader(Serializable):
         self.mixhash = mixhash
 
     def get_hash(self):
-        return sha3_256(self.serialize())
+        return self.memoize("hash", lambda: sha3_256(self.serialize()))
 
     def get_hash_for_mining(self):
         return sha3_256(self.serialize_without(["nonce", "mixhash"]))
@@ -783,9 +858,7 @@ class MinorBlock(Serializable):
         self.meta.evm_cross_shard_receive_gas_used = evm_state.xshard_receive_gas_used
         self.header.coinbase_amount = coinbase_amount
         self.finalize_merkle_root()
-        self.meta.hash_evm_receipt_root = mk_receipt_sha(
-            evm_state.receipts, evm_state.db
-        )
+        self.meta.hash_evm_receipt_root = mk_receipt_sha(evm_state.receipts)
         self.header.hash_meta = self.meta.get_hash()
         self.header.bloom = evm_state.bloom
         return self
@@ -794,9 +867,9 @@ class MinorBlock(Serializable):
         self.tx_list.append(tx)
         return self
 
-    def get_receipt(self, db, i):
-        t = trie.Trie(db, self.meta.hash_evm_receipt_root)
-        receipt = rlp.decode(t.get(rlp.encode(i)), quarkchain.evm.messages.Receipt)
+    def get_receipt(self, receipts, i):
+        """ receipts are the evm receipts of the block, see ShardDbOperator.get_receipts()"""
+        receipt = receipts[i]
         if receipt.contract_address != b"":
             contract_address = Address(
                 receipt.contract_address, receipt.contract_full_shard_key
@@ -805,9 +878,7 @@ class MinorBlock(Serializable):
             contract_address = Address.create_empty_account(full_shard_key=0)
 
         if i > 0:
-            prev_gas_used = rlp.decode(
-                t.get(rlp.encode(i - 1)), quarkchain.evm.messages.Receipt
-            ).gas_used
+            prev_gas_used = receipts[i - 1].gas_used
         else:
             prev_gas_used = self.meta.evm_cross_shard_receive_gas_used
 
@@ -865,7 +936,11 @@ class MinorBlock(Serializable):
         return MinorBlock(header, meta, [], b"")
 
 
-class RootBlockHeader(Serializable):
+class RootBlockHeader(MemoizedSerializable):
+    """ The hash is memoized, so coinbase_address must be replaced instead of changed
+    in place.  The miners assign nonce and mixhash, which is fine.
+    """
+
     FIELDS = [
         ("version", uint32),
         ("height", uint32),
@@ -910,7 +985,9 @@ class RootBlockHeader(Serializable):
         self.signature = signature
 
     def get_hash(self):
-        return sha3_256(self.serialize_without(["signature"]))
+        return self.memoize(
+            "hash", lambda: sha3_256(self.serialize_without(["signature"]))
+        )
 
     def get_hash_for_mining(self):
         return sha3_256(self.serialize_without(["nonce", "mixhash", "signature"]))
@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+import bisect
 import copy
 import pathlib
 import shutil
@@ -6,6 +7,26 @@ import shutil
 import rocksdb
 
 
+class WriteBatch:
+    """ A sequence of puts and deletes to be applied to a db atomically by Db.write()
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+    def __iter__(self):
+        return iter(self.ops)
+
+    def __len__(self):
+        return len(self.ops)
+
+
 class Db:
     def __getitem__(self, key):
         value = self.get(key)
@@ -13,44 +34,77 @@ class Db:
             raise KeyError("cannot find {}".format(key))
         return value
 
+    def write(self, batch: WriteBatch):
+        """ Apply all the puts and deletes in the batch.  None values are deletes."""
+        raise NotImplementedError()
+
+    def is_temporary(self, key):
+        """ Whether the value of key is only held by a temporary overlay, which is
+        never committed
+        """
+        return False
+
     def close(self):
         pass
 
 
 class InMemoryDb(Db):
     """ A simple in-memory key-value database
-    TODO: Need to support range operation (e.g., leveldb)
+    Keys are additionally kept in a sorted array so that range operations (e.g., leveldb)
+    take O(log n + k).  Newly inserted keys are buffered and merged into the sorted array
+    lazily on the next range operation so that put() stays O(1).
     """
 
     def __init__(self):
         self.kv = dict()
+        self._sorted_keys = []
+        self._pending_keys = set()
+
+    def __sorted_keys(self):
+        if self._pending_keys:
+            # timsort merges the two sorted runs in linear time
+            self._sorted_keys.extend(sorted(self._pending_keys))
+            self._sorted_keys.sort()
+            self._pending_keys = set()
+        return self._sorted_keys
 
     def range_iter(self, start, end):
-        keys = []
-        for k in self.kv.keys():
-            if k >= start and k < end:
-                keys.append(k)
-        keys.sort()
-        for k in keys:
-            yield k, self.kv[k]
+        keys = self.__sorted_keys()
+        lo = bisect.bisect_left(keys, start)
+        hi = bisect.bisect_left(keys, end, lo)
+        for i in range(lo, hi):
+            yield keys[i], self.kv[keys[i]]
 
     def reversed_range_iter(self, start, end):
-        keys = []
-        for k in self.kv.keys():
-            if k <= start and k > end:
-                keys.append(k)
-        keys.sort(reverse=True)
-        for k in keys:
-            yield k, self.kv[k]
+        keys = self.__sorted_keys()
+        hi = bisect.bisect_right(keys, start)
+        lo = bisect.bisect_right(keys, end, 0, hi)
+        for i in range(hi - 1, lo - 1, -1):
+            yield keys[i], self.kv[keys[i]]
 
     def get(self, key, default=None):
         return self.kv.get(key, default)
 
     def put(self, key, value):
+        if key not in self.kv:
+            self._pending_keys.add(key)
         self.kv[key] = bytes(value)
 
     def remove(self, key):
         del self.kv[key]
+        if key in self._pending_keys:
+            self._pending_keys.discard(key)
+            return
+        i = bisect.bisect_left(self._sorted_keys, key)
+        del self._sorted_keys[i]
+
+    def write(self, batch):
+        for key, value in batch:
+            if value is None:
+                if key in self.kv:
+                    self.remove(key)
+            else:
+                self.put(key, value)
 
     def __contains__(self, key):
         return key in self.kv
@@ -97,6 +151,17 @@ class PersistentDb(Db):
     def remove(self, key):
         return self.delete(key)
 
+    def write(self, batch):
+        """ Apply the batch with a single rocksdb write so that it is atomic and appended to WAL once"""
+        wb = rocksdb.WriteBatch()
+        for key, value in batch:
+            key = key.encode() if not isinstance(key, bytes) else key
+            if value is None:
+                wb.delete(key)
+            else:
+                wb.put(key, bytes(value) if isinstance(value, bytearray) else value)
+        return self._db.write(wb)
+
     def __contains__(self, key):
         key = key.encode() if not isinstance(key, bytes) else key
         return self._db.get(key) is not None
@@ -142,17 +207,23 @@ class PersistentDb(Db):
 
 
 class OverlayDb(Db):
-    """ Used for making temporary objects in EvmState.ephemeral_clone()"""
+    """ Used for making temporary objects in EvmState.ephemeral_clone()
+    Also serves as a write batch with read-your-writes semantics: writes are buffered in memory
+    until commit() applies them to the underlying db atomically.
+    temporary is set for the overlays that are never committed.
+    """
 
-    def __init__(self, db):
+    def __init__(self, db, temporary=False):
         self._db = db
         self.kv = None
         self.overlay = {}
+        self.temporary = temporary
 
-    def get(self, key):
+    def get(self, key, default=None):
         if key in self.overlay:
-            return self.overlay[key]
-        return self._db.get(key)
+            value = self.overlay[key]
+            return default if value is None else value
+        return self._db.get(key, default)
 
     def put(self, key, value):
         self.overlay[key] = value
@@ -160,8 +231,30 @@ class OverlayDb(Db):
     def delete(self, key):
         self.overlay[key] = None
 
+    def remove(self, key):
+        self.delete(key)
+
+    def write(self, batch):
+        for key, value in batch:
+            self.overlay[key] = value
+
     def commit(self):
-        pass
+        """ Flush all buffered writes to the underlying db in one batch"""
+        if not self.overlay:
+            return
+        batch = WriteBatch()
+        for key, value in self.overlay.items():
+            if value is None:
+                batch.delete(key)
+            else:
+                batch.put(key, value)
+        self._db.write(batch)
+        self.overlay = {}
+
+    def is_temporary(self, key):
+        if key in self.overlay:
+            return self.temporary
+        return self._db.is_temporary(key)
 
     def _has_key(self, key):
         if key in self.overlay:
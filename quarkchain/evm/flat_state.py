@@ -0,0 +1,243 @@
+""" Flat account / storage tables that serve state reads without walking the trie.
+
+The tables on disk hold the state at `FlatState.disk_root`.  Every imported
+block adds an in-memory `FlatStateDiff` layer on top of its parent root, so the
+recent blocks (and their forks) are readable with a few dict lookups.  Once the
+head is more than `max_layers` blocks above the disk tables the oldest layer is
+flattened into them.  Reads at a root that is neither the disk root nor a layer
+return None and the caller falls back to the trie.
+"""
+import rlp
+
+from quarkchain.db import WriteBatch
+from quarkchain.evm import utils
+from quarkchain.evm.securetrie import SecureTrie
+from quarkchain.evm.trie import Trie, BLANK_ROOT
+
+ACCOUNT_PREFIX = b"flat_acc_"
+STORAGE_PREFIX = b"flat_st_"
+ROOT_KEY = b"flat_root"
+
+DIFF_LAYERS = 128
+# ops per write batch when regenerating the tables
+REBUILD_BATCH_SIZE = 10000
+
+
+def _storage_key(address, key):
+    return STORAGE_PREFIX + address + utils.encode_int32(key)
+
+
+def _storage_range(address):
+    # storage keys are fixed size so any longer key sorts after them
+    return STORAGE_PREFIX + address, STORAGE_PREFIX + address + b"\xff" * 33
+
+
+class FlatStateDiff:
+    """ State changes on top of `base_root` that lead to `root`.
+    accounts: address -> rlp encoded _Account, b"" if deleted
+    storage: address -> {key: value}, applied after the wipes in destructed
+    destructed: addresses whose storage was reset
+    """
+
+    def __init__(self, flat_state, base_root):
+        self.flat_state = flat_state
+        self.base_root = base_root
+        self.root = base_root
+        self.accounts = dict()
+        self.storage = dict()
+        self.destructed = set()
+
+    def get_account(self, address):
+        if address in self.accounts:
+            return self.accounts[address]
+        return self.flat_state.get_account(self.base_root, address)
+
+    def get_storage(self, address, key):
+        storage = self.storage.get(address)
+        if storage is not None and key in storage:
+            return storage[key]
+        if address in self.destructed:
+            return 0
+        return self.flat_state.get_storage(self.base_root, address, key)
+
+    def destruct(self, address):
+        self.destructed.add(address)
+        self.storage.pop(address, None)
+
+    def update_storage(self, address, storage):
+        if storage:
+            self.storage.setdefault(address, dict()).update(storage)
+
+    def update_account(self, address, rlpdata):
+        self.accounts[address] = rlpdata
+
+
+class FlatState:
+    def __init__(self, db, max_layers=DIFF_LAYERS):
+        self.db = db
+        self.max_layers = max_layers
+        self.disk_root = db.get(ROOT_KEY)
+        # root -> FlatStateDiff
+        self.layers = dict()
+
+    def has_root(self, root):
+        return root == self.disk_root or root in self.layers
+
+    def new_diff(self, root):
+        return FlatStateDiff(self, root)
+
+    def get_account(self, root, address):
+        """ Returns the rlp encoded account (b"" if it doesn't exist) or None if
+        the state at root is unknown.
+        """
+        layer = self.layers.get(root)
+        while layer is not None:
+            if address in layer.accounts:
+                return layer.accounts[address]
+            root = layer.base_root
+            layer = self.layers.get(root)
+        if root != self.disk_root:
+            return None
+        return self.db.get(ACCOUNT_PREFIX + address, b"")
+
+    def get_storage(self, root, address, key):
+        """ Returns the storage value or None if the state at root is unknown
+        """
+        layer = self.layers.get(root)
+        while layer is not None:
+            storage = layer.storage.get(address)
+            if storage is not None and key in storage:
+                return storage[key]
+            if address in layer.destructed:
+                return 0
+            root = layer.base_root
+            layer = self.layers.get(root)
+        if root != self.disk_root:
+            return None
+        value = self.db.get(_storage_key(address, key))
+        return utils.big_endian_to_int(value) if value else 0
+
+    def add_layer(self, diff):
+        """ Make the state at diff.root readable.  The diff must not be modified afterwards.
+        Returns False if the parent state is unknown.
+        """
+        if not self.has_root(diff.base_root):
+            return False
+        if diff.root != diff.base_root and not self.has_root(diff.root):
+            self.layers[diff.root] = diff
+        return True
+
+    def cap(self, head_root):
+        """ Flatten the layers more than max_layers below head_root into the disk
+        tables and drop the layers that are no longer reachable from them.
+        """
+        path = []
+        layer = self.layers.get(head_root)
+        while layer is not None:
+            path.append(layer)
+            layer = self.layers.get(layer.base_root)
+        if len(path) <= self.max_layers or path[-1].base_root != self.disk_root:
+            return
+        for layer in reversed(path[self.max_layers :]):
+            self.__flatten(layer)
+
+        for root in list(self.layers):
+            r = root
+            while r in self.layers:
+                r = self.layers[r].base_root
+            if r != self.disk_root:
+                del self.layers[root]
+
+    def __flatten(self, layer):
+        batch = WriteBatch()
+        for address in layer.destructed:
+            start, end = _storage_range(address)
+            for k, _ in self.db.range_iter(start, end):
+                batch.delete(k)
+        for address, storage in layer.storage.items():
+            for key, value in storage.items():
+                if value:
+                    batch.put(
+                        _storage_key(address, key), utils.int_to_big_endian(value)
+                    )
+                else:
+                    batch.delete(_storage_key(address, key))
+        for address, rlpdata in layer.accounts.items():
+            if rlpdata:
+                batch.put(ACCOUNT_PREFIX + address, rlpdata)
+            else:
+                batch.delete(ACCOUNT_PREFIX + address)
+        batch.put(ROOT_KEY, layer.root)
+        self.db.write(batch)
+        self.disk_root = layer.root
+        del self.layers[layer.root]
+
+    def __clear(self):
+        batch = WriteBatch()
+        for prefix in (ACCOUNT_PREFIX, STORAGE_PREFIX):
+            for k, _ in self.db.range_iter(prefix, prefix + b"\xff" * 64):
+                batch.delete(k)
+        batch.delete(ROOT_KEY)
+        self.db.write(batch)
+        self.disk_root = None
+        self.layers = dict()
+
+    def rebuild(self, root):
+        """ Regenerate the disk tables from the state trie at root """
+        self.__clear()
+        batch = WriteBatch()
+
+        def put(k, v):
+            nonlocal batch
+            batch.put(k, v)
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                self.db.write(batch)
+                batch = WriteBatch()
+
+        state_trie = SecureTrie(Trie(self.db, root))
+        for address, rlpdata in state_trie.iter_branch():
+            put(ACCOUNT_PREFIX + address, rlpdata)
+            storage_root = rlp.decode(rlpdata)[2]
+            if storage_root == BLANK_ROOT:
+                continue
+            storage_trie = SecureTrie(Trie(self.db, storage_root))
+            for k, v in storage_trie.iter_branch():
+                put(STORAGE_PREFIX + address + k, rlp.decode(v))
+        # the root goes last so an interrupted rebuild leaves no usable tables
+        batch.put(ROOT_KEY, root)
+        self.db.write(batch)
+        self.disk_root = root
+
+    def verify(self):
+        """ Compare the disk tables with the state trie at disk_root.
+        Returns a list of mismatches, empty if consistent.
+        """
+        errors = []
+        if self.disk_root is None:
+            return ["no flat state"]
+        accounts = dict()
+        storage = dict()
+        state_trie = SecureTrie(Trie(self.db, self.disk_root))
+        for address, rlpdata in state_trie.iter_branch():
+            accounts[address] = rlpdata
+            storage_root = rlp.decode(rlpdata)[2]
+            if storage_root == BLANK_ROOT:
+                continue
+            storage_trie = SecureTrie(Trie(self.db, storage_root))
+            for k, v in storage_trie.iter_branch():
+                storage[address + k] = rlp.decode(v)
+
+        for prefix, expected in ((ACCOUNT_PREFIX, accounts), (STORAGE_PREFIX, storage)):
+            seen = set()
+            for k, v in self.db.range_iter(prefix, prefix + b"\xff" * 64):
+                key = k[len(prefix) :]
+                seen.add(key)
+                if expected.get(key) != v:
+                    errors.append(
+                        "{} mismatch: flat {} trie {}".format(
+                            k.hex(), v.hex(), (expected.get(key) or b"").hex()
+                        )
+                    )
+            for key in expected.keys() - seen:
+                errors.append("{} missing".format((prefix + key).hex()))
+        return errors
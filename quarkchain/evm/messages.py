@@ -132,6 +132,22 @@ def config_fork_specific_validation(config, blknum, tx):
     return True
 
 
+class ValidatedTransaction:
+    """ Returned by validate_transaction(), so that apply_transaction() skips
+    validating the tx again.  It only holds until the next tx is applied to the state.
+    """
+
+    __slots__ = ("state", "tx", "gas_used")
+
+    def __init__(self, state, tx):
+        self.state = state
+        self.tx = tx
+        self.gas_used = state.gas_used
+
+    def covers(self, state, tx):
+        return self.state is state and self.tx is tx and self.gas_used == state.gas_used
+
+
 def validate_transaction(state, tx):
 
     # (1) The transaction signature is valid;
@@ -172,7 +188,7 @@ def validate_transaction(state, tx):
     if tx.sender == null_address and (tx.value != 0 or tx.gasprice != 0):
         raise InvalidTransaction("EIP86 transactions must have 0 value and gasprice")
 
-    return True
+    return ValidatedTransaction(state, tx)
 
 
 def apply_message(state, msg=None, **kwargs):
@@ -185,19 +201,28 @@ def apply_message(state, msg=None, **kwargs):
     return bytearray_to_bytestr(data) if result else None
 
 
-def apply_transaction(state, tx: transactions.Transaction, tx_wrapper_hash):
+def apply_transaction(
+    state,
+    tx: transactions.Transaction,
+    tx_wrapper_hash,
+    validated: ValidatedTransaction = None,
+):
     """tx_wrapper_hash is the hash for quarkchain.core.Transaction
+    validated is what validate_transaction() returned for the tx, for callers that have
+    just run it on the same state.  The tx is validated again if it doesn't cover them.
     TODO: remove quarkchain.core.Transaction wrapper and use evm.Transaction directly
     """
     state.logs = []
     state.suicides = []
     state.refunds = 0
-    validate_transaction(state, tx)
+    if validated is None or not validated.covers(state, tx):
+        validate_transaction(state, tx)
 
     state.full_shard_key = tx.to_full_shard_key
 
     intrinsic_gas = tx.intrinsic_gas_used
-    log_tx.debug("TX NEW", txdict=tx.to_dict())
+    if log_tx.debug_enabled:
+        log_tx.debug("TX NEW", txdict=tx.to_dict())
 
     # start transacting #################
     if tx.sender != null_address:
@@ -212,47 +237,56 @@ def apply_transaction(state, tx: transactions.Transaction, tx_wrapper_hash):
     assert state.get_balance(tx.sender) >= tx.startgas * tx.gasprice
     state.delta_balance(tx.sender, -tx.startgas * tx.gasprice)
 
-    message_data = vm.CallData([safe_ord(x) for x in tx.data], 0, len(tx.data))
-    message = vm.Message(
-        tx.sender,
-        tx.to,
-        tx.value,
-        tx.startgas - intrinsic_gas,
-        message_data,
-        code_address=tx.to,
-        is_cross_shard=tx.is_cross_shard,
-        from_full_shard_key=tx.from_full_shard_key,
-        to_full_shard_key=tx.to_full_shard_key,
-        tx_hash=tx_wrapper_hash,
-    )
+    contract_address = b""
+    if is_value_transfer(state, tx):
+        result, gas_remained, data = apply_value_transfer(
+            state, tx, tx_wrapper_hash, tx.startgas - intrinsic_gas
+        )
+    else:
+        message_data = vm.CallData([safe_ord(x) for x in tx.data], 0, len(tx.data))
+        message = vm.Message(
+            tx.sender,
+            tx.to,
+            tx.value,
+            tx.startgas - intrinsic_gas,
+            message_data,
+            code_address=tx.to,
+            is_cross_shard=tx.is_cross_shard,
+            from_full_shard_key=tx.from_full_shard_key,
+            to_full_shard_key=tx.to_full_shard_key,
+            tx_hash=tx_wrapper_hash,
+        )
 
-    # MESSAGE
-    ext = VMExt(state, tx)
+        # MESSAGE
+        ext = VMExt(state, tx)
 
-    contract_address = b""
-    if tx.to != b"":
-        result, gas_remained, data = apply_msg(ext, message)
-    else:  # CREATE
-        result, gas_remained, data = create_contract(ext, message)
-        contract_address = (
-            data if data else b""
-        )  # data could be [] when vm failed execution
+        if tx.to != b"":
+            result, gas_remained, data = apply_msg(ext, message)
+        else:  # CREATE
+            result, gas_remained, data = create_contract(ext, message)
+            contract_address = (
+                data if data else b""
+            )  # data could be [] when vm failed execution
 
     assert gas_remained >= 0
 
-    log_tx.debug("TX APPLIED", result=result, gas_remained=gas_remained, data=data)
+    if log_tx.debug_enabled:
+        log_tx.debug(
+            "TX APPLIED", result=result, gas_remained=gas_remained, data=data
+        )
 
     gas_used = tx.startgas - gas_remained
 
     # pay CORRECT tx fee (after tax) to coinbase so that each step of state is accurate
     # Transaction failed
     if not result:
-        log_tx.debug(
-            "TX FAILED",
-            reason="out of gas",
-            startgas=tx.startgas,
-            gas_remained=gas_remained,
-        )
+        if log_tx.debug_enabled:
+            log_tx.debug(
+                "TX FAILED",
+                reason="out of gas",
+                startgas=tx.startgas,
+                gas_remained=gas_remained,
+            )
         state.delta_balance(tx.sender, tx.gasprice * gas_remained)
         fee = (
             tx.gasprice
@@ -266,10 +300,14 @@ def apply_transaction(state, tx: transactions.Transaction, tx_wrapper_hash):
         success = 0
     # Transaction success
     else:
-        log_tx.debug("TX SUCCESS", data=data)
+        if log_tx.debug_enabled:
+            log_tx.debug("TX SUCCESS", data=data)
         state.refunds += len(set(state.suicides)) * opcodes.GSUICIDEREFUND
         if state.refunds > 0:
-            log_tx.debug("Refunding", gas_refunded=min(state.refunds, gas_used // 2))
+            if log_tx.debug_enabled:
+                log_tx.debug(
+                    "Refunding", gas_refunded=min(state.refunds, gas_used // 2)
+                )
             gas_remained += min(state.refunds, gas_used // 2)
             gas_used -= min(state.refunds, gas_used // 2)
             state.refunds = 0
@@ -324,6 +362,7 @@ class VMExt:
             self.specials[k] = v
         self._state = state
         self.get_code = state.get_code
+        self.get_code_hash = state.get_code_hash
         self.set_code = state.set_code
         self.get_balance = state.get_balance
         self.set_balance = state.set_balance
@@ -347,7 +386,7 @@ class VMExt:
         self.block_gas_limit = state.gas_limit
         self.log = lambda addr, topics, data: state.add_log(Log(addr, topics, data))
         self.create = lambda msg: create_contract(self, msg)
-        self.msg = lambda msg: _apply_msg(self, msg, self.get_code(msg.code_address))
+        self.msg = lambda msg: apply_msg(self, msg)
         self.account_exists = state.account_exists
         self.post_homestead_hardfork = lambda: state.is_HOMESTEAD()
         self.post_metropolis_hardfork = lambda: state.is_METROPOLIS()
@@ -368,12 +407,51 @@ class VMExt:
         self.tx_gasprice = tx.gasprice if tx else 0
 
 
+def is_value_transfer(state, tx):
+    """ Whether the tx only moves value, i.e. has no data and calls no code"""
+    if tx.to == CREATE_CONTRACT_ADDRESS or tx.data:
+        return False
+    if tx.to in default_specials or any(
+        tx.to == k for k, _ in state.config["CUSTOM_SPECIALS"]
+    ):
+        return False
+    return not state.get_code(tx.to)
+
+
+def apply_value_transfer(state, tx, tx_wrapper_hash, gas):
+    """ Same as apply_msg() for a tx passing is_value_transfer() but without
+    setting up the VM.  Running empty code can't fail so the call always succeeds
+    and leaves the gas untouched, even if the value couldn't be transferred.
+    """
+    if tx.is_cross_shard:
+        if state.deduct_value(tx.sender, tx.value):
+            state.xshard_list.append(
+                quarkchain.core.CrossShardTransactionDeposit(
+                    tx_hash=tx_wrapper_hash,
+                    from_address=quarkchain.core.Address(
+                        tx.sender, tx.from_full_shard_key
+                    ),
+                    to_address=quarkchain.core.Address(tx.to, tx.to_full_shard_key),
+                    value=tx.value,
+                    gas_price=tx.gasprice,
+                )
+            )
+    elif not state.transfer_value(tx.sender, tx.to, tx.value):
+        if log_msg.debug_enabled:
+            log_msg.debug(
+                "MSG TRANSFER FAILED", have=state.get_balance(tx.to), want=tx.value
+            )
+    return 1, gas, []
+
+
 def apply_msg(ext, msg):
-    return _apply_msg(ext, msg, ext.get_code(msg.code_address))
+    return _apply_msg(
+        ext, msg, ext.get_code(msg.code_address), ext.get_code_hash(msg.code_address)
+    )
 
 
-def _apply_msg(ext, msg, code):
-    trace_msg = log_msg.is_active("trace")
+def _apply_msg(ext, msg, code, code_hash=None):
+    trace_msg = log_msg.trace_enabled
     if trace_msg:
         log_msg.debug(
             "MSG APPLY",
@@ -408,9 +486,10 @@ def _apply_msg(ext, msg, code):
                 )
             )
         elif not ext.transfer_value(msg.sender, msg.to, msg.value):
-            log_msg.debug(
-                "MSG TRANSFER FAILED", have=ext.get_balance(msg.to), want=msg.value
-            )
+            if log_msg.debug_enabled:
+                log_msg.debug(
+                    "MSG TRANSFER FAILED", have=ext.get_balance(msg.to), want=msg.value
+                )
             return 1, msg.gas, []
 
     if msg.is_cross_shard:
@@ -421,7 +500,7 @@ def _apply_msg(ext, msg, code):
     if msg.code_address in ext.specials:
         res, gas, dat = ext.specials[msg.code_address](ext, msg)
     else:
-        res, gas, dat = vm.vm_execute(ext, msg, code)
+        res, gas, dat = vm.vm_execute(ext, msg, code, code_hash)
 
     if trace_msg:
         log_msg.debug(
@@ -434,7 +513,8 @@ def _apply_msg(ext, msg, code):
         )
 
     if res == 0:
-        log_msg.debug("REVERTING")
+        if log_msg.debug_enabled:
+            log_msg.debug("REVERTING")
         ext.revert(snapshot)
 
     return res, gas, dat
@@ -447,7 +527,8 @@ def mk_contract_address(sender, full_shard_key, nonce):
 
 
 def create_contract(ext, msg):
-    log_msg.debug("CONTRACT CREATION")
+    if log_msg.debug_enabled:
+        log_msg.debug("CONTRACT CREATION")
 
     if msg.is_cross_shard:
         return 0, msg.gas, b""
@@ -467,7 +548,8 @@ def create_contract(ext, msg):
     if ext.post_metropolis_hardfork() and (
         ext.get_nonce(msg.to) or len(ext.get_code(msg.to))
     ):
-        log_msg.debug("CREATING CONTRACT ON TOP OF EXISTING CONTRACT")
+        if log_msg.debug_enabled:
+            log_msg.debug("CREATING CONTRACT ON TOP OF EXISTING CONTRACT")
         return 0, 0, b""
 
     b = ext.get_balance(msg.to)
@@ -485,12 +567,13 @@ def create_contract(ext, msg):
     ext.set_nonce(msg.to, 1 if ext.post_spurious_dragon_hardfork() else 0)
     res, gas, dat = _apply_msg(ext, msg, code)
 
-    log_msg.debug(
-        "CONTRACT CREATION FINISHED",
-        res=res,
-        gas=gas,
-        dat=dat if len(dat) < 2500 else ("data<%d>" % len(dat)),
-    )
+    if log_msg.debug_enabled:
+        log_msg.debug(
+            "CONTRACT CREATION FINISHED",
+            res=res,
+            gas=gas,
+            dat=dat if len(dat) < 2500 else ("data<%d>" % len(dat)),
+        )
 
     if res:
         if not len(dat):
@@ -503,17 +586,19 @@ def create_contract(ext, msg):
             gas -= gcost
         else:
             dat = []
-            log_msg.debug(
-                "CONTRACT CREATION FAILED",
-                have=gas,
-                want=gcost,
-                block_number=ext.block_number,
-            )
+            if log_msg.debug_enabled:
+                log_msg.debug(
+                    "CONTRACT CREATION FAILED",
+                    have=gas,
+                    want=gcost,
+                    block_number=ext.block_number,
+                )
             if ext.post_homestead_hardfork():
                 ext.revert(snapshot)
                 return 0, 0, b""
         ext.set_code(msg.to, bytearray_to_bytestr(dat))
-        log_msg.debug("SETTING CODE", addr=encode_hex(msg.to), lendat=len(dat))
+        if log_msg.debug_enabled:
+            log_msg.debug("SETTING CODE", addr=encode_hex(msg.to), lendat=len(dat))
         return 1, gas, msg.to
     else:
         ext.revert(snapshot)
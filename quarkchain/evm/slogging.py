@@ -171,6 +171,7 @@ class SLogger(logging.Logger):
     def __init__(self, name, level=DEFAULT_LOGLEVEL):
         self.warn = self.warning
         super(SLogger, self).__init__(name, level=level)
+        self.refresh_enabled()
 
     @property
     def log_json(self):
@@ -179,6 +180,22 @@ class SLogger(logging.Logger):
     def is_active(self, level_name='trace'):
         return self.isEnabledFor(logging._checkLevel(level_name.upper()))
 
+    def refresh_enabled(self):
+        """
+        trace_enabled and debug_enabled are plain attributes so that hot paths can
+        skip building the arguments of disabled log calls with one attribute check:
+
+            if log.debug_enabled:
+                log.debug("TX NEW", txdict=tx.to_dict())
+        """
+        self.trace_enabled = self.isEnabledFor(TRACE)
+        self.debug_enabled = self.isEnabledFor(logging.DEBUG)
+
+    def setLevel(self, level):
+        super(SLogger, self).setLevel(level)
+        # the effective level of the descendants may have changed as well
+        SLogger.manager.refresh_enabled()
+
     def format_message(self, msg, kwargs, highlight, level):
         if getattr(self, 'log_json', False):
             message = dict()
@@ -254,7 +271,16 @@ class SManager(logging.Manager):
 
     def getLogger(self, name):
         logging.setLoggerClass(SLogger)
-        return super(SManager, self).getLogger(name)
+        logger = super(SManager, self).getLogger(name)
+        # now that it is attached to its parent
+        logger.refresh_enabled()
+        return logger
+
+    def refresh_enabled(self):
+        self.root.refresh_enabled()
+        for logger in self.loggerDict.values():
+            if isinstance(logger, SLogger):
+                logger.refresh_enabled()
 
 
 rootLogger = RootLogger(DEFAULT_LOGLEVEL)
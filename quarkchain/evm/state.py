@@ -21,6 +21,7 @@ from quarkchain.evm.securetrie import SecureTrie
 from quarkchain.evm.config import Env
 from quarkchain.db import Db, OverlayDb
 from quarkchain.evm.common import FakeHeader
+from quarkchain.evm.vm import get_cached_code
 import copy
 
 
@@ -86,8 +87,11 @@ class Account(rlp.Serializable):
         self.full_shard_key = acc.full_shard_key
 
         self.storage_cache = {}
-        self.storage_trie = SecureTrie(Trie(self.db))
+        self.storage_trie = SecureTrie(Trie(self.db, write_back=True))
         self.storage_trie.root_hash = self.storage
+        # reads storage from the flat state, None if unavailable
+        self.flat_storage = None
+        self.storage_reset = False
         self.touched = False
         self.existent_at_start = True
         self._mutable = True
@@ -104,7 +108,7 @@ class Account(rlp.Serializable):
 
     @property
     def code(self):
-        return self.db[self.code_hash]
+        return get_cached_code(self.code_hash, lambda: self.db[self.code_hash]).code
 
     @code.setter
     def code(self, value):
@@ -116,10 +120,13 @@ class Account(rlp.Serializable):
 
     def get_storage_data(self, key):
         if key not in self.storage_cache:
-            v = self.storage_trie.get(utils.encode_int32(key))
-            self.storage_cache[key] = utils.big_endian_to_int(
-                rlp.decode(v) if v else b""
-            )
+            v = None
+            if self.flat_storage is not None:
+                v = self.flat_storage(self.address, key)
+            if v is None:
+                v = self.storage_trie.get(utils.encode_int32(key))
+                v = utils.big_endian_to_int(rlp.decode(v) if v else b"")
+            self.storage_cache[key] = v
         return self.storage_cache[key]
 
     def set_storage_data(self, key, value):
@@ -143,6 +150,27 @@ class Account(rlp.Serializable):
         o.existent_at_start = False
         return o
 
+    def is_clean(self):
+        """ Unmodified since it was read from the trie """
+        return not (self.touched or self.deleted or self.storage_reset)
+
+    def copy(self, env, db):
+        """ Copy of a clean account that writes to db """
+        o = Account(
+            self.nonce,
+            self.balance,
+            self.storage,
+            self.code_hash,
+            self.full_shard_key,
+            env,
+            self.address,
+            db=db,
+        )
+        o.storage_cache = dict(self.storage_cache)
+        o.existent_at_start = self.existent_at_start
+        o._cached_rlp = None
+        return o
+
     def is_blank(self):
         return self.nonce == 0 and self.balance == 0 and self.code_hash == BLANK_HASH
 
@@ -184,21 +212,47 @@ class State:
             db = env.db
         self.env = env
         self.__db = db
-        self.trie = SecureTrie(Trie(self.db, root))
+        self.trie = SecureTrie(Trie(self.db, root, write_back=True))
         for k, v in STATE_DEFAULTS.items():
             setattr(self, k, kwargs.get(k, copy.copy(v)))
         self.journal = []
         self.cache = {}
+        # accounts cached by the state this one was cloned from, see ephemeral_clone()
+        self.parent_cache = {}
+        self.parent_root = None
         self.log_listeners = []
         self.deletes = []
         self.changed = {}
         self.executing_on_head = executing_on_head
         self.qkc_config = qkc_config
+        # optional FlatState serving account and storage reads, and the
+        # changes made by commit() since a root known to it
+        self.flat_state = None
+        self.flat_diff = None
+        # trie nodes flushed to db by commit()
+        self.trie_nodes_written = 0
+        self.trie_bytes_written = 0
+        # when set to a list, receives the (hash, rlp) of the trie nodes flushed that
+        # were not in db yet, see cluster.state_pruning
+        self.new_trie_nodes = None
 
     @property
     def db(self):
         return self.__db
 
+    def set_db(self, db):
+        """ Moves the committed state to db, which must have all its nodes, e.g. the
+        db that the write batch of the state was committed to
+        """
+        self.__db = db
+        trie_list = [self.trie]
+        for acct in self.cache.values():
+            acct.db = db
+            trie_list.append(acct.storage_trie)
+        for t in trie_list:
+            t.db = db
+            t.trie.db = db
+
     @property
     def config(self):
         return self.env.config
@@ -217,15 +271,33 @@ class State:
     def add_block_header(self, block_header):
         self.prev_headers = [block_header] + self.prev_headers
 
+    def get_flat_diff(self):
+        if self.flat_state is None:
+            return None
+        if self.flat_diff is None or self.flat_diff.root != self.trie.root_hash:
+            # root was set outside commit(), start over from it
+            self.flat_diff = self.flat_state.new_diff(self.trie.root_hash)
+        return self.flat_diff
+
     def get_and_cache_account(self, address):
         if address in self.cache:
             return self.cache[address]
-        if self.executing_on_head and False:
-            try:
-                rlpdata = self.db[b"address:" + address]
-            except KeyError:
-                rlpdata = b""
-        else:
+        flat_diff = self.get_flat_diff()
+        parent_acct = self.parent_cache.get(address)
+        if (
+            parent_acct is not None
+            and parent_acct.is_clean()
+            and self.parent_root == self.trie.root_hash
+        ):
+            o = parent_acct.copy(self.env, self.db)
+            if flat_diff is not None:
+                o.flat_storage = flat_diff.get_storage
+            self.cache[address] = o
+            return o
+        rlpdata = None
+        if flat_diff is not None:
+            rlpdata = flat_diff.get_account(address)
+        if rlpdata is None:
             rlpdata = self.trie.get(address)
         if rlpdata != trie.BLANK_NODE:
             o = rlp.decode(rlpdata, _Account)
@@ -247,6 +319,8 @@ class State:
                 self.config["ACCOUNT_INITIAL_NONCE"],
                 db=self.db,
             )
+        if flat_diff is not None:
+            o.flat_storage = flat_diff.get_storage
         self.cache[address] = o
         o._mutable = True
         o._cached_rlp = None
@@ -258,6 +332,9 @@ class State:
     def get_code(self, address):
         return self.get_and_cache_account(utils.normalize_address(address)).code
 
+    def get_code_hash(self, address):
+        return self.get_and_cache_account(utils.normalize_address(address)).code_hash
+
     def get_nonce(self, address):
         return self.get_and_cache_account(utils.normalize_address(address)).nonce
 
@@ -354,6 +431,7 @@ class State:
             assert L == 0
             self.trie.root_hash = h
             self.cache = {}
+            self.parent_cache = {}
         for k in STATE_DEFAULTS:
             setattr(self, k, copy.copy(auxvars[k]))
         if (
@@ -441,10 +519,25 @@ class State:
     def account_to_dict(self, address):
         return self.get_and_cache_account(utils.normalize_address(address)).to_dict()
 
+    def flush_trie(self, t):
+        if self.new_trie_nodes is not None:
+            self.new_trie_nodes.extend(
+                (k, v) for k, v in t.trie.dirty.items() if self.db.get(k) is None
+            )
+        count, size = t.flush()
+        self.trie_nodes_written += count
+        self.trie_bytes_written += size
+
     def commit(self, allow_empties=False):
+        flat_diff = self.get_flat_diff()
         for addr, acct in self.cache.items():
             if acct.touched or acct.deleted:
+                if flat_diff is not None:
+                    if acct.storage_reset:
+                        flat_diff.destruct(addr)
+                    flat_diff.update_storage(addr, acct.storage_cache)
                 acct.commit()
+                self.flush_trie(acct.storage_trie)
                 self.deletes.extend(acct.storage_trie.deletes)
                 self.changed[addr] = True
                 if self.account_exists(addr) or allow_empties:
@@ -456,18 +549,27 @@ class State:
                         acct.full_shard_key,
                     )
                     self.trie.update(addr, rlp.encode(_acct))
+                    if flat_diff is not None:
+                        flat_diff.update_account(addr, rlp.encode(_acct))
                     if self.executing_on_head:
                         self.db.put(b"address:" + addr, rlp.encode(_acct))
                 else:
                     self.trie.delete(addr)
+                    if flat_diff is not None:
+                        flat_diff.destruct(addr)
+                        flat_diff.update_account(addr, b"")
                     if self.executing_on_head:
                         try:
                             self.db.remove(b"address:" + addr)
                         except KeyError:
                             pass
+        self.flush_trie(self.trie)
         self.deletes.extend(self.trie.deletes)
         self.trie.deletes = []
         self.cache = {}
+        self.parent_cache = {}
+        if flat_diff is not None:
+            flat_diff.root = self.trie.root_hash
         self.journal = []
 
     def to_dict(self):
@@ -497,6 +599,12 @@ class State:
         pre_cache = acct.storage_cache
         acct.storage_cache = {}
         self.journal.append(lambda: setattr(acct, "storage_cache", pre_cache))
+        pre_flat_storage = acct.flat_storage
+        acct.flat_storage = None
+        self.journal.append(lambda: setattr(acct, "flat_storage", pre_flat_storage))
+        pre_reset = acct.storage_reset
+        acct.storage_reset = True
+        self.journal.append(lambda: setattr(acct, "storage_reset", pre_reset))
         pre_root = acct.storage_trie.root_hash
         self.journal.append(lambda: setattr(acct.storage_trie, "root_hash", pre_root))
         acct.storage_trie.root_hash = BLANK_ROOT
@@ -589,18 +697,26 @@ class State:
         return state
 
     def ephemeral_clone(self):
-        snapshot = self.to_snapshot(root_only=True, no_prevblocks=True)
-        env2 = Env(OverlayDb(self.db), self.env.config)
-        s = State.from_snapshot(snapshot, env2)
+        """ Copy-on-write fork of the committed state.
+
+        The clone opens the same state root on an OverlayDb over this state's db, so
+        trie nodes are read through (and from the shared node cache) while its
+        writes stay local.  Clean accounts cached here are copied into the clone
+        on first access instead of being decoded again.
+        """
+        env2 = Env(OverlayDb(self.db, temporary=True), self.env.config)
+        s = State(self.trie.root_hash, env2, qkc_config=self.qkc_config)
         for param in STATE_DEFAULTS:
-            setattr(s, param, getattr(self, param))
+            v = getattr(self, param)
+            # the per-block lists are appended to by apply_transaction
+            setattr(s, param, list(v) if isinstance(v, list) else v)
         s.recent_uncles = self.recent_uncles
-        s.prev_headers = self.prev_headers
         for acct in self.cache.values():
             assert not acct.touched or not acct.deleted
         s.journal = copy.copy(self.journal)
-        s.cache = {}
-        s.qkc_config = self.qkc_config
+        s.parent_cache = self.cache
+        s.parent_root = self.trie.root_hash
+        s.flat_state = self.flat_state
         return s
 
 
@@ -3,7 +3,7 @@ from quarkchain.evm.common import FakeHeader
 from quarkchain.evm.utils import decode_hex, parse_int_or_hex, sha3, to_string, \
     remove_0x_head, encode_hex, big_endian_to_int
 from quarkchain.evm.config import default_config, Env
-from quarkchain.config import get_default_evm_config
+from quarkchain.config import get_default_evm_config, QuarkChainConfig
 from quarkchain.evm.exceptions import InvalidTransaction
 import quarkchain.evm.transactions as transactions
 from quarkchain.evm.messages import apply_transaction
@@ -92,6 +92,8 @@ def compute_state_test_unit(state, txdata, indices, konfig):
             to=decode_hex(remove_0x_head(txdata['to'])),
             value=parse_int_or_hex(txdata['value'][indices["value"]] or b"0"),
             data=decode_hex(remove_0x_head(txdata['data'][indices["data"]])))
+        # an in-shard tx
+        tx.set_quark_chain_config(QuarkChainConfig())
         if 'secretKey' in txdata:
             tx.sign(decode_hex(remove_0x_head(txdata['secretKey'])))
         else:
@@ -100,7 +102,7 @@ def compute_state_test_unit(state, txdata, indices, konfig):
             tx._in_mutable_context = False
         # Run it
         prev = state.to_dict()
-        success, output = apply_transaction(state, tx)
+        success, output = apply_transaction(state, tx, b"")
         print("Applied tx")
     except InvalidTransaction as e:
         print("Exception: %r" % e)
@@ -0,0 +1,69 @@
+import unittest
+
+from quarkchain.db import InMemoryDb
+from quarkchain.evm.config import Env
+from quarkchain.evm.flat_state import FlatState
+from quarkchain.evm.state import State
+
+
+class TestFlatState(unittest.TestCase):
+    def new_state(self, flat_state, root):
+        state = State(env=Env(flat_state.db), db=flat_state.db)
+        state.trie.root_hash = root
+        state.flat_state = flat_state
+        return state
+
+    def commit_block(self, flat_state, state):
+        state.commit()
+        self.assertTrue(flat_state.add_layer(state.get_flat_diff()))
+        state.flat_diff = None
+        flat_state.cap(state.trie.root_hash)
+        return state.trie.root_hash
+
+    def test_layers_and_flatten(self):
+        db = InMemoryDb()
+        a1, a2 = b"\x01" * 20, b"\x02" * 20
+        state = State(env=Env(db), db=db)
+        state.set_balance(a1, 100)
+        state.set_storage_data(a2, 1, 11)
+        state.set_storage_data(a2, 2, 22)
+        state.commit()
+        genesis_root = state.trie.root_hash
+
+        flat_state = FlatState(db, max_layers=1)
+        flat_state.rebuild(genesis_root)
+        self.assertEqual(flat_state.verify(), [])
+        self.assertEqual(flat_state.get_storage(genesis_root, a2, 2), 22)
+
+        state = self.new_state(flat_state, genesis_root)
+        state.set_storage_data(a2, 2, 0)
+        state.set_storage_data(a2, 3, 33)
+        state.delta_balance(a1, 1)
+        state.commit()
+        # several commits within a block make one layer
+        state.delta_balance(a1, 1)
+        root1 = self.commit_block(flat_state, state)
+        self.assertEqual(flat_state.layers[root1].base_root, genesis_root)
+        self.assertEqual(flat_state.get_storage(root1, a2, 2), 0)
+        self.assertEqual(flat_state.get_storage(root1, a2, 3), 33)
+        self.assertEqual(self.new_state(flat_state, root1).get_balance(a1), 102)
+
+        # wiping the storage of a2 in the next block
+        state = self.new_state(flat_state, root1)
+        state.del_account(a2)
+        state.set_storage_data(a2, 4, 44)
+        root2 = self.commit_block(flat_state, state)
+        self.assertEqual(flat_state.disk_root, root1)
+        self.assertEqual(flat_state.verify(), [])
+        self.assertEqual(flat_state.get_storage(root2, a2, 1), 0)
+        self.assertEqual(flat_state.get_storage(root2, a2, 4), 44)
+
+        state = self.new_state(flat_state, root2)
+        state.delta_balance(a1, 1)
+        root3 = self.commit_block(flat_state, state)
+        self.assertEqual(flat_state.disk_root, root2)
+        self.assertEqual(list(flat_state.layers), [root3])
+        self.assertEqual(flat_state.verify(), [])
+        # root is no longer known
+        self.assertIsNone(flat_state.get_account(genesis_root, a1))
+        self.assertEqual(self.new_state(flat_state, root3).get_storage_data(a2, 4), 44)
@@ -0,0 +1,118 @@
+import unittest
+from unittest import mock
+
+from quarkchain.config import QuarkChainConfig
+from quarkchain.db import InMemoryDb
+from quarkchain.evm import messages, opcodes
+from quarkchain.evm.config import Env
+from quarkchain.evm.messages import apply_transaction
+from quarkchain.evm.state import State
+from quarkchain.evm.transactions import Transaction
+
+
+class TestApplyValueTransfer(unittest.TestCase):
+    sender = b"\x01" * 20
+    coinbase = b"\x02" * 20
+    contract = b"\x03" * 20
+    precompile = b"\x00" * 19 + b"\x04"  # identity
+
+    def new_state(self):
+        db = InMemoryDb()
+        state = State(env=Env(db), db=db, qkc_config=QuarkChainConfig())
+        state.set_balance(self.sender, 10 ** 18)
+        # STOP
+        state.set_code(self.contract, b"\x00")
+        state.commit()
+        state.block_coinbase = self.coinbase
+        return state
+
+    def make_txs(self, qkc_config):
+        xshard_gas = opcodes.GTXCOST + opcodes.GTXXSHARDCOST
+        txs = []
+        for to, value, data, startgas, to_full_shard_key in [
+            (b"\x10" * 20, 12345, b"", 21000, 0),
+            (b"\x11" * 20, 0, b"", 30000, 0),
+            (self.sender, 7, b"", 21000, 0),
+            (b"\x12" * 20, 999, b"", xshard_gas, 1 << 16),
+            (b"\x12" * 20, 999, b"", xshard_gas + 5000, 2 << 16),
+            (self.contract, 5, b"", 50000, 0),
+            (self.precompile, 5, b"", 50000, 0),
+            (b"\x13" * 20, 5, b"\x01\x02", 50000, 0),
+        ]:
+            tx = Transaction(
+                nonce=len(txs),
+                gasprice=3,
+                startgas=startgas,
+                to=to,
+                value=value,
+                data=data,
+                to_full_shard_key=to_full_shard_key,
+            )
+            tx.sender = self.sender
+            tx.set_quark_chain_config(qkc_config)
+            txs.append(tx)
+        return txs
+
+    def apply(self, state):
+        results = [
+            apply_transaction(state, tx, i.to_bytes(32, byteorder="big"))
+            for i, tx in enumerate(self.make_txs(state.qkc_config))
+        ]
+        state.commit()
+        return results
+
+    def test_same_as_vm(self):
+        fast = self.new_state()
+        with mock.patch.object(
+            messages, "apply_value_transfer", wraps=messages.apply_value_transfer
+        ) as m:
+            fast_results = self.apply(fast)
+        # the transfers to accounts without code
+        self.assertEqual(m.call_count, 5)
+
+        slow = self.new_state()
+        with mock.patch.object(messages, "is_value_transfer", return_value=False):
+            slow_results = self.apply(slow)
+
+        self.assertEqual(fast_results, slow_results)
+        self.assertEqual(fast.trie.root_hash, slow.trie.root_hash)
+        self.assertEqual(fast.receipts, slow.receipts)
+        self.assertEqual(fast.bloom, slow.bloom)
+        self.assertEqual(fast.gas_used, slow.gas_used)
+        self.assertEqual(fast.block_fee, slow.block_fee)
+        self.assertEqual(fast.xshard_list, slow.xshard_list)
+        self.assertEqual(len(fast.xshard_list), 2)
+        self.assertEqual(
+            fast.get_balance(self.coinbase), slow.get_balance(self.coinbase)
+        )
+
+
+class TestApplyTransaction(unittest.TestCase):
+    def test_validated(self):
+        db = InMemoryDb()
+        state = State(env=Env(db), db=db, qkc_config=QuarkChainConfig())
+        state.gas_limit = 10 ** 6
+        state.set_balance(b"\x01" * 20, 10 ** 18)
+        tx_list = []
+        for nonce in range(3):
+            tx = Transaction(nonce, 1, 21000, b"\x02" * 20, 1, b"")
+            tx.sender = b"\x01" * 20
+            tx.set_quark_chain_config(state.qkc_config)
+            tx_list.append(tx)
+
+        def count_validations(tx, validated):
+            with mock.patch.object(
+                messages, "validate_transaction", wraps=messages.validate_transaction
+            ) as m:
+                apply_transaction(state, tx, bytes(32), validated=validated)
+            return m.call_count
+
+        validated = messages.validate_transaction(state, tx_list[0])
+        self.assertEqual(count_validations(tx_list[0], validated), 0)
+        # validated for another tx
+        self.assertEqual(count_validations(tx_list[1], validated), 1)
+        # validated before another tx was applied
+        validated = messages.validate_transaction(state, tx_list[2])
+        state.gas_used += 21000
+        self.assertEqual(count_validations(tx_list[2], validated), 1)
+        self.assertEqual(state.get_balance(b"\x02" * 20), 3)
@@ -0,0 +1,22 @@
+from quarkchain.evm import slogging
+
+
+def test_enabled_flags_follow_levels():
+    parent = slogging.get_logger("test_slogging")
+    child = slogging.get_logger("test_slogging.child")
+    try:
+        slogging.configure(":info")
+        assert not child.debug_enabled and not child.trace_enabled
+
+        # setting the level of a parent updates the descendants
+        parent.setLevel("TRACE")
+        assert child.debug_enabled and child.trace_enabled
+
+        parent.setLevel("DEBUG")
+        assert child.debug_enabled and not child.trace_enabled
+
+        slogging.configure("test_slogging.child.grandchild:trace")
+        grandchild = slogging.get_logger("test_slogging.child.grandchild")
+        assert grandchild.trace_enabled and not child.debug_enabled
+    finally:
+        slogging.configure(":info")
@@ -0,0 +1,92 @@
+""" Regression test of the interpreter on the GeneralStateTests fixtures.
+
+The roots in the fixtures need the changes of
+fixtures/0001-Necessary-changes-to-let-evm-tests-pass.patch (see test_state.py),
+so the post-state roots under the QuarkChain account format are recorded instead,
+with the interpreter that ran code one instruction at a time.  To record them
+again, e.g. after a change of the expected behavior:
+
+    python -m quarkchain.evm.tests.test_state_roots
+"""
+import json
+import os
+
+import pytest
+
+from quarkchain.evm.tests import new_statetest_utils, testutils
+
+# covering arithmetic, stack, memory, jumps, logs, calls, creates, reverts, refunds
+# and the invalid opcodes, running all the fixtures takes minutes
+FIXTURE_DIRS = [
+    "stBadOpcode",
+    "stCallCodes",
+    "stChangedEIP150",
+    "stCreateTest",
+    "stExample",
+    "stInitCodeTest",
+    "stLogTests",
+    "stMemoryTest",
+    "stRefundTest",
+    "stReturnDataTest",
+    "stRevertTest",
+    "stSolidityTest",
+    "stStackTests",
+    "stSystemOperationsTest",
+    "stTransactionTest",
+    "stWalletTest",
+]
+ROOTS_PATH = os.path.join(os.path.dirname(__file__), "state_roots.json")
+
+
+def compute_state_roots(testdata):
+    """ Post-state roots of the Byzantium units of the test, None if it can't run"""
+    try:
+        state = new_statetest_utils.init_state(testdata["env"], testdata["pre"])
+        return [
+            new_statetest_utils.compute_state_test_unit(
+                state,
+                testdata["transaction"],
+                result["indexes"],
+                new_statetest_utils.configs["Byzantium"],
+            )["hash"][2:]
+            for result in testdata["post"].get("Byzantium", [])
+        ]
+    except Exception:
+        # e.g. the creates from a message with no full shard key
+        return None
+
+
+def compute_dir_roots(dirname):
+    fixtures = testutils.get_tests_from_file_or_dir(
+        os.path.join(testutils.fixture_path, "GeneralStateTests", dirname)
+    )
+    roots = dict()
+    for tests in fixtures.values():
+        for testname, testdata in tests.items():
+            roots[dirname + "/" + testname] = compute_state_roots(testdata)
+    return roots
+
+
+@pytest.mark.parametrize("dirname", FIXTURE_DIRS)
+def test_state_roots(dirname):
+    with open(ROOTS_PATH) as f:
+        expected = {
+            k: v for k, v in json.load(f).items() if k.startswith(dirname + "/")
+        }
+    roots = compute_dir_roots(dirname)
+    assert roots.keys() == expected.keys()
+    mismatched = sorted(k for k in roots if roots[k] != expected[k])
+    assert not mismatched, mismatched
+
+
+def main():
+    roots = dict()
+    for dirname in FIXTURE_DIRS:
+        roots.update(compute_dir_roots(dirname))
+    with open(ROOTS_PATH, "w") as f:
+        json.dump(roots, f, indent=0, sort_keys=True)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
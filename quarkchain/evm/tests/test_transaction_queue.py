@@ -1,12 +1,24 @@
 import unittest
 
 from quarkchain.evm.transactions import Transaction
-from quarkchain.evm.transaction_queue import OrderableTx, TransactionQueue
+from quarkchain.evm.transaction_queue import (
+    OrderableTx,
+    TransactionQueue,
+    ReplacementUnderpriced,
+    QueueFull,
+)
 
 
-def make_test_tx(s=100000, g=50, data=b'', nonce=0):
-        return Transaction(nonce=nonce, startgas=s, gasprice=g,
-                           value=0, data=data, to=b'\x35' * 20)
+def make_test_tx(s=100000, g=50, data=b'', nonce=0, sender=None):
+        tx = Transaction(nonce=nonce, startgas=s, gasprice=g,
+                         value=0, data=data, to=b'\x35' * 20)
+        if sender is not None:
+            tx.sender = sender
+        return tx
+
+
+def make_sender(i):
+    return i.to_bytes(20, byteorder="big")
 
 
 class TestTransactionQueue(unittest.TestCase):
@@ -26,8 +38,9 @@ class TestTransactionQueue(unittest.TestCase):
                       (30000, None, None),
                       (999999, 50000, 74)]
         # Add transactions to queue
-        for param in params:
-            q.add_transaction(make_test_tx(s=param[0], g=param[1]))
+        for i, param in enumerate(params):
+            q.add_transaction(
+                make_test_tx(s=param[0], g=param[1], nonce=i, sender=make_sender(i)))
         # Attempt pops from queue
         for (maxgas, expected_s, expected_g) in operations:
             tx = q.pop_transaction(max_gas=maxgas)
@@ -38,23 +51,23 @@ class TestTransactionQueue(unittest.TestCase):
         print('Test successful')
 
     def test_diff(self):
-        tx1 = make_test_tx(data=b'foo')
-        tx2 = make_test_tx(data=b'bar')
-        tx3 = make_test_tx(data=b'baz')
-        tx4 = make_test_tx(data=b'foobar')
+        tx1 = make_test_tx(data=b'foo', sender=make_sender(1))
+        tx2 = make_test_tx(data=b'bar', sender=make_sender(2))
+        tx3 = make_test_tx(data=b'baz', sender=make_sender(3))
+        tx4 = make_test_tx(data=b'foobar', sender=make_sender(4))
         q1 = TransactionQueue()
         for tx in [tx1, tx2, tx3, tx4]:
             q1.add_transaction(tx)
         q2 = q1.diff([tx2])
         assert len(q2) == 3
-        assert tx1 in [item.tx for item in q2.txs]
-        assert tx3 in [item.tx for item in q2.txs]
-        assert tx4 in [item.tx for item in q2.txs]
+        assert tx1 in [item.tx for item in q2]
+        assert tx3 in [item.tx for item in q2]
+        assert tx4 in [item.tx for item in q2]
 
         q3 = q2.diff([tx4])
         assert len(q3) == 2
-        assert tx1 in [item.tx for item in q3.txs]
-        assert tx3 in [item.tx for item in q3.txs]
+        assert tx1 in [item.tx for item in q3]
+        assert tx3 in [item.tx for item in q3]
 
     def test_orderable_tx(self):
         assert OrderableTx(-1, 0, None) < OrderableTx(0, 0, None)
@@ -78,3 +91,94 @@ class TestTransactionQueue(unittest.TestCase):
         # Since they have the same gasprice they should have the same priority and
         # thus be popped in the order they were inserted.
         assert nonces == expected_nonce_order
+
+    def test_nonce_order_within_sender(self):
+        sender = make_sender(1)
+        q = TransactionQueue()
+        # higher nonces pay more but must not be popped before the lower ones
+        for nonce in [2, 0, 1]:
+            q.add_transaction(make_test_tx(g=10 + nonce, nonce=nonce, sender=sender))
+        other = make_test_tx(g=11, sender=make_sender(2))
+        q.add_transaction(other)
+        assert q.pop_transaction() == other
+        assert [q.pop_transaction().nonce for _ in range(3)] == [0, 1, 2]
+        assert q.pop_transaction() is None
+
+    def test_nonce_gap(self):
+        nonces = {make_sender(1): 0, make_sender(2): 0}
+        q = TransactionQueue()
+        gapped = make_test_tx(g=100, nonce=1, sender=make_sender(1))
+        ready = make_test_tx(g=10, nonce=0, sender=make_sender(2))
+        q.add_transaction(gapped)
+        q.add_transaction(ready)
+        assert q.pop_transaction(get_nonce=nonces.get) == ready
+        assert q.pop_transaction(get_nonce=nonces.get) is None
+        assert len(q) == 1
+        q.requeue_gapped()
+        nonces[make_sender(1)] = 1
+        assert q.pop_transaction(get_nonce=nonces.get) == gapped
+
+    def test_remove_later_transactions(self):
+        sender = make_sender(1)
+        failed = make_test_tx(g=100, nonce=0, sender=sender)
+        later = [make_test_tx(g=100, nonce=n, sender=sender) for n in [1, 2]]
+        other = make_test_tx(g=10, sender=make_sender(2))
+        q = TransactionQueue()
+        for tx in [failed, other] + later:
+            q.add_transaction(tx)
+        assert q.pop_transaction() == failed
+        assert q.remove_later_transactions(failed) == later
+        assert len(q) == 1
+        assert q.pop_transaction() == other
+        assert q.remove_later_transactions(other) == []
+
+    def test_replace_by_fee(self):
+        sender = make_sender(1)
+        q = TransactionQueue()
+        tx1 = make_test_tx(g=100, sender=sender)
+        q.add_transaction(tx1)
+        with self.assertRaises(ReplacementUnderpriced):
+            q.add_transaction(make_test_tx(g=109, data=b'foo', sender=sender))
+        tx2 = make_test_tx(g=110, data=b'bar', sender=sender)
+        assert q.add_transaction(tx2) == [tx1]
+        assert len(q) == 1
+        assert tx1.hash not in q
+        assert q.pop_transaction() == tx2
+        assert q.pop_transaction() is None
+
+    def test_evict_lowest_price(self):
+        q = TransactionQueue(limit=3)
+        cheap0 = make_test_tx(g=10, nonce=0, sender=make_sender(1))
+        cheap1 = make_test_tx(g=50, nonce=1, sender=make_sender(1))
+        other = make_test_tx(g=20, sender=make_sender(2))
+        for tx in [cheap0, cheap1, other]:
+            q.add_transaction(tx)
+        with self.assertRaises(QueueFull):
+            q.add_transaction(make_test_tx(g=10, sender=make_sender(3)))
+        new = make_test_tx(g=30, sender=make_sender(3))
+        # cheap1 can't execute without cheap0 and goes with it
+        assert q.add_transaction(new) == [cheap0, cheap1]
+        assert len(q) == 2
+        assert q.pop_transaction() == new
+        assert q.pop_transaction() == other
+
+    def test_remove_transactions(self):
+        sender = make_sender(1)
+        tx1 = make_test_tx(s=30000, g=60, data=b'foo', sender=make_sender(2))
+        tx2 = make_test_tx(s=100000, g=40, nonce=0, sender=sender)
+        tx3 = make_test_tx(s=30000, g=40, nonce=1, sender=sender)
+        tx4 = make_test_tx(s=30000, g=30, nonce=2, sender=sender)
+        q = TransactionQueue()
+        for tx in [tx1, tx2, tx3, tx4]:
+            q.add_transaction(tx)
+        # move tx2 aside
+        assert q.pop_transaction(max_gas=50000) == tx1
+        # tx2 goes with tx3 as the lower nonce can't be included anymore
+        assert q.remove_transactions([tx3, make_test_tx(data=b'unknown')]) == [tx2]
+        assert len(q) == 1
+        assert tx2.hash not in q
+        assert [item.tx for item in q] == [tx4]
+        assert [item.tx for item in q.peek()] == [tx4]
+        assert q.pop_transaction() == tx4
+        assert q.pop_transaction() is None
+        assert len(q) == 0
@@ -1,7 +1,7 @@
 import os
 import json
 import quarkchain.evm.trie as trie
-from quarkchain.db import InMemoryDb
+from quarkchain.db import InMemoryDb, OverlayDb
 import itertools
 from quarkchain.utils import Logger
 import unittest
@@ -75,6 +75,54 @@ def run_test(name, pairs):
                 name, pairs['root'], '0x' + t.root_hash.hex(), (i, list(permut) + deletes)))
 
 
+class TestTrieWriteBack(unittest.TestCase):
+
+    def test_write_back(self):
+        db = InMemoryDb()
+        t = trie.Trie(db, write_back=True)
+        expected = trie.Trie(InMemoryDb())
+        for i in range(100):
+            k, v = bytes([i]) * 32, bytes([i]) * 8
+            t.update(k, v)
+            expected.update(k, v)
+        self.assertEqual(t.root_hash, expected.root_hash)
+        # nothing is written until flush
+        self.assertNotIn(t.root_hash, db)
+        self.assertTrue(t.root_hash_valid())
+        self.assertEqual(t.get(bytes([1]) * 32), bytes([1]) * 8)
+        # the nodes not in a db yet aren't cached
+        self.assertNotIn(t.root_hash, trie.node_cache)
+
+        count, size = t.flush()
+        self.assertGreater(count, 0)
+        self.assertGreater(size, 0)
+        self.assertEqual(t.flush(), (0, 0))
+        self.assertIn(t.root_hash, trie.node_cache)
+
+        trie.node_cache.clear()
+        t2 = trie.Trie(db, t.root_hash)
+        self.assertEqual(t2.to_dict(), expected.to_dict())
+        self.assertIn(t.root_hash, trie.node_cache)
+
+    def test_temporary_nodes_not_cached(self):
+        db = InMemoryDb()
+        t = trie.Trie(db, write_back=True)
+        t.update(b"\x01" * 32, b"\x01" * 8)
+        t.flush()
+        overlay = OverlayDb(db, temporary=True)
+        t2 = trie.Trie(overlay, t.root_hash, write_back=True)
+        t2.update(b"\x02" * 32, b"\x02" * 8)
+        t2.flush()
+        self.assertIn(t2.root_hash, overlay)
+        self.assertNotIn(t2.root_hash, trie.node_cache)
+        trie.Trie(overlay, t2.root_hash).to_dict()
+        self.assertNotIn(t2.root_hash, trie.node_cache)
+        # read through the overlay from the db below
+        trie.node_cache.clear()
+        trie.Trie(overlay, t.root_hash).to_dict()
+        self.assertIn(t.root_hash, trie.node_cache)
+
+
 if __name__ == '__main__':
     for name, pairs in load_tests_dict().items():
         run_test(name, pairs)
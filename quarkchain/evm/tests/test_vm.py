@@ -0,0 +1,120 @@
+import unittest
+
+from quarkchain.db import InMemoryDb
+from quarkchain.evm import vm
+from quarkchain.evm.config import Env
+from quarkchain.evm.messages import VMExt, apply_msg
+from quarkchain.evm.slogging import configure_logging
+from quarkchain.evm.state import State
+from quarkchain.evm.transactions import Transaction
+from quarkchain.evm.utils import sha3
+
+
+def loop_code(n):
+    """ for (c = n; c != 0; c--) mstore(0, c * c)"""
+    body = bytes.fromhex("5b808002600052600190038060035700")
+    return b"\x61" + n.to_bytes(2, "big") + body
+
+
+def loop_gas(n):
+    # 3 for PUSH2, 43 per iteration and 3 for a word of memory
+    return 3 + 43 * n + 3
+
+
+LOOP_CODE = loop_code(1000)
+LOOP_GAS = loop_gas(1000)
+
+
+class TestVm(unittest.TestCase):
+    def execute(self, code, gas=100000):
+        db = InMemoryDb()
+        state = State(env=Env(db), db=db)
+        ext = VMExt(state, Transaction(0, 0, 21000, b"", 0, b""))
+        msg = vm.Message(b"\x01" * 20, b"\x02" * 20, gas=gas, data=b"")
+        return vm.vm_execute(ext, msg, code)
+
+    def test_basic_blocks(self):
+        program = vm.preprocess_code(LOOP_CODE)
+        self.assertEqual(program.jumpdest_mask, 1 << 3)
+        starts = [pc for pc, block in enumerate(program.blocks) if block]
+        # entry, loop body ending with JUMPI and the STOP after it
+        self.assertEqual(starts, [0, 3, 18])
+        gas, min_stack, max_growth, ops, next_pc = program.blocks[3]
+        self.assertEqual((gas, min_stack, max_growth, next_pc), (43, 1, 2, 18))
+        # JUMPDEST does nothing at run time
+        self.assertEqual(len(ops), 11)
+
+    def test_loop(self):
+        self.assertEqual(self.execute(LOOP_CODE), (1, 100000 - LOOP_GAS, []))
+
+    def test_out_of_gas_within_block(self):
+        self.assertEqual(self.execute(LOOP_CODE, gas=LOOP_GAS - 1), (0, 0, []))
+
+    def test_stack_errors(self):
+        # ADD on an empty stack
+        self.assertEqual(self.execute(b"\x60\x01\x01"), (0, 0, []))
+        # 1025 PUSH1s
+        self.assertEqual(self.execute(b"\x60\x01" * 1025), (0, 0, []))
+        self.assertEqual(
+            self.execute(b"\x60\x01" * 1024), (1, 100000 - 3 * 1024, [])
+        )
+
+    def test_bad_jump_and_invalid_op(self):
+        # jump into the data of a PUSH
+        self.assertEqual(self.execute(b"\x60\x03\x56\x60\x5b"), (0, 0, []))
+        self.assertEqual(self.execute(b"\x60\x01\xfe"), (0, 0, []))
+
+    def test_traced(self):
+        configure_logging("eth.vm.op:trace")
+        try:
+            code, gas = loop_code(3), loop_gas(3)
+            self.assertEqual(self.execute(code, gas=gas), (1, 0, []))
+            self.assertEqual(self.execute(code, gas=gas - 1), (0, 0, []))
+        finally:
+            configure_logging(":info")
+
+
+class TestCodeCache(unittest.TestCase):
+    contract = b"\x02" * 20
+
+    def setUp(self):
+        self.code = loop_code(7)
+        self.code_hash = sha3(self.code)
+        vm.code_cache.pop(self.code_hash)
+
+    def call(self, state):
+        ext = VMExt(state, Transaction(0, 0, 21000, b"", 0, b""))
+        msg = vm.Message(b"\x01" * 20, self.contract, gas=100000, data=b"")
+        return apply_msg(ext, msg)
+
+    def test_shared_by_states(self):
+        db = InMemoryDb()
+        state = State(env=Env(db), db=db)
+        state.set_code(self.contract, self.code)
+        state.commit()
+        self.assertEqual(self.call(state), (1, 100000 - loop_gas(7), []))
+        program = vm.code_cache.get(self.code_hash).program
+        self.assertIsNotNone(program)
+
+        # a State of another db with the same code reuses the translation
+        other_db = InMemoryDb()
+        other = State(env=Env(other_db), db=other_db)
+        other.set_code(self.contract, self.code)
+        other.commit()
+        other = State(other.trie.root_hash, Env(other_db))
+        hits, misses = vm.code_cache.hits, vm.code_cache.misses
+        self.assertEqual(self.call(other), (1, 100000 - loop_gas(7), []))
+        self.assertIs(vm.code_cache.get(self.code_hash).program, program)
+        self.assertEqual(vm.code_cache.misses, misses)
+        self.assertGreater(vm.code_cache.hits, hits)
+
+    def test_read_once(self):
+        db = InMemoryDb()
+        state = State(env=Env(db), db=db)
+        state.set_code(self.contract, self.code)
+        state.commit()
+        state = State(state.trie.root_hash, Env(db))
+        self.assertEqual(state.get_code(self.contract), self.code)
+        # served from the cache once it has been read
+        db.kv.pop(self.code_hash)
+        self.assertEqual(state.get_code(self.contract), self.code)
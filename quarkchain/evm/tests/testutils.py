@@ -2,7 +2,7 @@ import os
 import json
 
 
-fixture_path = os.path.join(os.path.dirname(__file__), '../..', 'fixtures')
+fixture_path = os.path.join(os.path.dirname(__file__), '../../..', 'fixtures')
 
 
 def generate_test_params(testsource, metafunc,
@@ -1,14 +1,26 @@
 import heapq
+from quarkchain.evm.exceptions import InvalidTransaction
 heapq.heaptop = lambda x: x[0]
 PRIO_INFINITY = -2**100
+# a tx replacing a queued tx with the same sender and nonce must pay this much more
+PRICE_BUMP_PERCENT = 10
+
+
+class ReplacementUnderpriced(InvalidTransaction):
+    pass
+
+
+class QueueFull(InvalidTransaction):
+    pass
 
 
 class OrderableTx(object):
 
-    def __init__(self, prio, counter, tx):
+    def __init__(self, prio, counter, tx, tx_hash=None):
         self.prio = prio
         self.counter = counter
         self.tx = tx
+        self.tx_hash = tx_hash
 
     def __lt__(self, other):
         if self.prio < other.prio:
@@ -20,52 +32,231 @@ class OrderableTx(object):
 
 
 class TransactionQueue():
+    """ Pending txs grouped by sender and ordered by nonce.
+
+    Only the lowest-nonce tx of each sender (its head) competes by gas price in
+    `txs` (or waits in `aside` if its startgas didn't fit), so a sender's txs
+    are popped in nonce order.  Heap entries are copies of the queued items and
+    an entry is live only while it is its sender's entry in `heads`; stale ones
+    are dropped when they reach the top.
+    """
 
-    def __init__(self):
+    def __init__(self, limit=None):
         self.counter = 0
         self.txs = []
         self.aside = []
+        # heads skipped by pop_transaction for a nonce gap, see requeue_gapped()
+        self.gapped = []
+        self.limit = limit
+        # sender -> {nonce: OrderableTx}
+        self.senders = dict()
+        # sender -> live heap entry
+        self.heads = dict()
+        # tx hash -> OrderableTx
+        self.items = dict()
+        # (gasprice, counter, OrderableTx) of all the items for eviction
+        self.by_price = []
 
     def __len__(self):
-        return len(self.txs)
+        return len(self.items)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.items
+
+    def __iter__(self):
+        """ Queued items in no particular order"""
+        return iter(list(self.items.values()))
 
     def add_transaction(self, tx, force=False):
+        """ Queue the tx, replacing the sender's tx with the same nonce.
+        Returns the txs dropped to make room for it.
+        Raises ReplacementUnderpriced or QueueFull if it doesn't pay enough to do so.
+        """
         prio = PRIO_INFINITY if force else -tx.gasprice
-        heapq.heappush(self.txs, OrderableTx(prio, self.counter, tx))
+        item = OrderableTx(prio, self.counter, tx, tx.hash)
+        sender = tx.sender
+        group = self.senders.get(sender, dict())
+        dropped = []
+        old = group.get(tx.nonce)
+        if old is not None:
+            if (
+                not force
+                and tx.gasprice * 100 < old.tx.gasprice * (100 + PRICE_BUMP_PERCENT)
+            ):
+                raise ReplacementUnderpriced(
+                    "replacing a tx requires {}% higher gas price".format(
+                        PRICE_BUMP_PERCENT
+                    )
+                )
+            self.__remove_item(old)
+            self.__compact()
+            dropped.append(old.tx)
+        elif self.limit is not None and len(self.items) >= self.limit:
+            cheapest = self.__cheapest()
+            if not force and (cheapest is None or tx.gasprice <= cheapest.tx.gasprice):
+                raise QueueFull("tx queue is full")
+            dropped.extend(self.__evict(cheapest))
+
+        self.senders[sender] = group
+        group[tx.nonce] = item
+        self.items[item.tx_hash] = item
+        heapq.heappush(self.by_price, (tx.gasprice, item.counter, item))
         self.counter += 1
+        head = self.heads.get(sender)
+        if head is None or tx.nonce <= head.tx.nonce:
+            self.__update_head(sender)
+        return dropped
+
+    def __remove_item(self, item):
+        sender = item.tx.sender
+        group = self.senders[sender]
+        del group[item.tx.nonce]
+        del self.items[item.tx_hash]
+        if not group:
+            del self.senders[sender]
+        head = self.heads.get(sender)
+        if head is not None and head.counter == item.counter:
+            self.__update_head(sender)
+
+    def __update_head(self, sender):
+        """ Push a heap entry for the sender's lowest-nonce tx if it changed"""
+        group = self.senders.get(sender)
+        if not group:
+            self.heads.pop(sender, None)
+            return
+        item = group[min(group)]
+        head = self.heads.get(sender)
+        if head is not None and head.counter == item.counter:
+            return
+        entry = OrderableTx(item.prio, item.counter, item.tx, item.tx_hash)
+        self.heads[sender] = entry
+        heapq.heappush(self.txs, entry)
+
+    def __is_live(self, entry):
+        return self.heads.get(entry.tx.sender) is entry
+
+    def __top(self, heap):
+        while heap and not self.__is_live(heapq.heaptop(heap)):
+            heapq.heappop(heap)
+        return heapq.heaptop(heap) if heap else None
+
+    def __cheapest(self):
+        while self.by_price:
+            _, _, item = heapq.heaptop(self.by_price)
+            if self.items.get(item.tx_hash) is item:
+                return item
+            heapq.heappop(self.by_price)
+        return None
+
+    def __evict(self, item):
+        """ Drop the item and the sender's later txs, which can't execute without it"""
+        group = self.senders[item.tx.sender]
+        evicted = [group[n] for n in sorted(group) if n >= item.tx.nonce]
+        for i in reversed(evicted):
+            self.__remove_item(i)
+        self.__compact()
+        return [i.tx for i in evicted]
+
+    def __compact(self):
+        """ Drop the stale heap entries once they make up half of a heap"""
+        if len(self.by_price) > 2 * len(self.items):
+            self.by_price = [
+                e for e in self.by_price if self.items.get(e[2].tx_hash) is e[2]
+            ]
+            heapq.heapify(self.by_price)
+        if len(self.txs) + len(self.aside) > 2 * len(self.heads):
+            self.txs = [e for e in self.txs if self.__is_live(e)]
+            self.aside = [e for e in self.aside if self.__is_live(e)]
+            heapq.heapify(self.txs)
+            heapq.heapify(self.aside)
 
     def pop_transaction(self, max_gas=9999999999,
-                        max_seek_depth=16, min_gasprice=0):
-        while len(self.aside) and max_gas >= heapq.heaptop(self.aside).prio:
+                        max_seek_depth=16, min_gasprice=0, get_nonce=None):
+        """ Pop the best priced executable head.
+
+        :param get_nonce: sender -> current account nonce.  Heads with a higher nonce
+        can't execute yet and are set aside until requeue_gapped() is called.
+        """
+        while (
+            self.__top(self.aside) is not None
+            and max_gas >= heapq.heaptop(self.aside).prio
+        ):
             item = heapq.heappop(self.aside)
             item.prio = -item.tx.gasprice
             heapq.heappush(self.txs, item)
-        for i in range(min(len(self.txs), max_seek_depth)):
-            item = heapq.heaptop(self.txs)
-            if item.tx.startgas > max_gas:
+        seek = 0
+        while seek < max_seek_depth:
+            item = self.__top(self.txs)
+            if item is None:
+                return None
+            if get_nonce is not None and item.tx.nonce > get_nonce(item.tx.sender):
+                heapq.heappop(self.txs)
+                self.gapped.append(item)
+            elif item.tx.startgas > max_gas:
                 heapq.heappop(self.txs)
                 item.prio = item.tx.startgas
                 heapq.heappush(self.aside, item)
+                seek += 1
             elif item.tx.gasprice >= min_gasprice or item.prio == PRIO_INFINITY:
                 heapq.heappop(self.txs)
+                self.__remove_item(self.items[item.tx_hash])
                 return item.tx
             else:
                 return None
         return None
 
+    def requeue_gapped(self):
+        """ Make the heads skipped for a nonce gap poppable again"""
+        for item in self.gapped:
+            if self.__is_live(item):
+                heapq.heappush(self.txs, item)
+        self.gapped = []
+
     def peek(self, num=None):
+        txs = [item for item in self.txs if self.__is_live(item)]
         if num:
-            return self.txs[0:num]
+            return txs[0:num]
         else:
-            return self.txs
+            return txs
+
+    def remove_transactions(self, txs):
+        """ Remove the given txs (e.g. those included in a block) together with the
+        same senders' txs of lower nonces, which became invalid.
+        Returns the latter.
+        """
+        stale = []
+        for tx in txs:
+            item = self.items.get(tx.hash)
+            if item is None:
+                continue
+            group = self.senders[item.tx.sender]
+            for nonce in sorted(group):
+                if nonce >= item.tx.nonce:
+                    break
+                stale.append(group[nonce].tx)
+                self.__remove_item(group[nonce])
+            self.__remove_item(item)
+        self.__compact()
+        return stale
+
+    def remove_later_transactions(self, tx):
+        """ Remove the sender's txs of higher nonces than the given one, e.g. a popped
+        tx that failed, which they can't execute without.
+        Returns them.
+        """
+        group = self.senders.get(tx.sender)
+        if not group:
+            return []
+        later = [group[n] for n in sorted(group) if n > tx.nonce]
+        for item in reversed(later):
+            self.__remove_item(item)
+        self.__compact()
+        return [item.tx for item in later]
 
     def diff(self, txs):
-        remove_hashes = [tx.hash for tx in txs]
-        keep_txs = [item for item in self.txs if item.tx.hash not in remove_hashes]
-        keep_aside = [item for item in self.aside if item.tx.hash not in remove_hashes]
-        q = TransactionQueue()
-        q.txs = keep_txs
-        q.aside = keep_aside
-        heapq.heapify(q.txs)
-        heapq.heapify(q.aside)
+        """ A new queue without the given txs, leaving this one untouched"""
+        q = TransactionQueue(self.limit)
+        for item in sorted(self.items.values(), key=lambda i: i.counter):
+            q.add_transaction(item.tx, force=item.prio == PRIO_INFINITY)
+        q.remove_transactions(txs)
         return q
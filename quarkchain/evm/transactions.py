@@ -15,7 +15,7 @@ from rlp.sedes import big_endian_int, binary, BigEndianInt
 from quarkchain.rlp.utils import str_to_bytes, ascii_chr
 
 from quarkchain.evm import opcodes
-from quarkchain.utils import sha3_256, is_p2, check
+from quarkchain.utils import sha3_256, is_p2, check, LRUCache
 from quarkchain.evm.solidity_abi_utils import tx_to_typed_data, typed_signature_hash
 
 # in the yellow paper it is specified that s should be smaller than
@@ -23,6 +23,12 @@ from quarkchain.evm.solidity_abi_utils import tx_to_typed_data, typed_signature_
 secpk1n = 115792089237316195423570985008687907852837564279074904382605163141518161494337
 null_address = b"\xff" * 20
 
+# tx hash -> sender shared by mempool admission and block execution so that each
+# signature is recovered once.  The hash covers the signature so entries never go
+# stale.
+SENDER_CACHE_SIZE = 128 * 1024
+sender_cache = LRUCache(SENDER_CACHE_SIZE)
+
 
 class Transaction(rlp.Serializable):
 
@@ -125,7 +131,10 @@ class Transaction(rlp.Serializable):
             # Determine sender
             if self.r == 0 and self.s == 0:
                 self._sender = null_address
-            else:
+                return self._sender
+            tx_hash = self.hash
+            self._sender = sender_cache.get(tx_hash)
+            if not self._sender:
                 if self.r >= secpk1n or self.s >= secpk1n or self.r == 0 or self.s == 0:
                     raise InvalidTransaction("Invalid signature values!")
                 if self.version == 0:
@@ -137,6 +146,7 @@ class Transaction(rlp.Serializable):
                         "Invalid signature (zero privkey cannot sign)"
                     )
                 self._sender = sha3_256(pub)[-20:]
+                sender_cache.put(tx_hash, self._sender)
         return self._sender
 
     @sender.setter
@@ -158,6 +168,7 @@ class Transaction(rlp.Serializable):
         self._in_mutable_context = False
 
         self._sender = utils.privtoaddr(key)
+        sender_cache.put(self.hash, self._sender)
         return self
 
     @property
@@ -296,3 +307,13 @@ def unsigned_tx_from_tx(tx):
         to_full_shard_key=tx.to_full_shard_key,
         network_id=tx.network_id,
     )
+
+
+def recover_sender(rlp_tx):
+    """ Sender of the rlp encoded tx, None if it is malformed or badly signed.
+    A plain function of bytes so it can run in another process.
+    """
+    try:
+        return rlp.decode(rlp_tx, Transaction).sender
+    except Exception:
+        return None
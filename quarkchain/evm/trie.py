@@ -1,11 +1,20 @@
 #!/usr/bin/python3
 # trie.py from ethereum under MIT license
 # use rlp to encode/decode a node as the original code
+import sys
+
 import rlp
 from quarkchain import utils
+from quarkchain.db import WriteBatch
 from quarkchain.evm.fast_rlp import encode_optimized
 rlp_encode = encode_optimized
 
+# hash -> decoded node shared by all the tries.  Nodes are content-addressed so
+# entries never go stale.  Only the nodes read from or flushed to a db that keeps
+# them are cached, bounded by the memory used by the decoded nodes.
+NODE_CACHE_SIZE = 32 * 1024 * 1024
+node_cache = utils.LRUCache(NODE_CACHE_SIZE)
+
 bin_to_nibbles_cache = {}
 
 
@@ -142,15 +151,36 @@ BLANK_NODE = b''
 BLANK_ROOT = utils.sha3_256(rlp.encode(b''))
 
 
+def copy_node(node):
+    """nodes are updated in place, so never hand out the cached ones"""
+    return [copy_node(x) if isinstance(x, list) else x for x in node]
+
+
+def node_footprint(node):
+    """approximate memory used by a decoded node, its lists and bytes"""
+    size = sys.getsizeof(node)
+    for x in node:
+        size += node_footprint(x) if isinstance(x, list) else sys.getsizeof(x)
+    return size
+
+
+def cache_node(key, node):
+    node_cache.put(key, node, node_footprint(node))
+
+
 class Trie(object):
 
-    def __init__(self, db, root_hash=BLANK_ROOT):
+    def __init__(self, db, root_hash=BLANK_ROOT, write_back=False):
         """it also present a dictionary like interface
 
         :param db key value database
         :root: blank or trie node in form of [key, value] or [v0,v1..v15,v]
+        :param write_back: buffer new nodes in memory until flush() is called
         """
         self.db = db  # Pass in a database object directly
+        self.write_back = write_back
+        self.dirty = {}  # hash -> rlp-encoded node not flushed to db yet
+        self.dirty_nodes = {}  # hash -> decoded node not flushed to db yet
         self.set_root_hash(root_hash)
         self.deletes = []
 
@@ -179,9 +209,37 @@ class Trie(object):
     def _update_root_hash(self):
         val = rlp_encode(self.root_node)
         key = utils.sha3_256(val)
-        self.db.put(key, val)
+        self._put_node(key, val, self.root_node)
         self._root_hash = key
 
+    def _put_node(self, key, rlpnode, node):
+        if self.write_back:
+            self.dirty[key] = rlpnode
+            self.dirty_nodes[key] = copy_node(node)
+        else:
+            self.db.put(key, rlpnode)
+
+    def flush(self):
+        """ write all the buffered nodes to db in one batch
+
+        :return: number of nodes and bytes written
+        """
+        if not self.dirty:
+            return 0, 0
+        batch = WriteBatch()
+        size = 0
+        for key, rlpnode in self.dirty.items():
+            batch.put(key, rlpnode)
+            size += len(rlpnode)
+        self.db.write(batch)
+        for key, node in self.dirty_nodes.items():
+            if not self.db.is_temporary(key):
+                cache_node(key, node)
+        count = len(self.dirty)
+        self.dirty = {}
+        self.dirty_nodes = {}
+        return count, size
+
     @root_hash.setter
     def root_hash(self, value):
         self.set_root_hash(value)
@@ -222,7 +280,7 @@ class Trie(object):
 
         hashkey = utils.sha3_256(rlpnode)
         if put_in_db:
-            self.db.put(hashkey, rlpnode)
+            self._put_node(hashkey, rlpnode, node)
         return hashkey
 
     def _decode_to_node(self, encoded):
@@ -230,7 +288,14 @@ class Trie(object):
             return BLANK_NODE
         if isinstance(encoded, list):
             return encoded
+        o = node_cache.get(encoded)
+        if o is None:
+            o = self.dirty_nodes.get(encoded)
+        if o is not None:
+            return copy_node(o)
         o = rlp.decode(self.db[encoded])
+        if not self.db.is_temporary(encoded):
+            cache_node(encoded, copy_node(o))
         return o
 
     def _get_node_type(self, node):
@@ -798,7 +863,7 @@ class Trie(object):
             Here key is in full form, rather than key of the individual node
         """
         if node == BLANK_NODE:
-            raise StopIteration
+            return
 
         node_type = self._get_node_type(node)
 
@@ -942,7 +1007,26 @@ class Trie(object):
     def root_hash_valid(self):
         if self.root_hash == BLANK_ROOT:
             return True
-        return self.root_hash in self.db
+        return self.root_hash in self.dirty or self.root_hash in self.db
+
+
+class MemoryTrie(Trie):
+    """ Trie living in memory only, for the root of short-lived items such as the
+    receipts of a block.  Its nodes never reach a db or the shared node cache.
+    """
+
+    def __init__(self):
+        super().__init__(db=None, write_back=True)
+
+    def _put_node(self, key, rlpnode, node):
+        self.dirty[key] = rlpnode
+
+    def _decode_to_node(self, encoded):
+        if encoded == BLANK_NODE:
+            return BLANK_NODE
+        if isinstance(encoded, list):
+            return encoded
+        return rlp.decode(self.dirty[encoded])
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ from quarkchain.evm import utils
 from quarkchain.evm import opcodes
 from quarkchain.evm.slogging import get_logger
 from quarkchain.evm.utils import to_string, bytearray_to_bytestr, safe_ord
+from quarkchain.utils import LRUCache
 from functools import lru_cache
 
 # ###### dev hack flags ###############
@@ -137,24 +138,137 @@ class Compustate:
         self.prev_gas = self.gas
 
 
-# Preprocesses code, and determines which locations are in the middle
-# of pushdata and thus invalid
-@lru_cache(128)
-def preprocess_code(code):
+# Instructions that end a basic block: jumps and exits, and the ops that depend on
+# the exact gas left, which must not be charged for the ops after them
+BLOCK_ENDS = {
+    "STOP",
+    "JUMP",
+    "JUMPI",
+    "GAS",
+    "CREATE",
+    "CALL",
+    "CALLCODE",
+    "RETURN",
+    "DELEGATECALL",
+    "STATICCALL",
+    "REVERT",
+    "SUICIDE",
+}
+
+
+class Program:
+    """
+    Code translated for vm_execute().  blocks[pc] is set at the start of each basic
+    block as (gas, min_stack, max_growth, ops, next_pc):
+    - gas is the static fee of all its instructions, charged on entering the block
+    - the stack must hold min_stack items on entry and may grow by max_growth
+    - ops are the (handler, arg) of its instructions, with handler None for PUSHes
+    - next_pc is where execution continues unless the block jumps
+    """
+
+    def __init__(self, jumpdest_mask, pushcache, instructions, blocks):
+        self.jumpdest_mask = jumpdest_mask
+        self.pushcache = pushcache
+        # pc -> (opcode, handler, arg, next_pc), used when tracing
+        self.instructions = instructions
+        self.blocks = blocks
+
+
+# Translates code into basic blocks of op handlers, and determines which locations
+# are in the middle of pushdata and thus invalid
+def translate_code(code):
     o = 0
     i = 0
     pushcache = {}
-    code = code + b"\x00" * 32
-    while i < len(code) - 32:
+    instructions = {}
+    padded = code + b"\x00" * 32
+    while i < len(code):
         codebyte = safe_ord(code[i])
         if codebyte == 0x5b:
             o |= 1 << i
         if 0x60 <= codebyte <= 0x7f:
-            pushcache[i] = utils.big_endian_to_int(code[i + 1 : i + codebyte - 0x5e])
-            i += codebyte - 0x5e
+            pushcache[i] = utils.big_endian_to_int(padded[i + 1 : i + codebyte - 0x5e])
+            next_pc = i + codebyte - 0x5e
+            handler, arg = None, pushcache[i]
         else:
-            i += 1
-    return o, pushcache
+            next_pc = i + 1
+            handler, arg = _handlers.get(codebyte, (_op_invalid, codebyte))
+            if arg is _PC:
+                arg = i
+        instructions[i] = (codebyte, handler, arg, next_pc)
+        i = next_pc
+
+    blocks = [None] * len(code)
+    block = []
+    for pc, (opcode, handler, _, next_pc) in instructions.items():
+        block.append(pc)
+        op = opcodes.opcodes[opcode][0] if opcode in opcodes.opcodes else None
+        if (
+            op is None
+            or op in BLOCK_ENDS
+            or (handler is _op_noop and op != "JUMPDEST")
+            or (o >> next_pc) & 1
+            or next_pc >= len(code)
+        ):
+            blocks[block[0]] = _make_block(block, instructions)
+            block = []
+    return Program(o, pushcache, instructions, blocks)
+
+
+def _make_block(block, instructions):
+    gas = min_stack = max_growth = height = 0
+    ops = []
+    for pc in block:
+        opcode, handler, arg, next_pc = instructions[pc]
+        op, in_args, out_args, fee = opcodes.opcodes.get(opcode, (None, 0, 0, 0))
+        gas += fee
+        min_stack = max(min_stack, in_args - height)
+        height += out_args - in_args
+        max_growth = max(max_growth, height)
+        if handler is not _op_noop:
+            ops.append((handler, arg))
+    return gas, min_stack, max_growth, tuple(ops), next_pc
+
+
+# For code without a hash, i.e. contract init code.  Stored code is looked up by its
+# hash in code_cache instead of hashing the whole code on every call.
+@lru_cache(128)
+def preprocess_code(code):
+    return translate_code(code)
+
+
+class CachedCode:
+    """ Stored code and, once it has run, its Program"""
+
+    __slots__ = ("code", "program")
+
+    def __init__(self, code):
+        self.code = code
+        self.program = None
+
+
+# code hash -> CachedCode shared by all the States of the process, so that hot
+# contracts are neither read from the db nor translated again.  The hash covers the
+# code so entries never go stale.  Bounded by the total length of the code; the
+# Programs take several times as much memory.
+CODE_CACHE_SIZE = 8 * 1024 * 1024
+code_cache = LRUCache(CODE_CACHE_SIZE)
+
+
+def get_cached_code(code_hash, load_code):
+    """ The cache entry of the code, calling load_code() on a miss"""
+    entry = code_cache.get(code_hash)
+    if entry is None:
+        entry = CachedCode(load_code())
+        code_cache.put(code_hash, entry, len(entry.code) + 1)
+    return entry
+
+
+def get_program(code, code_hash):
+    entry = get_cached_code(code_hash, lambda: code)
+    if entry.program is None:
+        entry.program = translate_code(entry.code)
+    return entry.program
 
 
 # Extends memory, and pays gas for it
@@ -200,19 +314,22 @@ def all_but_1n(x, n):
 
 # Throws a VM exception
 def vm_exception(error, **kargs):
-    log_vm_exit.trace("EXCEPTION", cause=error, **kargs)
+    if log_vm_exit.trace_enabled:
+        log_vm_exit.trace("EXCEPTION", cause=error, **kargs)
     return 0, 0, []
 
 
 # Peacefully exits the VM
 def peaceful_exit(cause, gas, data, **kargs):
-    log_vm_exit.trace("EXIT", cause=cause, **kargs)
+    if log_vm_exit.trace_enabled:
+        log_vm_exit.trace("EXIT", cause=cause, **kargs)
     return 1, gas, data
 
 
 # Exits with the REVERT opcode
 def revert(gas, data, **kargs):
-    log_vm_exit.trace("REVERT", **kargs)
+    if log_vm_exit.trace_enabled:
+        log_vm_exit.trace("REVERT", **kargs)
     return 0, gas, data
 
 
@@ -268,622 +385,867 @@ def vm_trace(ext, msg, compustate, opcode, pushcache, tracer=log_vm_op):
     compustate.prev_prev_op = op
 
 
-# Main function
-def vm_execute(ext, msg, code):
-    # precompute trace flag
-    # if we trace vm, we're in slow mode anyway
-    trace_vm = log_vm_op.is_active("trace")
+# Op handlers of vm_execute().  Each takes the Compustate of the call, which also
+# holds ext, msg, code and jumpdest_mask, and the arg translated with the op.
+# Gas and stack checks are done per block before it runs.  A handler returns None
+# to continue, or the result of the call to end it.  Jumps set compustate.pc.
 
-    # Initialize stack, memory, program counter, etc
-    compustate = Compustate(gas=msg.gas)
-    stk = compustate.stack
-    mem = compustate.memory
 
-    # Compute
-    jumpdest_mask, pushcache = preprocess_code(code)
-    codelen = len(code)
+def _op_noop(c, a):
+    pass
 
-    # For tracing purposes
-    op = None
-    _prevop = None
-    steps = 0
-    while compustate.pc < codelen:
 
-        opcode = safe_ord(code[compustate.pc])
+def _op_invalid(c, opcode):
+    return vm_exception("INVALID OP", opcode=opcode)
 
-        # Invalid operation
-        if opcode not in opcodes.opcodes:
-            return vm_exception("INVALID OP", opcode=opcode)
 
-        if opcode in opcodes.opcodesMetropolis and not ext.post_metropolis_hardfork():
-            return vm_exception("INVALID OP (not yet enabled)", opcode=opcode)
+def _metropolis(handler):
+    def op(c, a):
+        if not c.ext.post_metropolis_hardfork():
+            return vm_exception("INVALID OP (not yet enabled)")
+        return handler(c, a)
 
-        op, in_args, out_args, fee = opcodes.opcodes[opcode]
+    return op
 
-        # Apply operation
-        if trace_vm:
-            compustate.reset_prev()
-        compustate.gas -= fee
-        compustate.pc += 1
-
-        # Tracing
-        if trace_vm:
-            """
-            This diverges from normal logging, as we use the logging namespace
-            only to decide which features get logged in 'eth.vm.op'
-            i.e. tracing can not be activated by activating a sub
-            like 'eth.vm.op.stack'
-            """
-            trace_data = {}
-            trace_data["stack"] = list(map(to_string, list(compustate.stack)))
-            if _prevop in (
-                "MLOAD",
-                "MSTORE",
-                "MSTORE8",
-                "SHA3",
-                "CALL",
-                "CALLCODE",
-                "CREATE",
-                "CALLDATACOPY",
-                "CODECOPY",
-                "EXTCODECOPY",
-            ):
-                if len(compustate.memory) < 4096:
-                    trace_data["memory"] = "".join(
-                        [encode_hex(ascii_chr(x)) for x in compustate.memory]
-                    )
-                else:
-                    trace_data["sha3memory"] = encode_hex(
-                        utils.sha3(b"".join([ascii_chr(x) for x in compustate.memory]))
-                    )
-            if _prevop in ("SSTORE",) or steps == 0:
-                trace_data["storage"] = ext.log_storage(msg.to)
-            trace_data["gas"] = to_string(compustate.gas + fee)
-            trace_data["inst"] = opcode
-            trace_data["pc"] = to_string(compustate.pc - 1)
-            if steps == 0:
-                trace_data["depth"] = msg.depth
-                trace_data["address"] = msg.to
-            trace_data["steps"] = steps
-            trace_data["depth"] = msg.depth
-            if op[:4] == "PUSH":
-                trace_data["pushvalue"] = pushcache[compustate.pc - 1]
-            log_vm_op.trace("vm", op=op, **trace_data)
-            steps += 1
-            _prevop = op
+
+def _op_stop(c, a):
+    return peaceful_exit("STOP", c.gas, [])
+
+
+def _op_add(c, a):
+    stk = c.stack
+    stk.append((stk.pop() + stk.pop()) & TT256M1)
+
+
+def _op_sub(c, a):
+    stk = c.stack
+    stk.append((stk.pop() - stk.pop()) & TT256M1)
+
+
+def _op_mul(c, a):
+    stk = c.stack
+    stk.append((stk.pop() * stk.pop()) & TT256M1)
+
+
+def _op_div(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 // s1)
+
+
+def _op_mod(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 % s1)
+
+
+def _op_sdiv(c, a):
+    stk = c.stack
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(
+        0
+        if s1 == 0
+        else (abs(s0) // abs(s1) * (-1 if s0 * s1 < 0 else 1)) & TT256M1
+    )
+
+
+def _op_smod(c, a):
+    stk = c.stack
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(
+        0 if s1 == 0 else (abs(s0) % abs(s1) * (-1 if s0 < 0 else 1)) & TT256M1
+    )
+
+
+def _op_addmod(c, a):
+    stk = c.stack
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 + s1) % s2 if s2 else 0)
+
+
+def _op_mulmod(c, a):
+    stk = c.stack
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 * s1) % s2 if s2 else 0)
+
+
+def _op_exp(c, a):
+    stk = c.stack
+    base, exponent = stk.pop(), stk.pop()
+    # fee for exponent is dependent on its bytes
+    # calc n bytes to represent exponent
+    nbytes = len(utils.encode_int(exponent))
+    expfee = nbytes * opcodes.GEXPONENTBYTE
+    if c.ext.post_spurious_dragon_hardfork():
+        expfee += opcodes.EXP_SUPPLEMENTAL_GAS * nbytes
+    if c.gas < expfee:
+        c.gas = 0
+        return vm_exception("OOG EXPONENT")
+    c.gas -= expfee
+    stk.append(pow(base, exponent, TT256))
+
+
+def _op_signextend(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if s0 <= 31:
+        testbit = s0 * 8 + 7
+        if s1 & (1 << testbit):
+            stk.append(s1 | (TT256 - (1 << testbit)))
+        else:
+            stk.append(s1 & ((1 << testbit) - 1))
+    else:
+        stk.append(s1)
+
+
+def _op_lt(c, a):
+    stk = c.stack
+    stk.append(1 if stk.pop() < stk.pop() else 0)
+
+
+def _op_gt(c, a):
+    stk = c.stack
+    stk.append(1 if stk.pop() > stk.pop() else 0)
+
+
+def _op_slt(c, a):
+    stk = c.stack
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(1 if s0 < s1 else 0)
+
+
+def _op_sgt(c, a):
+    stk = c.stack
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(1 if s0 > s1 else 0)
+
+
+def _op_eq(c, a):
+    stk = c.stack
+    stk.append(1 if stk.pop() == stk.pop() else 0)
+
+
+def _op_iszero(c, a):
+    stk = c.stack
+    stk.append(0 if stk.pop() else 1)
+
+
+def _op_and(c, a):
+    stk = c.stack
+    stk.append(stk.pop() & stk.pop())
+
+
+def _op_or(c, a):
+    stk = c.stack
+    stk.append(stk.pop() | stk.pop())
+
+
+def _op_xor(c, a):
+    stk = c.stack
+    stk.append(stk.pop() ^ stk.pop())
+
+
+def _op_not(c, a):
+    stk = c.stack
+    stk.append(TT256M1 - stk.pop())
+
+
+def _op_byte(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if s0 >= 32:
+        stk.append(0)
+    else:
+        stk.append((s1 // 256 ** (31 - s0)) % 256)
+
+
+def _op_sha3(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    c.gas -= opcodes.GSHA3WORD * (utils.ceil32(s1) // 32)
+    if c.gas < 0:
+        return vm_exception("OOG PAYING FOR SHA3")
+    if not mem_extend(c.memory, c, "SHA3", s0, s1):
+        return vm_exception("OOG EXTENDING MEMORY")
+    data = bytearray_to_bytestr(c.memory[s0 : s0 + s1])
+    stk.append(utils.big_endian_to_int(utils.sha3(data)))
+
+
+def _op_address(c, a):
+    c.stack.append(utils.coerce_to_int(c.msg.to))
+
+
+def _op_balance(c, a):
+    if c.ext.post_anti_dos_hardfork():
+        if not eat_gas(c, opcodes.BALANCE_SUPPLEMENTAL_GAS):
+            return vm_exception("OUT OF GAS")
+    addr = utils.coerce_addr_to_hex(c.stack.pop() % 2 ** 160)
+    c.stack.append(c.ext.get_balance(addr))
+
+
+def _op_origin(c, a):
+    c.stack.append(utils.coerce_to_int(c.ext.tx_origin))
+
+
+def _op_caller(c, a):
+    c.stack.append(utils.coerce_to_int(c.msg.sender))
+
+
+def _op_callvalue(c, a):
+    c.stack.append(c.msg.value)
+
+
+def _op_calldataload(c, a):
+    stk = c.stack
+    stk.append(c.msg.data.extract32(stk.pop()))
+
+
+def _op_calldatasize(c, a):
+    c.stack.append(c.msg.data.size)
+
+
+def _op_calldatacopy(c, a):
+    stk = c.stack
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "CALLDATACOPY", mstart, size):
+        return vm_exception("OOG EXTENDING MEMORY")
+    if not data_copy(c, size):
+        return vm_exception("OOG COPY DATA")
+    c.msg.data.extract_copy(c.memory, mstart, dstart, size)
+
+
+def _op_codesize(c, a):
+    c.stack.append(len(c.code))
+
+
+def _op_codecopy(c, a):
+    stk = c.stack
+    mem = c.memory
+    code = c.code
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(mem, c, "CODECOPY", mstart, size):
+        return vm_exception("OOG EXTENDING MEMORY")
+    if not data_copy(c, size):
+        return vm_exception("OOG COPY DATA")
+    for i in range(size):
+        if dstart + i < len(code):
+            mem[mstart + i] = safe_ord(code[dstart + i])
+        else:
+            mem[mstart + i] = 0
+
+
+def _op_returndatacopy(c, a):
+    stk = c.stack
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "RETURNDATACOPY", mstart, size):
+        return vm_exception("OOG EXTENDING MEMORY")
+    if not data_copy(c, size):
+        return vm_exception("OOG COPY DATA")
+    if dstart + size > len(c.last_returned):
+        return vm_exception("RETURNDATACOPY out of range")
+    c.memory[mstart : mstart + size] = c.last_returned[dstart : dstart + size]
+
+
+def _op_returndatasize(c, a):
+    c.stack.append(len(c.last_returned))
+
+
+def _op_gasprice(c, a):
+    c.stack.append(c.ext.tx_gasprice)
+
+
+def _op_extcodesize(c, a):
+    if c.ext.post_anti_dos_hardfork():
+        if not eat_gas(c, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
+            return vm_exception("OUT OF GAS")
+    addr = utils.coerce_addr_to_hex(c.stack.pop() % 2 ** 160)
+    c.stack.append(len(c.ext.get_code(addr) or b""))
+
+
+def _op_extcodecopy(c, a):
+    stk = c.stack
+    mem = c.memory
+    if c.ext.post_anti_dos_hardfork():
+        if not eat_gas(c, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
+            return vm_exception("OUT OF GAS")
+    addr = utils.coerce_addr_to_hex(stk.pop() % 2 ** 160)
+    start, s2, size = stk.pop(), stk.pop(), stk.pop()
+    extcode = c.ext.get_code(addr) or b""
+    assert utils.is_string(extcode)
+    if not mem_extend(mem, c, "EXTCODECOPY", start, size):
+        return vm_exception("OOG EXTENDING MEMORY")
+    if not data_copy(c, size):
+        return vm_exception("OOG COPY DATA")
+    for i in range(size):
+        if s2 + i < len(extcode):
+            mem[start + i] = safe_ord(extcode[s2 + i])
+        else:
+            mem[start + i] = 0
+
+
+def _op_blockhash(c, a):
+    stk = c.stack
+    ext = c.ext
+    if ext.post_constantinople_hardfork() and False:
+        bh_addr = ext.blockhash_store
+        stk.append(ext.get_storage_data(bh_addr, stk.pop()))
+    else:
+        stk.append(utils.big_endian_to_int(ext.block_hash(stk.pop())))
+
+
+def _op_coinbase(c, a):
+    c.stack.append(utils.big_endian_to_int(c.ext.block_coinbase))
+
+
+def _op_timestamp(c, a):
+    c.stack.append(c.ext.block_timestamp)
+
+
+def _op_number(c, a):
+    c.stack.append(c.ext.block_number)
+
+
+def _op_difficulty(c, a):
+    c.stack.append(c.ext.block_difficulty)
+
+
+def _op_gaslimit(c, a):
+    c.stack.append(c.ext.block_gas_limit)
+
+
+def _op_pop(c, a):
+    c.stack.pop()
+
+
+def _op_mload(c, a):
+    stk = c.stack
+    mem = c.memory
+    s0 = stk.pop()
+    if not mem_extend(mem, c, "MLOAD", s0, 32):
+        return vm_exception("OOG EXTENDING MEMORY")
+    stk.append(utils.bytes_to_int(mem[s0 : s0 + 32]))
+
+
+def _op_mstore(c, a):
+    stk = c.stack
+    mem = c.memory
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(mem, c, "MSTORE", s0, 32):
+        return vm_exception("OOG EXTENDING MEMORY")
+    mem[s0 : s0 + 32] = utils.encode_int32(s1)
+
+
+def _op_mstore8(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "MSTORE8", s0, 1):
+        return vm_exception("OOG EXTENDING MEMORY")
+    c.memory[s0] = s1 % 256
+
+
+def _op_sload(c, a):
+    if c.ext.post_anti_dos_hardfork():
+        if not eat_gas(c, opcodes.SLOAD_SUPPLEMENTAL_GAS):
+            return vm_exception("OUT OF GAS")
+    stk = c.stack
+    stk.append(c.ext.get_storage_data(c.msg.to, stk.pop()))
+
+
+def _op_sstore(c, a):
+    stk = c.stack
+    ext = c.ext
+    s0, s1 = stk.pop(), stk.pop()
+    if c.msg.static:
+        return vm_exception("Cannot SSTORE inside a static context")
+    if ext.get_storage_data(c.msg.to, s0):
+        gascost = opcodes.GSTORAGEMOD if s1 else opcodes.GSTORAGEKILL
+        refund = 0 if s1 else opcodes.GSTORAGEREFUND
+    else:
+        gascost = opcodes.GSTORAGEADD if s1 else opcodes.GSTORAGEMOD
+        refund = 0
+    if c.gas < gascost:
+        return vm_exception("OUT OF GAS")
+    c.gas -= gascost
+    # adds neg gascost as a refund if below zero
+    ext.add_refund(refund)
+    ext.set_storage_data(c.msg.to, s0, s1)
+
+
+def _op_jump(c, a):
+    c.pc = c.stack.pop()
+    if c.pc >= len(c.code) or not ((1 << c.pc) & c.jumpdest_mask):
+        return vm_exception("BAD JUMPDEST")
+
+
+def _op_jumpi(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if s1:
+        c.pc = s0
+        if c.pc >= len(c.code) or not ((1 << c.pc) & c.jumpdest_mask):
+            return vm_exception("BAD JUMPDEST")
+
+
+# arg of the PC op, replaced by its pc by translate_code()
+_PC = object()
+
+
+def _op_pc(c, pc):
+    c.stack.append(pc)
+
+
+def _op_msize(c, a):
+    c.stack.append(len(c.memory))
+
+
+def _op_gas(c, a):
+    c.stack.append(c.gas)  # AFTER subtracting cost 1
+
+
+# DUPn (eg. DUP1: a b c -> a b c c, DUP3: a b c -> a b c a)
+# index is -1 for 0x80 ... -16 for 0x8f
+def _op_dup(c, index):
+    stk = c.stack
+    stk.append(stk[index])
+
+
+# SWAPn (eg. SWAP1: a b c d -> a b d c, SWAP3: a b c d -> d b c a)
+# index is -2 for 0x90 ... -17 for 0x9f
+def _op_swap(c, index):
+    stk = c.stack
+    temp = stk[index]
+    stk[index] = stk[-1]
+    stk[-1] = temp
+
+
+def _op_log(c, depth):
+    """
+    0xa0 ... 0xa4, 32/64/96/128/160 + len(data) gas
+    a. Opcodes LOG0...LOG4 are added, takes 2-6 stack arguments
+            MEMSTART MEMSZ (TOPIC1) (TOPIC2) (TOPIC3) (TOPIC4)
+    b. Logs are kept track of during tx execution exactly the same way as suicides
+       (except as an ordered list, not a set).
+       Each log is in the form [address, [topic1, ... ], data] where:
+       * address is what the ADDRESS opcode would output
+       * data is mem[MEMSTART: MEMSTART + MEMSZ]
+       * topics are as provided by the opcode
+    c. The ordered list of logs in the transaction are expressed as [log0, log1, ..., logN].
+    """
+    stk = c.stack
+    msg = c.msg
+    mstart, msz = stk.pop(), stk.pop()
+    topics = [stk.pop() for x in range(depth)]
+    c.gas -= msz * opcodes.GLOGBYTE
+    # not caught by the check of the next op if LOG is the last op of its block
+    if c.gas < 0:
+        return vm_exception("OUT OF GAS")
+    if msg.static:
+        return vm_exception("Cannot LOG inside a static context")
+    if not mem_extend(c.memory, c, "LOG", mstart, msz):
+        return vm_exception("OOG EXTENDING MEMORY")
+    data = bytearray_to_bytestr(c.memory[mstart : mstart + msz])
+    c.ext.log(msg.to, topics, data)
+    if log_log.trace_enabled:
+        log_log.trace(
+            "LOG", to=msg.to, topics=topics, data=list(map(utils.safe_ord, data))
+        )
+
+
+def _op_create(c, a):
+    stk = c.stack
+    ext = c.ext
+    msg = c.msg
+    value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "CREATE", mstart, msz):
+        return vm_exception("OOG EXTENDING MEMORY")
+    if msg.static:
+        return vm_exception("Cannot CREATE inside a static context")
+    if ext.get_balance(msg.to) >= value and msg.depth < MAX_DEPTH:
+        cd = CallData(c.memory, mstart, msz)
+        ingas = c.gas
+        if ext.post_anti_dos_hardfork():
+            ingas = all_but_1n(ingas, opcodes.CALL_CHILD_LIMIT_DENOM)
+        create_msg = Message(
+            msg.to,
+            b"",
+            value,
+            ingas,
+            cd,
+            msg.depth + 1,
+            to_full_shard_key=msg.from_full_shard_key,
+        )
+        o, gas, data = ext.create(create_msg)
+        if o:
+            stk.append(utils.coerce_to_int(data))
+            c.last_returned = bytearray(b"")
+        else:
+            stk.append(0)
+            c.last_returned = bytearray(data)
+        c.gas = c.gas - ingas + gas
+    else:
+        stk.append(0)
+        c.last_returned = bytearray(b"")
+
+
+def _op_call(c, op):
+    stk = c.stack
+    mem = c.memory
+    ext = c.ext
+    msg = c.msg
+    # Pull arguments from the stack
+    if op in ("CALL", "CALLCODE"):
+        gas, to, value, meminstart, meminsz, memoutstart, memoutsz = (
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+        )
+    else:
+        gas, to, meminstart, meminsz, memoutstart, memoutsz = (
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+            stk.pop(),
+        )
+        value = 0
+    # Static context prohibition
+    if msg.static and value > 0 and op == "CALL":
+        return vm_exception("Cannot make a non-zero-value call inside a static context")
+    # Expand memory
+    if not mem_extend(mem, c, op, meminstart, meminsz) or not mem_extend(
+        mem, c, op, memoutstart, memoutsz
+    ):
+        return vm_exception("OOG EXTENDING MEMORY")
+    to = utils.int_to_addr(to)
+    # Extra gas costs based on various factors
+    extra_gas = 0
+    # Creating a new account
+    if (
+        op == "CALL"
+        and not ext.account_exists(to)
+        and (value > 0 or not ext.post_spurious_dragon_hardfork())
+    ):
+        extra_gas += opcodes.GCALLNEWACCOUNT
+    # Value transfer
+    if value > 0:
+        extra_gas += opcodes.GCALLVALUETRANSFER
+    # Cost increased from 40 to 700 in Tangerine Whistle
+    if ext.post_anti_dos_hardfork():
+        extra_gas += opcodes.CALL_SUPPLEMENTAL_GAS
+    # Compute child gas limit
+    if ext.post_anti_dos_hardfork():
+        if c.gas < extra_gas:
+            return vm_exception("OUT OF GAS", needed=extra_gas)
+        gas = min(
+            gas, all_but_1n(c.gas - extra_gas, opcodes.CALL_CHILD_LIMIT_DENOM)
+        )
+    else:
+        if c.gas < gas + extra_gas:
+            return vm_exception("OUT OF GAS", needed=gas + extra_gas)
+    submsg_gas = gas + opcodes.GSTIPEND * (value > 0)
+    # Verify that there is sufficient balance and depth
+    if ext.get_balance(msg.to) < value or msg.depth >= MAX_DEPTH:
+        c.gas -= gas + extra_gas - submsg_gas
+        stk.append(0)
+        c.last_returned = bytearray(b"")
+        return
+    # Subtract gas from parent
+    c.gas -= gas + extra_gas
+    assert c.gas >= 0
+    cd = CallData(mem, meminstart, meminsz)
+    # Generate the message
+    if op == "CALL":
+        call_msg = Message(
+            msg.to,
+            to,
+            value,
+            submsg_gas,
+            cd,
+            msg.depth + 1,
+            code_address=to,
+            static=msg.static,
+        )
+    elif ext.post_homestead_hardfork() and op == "DELEGATECALL":
+        call_msg = Message(
+            msg.sender,
+            msg.to,
+            msg.value,
+            submsg_gas,
+            cd,
+            msg.depth + 1,
+            code_address=to,
+            transfers_value=False,
+            static=msg.static,
+        )
+    elif ext.post_metropolis_hardfork() and op == "STATICCALL":
+        call_msg = Message(
+            msg.to,
+            to,
+            value,
+            submsg_gas,
+            cd,
+            msg.depth + 1,
+            code_address=to,
+            static=True,
+        )
+    elif op in ("DELEGATECALL", "STATICCALL"):
+        return vm_exception("OPCODE %s INACTIVE" % op)
+    elif op == "CALLCODE":
+        call_msg = Message(
+            msg.to,
+            msg.to,
+            value,
+            submsg_gas,
+            cd,
+            msg.depth + 1,
+            code_address=to,
+            static=msg.static,
+        )
+    else:
+        raise Exception("Lolwut")
+    # Get result
+    result, gas, data = ext.msg(call_msg)
+    if result == 0:
+        stk.append(0)
+    else:
+        stk.append(1)
+    # Set output memory
+    for i in range(min(len(data), memoutsz)):
+        mem[memoutstart + i] = data[i]
+    c.gas += gas
+    c.last_returned = bytearray(data)
+
+
+def _op_return(c, a):
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "RETURN", s0, s1):
+        return vm_exception("OOG EXTENDING MEMORY")
+    return peaceful_exit("RETURN", c.gas, c.memory[s0 : s0 + s1])
+
+
+def _op_revert(c, a):
+    if not c.ext.post_metropolis_hardfork():
+        return vm_exception("Opcode not yet enabled")
+    stk = c.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, "REVERT", s0, s1):
+        return vm_exception("OOG EXTENDING MEMORY")
+    return revert(c.gas, c.memory[s0 : s0 + s1])
+
+
+def _op_suicide(c, a):
+    ext = c.ext
+    msg = c.msg
+    if msg.static:
+        return vm_exception("Cannot SUICIDE inside a static context")
+    to = utils.encode_int(c.stack.pop())
+    to = ((b"\x00" * (32 - len(to))) + to)[12:]
+    xfer = ext.get_balance(msg.to)
+    if ext.post_anti_dos_hardfork():
+        extra_gas = (
+            opcodes.SUICIDE_SUPPLEMENTAL_GAS
+            + (not ext.account_exists(to))
+            * (xfer > 0 or not ext.post_spurious_dragon_hardfork())
+            * opcodes.GCALLNEWACCOUNT
+        )
+        if not eat_gas(c, extra_gas):
+            return vm_exception("OUT OF GAS")
+    ext.set_balance(to, ext.get_balance(to) + xfer)
+    ext.set_balance(msg.to, 0)
+    ext.add_suicide(msg.to)
+    if log_msg.debug_enabled:
+        log_msg.debug(
+            "SUICIDING",
+            addr=utils.checksum_encode(msg.to),
+            to=utils.checksum_encode(to),
+            xferring=xfer,
+        )
+    return peaceful_exit("SUICIDED", c.gas, [])
+
+
+# opcode -> (handler, arg).  PUSHes are handled by the interpreter loop.
+_handlers = {
+    0x00: (_op_stop, None),
+    0x01: (_op_add, None),
+    0x02: (_op_mul, None),
+    0x03: (_op_sub, None),
+    0x04: (_op_div, None),
+    0x05: (_op_sdiv, None),
+    0x06: (_op_mod, None),
+    0x07: (_op_smod, None),
+    0x08: (_op_addmod, None),
+    0x09: (_op_mulmod, None),
+    0x0a: (_op_exp, None),
+    0x0b: (_op_signextend, None),
+    0x10: (_op_lt, None),
+    0x11: (_op_gt, None),
+    0x12: (_op_slt, None),
+    0x13: (_op_sgt, None),
+    0x14: (_op_eq, None),
+    0x15: (_op_iszero, None),
+    0x16: (_op_and, None),
+    0x17: (_op_or, None),
+    0x18: (_op_xor, None),
+    0x19: (_op_not, None),
+    0x1a: (_op_byte, None),
+    0x20: (_op_sha3, None),
+    0x30: (_op_address, None),
+    0x31: (_op_balance, None),
+    0x32: (_op_origin, None),
+    0x33: (_op_caller, None),
+    0x34: (_op_callvalue, None),
+    0x35: (_op_calldataload, None),
+    0x36: (_op_calldatasize, None),
+    0x37: (_op_calldatacopy, None),
+    0x38: (_op_codesize, None),
+    0x39: (_op_codecopy, None),
+    0x3a: (_op_gasprice, None),
+    0x3b: (_op_extcodesize, None),
+    0x3c: (_op_extcodecopy, None),
+    0x3d: (_op_returndatasize, None),
+    0x3e: (_op_returndatacopy, None),
+    0x40: (_op_blockhash, None),
+    0x41: (_op_coinbase, None),
+    0x42: (_op_timestamp, None),
+    0x43: (_op_number, None),
+    0x44: (_op_difficulty, None),
+    0x45: (_op_gaslimit, None),
+    0x50: (_op_pop, None),
+    0x51: (_op_mload, None),
+    0x52: (_op_mstore, None),
+    0x53: (_op_mstore8, None),
+    0x54: (_op_sload, None),
+    0x55: (_op_sstore, None),
+    0x56: (_op_jump, None),
+    0x57: (_op_jumpi, None),
+    0x58: (_op_pc, _PC),
+    0x59: (_op_msize, None),
+    0x5a: (_op_gas, None),
+    0x5b: (_op_noop, None),  # JUMPDEST
+    0xf0: (_op_create, None),
+    0xf1: (_op_call, "CALL"),
+    0xf2: (_op_call, "CALLCODE"),
+    0xf3: (_op_return, None),
+    0xf4: (_op_call, "DELEGATECALL"),
+    0xfa: (_op_call, "STATICCALL"),
+    0xfd: (_op_revert, None),
+    0xff: (_op_suicide, None),
+}
+for i in range(1, 17):
+    _handlers[0x7f + i] = (_op_dup, -i)
+    _handlers[0x8f + i] = (_op_swap, -i - 1)
+for i in range(5):
+    _handlers[0xa0 + i] = (_op_log, i)
+for opcode in opcodes.opcodesMetropolis:
+    handler, arg = _handlers[opcode]
+    _handlers[opcode] = (_metropolis(handler), arg)
+# known opcodes without an implementation (e.g. CALLBLACKBOX) cost gas and check the
+# stack but do nothing
+for opcode in opcodes.opcodes:
+    if opcode not in _handlers and not 0x60 <= opcode <= 0x7f:
+        _handlers[opcode] = (_op_noop, None)
+
+
+# Main function
+def vm_execute(ext, msg, code, code_hash=None):
+    if code_hash is None:
+        program = preprocess_code(code)
+    else:
+        program = get_program(code, code_hash)
+
+    # Initialize stack, memory, program counter, etc
+    compustate = Compustate(gas=msg.gas)
+    compustate.ext = ext
+    compustate.msg = msg
+    compustate.code = code
+    compustate.jumpdest_mask = program.jumpdest_mask
+
+    # if we trace vm, we're in slow mode anyway
+    if log_vm_op.trace_enabled:
+        return _vm_execute_traced(compustate, program)
+
+    stk = compustate.stack
+    push = stk.append
+    blocks = program.blocks
+    codelen = len(code)
+    pc = 0
+    while pc < codelen:
+        gas, min_stack, max_growth, ops, next_pc = blocks[pc]
 
         # out of gas error
+        compustate.gas -= gas
         if compustate.gas < 0:
             return vm_exception("OUT OF GAS")
 
         # empty stack error
-        if in_args > len(compustate.stack):
+        if min_stack > len(stk):
             return vm_exception(
                 "INSUFFICIENT STACK",
-                op=op,
-                needed=to_string(in_args),
-                available=to_string(len(compustate.stack)),
+                needed=to_string(min_stack),
+                available=to_string(len(stk)),
             )
 
         # overfull stack error
-        if len(compustate.stack) - in_args + out_args > 1024:
+        if len(stk) + max_growth > 1024:
             return vm_exception(
-                "STACK SIZE LIMIT EXCEEDED",
-                op=op,
-                pre_height=to_string(len(compustate.stack)),
+                "STACK SIZE LIMIT EXCEEDED", pre_height=to_string(len(stk))
             )
 
-        # Valid operations
-        # Pushes first because they are very frequent
-        if 0x60 <= opcode <= 0x7f:
-            stk.append(pushcache[compustate.pc - 1])
-            # Move 1 byte forward for 0x60, up to 32 bytes for 0x7f
-            compustate.pc += opcode - 0x5f
-        # Arithmetic
-        elif opcode < 0x10:
-            if op == "STOP":
-                return peaceful_exit("STOP", compustate.gas, [])
-            elif op == "ADD":
-                stk.append((stk.pop() + stk.pop()) & TT256M1)
-            elif op == "SUB":
-                stk.append((stk.pop() - stk.pop()) & TT256M1)
-            elif op == "MUL":
-                stk.append((stk.pop() * stk.pop()) & TT256M1)
-            elif op == "DIV":
-                s0, s1 = stk.pop(), stk.pop()
-                stk.append(0 if s1 == 0 else s0 // s1)
-            elif op == "MOD":
-                s0, s1 = stk.pop(), stk.pop()
-                stk.append(0 if s1 == 0 else s0 % s1)
-            elif op == "SDIV":
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(
-                    0
-                    if s1 == 0
-                    else (abs(s0) // abs(s1) * (-1 if s0 * s1 < 0 else 1)) & TT256M1
-                )
-            elif op == "SMOD":
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(
-                    0
-                    if s1 == 0
-                    else (abs(s0) % abs(s1) * (-1 if s0 < 0 else 1)) & TT256M1
-                )
-            elif op == "ADDMOD":
-                s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-                stk.append((s0 + s1) % s2 if s2 else 0)
-            elif op == "MULMOD":
-                s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-                stk.append((s0 * s1) % s2 if s2 else 0)
-            elif op == "EXP":
-                base, exponent = stk.pop(), stk.pop()
-                # fee for exponent is dependent on its bytes
-                # calc n bytes to represent exponent
-                nbytes = len(utils.encode_int(exponent))
-                expfee = nbytes * opcodes.GEXPONENTBYTE
-                if ext.post_spurious_dragon_hardfork():
-                    expfee += opcodes.EXP_SUPPLEMENTAL_GAS * nbytes
-                if compustate.gas < expfee:
-                    compustate.gas = 0
-                    return vm_exception("OOG EXPONENT")
-                compustate.gas -= expfee
-                stk.append(pow(base, exponent, TT256))
-            elif op == "SIGNEXTEND":
-                s0, s1 = stk.pop(), stk.pop()
-                if s0 <= 31:
-                    testbit = s0 * 8 + 7
-                    if s1 & (1 << testbit):
-                        stk.append(s1 | (TT256 - (1 << testbit)))
-                    else:
-                        stk.append(s1 & ((1 << testbit) - 1))
-                else:
-                    stk.append(s1)
-        # Comparisons
-        elif opcode < 0x20:
-            if op == "LT":
-                stk.append(1 if stk.pop() < stk.pop() else 0)
-            elif op == "GT":
-                stk.append(1 if stk.pop() > stk.pop() else 0)
-            elif op == "SLT":
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(1 if s0 < s1 else 0)
-            elif op == "SGT":
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(1 if s0 > s1 else 0)
-            elif op == "EQ":
-                stk.append(1 if stk.pop() == stk.pop() else 0)
-            elif op == "ISZERO":
-                stk.append(0 if stk.pop() else 1)
-            elif op == "AND":
-                stk.append(stk.pop() & stk.pop())
-            elif op == "OR":
-                stk.append(stk.pop() | stk.pop())
-            elif op == "XOR":
-                stk.append(stk.pop() ^ stk.pop())
-            elif op == "NOT":
-                stk.append(TT256M1 - stk.pop())
-            elif op == "BYTE":
-                s0, s1 = stk.pop(), stk.pop()
-                if s0 >= 32:
-                    stk.append(0)
-                else:
-                    stk.append((s1 // 256 ** (31 - s0)) % 256)
-        # SHA3 and environment info
-        elif opcode < 0x40:
-            if op == "SHA3":
-                s0, s1 = stk.pop(), stk.pop()
-                compustate.gas -= opcodes.GSHA3WORD * (utils.ceil32(s1) // 32)
-                if compustate.gas < 0:
-                    return vm_exception("OOG PAYING FOR SHA3")
-                if not mem_extend(mem, compustate, op, s0, s1):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                data = bytearray_to_bytestr(mem[s0 : s0 + s1])
-                stk.append(utils.big_endian_to_int(utils.sha3(data)))
-            elif op == "ADDRESS":
-                stk.append(utils.coerce_to_int(msg.to))
-            elif op == "BALANCE":
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate, opcodes.BALANCE_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2 ** 160)
-                stk.append(ext.get_balance(addr))
-            elif op == "ORIGIN":
-                stk.append(utils.coerce_to_int(ext.tx_origin))
-            elif op == "CALLER":
-                stk.append(utils.coerce_to_int(msg.sender))
-            elif op == "CALLVALUE":
-                stk.append(msg.value)
-            elif op == "CALLDATALOAD":
-                stk.append(msg.data.extract32(stk.pop()))
-            elif op == "CALLDATASIZE":
-                stk.append(msg.data.size)
-            elif op == "CALLDATACOPY":
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                if not data_copy(compustate, size):
-                    return vm_exception("OOG COPY DATA")
-                msg.data.extract_copy(mem, mstart, dstart, size)
-            elif op == "CODESIZE":
-                stk.append(codelen)
-            elif op == "CODECOPY":
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                if not data_copy(compustate, size):
-                    return vm_exception("OOG COPY DATA")
-                for i in range(size):
-                    if dstart + i < codelen:
-                        mem[mstart + i] = safe_ord(code[dstart + i])
-                    else:
-                        mem[mstart + i] = 0
-            elif op == "RETURNDATACOPY":
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                if not data_copy(compustate, size):
-                    return vm_exception("OOG COPY DATA")
-                if dstart + size > len(compustate.last_returned):
-                    return vm_exception("RETURNDATACOPY out of range")
-                mem[mstart : mstart + size] = compustate.last_returned[
-                    dstart : dstart + size
-                ]
-            elif op == "RETURNDATASIZE":
-                stk.append(len(compustate.last_returned))
-            elif op == "GASPRICE":
-                stk.append(ext.tx_gasprice)
-            elif op == "EXTCODESIZE":
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2 ** 160)
-                stk.append(len(ext.get_code(addr) or b""))
-            elif op == "EXTCODECOPY":
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2 ** 160)
-                start, s2, size = stk.pop(), stk.pop(), stk.pop()
-                extcode = ext.get_code(addr) or b""
-                assert utils.is_string(extcode)
-                if not mem_extend(mem, compustate, op, start, size):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                if not data_copy(compustate, size):
-                    return vm_exception("OOG COPY DATA")
-                for i in range(size):
-                    if s2 + i < len(extcode):
-                        mem[start + i] = safe_ord(extcode[s2 + i])
-                    else:
-                        mem[start + i] = 0
-        # Block info
-        elif opcode < 0x50:
-            if op == "BLOCKHASH":
-                if ext.post_constantinople_hardfork() and False:
-                    bh_addr = ext.blockhash_store
-                    stk.append(ext.get_storage_data(bh_addr, stk.pop()))
-                else:
-                    stk.append(utils.big_endian_to_int(ext.block_hash(stk.pop())))
-            elif op == "COINBASE":
-                stk.append(utils.big_endian_to_int(ext.block_coinbase))
-            elif op == "TIMESTAMP":
-                stk.append(ext.block_timestamp)
-            elif op == "NUMBER":
-                stk.append(ext.block_number)
-            elif op == "DIFFICULTY":
-                stk.append(ext.block_difficulty)
-            elif op == "GASLIMIT":
-                stk.append(ext.block_gas_limit)
-        # VM state manipulations
-        elif opcode < 0x60:
-            if op == "POP":
-                stk.pop()
-            elif op == "MLOAD":
-                s0 = stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 32):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                stk.append(utils.bytes_to_int(mem[s0 : s0 + 32]))
-            elif op == "MSTORE":
-                s0, s1 = stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 32):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                mem[s0 : s0 + 32] = utils.encode_int32(s1)
-            elif op == "MSTORE8":
-                s0, s1 = stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 1):
-                    return vm_exception("OOG EXTENDING MEMORY")
-                mem[s0] = s1 % 256
-            elif op == "SLOAD":
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate, opcodes.SLOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                stk.append(ext.get_storage_data(msg.to, stk.pop()))
-            elif op == "SSTORE":
-                s0, s1 = stk.pop(), stk.pop()
-                if msg.static:
-                    return vm_exception("Cannot SSTORE inside a static context")
-                if ext.get_storage_data(msg.to, s0):
-                    gascost = opcodes.GSTORAGEMOD if s1 else opcodes.GSTORAGEKILL
-                    refund = 0 if s1 else opcodes.GSTORAGEREFUND
-                else:
-                    gascost = opcodes.GSTORAGEADD if s1 else opcodes.GSTORAGEMOD
-                    refund = 0
-                if compustate.gas < gascost:
-                    return vm_exception("OUT OF GAS")
-                compustate.gas -= gascost
-                # adds neg gascost as a refund if below zero
-                ext.add_refund(refund)
-                ext.set_storage_data(msg.to, s0, s1)
-            elif op == "JUMP":
-                compustate.pc = stk.pop()
-                if compustate.pc >= codelen or not (
-                    (1 << compustate.pc) & jumpdest_mask
-                ):
-                    return vm_exception("BAD JUMPDEST")
-            elif op == "JUMPI":
-                s0, s1 = stk.pop(), stk.pop()
-                if s1:
-                    compustate.pc = s0
-                    if compustate.pc >= codelen or not (
-                        (1 << compustate.pc) & jumpdest_mask
-                    ):
-                        return vm_exception("BAD JUMPDEST")
-            elif op == "PC":
-                stk.append(compustate.pc - 1)
-            elif op == "MSIZE":
-                stk.append(len(mem))
-            elif op == "GAS":
-                stk.append(compustate.gas)  # AFTER subtracting cost 1
-        # DUPn (eg. DUP1: a b c -> a b c c, DUP3: a b c -> a b c a)
-        elif op[:3] == "DUP":
-            # 0x7f - opcode is a negative number, -1 for 0x80 ... -16 for 0x8f
-            stk.append(stk[0x7f - opcode])
-        # SWAPn (eg. SWAP1: a b c d -> a b d c, SWAP3: a b c d -> d b c a)
-        elif op[:4] == "SWAP":
-            # 0x8e - opcode is a negative number, -2 for 0x90 ... -17 for 0x9f
-            temp = stk[0x8e - opcode]
-            stk[0x8e - opcode] = stk[-1]
-            stk[-1] = temp
-        # Logs (aka "events")
-        elif op[:3] == "LOG":
-            """
-            0xa0 ... 0xa4, 32/64/96/128/160 + len(data) gas
-            a. Opcodes LOG0...LOG4 are added, takes 2-6 stack arguments
-                    MEMSTART MEMSZ (TOPIC1) (TOPIC2) (TOPIC3) (TOPIC4)
-            b. Logs are kept track of during tx execution exactly the same way as suicides
-               (except as an ordered list, not a set).
-               Each log is in the form [address, [topic1, ... ], data] where:
-               * address is what the ADDRESS opcode would output
-               * data is mem[MEMSTART: MEMSTART + MEMSZ]
-               * topics are as provided by the opcode
-            c. The ordered list of logs in the transaction are expressed as [log0, log1, ..., logN].
-            """
-            depth = int(op[3:])
-            mstart, msz = stk.pop(), stk.pop()
-            topics = [stk.pop() for x in range(depth)]
-            compustate.gas -= msz * opcodes.GLOGBYTE
-            if msg.static:
-                return vm_exception("Cannot LOG inside a static context")
-            if not mem_extend(mem, compustate, op, mstart, msz):
-                return vm_exception("OOG EXTENDING MEMORY")
-            data = bytearray_to_bytestr(mem[mstart : mstart + msz])
-            ext.log(msg.to, topics, data)
-            log_log.trace(
-                "LOG", to=msg.to, topics=topics, data=list(map(utils.safe_ord, data))
-            )
-            # print('LOG', msg.to, topics, list(map(ord, data)))
-        # Create a new contract
-        elif op == "CREATE":
-            value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, mstart, msz):
-                return vm_exception("OOG EXTENDING MEMORY")
-            if msg.static:
-                return vm_exception("Cannot CREATE inside a static context")
-            if ext.get_balance(msg.to) >= value and msg.depth < MAX_DEPTH:
-                cd = CallData(mem, mstart, msz)
-                ingas = compustate.gas
-                if ext.post_anti_dos_hardfork():
-                    ingas = all_but_1n(ingas, opcodes.CALL_CHILD_LIMIT_DENOM)
-                create_msg = Message(
-                    msg.to,
-                    b"",
-                    value,
-                    ingas,
-                    cd,
-                    msg.depth + 1,
-                    to_full_shard_key=msg.from_full_shard_key,
-                )
-                o, gas, data = ext.create(create_msg)
-                if o:
-                    stk.append(utils.coerce_to_int(data))
-                    compustate.last_returned = bytearray(b"")
-                else:
-                    stk.append(0)
-                    compustate.last_returned = bytearray(data)
-                compustate.gas = compustate.gas - ingas + gas
-            else:
-                stk.append(0)
-                compustate.last_returned = bytearray(b"")
-        # Calls
-        elif op in ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL"):
-            # Pull arguments from the stack
-            if op in ("CALL", "CALLCODE"):
-                gas, to, value, meminstart, meminsz, memoutstart, memoutsz = (
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                )
-            else:
-                gas, to, meminstart, meminsz, memoutstart, memoutsz = (
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                    stk.pop(),
-                )
-                value = 0
-            # Static context prohibition
-            if msg.static and value > 0 and op == "CALL":
-                return vm_exception(
-                    "Cannot make a non-zero-value call inside a static context"
-                )
-            # Expand memory
-            if not mem_extend(
-                mem, compustate, op, meminstart, meminsz
-            ) or not mem_extend(mem, compustate, op, memoutstart, memoutsz):
-                return vm_exception("OOG EXTENDING MEMORY")
-            to = utils.int_to_addr(to)
-            # Extra gas costs based on various factors
-            extra_gas = 0
-            # Creating a new account
-            if (
-                op == "CALL"
-                and not ext.account_exists(to)
-                and (value > 0 or not ext.post_spurious_dragon_hardfork())
-            ):
-                extra_gas += opcodes.GCALLNEWACCOUNT
-            # Value transfer
-            if value > 0:
-                extra_gas += opcodes.GCALLVALUETRANSFER
-            # Cost increased from 40 to 700 in Tangerine Whistle
-            if ext.post_anti_dos_hardfork():
-                extra_gas += opcodes.CALL_SUPPLEMENTAL_GAS
-            # Compute child gas limit
-            if ext.post_anti_dos_hardfork():
-                if compustate.gas < extra_gas:
-                    return vm_exception("OUT OF GAS", needed=extra_gas)
-                gas = min(
-                    gas,
-                    all_but_1n(
-                        compustate.gas - extra_gas, opcodes.CALL_CHILD_LIMIT_DENOM
-                    ),
-                )
+        compustate.pc = next_pc
+        for handler, arg in ops:
+            if handler is None:
+                push(arg)
             else:
-                if compustate.gas < gas + extra_gas:
-                    return vm_exception("OUT OF GAS", needed=gas + extra_gas)
-            submsg_gas = gas + opcodes.GSTIPEND * (value > 0)
-            # Verify that there is sufficient balance and depth
-            if ext.get_balance(msg.to) < value or msg.depth >= MAX_DEPTH:
-                compustate.gas -= gas + extra_gas - submsg_gas
-                stk.append(0)
-                compustate.last_returned = bytearray(b"")
-            else:
-                # Subtract gas from parent
-                compustate.gas -= gas + extra_gas
-                assert compustate.gas >= 0
-                cd = CallData(mem, meminstart, meminsz)
-                # Generate the message
-                if op == "CALL":
-                    call_msg = Message(
-                        msg.to,
-                        to,
-                        value,
-                        submsg_gas,
-                        cd,
-                        msg.depth + 1,
-                        code_address=to,
-                        static=msg.static,
-                    )
-                elif ext.post_homestead_hardfork() and op == "DELEGATECALL":
-                    call_msg = Message(
-                        msg.sender,
-                        msg.to,
-                        msg.value,
-                        submsg_gas,
-                        cd,
-                        msg.depth + 1,
-                        code_address=to,
-                        transfers_value=False,
-                        static=msg.static,
-                    )
-                elif ext.post_metropolis_hardfork() and op == "STATICCALL":
-                    call_msg = Message(
-                        msg.to,
-                        to,
-                        value,
-                        submsg_gas,
-                        cd,
-                        msg.depth + 1,
-                        code_address=to,
-                        static=True,
-                    )
-                elif op in ("DELEGATECALL", "STATICCALL"):
-                    return vm_exception("OPCODE %s INACTIVE" % op)
-                elif op == "CALLCODE":
-                    call_msg = Message(
-                        msg.to,
-                        msg.to,
-                        value,
-                        submsg_gas,
-                        cd,
-                        msg.depth + 1,
-                        code_address=to,
-                        static=msg.static,
-                    )
-                else:
-                    raise Exception("Lolwut")
-                # Get result
-                result, gas, data = ext.msg(call_msg)
-                if result == 0:
-                    stk.append(0)
-                else:
-                    stk.append(1)
-                # Set output memory
-                for i in range(min(len(data), memoutsz)):
-                    mem[memoutstart + i] = data[i]
-                compustate.gas += gas
-                compustate.last_returned = bytearray(data)
-        # Return opcode
-        elif op == "RETURN":
-            s0, s1 = stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, s0, s1):
-                return vm_exception("OOG EXTENDING MEMORY")
-            return peaceful_exit("RETURN", compustate.gas, mem[s0 : s0 + s1])
-        # Revert opcode (Metropolis)
-        elif op == "REVERT":
-            if not ext.post_metropolis_hardfork():
-                return vm_exception("Opcode not yet enabled")
-            s0, s1 = stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, s0, s1):
-                return vm_exception("OOG EXTENDING MEMORY")
-            return revert(compustate.gas, mem[s0 : s0 + s1])
-        # SUICIDE opcode (also called SELFDESTRUCT)
-        elif op == "SUICIDE":
-            if msg.static:
-                return vm_exception("Cannot SUICIDE inside a static context")
-            to = utils.encode_int(stk.pop())
-            to = ((b"\x00" * (32 - len(to))) + to)[12:]
-            xfer = ext.get_balance(msg.to)
-            if ext.post_anti_dos_hardfork():
-                extra_gas = (
-                    opcodes.SUICIDE_SUPPLEMENTAL_GAS
-                    + (not ext.account_exists(to))
-                    * (xfer > 0 or not ext.post_spurious_dragon_hardfork())
-                    * opcodes.GCALLNEWACCOUNT
-                )
-                if not eat_gas(compustate, extra_gas):
-                    return vm_exception("OUT OF GAS")
-            ext.set_balance(to, ext.get_balance(to) + xfer)
-            ext.set_balance(msg.to, 0)
-            ext.add_suicide(msg.to)
-            log_msg.debug(
-                "SUICIDING",
-                addr=utils.checksum_encode(msg.to),
-                to=utils.checksum_encode(to),
-                xferring=xfer,
-            )
-            return peaceful_exit("SUICIDED", compustate.gas, [])
+                result = handler(compustate, arg)
+                if result is not None:
+                    return result
+        pc = compustate.pc
+
+    return peaceful_exit("CODE OUT OF RANGE", compustate.gas, [])
 
-        if trace_vm:
-            vm_trace(ext, msg, compustate, opcode, pushcache)
 
-    if trace_vm:
+def _vm_execute_traced(compustate, program):
+    """ vm_execute() one instruction at a time, tracing each of them"""
+    stk = compustate.stack
+    codelen = len(compustate.code)
+    while compustate.pc < codelen:
+        opcode, handler, arg, next_pc = program.instructions[compustate.pc]
+        op, in_args, out_args, fee = opcodes.opcodes.get(opcode, (None, 0, 0, 0))
+
         compustate.reset_prev()
-        vm_trace(ext, msg, compustate, 0, None)
+        compustate.gas -= fee
+        compustate.pc = next_pc
+
+        if compustate.gas < 0:
+            return vm_exception("OUT OF GAS")
+        if in_args > len(stk):
+            return vm_exception(
+                "INSUFFICIENT STACK",
+                op=op,
+                needed=to_string(in_args),
+                available=to_string(len(stk)),
+            )
+        if len(stk) - in_args + out_args > 1024:
+            return vm_exception(
+                "STACK SIZE LIMIT EXCEEDED", op=op, pre_height=to_string(len(stk))
+            )
+
+        if handler is None:
+            stk.append(arg)
+        else:
+            result = handler(compustate, arg)
+            if result is not None:
+                return result
+        vm_trace(compustate.ext, compustate.msg, compustate, opcode, program.pushcache)
+
+    compustate.reset_prev()
+    vm_trace(compustate.ext, compustate.msg, compustate, 0, None)
     return peaceful_exit("CODE OUT OF RANGE", compustate.gas, [])
 
 
@@ -892,6 +1254,7 @@ def vm_execute(ext, msg, code):
 class VmExtBase:
     def __init__(self):
         self.get_code = lambda addr: b""
+        self.get_code_hash = lambda addr: utils.sha3(b"")
         self.get_balance = lambda addr: 0
         self.set_balance = lambda addr, balance: 0
         self.set_storage_data = lambda addr, key, value: 0
@@ -0,0 +1,70 @@
+# Performance of range iteration of InMemoryDb
+#
+# Some numbers on my machine (1M keys, 10 keys per page, 100 pages):
+# Dict scan: 2.92 pages/sec
+# Sorted keys: 55998.72 pages/sec
+
+from quarkchain.db import InMemoryDb
+import argparse
+import os
+import time
+import profile
+
+
+class DictScanDb(InMemoryDb):
+    """ The previous implementation of range iteration, which scans and sorts all the keys"""
+
+    def range_iter(self, start, end):
+        keys = []
+        for k in self.kv.keys():
+            if k >= start and k < end:
+                keys.append(k)
+        keys.sort()
+        for k in keys:
+            yield k, self.kv[k]
+
+    def reversed_range_iter(self, start, end):
+        keys = []
+        for k in self.kv.keys():
+            if k <= start and k > end:
+                keys.append(k)
+        keys.sort(reverse=True)
+        for k in keys:
+            yield k, self.kv[k]
+
+
+def run_pages(db, starts, page_size):
+    for start in starts:
+        for i, _ in enumerate(db.reversed_range_iter(start, b"")):
+            if i + 1 >= page_size:
+                break
+
+
+def test_perf(N=1000000, pages=100, page_size=10):
+    keys = [os.urandom(32) for i in range(N)]
+    starts = [os.urandom(32) for i in range(pages)]
+    for name, db in [("Dict scan", DictScanDb()), ("Sorted keys", InMemoryDb())]:
+        for k in keys:
+            db.put(k, k)
+        # warm up so that the sorted array is built
+        run_pages(db, starts[:1], page_size)
+        start_time = time.time()
+        run_pages(db, starts, page_size)
+        duration = time.time() - start_time
+        print("%s: %.2f pages/sec" % (name, pages / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", default=False)
+    parser.add_argument("--num_keys", type=int, default=1000000)
+    args = parser.parse_args()
+
+    if args.profile:
+        profile.run("test_perf({})".format(args.num_keys))
+    else:
+        test_perf(args.num_keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-
 # Performance of verification of transactions
 #
 # Some numbers on my machine (i7 7700K 4.2 GHZ):
@@ -6,33 +5,100 @@
 # One i7 4700K 3.5 GHZ):
 # SHA3 69000 shas/sec with pycryptodome.
 # SHA3 134000 shas/sec with pysha3.
+#
+# merkle: calculate_merkle_root() of a block of evm txs as received, hashing each
+# node with sha3_256() and hashing the leaves and the levels in batches with
+# sha3_256_batch()
+#
+# Some numbers (--bench merkle --num_txs 10000, pycryptodome):
+# Per node: 3.07 roots/sec
+# Batched: 9.16 roots/sec
 
-from quarkchain.core import MinorBlockHeader
+from quarkchain.core import MinorBlockHeader, Code, Transaction, calculate_merkle_root
+from quarkchain.evm.transactions import Transaction as EvmTransaction
+from quarkchain.utils import sha3_256
 import argparse
+import os
 import time
 import profile
 
 
-def test_perf():
-    N = 20000
+def test_perf(n=20000):
     start_time = time.time()
     m_header = MinorBlockHeader()
-    for i in range(N):
+    for i in range(n):
         m_header.nonce = i
         m_header.get_hash()
     duration = time.time() - start_time
-    print("TPS: %.2f" % (N / duration))
+    print("TPS: %.2f" % (n / duration))
+
+
+def per_node_merkle_root(item_list):
+    """ The previous calculate_merkle_root(), calling sha3_256() for every node"""
+    if len(item_list) == 0:
+        return bytes(32)
+
+    sha_tree = []
+    for item in item_list:
+        sha_tree.append(sha3_256(item.serialize()))
+
+    while len(sha_tree) != 1:
+        next_sha_tree = []
+        for i in range(0, len(sha_tree) - 1, 2):
+            next_sha_tree.append(sha3_256(sha_tree[i] + sha_tree[i + 1]))
+        if len(sha_tree) % 2 != 0:
+            next_sha_tree.append(sha3_256(sha_tree[-1] + sha_tree[-1]))
+        sha_tree = next_sha_tree
+    return sha_tree[0]
+
+
+def test_perf_merkle(n, rounds=10):
+    tx_list = []
+    for i in range(n):
+        evm_tx = EvmTransaction(
+            nonce=i,
+            gasprice=1,
+            startgas=21000,
+            to=os.urandom(20),
+            value=i,
+            data=b"",
+            from_full_shard_key=0,
+            to_full_shard_key=0,
+            network_id=1,
+        )
+        tx_list.append(Transaction(code=Code.create_evm_code(evm_tx)))
+    assert per_node_merkle_root(tx_list) == calculate_merkle_root(tx_list)
+
+    data_list = [tx.serialize() for tx in tx_list]
+    for name, merkle_root in [
+        ("Per node", per_node_merkle_root),
+        ("Batched", calculate_merkle_root),
+    ]:
+        # txs as received, without their serialization and hash memoized
+        copies = [
+            [Transaction.deserialize(data) for data in data_list] for _ in range(rounds)
+        ]
+        start_time = time.time()
+        for tx_list in copies:
+            merkle_root(tx_list)
+        duration = time.time() - start_time
+        print("%s: %.2f roots/sec" % (name, rounds / duration))
+
+
+BENCHMARKS = {"header": test_perf, "merkle": test_perf_merkle}
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--profile", default=False)
+    parser.add_argument("--bench", choices=sorted(BENCHMARKS), default="header")
+    parser.add_argument("--num_txs", type=int, default=20000)
     args = parser.parse_args()
 
     if args.profile:
-        profile.run("test_perf()")
+        profile.run("BENCHMARKS[{!r}]({})".format(args.bench, args.num_txs))
     else:
-        test_perf()
+        BENCHMARKS[args.bench](args.num_txs)
 
 
 if __name__ == "__main__":
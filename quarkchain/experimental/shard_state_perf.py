@@ -0,0 +1,467 @@
+# Performance of ShardState operations on an in-memory shard
+#
+# Usage:
+#   python -m quarkchain.experimental.shard_state_perf --bench add_tx
+#
+# add_tx: admission of transfers into the tx queue, with EvmState.ephemeral_clone()
+# going through the previous snapshot round trip and through the copy-on-write clone
+#
+# transfer: execution of a block of value transfers, through the VM and through the
+# transfer fast path of apply_transaction()
+#
+# Some numbers (--bench transfer --num_txs 10000):
+# VM: 2304.52 tps
+# Transfer fast path: 3793.02 tps
+#
+# logging: per-tx cost of apply_transaction() with the EVM log calls building their
+# arguments even though their loggers are disabled, and with the calls guarded
+#
+# Some numbers (--bench logging --num_txs 10000):
+# Eager log arguments: 357.24 us/tx
+# Guarded: 234.24 us/tx
+#
+# contract: execution of a block of calls to a contract looping 1000 times
+#
+# Some numbers (--bench contract --num_txs 200):
+# Contract calls: 28.37 tps with the if/elif interpreter of vm_execute()
+# Contract calls: 118.73 tps with ops translated into basic blocks of handlers
+#
+# code_cache: execution of a block of calls taking turns over 200 large contracts
+# that return at once.  Without the code cache each call reads the code from the db
+# and looks its translation up by the code bytes in an LRU of 128 entries.  With it,
+# both are kept by code hash.
+#
+# Some numbers (--bench code_cache --num_txs 2000):
+# Uncached: 236.90 tps
+# Code cache: 1274.83 tps
+#
+# create_block: creation of a block to mine out of a tx queue of transfers
+#
+# import_block: add_block() of a block of transfers, with apply_transaction()
+# validating each tx again after ShardState.__validate_tx() and validating it once
+#
+# parallel: add_block() of a block of transfers from distinct senders, with the txs
+# run in order and run speculatively by 2 and 4 workers
+#
+# sync: add_block() of a chain of blocks of 100 transfers deserialized as received
+# from a peer, with the serialization and hash of headers and txs computed on every
+# get_hash() and memoized
+#
+# Some numbers (--bench sync --num_txs 5000):
+# Not memoized: 536.67 tps, 30147 hashes of headers and txs
+# Memoized: 585.83 tps, 5049 hashes of headers and txs
+#
+# pruning: add_block() of a chain of blocks of 20 transfers keeping every state and
+# keeping the states of the last 64 blocks only, with the size of the db and the
+# import latency of the blocks, including the pruning passes
+#
+# Some numbers (--bench pruning --num_txs 20000):
+# Archive: 700.69 tps, block import 28.54 ms avg 256.13 ms max, db 25.41 MB, 60077 trie nodes, preimages and code
+# Pruning: 614.58 tps, block import 32.54 ms avg 235.97 ms max, db 12.20 MB, 4424 trie nodes, preimages and code
+
+from quarkchain.cluster import shard_state
+from quarkchain.cluster.parallel_execution import ParallelTxExecutor
+from quarkchain.cluster.tests.test_shard_state import create_default_shard_state
+from quarkchain.cluster.tests.test_utils import (
+    get_test_env,
+    create_transfer_transaction,
+)
+from quarkchain import core
+from quarkchain.core import Identity, Address, MinorBlock, MemoizedSerializable
+from quarkchain.db import InMemoryDb, OverlayDb
+from quarkchain.evm import messages, opcodes, vm
+from quarkchain.evm.config import Env
+from quarkchain.evm.slogging import SLogger
+from quarkchain.evm.state import State as EvmState, STATE_DEFAULTS
+from quarkchain.utils import LRUCache
+from unittest import mock
+import argparse
+import asyncio
+import contextlib
+import copy
+import profile
+import time
+
+
+def snapshot_clone(self):
+    """ The previous EvmState.ephemeral_clone(), which round-trips through a snapshot"""
+    snapshot = self.to_snapshot(root_only=True, no_prevblocks=True)
+    env2 = Env(OverlayDb(self.db, temporary=True), self.env.config)
+    s = EvmState.from_snapshot(snapshot, env2)
+    for param in STATE_DEFAULTS:
+        setattr(s, param, getattr(self, param))
+    s.recent_uncles = self.recent_uncles
+    s.prev_headers = self.prev_headers
+    s.journal = copy.copy(self.journal)
+    s.cache = {}
+    s.qkc_config = self.qkc_config
+    s.flat_state = self.flat_state
+    return s
+
+
+@contextlib.contextmanager
+def patched(obj, name, value):
+    orig = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, orig)
+
+
+def create_funded_shard_state(num_accounts, gas_limit=None):
+    """ Returns the shard state and the (identity, address) of funded accounts"""
+    id_list = [Identity.create_random_identity() for _ in range(num_accounts)]
+    acc_list = [Address.create_from_identity(i, full_shard_key=0) for i in id_list]
+    env = get_test_env(genesis_account=acc_list[0], genesis_minor_quarkash=10 ** 24)
+    for full_shard_id, shard in env.quark_chain_config.shards.items():
+        if gas_limit is not None:
+            shard.GENESIS.GAS_LIMIT = gas_limit
+        for acc in acc_list[1:]:
+            addr = acc.address_in_shard(full_shard_id).serialize().hex()
+            shard.GENESIS.ALLOC[addr] = 10 ** 24
+    state = create_default_shard_state(env=env)
+    return state, list(zip(id_list, acc_list))
+
+
+def create_transfers(state, accounts, n):
+    to = Address.create_random_account(full_shard_key=0)
+    nonces = [0] * len(accounts)
+    tx_list = []
+    for i in range(n):
+        j = i % len(accounts)
+        identity, acc = accounts[j]
+        tx_list.append(
+            create_transfer_transaction(
+                shard_state=state,
+                key=identity.get_key(),
+                from_address=acc,
+                to_address=to,
+                value=1,
+                nonce=nonces[j],
+            )
+        )
+        nonces[j] += 1
+    return tx_list
+
+
+def bench_add_tx(n):
+    # add_tx() only admits the next nonce of the sender
+    state, accounts = create_funded_shard_state(n)
+    tx_list = create_transfers(state, accounts, n)
+
+    for name, clone in [
+        ("Snapshot clone", snapshot_clone),
+        ("Copy-on-write clone", EvmState.ephemeral_clone),
+    ]:
+        with patched(EvmState, "ephemeral_clone", clone):
+            start_time = time.time()
+            for _ in range(n):
+                state.evm_state.ephemeral_clone()
+            duration = time.time() - start_time
+            print("%s: %.2f us/clone" % (name, duration * 1e6 / n))
+
+            state.tx_queue = type(state.tx_queue)()
+            state.tx_dict = dict()
+            start_time = time.time()
+            for tx in tx_list:
+                assert state.add_tx(tx)
+            duration = time.time() - start_time
+            print("%s: %.2f add_tx/sec" % (name, n / duration))
+
+
+def revalidating_apply_transaction(state, tx, tx_wrapper_hash, validated=None):
+    """ apply_transaction() validating the tx again even if the caller just did"""
+    return messages.apply_transaction(state, tx, tx_wrapper_hash)
+
+
+def create_pending_transfers(n):
+    """ A shard state with n transfers in its tx queue, all fitting in the next block"""
+    # leave room for the adjustment of the gas limit between blocks
+    state, accounts = create_funded_shard_state(n, gas_limit=2 * opcodes.GTXCOST * n)
+    for tx in create_transfers(state, accounts, n):
+        assert state.add_tx(tx)
+    return state
+
+
+def bench_create_block(n):
+    state = create_pending_transfers(n)
+    start_time = time.time()
+    block = state.create_block_to_mine()
+    duration = time.time() - start_time
+    assert len(block.tx_list) == n
+    print("Block creation: %.2f tps" % (n / duration))
+
+
+def bench_import_block(n):
+    state = create_pending_transfers(n)
+    block = state.create_block_to_mine()
+    assert len(block.tx_list) == n
+
+    for name, apply in [
+        ("Revalidated", revalidating_apply_transaction),
+        ("Validated once", messages.apply_transaction),
+    ]:
+        other = create_default_shard_state(env=state.env)
+        with patched(shard_state, "apply_transaction", apply):
+            start_time = time.time()
+            other.add_block(block)
+            duration = time.time() - start_time
+        assert other.header_tip == block.header
+        print("%s: %.2f tps" % (name, n / duration))
+
+
+def bench_parallel(n):
+    state = create_pending_transfers(n)
+    block = state.create_block_to_mine()
+    assert len(block.tx_list) == n
+
+    for num_workers in [0, 2, 4]:
+        other = create_default_shard_state(env=state.env)
+        other.tx_executor = ParallelTxExecutor(num_workers) if num_workers else None
+        if other.tx_executor is not None:
+            other.tx_executor.start()
+        start_time = time.time()
+        other.add_block(block)
+        duration = time.time() - start_time
+        if other.tx_executor is not None:
+            other.tx_executor.shutdown()
+        assert other.header_tip == block.header
+        print("%d workers: %.2f tps" % (num_workers, n / duration))
+
+
+def create_chain(num_blocks, block_size):
+    """ Returns the shard state and the blocks of a chain of transfers on it"""
+    state, accounts = create_funded_shard_state(block_size)
+    to = Address.create_random_account(full_shard_key=0)
+    block_list = []
+    for nonce in range(num_blocks):
+        block = state.create_block_to_mine()
+        for identity, acc in accounts:
+            block.add_tx(
+                create_transfer_transaction(
+                    shard_state=state,
+                    key=identity.get_key(),
+                    from_address=acc,
+                    to_address=to,
+                    value=1,
+                    nonce=nonce,
+                )
+            )
+        state.finalize_and_add_block(block)
+        block_list.append(block)
+    return state, block_list
+
+
+def bench_sync(n, block_size=100):
+    state, block_list = create_chain(n // block_size, block_size)
+    data_list = [block.serialize() for block in block_list]
+
+    sha3_calls = [0]
+    sha3_256 = core.sha3_256
+
+    def counting_sha3_256(x):
+        sha3_calls[0] += 1
+        return sha3_256(x)
+
+    for name, memoize in [
+        ("Not memoized", lambda self, key, func: func()),
+        ("Memoized", MemoizedSerializable.memoize),
+    ]:
+        other = create_default_shard_state(env=state.env)
+        sha3_calls[0] = 0
+        with patched(MemoizedSerializable, "memoize", memoize), patched(
+            core, "sha3_256", counting_sha3_256
+        ):
+            start_time = time.time()
+            for data in data_list:
+                other.add_block(MinorBlock.deserialize(data))
+            duration = time.time() - start_time
+        assert other.header_tip == state.header_tip
+        print(
+            "%s: %.2f tps, %d hashes of headers and txs"
+            % (name, n / duration, sha3_calls[0])
+        )
+
+
+def bench_pruning(n, block_size=20):
+    state, block_list = create_chain(n // block_size, block_size)
+    # the window is not widened to the forks accepted
+    state.env.quark_chain_config.ROOT.MAX_STALE_ROOT_BLOCK_HEIGHT_DIFF = 1
+    loop = asyncio.get_event_loop()
+
+    for name, num_blocks in [("Archive", 0), ("Pruning", 64)]:
+        with patched(
+            state.env.cluster_config, "STATE_PRUNING_BLOCKS", num_blocks
+        ), patched(state.env, "db", InMemoryDb()):
+            other = create_default_shard_state(env=state.env)
+        latency_list = []
+        for block in block_list:
+            start_time = time.time()
+            other.add_block(block)
+            # runs the pruning pass scheduled by add_block()
+            loop.run_until_complete(asyncio.sleep(0))
+            latency_list.append(time.time() - start_time)
+        assert other.header_tip == state.header_tip
+        db = other.raw_db
+        print(
+            "%s: %.2f tps, block import %.2f ms avg %.2f ms max, "
+            "db %.2f MB, %d trie nodes, preimages and code"
+            % (
+                name,
+                n / sum(latency_list),
+                sum(latency_list) * 1e3 / len(latency_list),
+                max(latency_list) * 1e3,
+                sum(len(k) + len(v) for k, v in db.kv.items()) / 2 ** 20,
+                sum(1 for k in db.kv if len(k) == 32),
+            )
+        )
+
+
+def create_transfer_block(n, num_accounts):
+    """ Returns the shard state and the (evm tx, tx hash) of n transfers"""
+    state, accounts = create_funded_shard_state(num_accounts)
+    evm_tx_list = []
+    for tx in create_transfers(state, accounts, n):
+        evm_tx = tx.code.get_evm_transaction()
+        evm_tx.set_quark_chain_config(state.env.quark_chain_config)
+        evm_tx_list.append((evm_tx, tx.get_hash()))
+    return state, evm_tx_list
+
+
+def apply_block(state, evm_tx_list):
+    """ Returns the seconds taken to apply the txs on a clone of the evm state"""
+    evm_state = state.evm_state.ephemeral_clone()
+    evm_state.gas_limit = sum(evm_tx.startgas for evm_tx, _ in evm_tx_list)
+    start_time = time.time()
+    for evm_tx, tx_hash in evm_tx_list:
+        messages.apply_transaction(evm_state, evm_tx, tx_hash)
+    evm_state.commit()
+    return time.time() - start_time
+
+
+def bench_transfer(n, num_accounts=10):
+    state, evm_tx_list = create_transfer_block(n, num_accounts)
+
+    for name, is_value_transfer in [
+        ("VM", lambda evm_state, evm_tx: False),
+        ("Transfer fast path", messages.is_value_transfer),
+    ]:
+        with patched(messages, "is_value_transfer", is_value_transfer):
+            duration = apply_block(state, evm_tx_list)
+            print("%s: %.2f tps" % (name, n / duration))
+
+
+def bench_logging(n, num_accounts=10):
+    state, evm_tx_list = create_transfer_block(n, num_accounts)
+    loggers = [
+        logger
+        for logger in SLogger.manager.loggerDict.values()
+        if isinstance(logger, SLogger)
+    ]
+
+    # forcing the guards on builds the log arguments as the unguarded calls did,
+    # while the disabled loggers still drop the records
+    for name, force in [("Eager log arguments", True), ("Guarded", False)]:
+        if force:
+            for logger in loggers:
+                logger.trace_enabled = logger.debug_enabled = True
+        duration = apply_block(state, evm_tx_list)
+        print("%s: %.2f us/tx" % (name, duration * 1e6 / n))
+        SLogger.manager.refresh_enabled()
+
+
+# for (c = 1000; c != 0; c--) mstore(0, c * c)
+LOOP_CODE = bytes.fromhex("6103e85b8080026000526001900380600357" + "00")
+
+
+def create_contract_call_block(n, code_list, num_accounts=10):
+    """ A block of n calls taking turns over contracts of the given code"""
+    state, accounts = create_funded_shard_state(num_accounts)
+    contracts = []
+    for code in code_list:
+        contract = Address.create_random_account(full_shard_key=0)
+        state.evm_state.set_code(contract.recipient, code)
+        contracts.append(contract)
+    state.evm_state.commit()
+    nonces = [0] * len(accounts)
+    evm_tx_list = []
+    for i in range(n):
+        j = i % len(accounts)
+        identity, acc = accounts[j]
+        tx = create_transfer_transaction(
+            shard_state=state,
+            key=identity.get_key(),
+            from_address=acc,
+            to_address=contracts[i % len(contracts)],
+            value=0,
+            gas=100000,
+            nonce=nonces[j],
+        )
+        nonces[j] += 1
+        evm_tx = tx.code.get_evm_transaction()
+        evm_tx.set_quark_chain_config(state.env.quark_chain_config)
+        evm_tx_list.append((evm_tx, tx.get_hash()))
+    return state, evm_tx_list
+
+
+def bench_contract(n):
+    state, evm_tx_list = create_contract_call_block(n, [LOOP_CODE])
+    duration = apply_block(state, evm_tx_list)
+    print("Contract calls: %.2f tps" % (n / duration))
+
+
+def large_code(i):
+    """ STOP followed by 24KB of PUSH32s"""
+    return b"\x00" + (b"\x7f" + i.to_bytes(32, "big")) * 740
+
+
+def bench_code_cache(n, num_contracts=200):
+    state, evm_tx_list = create_contract_call_block(
+        n, [large_code(i) for i in range(num_contracts)]
+    )
+    with mock.patch.object(vm, "code_cache", LRUCache(0)), mock.patch.object(
+        vm, "get_program", lambda code, code_hash: vm.preprocess_code(code)
+    ):
+        duration = apply_block(state, evm_tx_list)
+    print("Uncached: %.2f tps" % (n / duration))
+
+    vm.code_cache.clear()
+    hits, misses = vm.code_cache.hits, vm.code_cache.misses
+    duration = apply_block(state, evm_tx_list)
+    print("Code cache: %.2f tps" % (n / duration))
+    print(
+        "Hits: %d, misses: %d"
+        % (vm.code_cache.hits - hits, vm.code_cache.misses - misses)
+    )
+
+
+BENCHMARKS = {
+    "add_tx": bench_add_tx,
+    "create_block": bench_create_block,
+    "import_block": bench_import_block,
+    "parallel": bench_parallel,
+    "sync": bench_sync,
+    "pruning": bench_pruning,
+    "transfer": bench_transfer,
+    "logging": bench_logging,
+    "contract": bench_contract,
+    "code_cache": bench_code_cache,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", default=False)
+    parser.add_argument("--bench", choices=sorted(BENCHMARKS), default="add_tx")
+    parser.add_argument("--num_txs", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.profile:
+        profile.run("BENCHMARKS[{!r}]({})".format(args.bench, args.num_txs))
+    else:
+        BENCHMARKS[args.bench](args.num_txs)
+
+
+if __name__ == "__main__":
+    main()
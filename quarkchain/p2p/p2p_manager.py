@@ -165,6 +165,7 @@ class SecurePeer(Peer):
     Peer.get_connection_to_forward
     Peer.handle_error
     Peer.handle_get_root_block_header_list_request
+    Peer.handle_get_root_block_header_list_with_skip_request
     Peer.handle_get_root_block_list_request
     Peer.handle_new_minor_block_header_list
     Peer.handle_new_transaction_list
@@ -1,3 +1,4 @@
+import copy
 import unittest
 
 from eth_keys import KeyAPI
@@ -11,6 +12,7 @@ from quarkchain.core import (
     MinorBlockHeader,
     MinorBlockMeta,
     ChainMask,
+    Appended,
     Optional,
     Serializable,
     uint32,
@@ -18,9 +20,10 @@ from quarkchain.core import (
     ByteBuffer,
     hash256,
     EnumSerializer,
+    calculate_merkle_root,
 )
 from quarkchain.tests.test_utils import create_random_test_transaction
-from quarkchain.utils import check
+from quarkchain.utils import check, sha3_256
 
 SIZE_LIST = [(RootBlockHeader, 244), (MinorBlockHeader, 507), (MinorBlockMeta, 160)]
 
@@ -50,6 +53,43 @@ class TestTransaction(unittest.TestCase):
         self.assertTrue(tx1.verify_signature([id1.get_recipient()]))
 
 
+class TestMerkleRoot(unittest.TestCase):
+    def test_merkle_root(self):
+        header_list = [MinorBlockHeader(height=i) for i in range(3)]
+        h = [sha3_256(header.serialize()) for header in header_list]
+        self.assertEqual(calculate_merkle_root([]), bytes(32))
+        self.assertEqual(calculate_merkle_root(header_list[:1]), h[0])
+        self.assertEqual(
+            calculate_merkle_root(header_list),
+            sha3_256(sha3_256(h[0] + h[1]) + sha3_256(h[2] + h[2])),
+        )
+
+
+class TestMemoizedSerializable(unittest.TestCase):
+    def test_invalidation(self):
+        header = MinorBlockHeader()
+        h = header.get_hash()
+        self.assertEqual(header.get_hash(), h)
+        header.nonce = 1
+        self.assertNotEqual(header.get_hash(), h)
+        self.assertEqual(header.get_hash(), sha3_256(header.serialize()))
+        self.assertEqual(MinorBlockHeader.deserialize(header.serialize()), header)
+
+        header2 = copy.copy(header)
+        header2.mixhash = bytes([1] * 32)
+        self.assertNotEqual(header2.get_hash(), header.get_hash())
+        self.assertEqual(header.get_hash(), sha3_256(header.serialize()))
+
+    def test_root_block_header_signature(self):
+        header = RootBlockHeader()
+        h = header.get_hash()
+        data = header.serialize()
+        header.signature = bytes([1] * 65)
+        # the signature is not hashed
+        self.assertEqual(header.get_hash(), h)
+        self.assertNotEqual(header.serialize(), data)
+
+
 class TestBranch(unittest.TestCase):
     def test_branch(self):
         b = Branch.create(8, 6)
@@ -105,6 +145,31 @@ class TestOptional(unittest.TestCase):
         self.assertEqual(v.value, v1.value)
 
 
+class Uint32V1(Serializable):
+    FIELDS = [("value", uint32)]
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Uint32V2(Serializable):
+    FIELDS = [("value", uint32), ("count", Appended(uint32, 7))]
+
+    def __init__(self, value, count=7):
+        self.value = value
+        self.count = count
+
+
+class TestAppended(unittest.TestCase):
+    def test_appended(self):
+        v = Uint32V2.deserialize(Uint32V1(123).serialize())
+        self.assertEqual((v.value, v.count), (123, 7))
+        v = Uint32V2.deserialize(Uint32V2(123, 5).serialize())
+        self.assertEqual((v.value, v.count), (123, 5))
+        # the older version ignores the field
+        self.assertEqual(Uint32V1.deserialize(Uint32V2(123, 5).serialize()).value, 123)
+
+
 class ABigUint(Serializable):
     FIELDS = [("value", biguint)]
 
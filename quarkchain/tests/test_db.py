@@ -0,0 +1,76 @@
+import unittest
+
+from quarkchain.db import InMemoryDb, OverlayDb, WriteBatch
+
+
+class TestWriteBatch(unittest.TestCase):
+    def test_in_memory_db_write(self):
+        db = InMemoryDb()
+        db.put(b"a", b"1")
+        db.put(b"b", b"2")
+
+        batch = WriteBatch()
+        batch.put(b"c", bytearray(b"3"))
+        batch.delete(b"a")
+        batch.delete(b"not_exist")
+        self.assertEqual(len(batch), 3)
+        db.write(batch)
+
+        self.assertNotIn(b"a", db)
+        self.assertEqual(db.get(b"b"), b"2")
+        self.assertEqual(db.get(b"c"), b"3")
+
+    def test_overlay_db_commit(self):
+        db = InMemoryDb()
+        db.put(b"a", b"1")
+        overlay = OverlayDb(db)
+        overlay.put(b"b", b"2")
+        overlay.remove(b"a")
+
+        # buffered writes are visible through the overlay only
+        self.assertEqual(overlay.get(b"b"), b"2")
+        self.assertIsNone(overlay.get(b"a"))
+        self.assertEqual(overlay.get(b"a", b"default"), b"default")
+        self.assertNotIn(b"b", db)
+        self.assertEqual(db.get(b"a"), b"1")
+
+        overlay.commit()
+        self.assertEqual(db.get(b"b"), b"2")
+        self.assertNotIn(b"a", db)
+        self.assertEqual(overlay.overlay, {})
+
+
+class TestInMemoryDbRangeIter(unittest.TestCase):
+    def test_range_iter(self):
+        db = InMemoryDb()
+        for i in [5, 1, 3, 7, 9]:
+            db.put(bytes([i]), bytes([i]))
+        self.assertEqual(
+            [k for k, _ in db.range_iter(b"\x02", b"\x07")], [b"\x03", b"\x05"]
+        )
+        self.assertEqual(
+            [k for k, _ in db.reversed_range_iter(b"\x07", b"\x02")],
+            [b"\x07", b"\x05", b"\x03"],
+        )
+
+        # new keys and removed keys are reflected in later iterations
+        db.remove(b"\x05")
+        db.put(b"\x04", b"\x04")
+        db.put(b"\x06", b"\x06")
+        db.remove(b"\x06")
+        db.put(b"\x03", b"\x33")
+        self.assertEqual(
+            list(db.range_iter(b"\x00", b"\xff")),
+            [
+                (b"\x01", b"\x01"),
+                (b"\x03", b"\x33"),
+                (b"\x04", b"\x04"),
+                (b"\x07", b"\x07"),
+                (b"\x09", b"\x09"),
+            ],
+        )
+        self.assertEqual(
+            [k for k, _ in db.reversed_range_iter(b"\xff", b"\x01")],
+            [b"\x09", b"\x07", b"\x04", b"\x03"],
+        )
+        self.assertEqual(list(db.range_iter(b"\x0a", b"\xff")), [])
@@ -10,7 +10,15 @@ from quarkchain.core import (
     random_bytes,
 )
 
-from quarkchain.utils import token_id_encode, token_id_decode, ZZZZZZZZZZZZ
+from quarkchain import utils
+from quarkchain.utils import (
+    token_id_encode,
+    token_id_decode,
+    LRUCache,
+    ZZZZZZZZZZZZ,
+    sha3_256,
+    sha3_256_batch,
+)
 
 
 def create_test_transaction(
@@ -89,3 +97,61 @@ def test_token_id_exceptions():
         token_id_decode(-1)
     with pytest.raises(AssertionError):
         token_id_decode(ZZZZZZZZZZZZ + 1)
+
+
+def test_lru_cache():
+    cache = LRUCache(10)
+    cache.put(b"a", 1, 4)
+    cache.put(b"b", 2, 4)
+    assert cache.get(b"a") == 1  # b is now the least recently used
+    cache.put(b"c", 3, 4)
+    assert b"b" not in cache
+    assert cache.get(b"b") is None
+    assert cache.get(b"c") == 3
+    assert cache.size == 8
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # values larger than the cache are not kept
+    cache.put(b"d", 4, 11)
+    assert b"d" not in cache
+    assert cache.pop(b"a") == 1
+    assert cache.size == 4
+
+
+def test_sha3_256_batch(monkeypatch):
+    data_list = [b"", b"a", bytearray(b"abc"), bytes(range(256)) * 3]
+    expected = [sha3_256(x) for x in data_list]
+    assert sha3_256_batch(data_list) == expected
+    # without the pycryptodome bindings
+    monkeypatch.setattr(utils, "_raw_keccak_lib", None)
+    assert sha3_256_batch(data_list) == expected
+
+
+def test_sha3_256_batch_random():
+    # the bindings of the pycryptodome version in requirements.txt are used
+    assert utils._raw_keccak_lib is not None
+    rng = random.Random(0)
+    # around the multiples of the 136-byte rate of keccak-256
+    data_list = [
+        bytes(rng.getrandbits(8) for _ in range(rng.choice([n, n + 1, n - 1])))
+        for n in [1, 32, 135, 136, 272, 1000, 4096]
+        for _ in range(20)
+    ]
+    assert sha3_256_batch(data_list) == [sha3_256(x) for x in data_list]
+
+
+def test_check_raw_keccak(monkeypatch):
+    if utils._raw_keccak_lib is None:
+        return
+    assert utils._check_raw_keccak()
+
+    class Lib:
+        def __getattr__(self, name):
+            return getattr(utils._raw_keccak_lib, name)
+
+        def keccak_digest(self, state, out, digest_bytes):
+            raise TypeError("keccak_digest() takes 3 arguments")
+
+    # bindings of another version
+    monkeypatch.setattr(utils, "_raw_keccak_lib", Lib())
+    assert not utils._check_raw_keccak()
@@ -0,0 +1,42 @@
+# Rebuild the flat state tables of a shard db from its state trie, or verify them
+
+import argparse
+
+from quarkchain.db import PersistentDb
+from quarkchain.evm.flat_state import FlatState
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--db", default="data/shard-1.db", type=str)
+    # required by rebuild, e.g. the hash_evm_state_root of the shard tip
+    parser.add_argument("--state_root", default="", type=str)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    flat_state = FlatState(PersistentDb(args.db))
+    if args.command == "rebuild":
+        if not args.state_root:
+            raise RuntimeError("--state_root is required")
+        flat_state.rebuild(bytes.fromhex(args.state_root))
+        print("Rebuilt flat state at {}".format(args.state_root))
+        return
+
+    if flat_state.disk_root is None:
+        raise RuntimeError("No flat state in db")
+    errors = flat_state.verify()
+    for error in errors:
+        print(error)
+    print(
+        "Flat state at {}: {} mismatches".format(
+            flat_state.disk_root.hex(), len(errors)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
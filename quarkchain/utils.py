@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import ctypes
 import hashlib
 import io
@@ -9,8 +10,18 @@ import sys
 import time
 import traceback
 
+from eth_hash.auto import keccak as keccak_256
 from eth_utils import keccak
 
+try:
+    # cffi bindings of pycryptodome, for keccak states reused across hashes
+    from Crypto.Hash.keccak import _raw_keccak_lib
+    from Crypto.Util._raw_api import VoidPointer, SmartPointer, ffi
+
+    _raw_keccak_lib.keccak_reset
+except (ImportError, AttributeError):
+    _raw_keccak_lib = None
+
 
 def int_left_most_bit(v):
     """ Could be replaced by better raw implementation
@@ -48,6 +59,59 @@ def sha3_256(x):
     return keccak(x)
 
 
+def sha3_256_batch(data_list):
+    """ sha3_256 of each bytes or bytearray of data_list.  With pycryptodome one
+    keccak state and output buffer serve all of them, instead of a hash object
+    allocated and checked per item.
+    """
+    if _raw_keccak_lib is None:
+        hasher = keccak_256.hasher
+        return [hasher(x) for x in data_list]
+    return _raw_sha3_256_batch(data_list)
+
+
+def _raw_sha3_256_batch(data_list):
+    state = VoidPointer()
+    # capacity of keccak-256 and 24 rounds
+    result = _raw_keccak_lib.keccak_init(state.address_of(), 64, 24)
+    if result:
+        raise RuntimeError("Error %d while instantiating keccak" % result)
+    state = SmartPointer(state.get(), _raw_keccak_lib.keccak_destroy)
+    ptr = state.get()
+    out = ffi.new("uint8_t[32]")
+    digest_buffer = ffi.buffer(out)
+    reset = _raw_keccak_lib.keccak_reset
+    absorb = _raw_keccak_lib.keccak_absorb
+    digest = _raw_keccak_lib.keccak_digest
+    from_buffer = ffi.from_buffer
+    ret = []
+    for x in data_list:
+        reset(ptr)
+        absorb(ptr, from_buffer(x), len(x))
+        # keccak padding
+        digest(ptr, out, 32, 0x01)
+        ret.append(digest_buffer[:])
+    return ret
+
+
+def _check_raw_keccak():
+    """ The private bindings change across pycryptodome versions, so they are only
+    used if they hash a known vector right
+    """
+    try:
+        return _raw_sha3_256_batch([b"abc"]) == [
+            bytes.fromhex(
+                "4e03657aea45a94fc7d47ba826c8d667c0d1e6e33a64a036ec44f58fa12d6c45"
+            )
+        ]
+    except Exception:
+        return False
+
+
+if _raw_keccak_lib is not None and not _check_raw_keccak():
+    _raw_keccak_lib = None
+
+
 def sha256(x: bytes) -> bytes:
     m = hashlib.sha256()
     m.update(x)
@@ -441,6 +505,56 @@ def time_ms():
     return int(time.time() * 1e3)
 
 
+class LRUCache:
+    """ A least-recently-used cache bounded by the total size of its values.
+    The size of each value is given on put() (e.g., the length of its serialized form) and
+    defaults to 1, in which case max_size bounds the number of entries.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.cache.get(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size=1):
+        self.pop(key)
+        if size > self.max_size:
+            return
+        self.cache[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.cache.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key, default=None):
+        item = self.cache.pop(key, None)
+        if item is None:
+            return default
+        self.size -= item[1]
+        return item[0]
+
+    def clear(self):
+        self.cache.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+
 TOKEN_BASE = 36
 ZZZZZZZZZZZZ = 4873763662273663091
 